@@ -5,6 +5,7 @@ const makeWASocket = require('@whiskeysockets/baileys').default;
 const qrTerminal = require('qrcode-terminal');
 const fs = require('fs');
 const path = require('path');
+const net = require('net');
 
 const app = express();
 app.use(cors({
@@ -13,7 +14,7 @@ app.use(cors({
     methods: ['GET', 'POST', 'PUT', 'DELETE', 'PATCH', 'OPTIONS'],
     allowedHeaders: ['Content-Type', 'Authorization', 'Accept']
 }));
-app.use(express.json());
+app.use(express.json({ limit: '25mb' }));
 
 // Global state management
 let instances = new Map(); // instanceId -> { sock, qr, connected, connecting, user }
@@ -189,10 +190,19 @@ async function connectInstance(instanceId) {
                         const chats = await sock.getChats();
                         console.log(`📊 ${chats.length} conversas encontradas`);
                         
-                        // Process chats in batches to avoid overwhelming the system
-                        const batchSize = 20;
+                        // Process chats in batches; the backend writes each batch
+                        // with set-based upserts, so batches can be large
+                        const batchSize = 500;
                         for (let i = 0; i < chats.length; i += batchSize) {
-                            const batch = chats.slice(i, i + batchSize);
+                            // Only send the fields the import uses
+                            const batch = chats.slice(i, i + batchSize).map(chat => ({
+                                id: chat.id,
+                                name: chat.name,
+                                unreadCount: chat.unreadCount,
+                                messages: chat.messages && chat.messages.length > 0
+                                    ? [chat.messages[chat.messages.length - 1]]
+                                    : []
+                            }));
                             
                             // Send batch to Python backend
                             const fetch = (await import('node-fetch')).default;
@@ -211,7 +221,7 @@ async function connectInstance(instanceId) {
                             console.log(`📦 Lote ${Math.floor(i / batchSize) + 1}/${Math.ceil(chats.length / batchSize)} enviado`);
                             
                             // Small delay between batches
-                            await new Promise(resolve => setTimeout(resolve, 1000));
+                            await new Promise(resolve => setTimeout(resolve, 100));
                         }
                         
                         console.log('✅ Importação de conversas concluída');
@@ -251,9 +261,9 @@ async function connectInstance(instanceId) {
         
         // Handle incoming messages with better error handling
         sock.ev.on('messages.upsert', async (m) => {
-            const messages = m.messages;
+            const batch = [];
             
-            for (const message of messages) {
+            for (const message of m.messages) {
                 if (!message.key.fromMe && message.message) {
                     const from = message.key.remoteJid;
                     const messageText = message.message.conversation || 
@@ -269,38 +279,59 @@ async function connectInstance(instanceId) {
                     console.log(`👤 Contato: ${contactName || from.split('@')[0]} (${from.split('@')[0]})`);
                     console.log(`💬 Mensagem: ${messageText.substring(0, 50)}...`);
                     
-                    // Send to Python backend with retry logic
-                    let retries = 3;
-                    while (retries > 0) {
-                        try {
-                            const fetch = (await import('node-fetch')).default;
-                            const response = await fetch('http://localhost:8889/api/messages/receive', {
-                                method: 'POST',
-                                headers: { 'Content-Type': 'application/json' },
-                                body: JSON.stringify({
-                                    instanceId: instanceId,
-                                    from: from,
-                                    message: messageText,
-                                    pushName: pushName,
-                                    contactName: contactName,
-                                    timestamp: new Date().toISOString(),
-                                    messageId: message.key.id,
-                                    messageType: message.message.conversation ? 'text' : 'media'
-                                })
-                            });
-                            
-                            if (response.ok) {
-                                break; // Success, exit retry loop
-                            } else {
-                                throw new Error(`HTTP ${response.status}`);
-                            }
-                        } catch (err) {
-                            retries--;
-                            console.log(`❌ Erro ao enviar mensagem (tentativas restantes: ${retries}):`, err.message);
-                            if (retries > 0) {
-                                await new Promise(resolve => setTimeout(resolve, 2000));
-                            }
-                        }
+                    batch.push({
+                        instanceId: instanceId,
+                        from: from,
+                        message: messageText,
+                        pushName: pushName,
+                        contactName: contactName,
+                        timestamp: message.messageTimestamp
+                            ? new Date(Number(message.messageTimestamp) * 1000).toISOString()
+                            : new Date().toISOString(),
+                        messageId: message.key.id,
+                        messageType: message.message.conversation ? 'text' : 'media'
+                    });
+                }
+            }
+            
+            if (batch.length === 0) {
+                return;
+            }
+            
+            // Send the whole upsert in one request; the backend skips messages it
+            // already stored, so retries and reconnect replays are safe
+            let retries = 3;
+            while (retries > 0) {
+                try {
+                    let ok, status, result;
+                    if (ipcPeer) {
+                        const reply = await ipcRequest('POST', '/api/messages/receive/batch', { messages: batch });
+                        status = reply.status;
+                        ok = status >= 200 && status < 300;
+                        result = reply.payload;
+                    } else {
+                        const fetch = (await import('node-fetch')).default;
+                        const response = await fetch('http://localhost:8889/api/messages/receive/batch', {
+                            method: 'POST',
+                            headers: { 'Content-Type': 'application/json' },
+                            body: JSON.stringify({ messages: batch })
+                        });
+                        status = response.status;
+                        ok = response.ok;
+                        result = ok ? await response.json() : null;
+                    }
+                    
+                    if (ok) {
+                        console.log(`📦 Lote de ${batch.length} mensagens: ${result.inserted} novas, ${result.duplicates} duplicadas`);
+                        break; // Success, exit retry loop
+                    } else {
+                        throw new Error(`HTTP ${status}`);
+                    }
+                } catch (err) {
+                    retries--;
+                    console.log(`❌ Erro ao enviar lote de mensagens (tentativas restantes: ${retries}):`, err.message);
+                    if (retries > 0) {
+                        await new Promise(resolve => setTimeout(resolve, 2000));
                     }
                 }
             }
@@ -417,58 +448,71 @@ app.post('/disconnect/:instanceId', (req, res) => {
     }
 });
 
-app.post('/send/:instanceId', async (req, res) => {
-    const { instanceId } = req.params;
-    const { to, type = 'text', message, caption } = req.body;
+const MEDIA_FIELDS = ['image', 'video', 'audio', 'document'];
+const MEDIA_DIR = path.resolve(process.env.WHATSFLOW_MEDIA_DIR || path.join('..', 'uploads'));
+
+// Shared by the HTTP route and the IPC socket. Media arrives under its type
+// name (or the older <type>Data field) as raw bytes over IPC, as base64 in
+// JSON bodies, or as { url } naming a file inside MEDIA_DIR.
+async function sendMessage(instanceId, body) {
+    const { to, message, caption } = body;
 
     const instance = instances.get(instanceId);
     if (!instance || !instance.connected || !instance.sock) {
-        return res.status(400).json({ error: 'Instância não conectada', instanceId });
+        return { status: 400, body: { error: 'Instância não conectada', instanceId: instanceId } };
+    }
+    if (!to) {
+        return { status: 400, body: { error: 'Destinatário obrigatório', instanceId: instanceId } };
     }
 
+    const type = body.type || MEDIA_FIELDS.find(field => body[field] || body[field + 'Data']) || 'text';
+    const media = body[type] || body[type + 'Data'];
+
     try {
         const jid = to.includes('@') ? to : `${to}@s.whatsapp.net`;
-        const mediaTypes = ['image', 'audio', 'video', 'document'];
 
         if (type === 'text') {
             await instance.sock.sendMessage(jid, { text: message });
- codex/add-error-handling-for-fetch-requests-1k9r8k
-        } else if (type === 'image' && req.body.imageData) {
-            const buffer = Buffer.from(req.body.imageData, 'base64');
-            await instance.sock.sendMessage(jid, {
-                image: buffer,
-                caption: message || ''
-            });
-        } else if (type === 'audio' && req.body.audioData) {
-            const buffer = Buffer.from(req.body.audioData, 'base64');
-            await instance.sock.sendMessage(jid, {
-                audio: buffer,
-                mimetype: req.body.mimetype || 'audio/mpeg'
-            });
-        } else if (type === 'video' && req.body.videoData) {
-            const buffer = Buffer.from(req.body.videoData, 'base64');
-            await instance.sock.sendMessage(jid, {
-                video: buffer,
-                caption: message || ''
-            });
-        } else if (type === 'document' && req.body.documentData) {
-            const buffer = Buffer.from(req.body.documentData, 'base64');
-            await instance.sock.sendMessage(jid, {
-                document: buffer,
-                caption: message || '',
-                fileName: req.body.fileName || 'file'
-            });
+        } else if (MEDIA_FIELDS.includes(type) && media) {
+            let source;
+            if (Buffer.isBuffer(media)) {
+                source = media;
+            } else if (typeof media === 'string') {
+                source = Buffer.from(media, 'base64');
+            } else {
+                // Path reference: Baileys streams the file from disk
+                const file = path.resolve(media.url || '');
+                if (!file.startsWith(MEDIA_DIR + path.sep)) {
+                    return { status: 400, body: { error: 'Arquivo de mídia fora do diretório permitido', instanceId: instanceId } };
+                }
+                source = { url: file };
+            }
+            const content = { [type]: source };
+            if (type === 'audio') {
+                content.mimetype = body.mimetype || 'audio/mpeg';
+            } else {
+                content.caption = caption || message || '';
+            }
+            if (type === 'document') {
+                content.mimetype = body.mimetype || 'application/octet-stream';
+                content.fileName = body.fileName || 'file';
+            }
+            await instance.sock.sendMessage(jid, content);
         } else {
-            return res.status(400).json({ error: 'Tipo de mensagem não suportado' });
-
+            return { status: 400, body: { error: 'Tipo de mensagem não suportado', instanceId: instanceId } };
         }
 
         console.log(`📤 Mensagem enviada da instância ${instanceId} para ${to}`);
-        res.json({ success: true, instanceId });
+        return { status: 200, body: { success: true, instanceId: instanceId } };
     } catch (error) {
         console.error(`❌ Erro ao enviar mensagem da instância ${instanceId}:`, error);
-        res.status(500).json({ error: error.message, instanceId });
+        return { status: 500, body: { error: error.message, instanceId: instanceId } };
     }
+}
+
+app.post('/send/:instanceId', async (req, res) => {
+    const result = await sendMessage(req.params.instanceId, req.body);
+    res.status(result.status).json(result.body);
 });
 
 // Groups endpoint with robust error handling  
@@ -574,6 +618,118 @@ app.get('/health', (req, res) => {
     });
 });
 
+// Optional local IPC with the Python backend (WHATSFLOW_IPC_SOCKET). Frames
+// are uint32 header length + uint32 body length (big endian), a JSON header
+// and a raw body, so media needs no base64. Both sides send requests on the
+// same connection; responses are matched by id.
+const IPC_SOCKET = process.env.WHATSFLOW_IPC_SOCKET || '';
+let ipcPeer = null;
+let ipcSeq = 0;
+const ipcPending = new Map();
+
+function writeFrame(socket, header, body) {
+    const head = Buffer.from(JSON.stringify(header), 'utf8');
+    const prefix = Buffer.alloc(8);
+    prefix.writeUInt32BE(head.length, 0);
+    prefix.writeUInt32BE(body ? body.length : 0, 4);
+    socket.write(Buffer.concat([prefix, head]));
+    if (body && body.length) {
+        socket.write(body);
+    }
+}
+
+function frameReader(onFrame) {
+    let chunks = [];
+    let buffered = 0;
+    return (chunk) => {
+        chunks.push(chunk);
+        buffered += chunk.length;
+        while (buffered >= 8) {
+            if (chunks[0].length < 8) {
+                chunks = [Buffer.concat(chunks)];
+            }
+            const headLength = chunks[0].readUInt32BE(0);
+            const total = 8 + headLength + chunks[0].readUInt32BE(4);
+            if (buffered < total) {
+                return; // wait for the rest instead of copying partial frames
+            }
+            const data = chunks.length === 1 ? chunks[0] : Buffer.concat(chunks);
+            const header = JSON.parse(data.subarray(8, 8 + headLength).toString('utf8'));
+            const body = data.subarray(8 + headLength, total);
+            const rest = data.subarray(total);
+            chunks = rest.length ? [rest] : [];
+            buffered = rest.length;
+            onFrame(header, body);
+        }
+    };
+}
+
+function ipcRequest(method, path, payload, timeoutMs = 10000) {
+    return new Promise((resolve, reject) => {
+        if (!ipcPeer) {
+            return reject(new Error('IPC não conectado'));
+        }
+        const id = ++ipcSeq;
+        const timer = setTimeout(() => {
+            ipcPending.delete(id);
+            reject(new Error('Tempo esgotado aguardando resposta IPC'));
+        }, timeoutMs);
+        ipcPending.set(id, { resolve, reject, timer });
+        writeFrame(ipcPeer, { id: id, type: 'request', method: method, path: path, payload: payload });
+    });
+}
+
+async function handleIpcFrame(socket, header, body) {
+    if (header.type === 'response') {
+        const pending = ipcPending.get(header.id);
+        if (pending) {
+            ipcPending.delete(header.id);
+            clearTimeout(pending.timer);
+            pending.resolve(header);
+        }
+        return;
+    }
+
+    const reply = (status, payload) => writeFrame(socket, { id: header.id, type: 'response', status: status, payload: payload });
+    const parts = (header.path || '').split('/');
+    if (header.method === 'POST' && parts[1] === 'send' && parts[2]) {
+        const payload = header.payload || {};
+        if (header.bodyField) {
+            payload[header.bodyField] = body;
+        }
+        const result = await sendMessage(parts[2], payload);
+        reply(result.status, result.body);
+    } else {
+        reply(404, { error: `Rota IPC não encontrada: ${header.method} ${header.path}` });
+    }
+}
+
+if (IPC_SOCKET) {
+    if (fs.existsSync(IPC_SOCKET)) {
+        fs.unlinkSync(IPC_SOCKET);
+    }
+    net.createServer((socket) => {
+        ipcPeer = socket;
+        console.log('🔌 Backend Python conectado via IPC');
+        socket.on('data', frameReader((header, body) => {
+            handleIpcFrame(socket, header, body).catch(err => console.error('❌ Erro no IPC:', err.message));
+        }));
+        socket.on('error', err => console.error('❌ Erro no socket IPC:', err.message));
+        socket.on('close', () => {
+            if (ipcPeer === socket) {
+                ipcPeer = null;
+            }
+            for (const [id, pending] of ipcPending) {
+                clearTimeout(pending.timer);
+                pending.reject(new Error('IPC desconectado'));
+                ipcPending.delete(id);
+            }
+        });
+    }).listen(IPC_SOCKET, () => {
+        console.log(`🔌 IPC local em ${IPC_SOCKET}`);
+    });
+}
+
 const PORT = process.env.PORT || 3002;
 const BAILEYS_URL = process.env.BAILEYS_URL || `http://localhost:${PORT}`;
 app.listen(PORT, '0.0.0.0', () => {
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+Benchmark: request throughput with per-request sqlite3.connect vs. DatabaseManager
+
+Runs the real API server on a temporary database and hammers a few read
+endpoints plus /api/messages/receive from several client threads, once with
+the pooled connection manager and once with a stand-in that reopens the
+database on every access (the old behaviour).
+
+Uso: python3 benchmarks/bench_db.py [--seconds 5] [--clients 8] [--rows 5000]
+"""
+
+import argparse
+import http.client
+import importlib.util
+import json
+import os
+import pathlib
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+spec = importlib.util.spec_from_file_location(
+    "app", pathlib.Path(__file__).resolve().parents[1] / "whatsflow-real.py"
+)
+app = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(app)
+
+
+class PerRequestConnections:
+    """Old access pattern: a fresh connection for every handler call."""
+
+    def __init__(self, path):
+        self.path = path
+        self._write_lock = threading.Lock()
+
+    @contextmanager
+    def read(self):
+        conn = sqlite3.connect(self.path)
+        conn.row_factory = sqlite3.Row
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    @contextmanager
+    def write(self):
+        with self._write_lock:
+            conn = sqlite3.connect(self.path)
+            conn.row_factory = sqlite3.Row
+            try:
+                yield conn
+                conn.commit()
+            finally:
+                conn.close()
+
+
+def seed(rows):
+    now = time.time()
+    with app.get_db().write() as conn:
+        for i in range(rows):
+            phone = f"55119{i % 500:08d}"
+            conn.execute(
+                "INSERT INTO messages (id, contact_name, phone, message, direction, instance_id, created_at) VALUES (?,?,?,?,?,?,?)",
+                (str(uuid.uuid4()), "Bench", phone, f"msg {i}", "incoming", "default", str(now + i)),
+            )
+
+
+def run_clients(port, seconds, clients):
+    paths = ["/api/stats", "/api/messages", "/api/instances"]
+    stop = time.monotonic() + seconds
+    counts = []
+
+    def worker(n):
+        done = 0
+        conn = None
+        while time.monotonic() < stop:
+            if n % 4 == 0:
+                body = json.dumps({"from": f"55119{done:08d}@s.whatsapp.net", "message": "oi"})
+                conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+                conn.request("POST", "/api/messages/receive", body, {"Content-Type": "application/json"})
+            else:
+                conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+                conn.request("GET", paths[done % len(paths)])
+            conn.getresponse().read()
+            conn.close()
+            done += 1
+        counts.append(done)
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return sum(counts) / seconds
+
+
+def measure(label, seconds, clients, legacy):
+    original = app.get_db
+    if legacy:
+        legacy_db = PerRequestConnections(app.DB_FILE)
+        app.get_db = lambda: legacy_db
+    server = app.create_http_server(("127.0.0.1", 0), "threaded", clients)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        rps = run_clients(server.server_address[1], seconds, clients)
+    finally:
+        server.shutdown()
+        server.server_close()
+        app.get_db = original
+    print(f"{label:<28} {rps:10.1f} req/s")
+    return rps
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--rows", type=int, default=5000)
+    args = parser.parse_args()
+
+    fd, path = tempfile.mkstemp(suffix=".db")
+    os.close(fd)
+    app.DB_FILE = path
+    app.init_db()
+    seed(args.rows)
+    try:
+        before = measure("sqlite3.connect por request", args.seconds, args.clients, legacy=True)
+        after = measure("DatabaseManager", args.seconds, args.clients, legacy=False)
+        print(f"{'ganho':<28} {after / before:10.2f}x")
+    finally:
+        app.close_db()
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+Benchmark: Baileys sends over loopback HTTP (JSON + base64) vs. the Unix socket IPC
+
+Starts two stand-ins for the Baileys service in this process: a keep-alive
+HTTP/1.1 server that parses the JSON body and decodes base64 media the way
+the Express route does, and a Unix socket server that reads the framed
+requests. Then it times small text sends and 5 MB media sends through
+BaileysClient and BaileysIPCClient.
+
+Uso: python3 benchmarks/bench_ipc.py [--text 5000] [--media 20] [--media-mb 5]
+"""
+
+import argparse
+import base64
+import importlib.util
+import json
+import os
+import pathlib
+import socket
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+spec = importlib.util.spec_from_file_location(
+    "app", pathlib.Path(__file__).resolve().parents[1] / "whatsflow-real.py"
+)
+app = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(app)
+
+received = {"http": 0, "ipc": 0}
+
+
+class HTTPStub(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def do_POST(self):
+        raw = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        received["http"] += len(raw)
+        data = json.loads(raw)
+        for field in ("image", "video", "audio", "document"):
+            if field in data:
+                base64.b64decode(data[field])
+        body = b'{"success":true}'
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve_ipc(server):
+    while True:
+        try:
+            conn, _ = server.accept()
+        except OSError:
+            return
+        stream = conn.makefile("rb")
+        while True:
+            frame = app.read_frame(stream)
+            if frame is None:
+                break
+            header, body = frame
+            received["ipc"] += len(body) + len(json.dumps(header))
+            app.write_frame(conn, {"id": header["id"], "type": "response", "status": 200,
+                                   "payload": {"success": True}})
+        conn.close()
+
+
+def timed(label, client, payload, count):
+    started = time.perf_counter()
+    for _ in range(count):
+        client.send("bench", payload)
+    elapsed = time.perf_counter() - started
+    print(f"{label:<30} {elapsed / count * 1000:9.3f} ms/envio {count / elapsed:10.1f} envios/s")
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--text", type=int, default=5000)
+    parser.add_argument("--media", type=int, default=20)
+    parser.add_argument("--media-mb", type=float, default=5)
+    args = parser.parse_args()
+
+    http_server = ThreadingHTTPServer(("127.0.0.1", 0), HTTPStub)
+    threading.Thread(target=http_server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{http_server.server_address[1]}"
+
+    directory = tempfile.mkdtemp()
+    sock_path = os.path.join(directory, "baileys.sock")
+    ipc_server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    ipc_server.bind(sock_path)
+    ipc_server.listen(1)
+    threading.Thread(target=serve_ipc, args=(ipc_server,), daemon=True).start()
+
+    http_client = app.BaileysClient(base_url, timeout=60)
+    ipc_client = app.BaileysIPCClient(sock_path, base_url, timeout=60)
+    text = {"to": "5511999990001@s.whatsapp.net", "message": "Olá! Mensagem de teste."}
+    media = {"to": "120363000000000000@g.us", "image": os.urandom(int(args.media_mb * 1024 * 1024))}
+
+    try:
+        for client in (http_client, ipc_client):
+            client.send("bench", text)  # warm up the connection
+        received.update(http=0, ipc=0)
+
+        http_text = timed("texto via HTTP", http_client, text, args.text)
+        ipc_text = timed("texto via IPC", ipc_client, text, args.text)
+        print(f"{'ganho texto':<30} {http_text / ipc_text:9.2f}x")
+
+        received.update(http=0, ipc=0)
+        http_media = timed(f"mídia {args.media_mb:g} MB via HTTP", http_client, media, args.media)
+        ipc_media = timed(f"mídia {args.media_mb:g} MB via IPC", ipc_client, media, args.media)
+        print(f"{'ganho mídia':<30} {http_media / ipc_media:9.2f}x")
+        print(f"{'bytes por envio de mídia':<30} HTTP {received['http'] / args.media / 1e6:.2f} MB"
+              f" / IPC {received['ipc'] / args.media / 1e6:.2f} MB")
+    finally:
+        http_client.close()
+        ipc_client.close()
+        http_server.shutdown()
+        http_server.server_close()
+        ipc_server.close()
+        os.remove(sock_path)
+        os.rmdir(directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""
+Benchmark: memory and lookup cost of the flow session store
+
+Fills a FlowSessionStore with active sessions and reports the memory they
+take per 100k (traced with tracemalloc), next to the same state held as one
+dict per contact. Then times a session lookup served from the LRU against
+loading it from SQLite, which is what every incoming message paid before.
+
+Uso: python3 benchmarks/bench_sessions.py [--sessions 100000] [--lookups 20000]
+"""
+
+import argparse
+import importlib.util
+import os
+import pathlib
+import random
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+spec = importlib.util.spec_from_file_location(
+    "app", pathlib.Path(__file__).resolve().parents[1] / "whatsflow-real.py"
+)
+app = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(app)
+
+
+def traced(build):
+    tracemalloc.start()
+    try:
+        before, _ = tracemalloc.get_traced_memory()
+        kept = build()
+        after, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return after - before, kept
+
+
+def fill_store(count, now):
+    store = app.FlowSessionStore(capacity=count)
+    for i in range(count):
+        store.put(app.FlowSession("vendas", f"55119{i:08d}", "f-catalogo", "3", None, None, ("cliente",), now))
+    return store
+
+
+def fill_dicts(count, now):
+    return {
+        ("vendas", f"55119{i:08d}"): {"instance_id": "vendas", "phone": f"55119{i:08d}", "flow_id": "f-catalogo",
+                                      "node_id": "3", "resume_at": None, "variables": {}, "tags": ["cliente"],
+                                      "updated_at": datetime.fromtimestamp(now, timezone.utc).isoformat()}
+        for i in range(count)
+    }
+
+
+def report(label, size, count):
+    print(f"{label:<28} {size / count:8.0f} B/sessão  {size / count * 100_000 / 1e6:8.1f} MB por 100k")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--sessions", type=int, default=100_000)
+    parser.add_argument("--lookups", type=int, default=20_000)
+    args = parser.parse_args()
+    now = time.time()
+
+    size, _ = traced(lambda: fill_store(args.sessions, now))
+    report("FlowSessionStore", size, args.sessions)
+    size, _ = traced(lambda: fill_dicts(args.sessions, now))
+    report("um dict por contato", size, args.sessions)
+
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    app.DB_FILE = path
+    app.init_db()
+    try:
+        stamp = datetime.fromtimestamp(now, timezone.utc).isoformat()
+        with app.get_db().write() as conn:
+            conn.executemany(
+                "INSERT INTO flow_sessions (instance_id, phone, flow_id, node_id, started_at, updated_at) "
+                "VALUES ('vendas', ?, 'f-catalogo', '3', ?, ?)",
+                ((f"55119{i:08d}", stamp, stamp) for i in range(args.sessions)),
+            )
+        rng = random.Random(1)
+        phones = [f"55119{rng.randrange(args.sessions):08d}" for _ in range(args.lookups)]
+        moment = datetime.fromtimestamp(now, timezone.utc)
+
+        cold = app.FlowSessionStore(capacity=1)
+        started = time.perf_counter()
+        for phone in phones:
+            cold.get("vendas", phone, moment)
+        sqlite_us = (time.perf_counter() - started) / len(phones) * 1e6
+
+        warm = app.FlowSessionStore(capacity=args.sessions)
+        for phone in phones:
+            warm.get("vendas", phone, moment)
+        started = time.perf_counter()
+        for phone in phones:
+            warm.get("vendas", phone, moment)
+        cached_us = (time.perf_counter() - started) / len(phones) * 1e6
+    finally:
+        app.close_db()
+        os.remove(path)
+
+    print(f"{'leitura do SQLite':<28} {sqlite_us:8.1f} µs/mensagem")
+    print(f"{'leitura do cache':<28} {cached_us:8.1f} µs/mensagem")
+    print(f"{'ganho':<28} {sqlite_us / cached_us:8.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+Benchmark: flow trigger lookup with the TriggerIndex vs. scanning every condition
+
+Compiles flows whose start is gated by a keyword condition (four keywords
+each, some of them two-word phrases) and matches a set of incoming
+messages against them, once by checking every condition node in turn (what
+the flow engine did before the index) and once through TriggerIndex. The
+index is timed at 1k and at the full keyword count to show its cost does
+not grow with the number of flows.
+
+Uso: python3 benchmarks/bench_triggers.py [--keywords 10000] [--messages 2000]
+"""
+
+import argparse
+import importlib.util
+import pathlib
+import random
+import time
+
+spec = importlib.util.spec_from_file_location(
+    "app", pathlib.Path(__file__).resolve().parents[1] / "whatsflow-real.py"
+)
+app = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(app)
+
+WORDS = ("olá bom dia quero saber o preço do produto para entrega amanhã você tem disponível "
+         "obrigado pode me ajudar com pedido número cartão pix boleto endereço").split()
+
+
+def build_flows(keywords):
+    flows = []
+    for n in range(keywords // 4):
+        terms = [f"produto{n}", f"código {n}", f"promoção{n}", f"cupom {n}x"]
+        nodes = [
+            {"id": "1", "type": "startNode", "data": {}},
+            {"id": "2", "type": "conditionNode", "data": {"condition": ", ".join(terms)}},
+            {"id": "3", "type": "messageNode", "data": {"message": f"Resposta {n}"}},
+        ]
+        edges = [{"source": "1", "target": "2"}, {"source": "2", "target": "3", "sourceHandle": "yes"}]
+        flows.append(app.compile_flow(f"f{n}", nodes, edges, order=n))
+    return flows
+
+
+def build_messages(count, flows, rng):
+    messages = []
+    for i in range(count):
+        words = rng.choices(WORDS, k=12)
+        if i % 10 == 0:
+            # One message in ten mentions a keyword
+            words.insert(rng.randrange(len(words)), f"Produto{rng.randrange(len(flows))}")
+        messages.append(" ".join(words))
+    return messages
+
+
+def scan(flows, messages):
+    hits = 0
+    for text in messages:
+        for flow in flows:
+            if app.condition_matches(flow.nodes[flow.trigger], text):
+                hits += 1
+    return hits
+
+
+def lookup(index, messages):
+    return sum(len(index.match(text)) for text in messages)
+
+
+def timed(label, fn, messages):
+    started = time.perf_counter()
+    hits = fn(messages)
+    elapsed = time.perf_counter() - started
+    print(f"{label:<28} {elapsed / len(messages) * 1e6:10.1f} µs/mensagem  ({hits} acertos)")
+    return elapsed, hits
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--keywords", type=int, default=10000)
+    parser.add_argument("--messages", type=int, default=2000)
+    args = parser.parse_args()
+    rng = random.Random(42)
+
+    flows = build_flows(args.keywords)
+    messages = build_messages(args.messages, flows, rng)
+    small = app.TriggerIndex()
+    for flow in flows[:250]:
+        small.add(flow)
+    started = time.perf_counter()
+    index = app.TriggerIndex()
+    for flow in flows:
+        index.add(flow)
+    print(f"{len(flows)} fluxos, {index.keywords} palavras-chave indexadas em "
+          f"{(time.perf_counter() - started) * 1000:.1f} ms")
+
+    before, expected = timed("varredura de condições", lambda m: scan(flows, m), messages)
+    timed(f"índice ({small.keywords} palavras)", lambda m: lookup(small, m), messages)
+    after, hits = timed(f"índice ({index.keywords} palavras)", lambda m: lookup(index, m), messages)
+    assert hits == expected, "o índice e a varredura discordam"
+    print(f"{'ganho':<28} {before / after:10.2f}x")
+
+
+if __name__ == "__main__":
+    main()
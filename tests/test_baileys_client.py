@@ -0,0 +1,106 @@
+import importlib.util
+import json
+import pathlib
+import socket
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+spec = importlib.util.spec_from_file_location(
+    "app", pathlib.Path(__file__).resolve().parents[1] / "whatsflow-real.py"
+)
+app = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(app)
+
+
+class FakeBaileys(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    connections = set()
+    requests = []
+
+    def setup(self):
+        super().setup()
+        # Headers and body go out in separate writes; avoid Nagle delays
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        FakeBaileys.connections.add(self.client_address)
+
+    def _reply(self, status, data):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        FakeBaileys.requests.append(("GET", self.path, None))
+        if self.path == "/status/inst1":
+            self._reply(200, {"connected": True, "instanceId": "inst1"})
+        elif self.path == "/groups/inst1":
+            self._reply(200, [{"id": "1@g.us", "subject": "Grupo"}])
+        else:
+            self._reply(400, {"error": "Instância não conectada"})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(length)) if length else None
+        FakeBaileys.requests.append(("POST", self.path, body))
+        self._reply(200, {"success": True})
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def baileys():
+    FakeBaileys.connections = set()
+    FakeBaileys.requests = []
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeBaileys)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{server.server_address[1]}"
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+
+def test_calls_reuse_keep_alive_connection(baileys):
+    client = app.BaileysClient(baileys)
+    for n in range(20):
+        assert client.send("inst1", {"to": "1@g.us", "message": f"m{n}"}) == {"success": True}
+    assert client.status("inst1")["connected"] is True
+    assert client.groups("inst1") == [{"id": "1@g.us", "subject": "Grupo"}]
+    client.close()
+
+    assert len(FakeBaileys.connections) == 1
+    assert FakeBaileys.requests[0] == ("POST", "/send/inst1", {"to": "1@g.us", "message": "m0"})
+
+
+def test_error_status_raises_with_details(baileys):
+    client = app.BaileysClient(baileys)
+    with pytest.raises(app.BaileysError) as exc:
+        client.qr("offline")
+    assert exc.value.status == 400
+    assert "Instância não conectada" in str(exc.value)
+    assert not isinstance(exc.value, app.BaileysUnavailable)
+
+
+def test_unreachable_service_raises_unavailable():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    client = app.BaileysClient(f"http://127.0.0.1:{port}", timeout=1)
+    with pytest.raises(app.BaileysUnavailable):
+        client.connect("inst1")
+
+
+def test_baileys_post_uses_shared_client(baileys, monkeypatch):
+    monkeypatch.setattr(app, "BAILEYS_URL", baileys)
+    assert app.baileys_post(f"{baileys}/send/inst1", {"to": "x"}) is True
+    assert app.get_baileys_client() is app.get_baileys_client()
+    assert FakeBaileys.requests == [("POST", "/send/inst1", {"to": "x"})]
+    app.get_baileys_client().close()
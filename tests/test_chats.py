@@ -0,0 +1,213 @@
+import http.client
+import importlib.util
+import json
+import os
+import pathlib
+import sqlite3
+import tempfile
+import threading
+
+import pytest
+
+spec = importlib.util.spec_from_file_location(
+    "app", pathlib.Path(__file__).resolve().parents[1] / "whatsflow-real.py"
+)
+app = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(app)
+
+
+@pytest.fixture
+def server():
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    app.DB_FILE = path
+    app.init_db()
+    srv = app.create_http_server(("127.0.0.1", 0), "threaded", 4)
+    thread = threading.Thread(target=srv.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield srv.server_address[1], path
+    finally:
+        srv.shutdown()
+        srv.server_close()
+        thread.join()
+        app.close_db()
+        os.remove(path)
+
+
+def request(port, method, path, body=None):
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+    headers = {"Content-Type": "application/json"} if body is not None else {}
+    conn.request(method, path, json.dumps(body) if body is not None else None, headers)
+    resp = conn.getresponse()
+    data = json.loads(resp.read().decode())
+    conn.close()
+    return resp.status, data
+
+
+def receive(port, phone, text, ts, instance="inst1"):
+    return request(port, "POST", "/api/messages/receive", {
+        "instanceId": instance,
+        "from": f"{phone}@s.whatsapp.net",
+        "message": text,
+        "pushName": "Maria",
+        "timestamp": ts,
+    })
+
+
+def test_chat_summary_updated_with_each_message(server):
+    port, _ = server
+    receive(port, "5511999990001", "primeira", "2025-01-01T10:00:00+00:00")
+    receive(port, "5511999990001", "segunda", "2025-01-01T10:05:00+00:00")
+    receive(port, "5511999990002", "outro", "2025-01-01T09:00:00+00:00")
+    # Out-of-order delivery must not replace the newer summary
+    receive(port, "5511999990001", "atrasada", "2025-01-01T09:59:00+00:00")
+
+    status, chats = request(port, "GET", "/api/chats")
+    assert status == 200
+    assert [c["contact_phone"] for c in chats] == ["5511999990001", "5511999990002"]
+    first = chats[0]
+    assert first["last_message"] == "segunda"
+    assert first["last_message_time"] == "2025-01-01T10:05:00+00:00"
+    assert first["unread_count"] == 3
+    assert first["instance_id"] == "inst1"
+
+
+def test_rebuild_chat_summaries_backfills_from_messages(server):
+    _, path = server
+    conn = sqlite3.connect(path)
+    rows = [
+        ("m1", "Ana", "5511000000001", "oi", "incoming", "i1", "2025-01-01T08:00:00"),
+        ("m2", "Ana", "5511000000001", "tudo bem?", "outgoing", "i1", "2025-01-01T08:01:00"),
+        ("m3", "Ana", "5511000000001", "sim", "incoming", "i1", "2025-01-01T08:02:00"),
+        ("m4", "Bia", "5511000000002", "olá", "incoming", "i2", "2025-01-01T07:00:00"),
+    ]
+    conn.executemany(
+        "INSERT INTO messages (id, contact_name, phone, message, direction, instance_id, created_at) VALUES (?,?,?,?,?,?,?)",
+        rows,
+    )
+    conn.execute(
+        "INSERT INTO chats (id, contact_phone, contact_name, instance_id, last_message, last_message_time, unread_count) VALUES (?,?,?,?,?,?,?)",
+        ("old", "5511000000001", "Ana", "i1", "stale", "2024-01-01T00:00:00", 99),
+    )
+    conn.commit()
+    conn.close()
+
+    assert app.rebuild_chat_summaries() == 2
+
+    conn = sqlite3.connect(path)
+    summary = conn.execute(
+        "SELECT contact_phone, last_message, last_message_time, unread_count FROM chats ORDER BY contact_phone"
+    ).fetchall()
+    conn.close()
+    assert summary == [
+        ("5511000000001", "sim", "2025-01-01T08:02:00", 2),
+        ("5511000000002", "olá", "2025-01-01T07:00:00", 1),
+    ]
+
+
+def import_chats(port, body, content_type="application/json", query=""):
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+    conn.request("POST", "/api/chats/import" + query, body, {"Content-Type": content_type})
+    resp = conn.getresponse()
+    data = json.loads(resp.read().decode())
+    conn.close()
+    return resp.status, data
+
+
+def test_import_chats_upserts_by_phone_and_instance(server, monkeypatch):
+    port, path = server
+    monkeypatch.setattr(app, "IMPORT_CHUNK_SIZE", 2)
+    receive(port, "5511999990001", "já recebida", "2025-01-01T10:00:00+00:00")
+    chats = [
+        {"id": "5511999990001@s.whatsapp.net", "name": "Maria", "unreadCount": 4},
+        {"id": "5511999990002@s.whatsapp.net", "name": "João", "unreadCount": 1,
+         "messages": [{"message": {"conversation": "olá"}}]},
+        {"id": "120363000000000000@g.us", "name": "Grupo"},
+        {"id": "5511999990003@s.whatsapp.net"},
+    ]
+    body = json.dumps({"instanceId": "inst1", "chats": chats, "user": {"name": "Eu", "id": "me"}})
+    status, result = import_chats(port, body)
+    assert status == 200
+    assert result["imported_contacts"] == 2
+    assert result["imported_chats"] == 2
+    assert result["processed_chats"] == 3
+    assert result["chats_per_second"] > 0
+
+    # Importing the same list again creates nothing new
+    status, result = import_chats(port, body)
+    assert (result["imported_contacts"], result["imported_chats"]) == (0, 0)
+
+    conn = sqlite3.connect(path)
+    rows = conn.execute(
+        "SELECT contact_phone, contact_name, last_message, unread_count FROM chats ORDER BY contact_phone"
+    ).fetchall()
+    contacts = conn.execute("SELECT COUNT(*) FROM contacts").fetchone()[0]
+    conn.close()
+    assert rows == [
+        ("5511999990001", "Maria", "já recebida", 4),
+        ("5511999990002", "João", "olá", 1),
+        ("5511999990003", "Contato 0003", None, 0),
+    ]
+    assert contacts == 3
+
+
+def test_import_chats_accepts_ndjson(server):
+    port, path = server
+    lines = "\n".join(
+        json.dumps({"id": f"55119{n:08d}@s.whatsapp.net", "name": f"C{n}"}) for n in range(50)
+    )
+    status, result = import_chats(port, lines + "\n", "application/x-ndjson", "?instanceId=inst2")
+    assert status == 200
+    assert result["imported_chats"] == 50
+
+    conn = sqlite3.connect(path)
+    instances = conn.execute("SELECT DISTINCT instance_id FROM chats").fetchall()
+    conn.close()
+    assert instances == [("inst2",)]
+
+
+def test_import_chats_accepts_a_chunked_ndjson_stream(server):
+    port, _ = server
+    lines = [json.dumps({"id": f"55119{n:08d}@s.whatsapp.net", "name": f"C{n}"}).encode() + b"\n"
+             for n in range(30)]
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+    # Pieces split lines in the middle, and no Content-Length is sent
+    body = b"".join(lines)
+    conn.request("POST", "/api/chats/import?instanceId=inst3", (body[i:i + 100] for i in range(0, len(body), 100)),
+                 {"Content-Type": "application/x-ndjson", "Transfer-Encoding": "chunked"}, encode_chunked=True)
+    resp = conn.getresponse()
+    result = json.loads(resp.read().decode())
+    conn.close()
+    assert resp.status == 200
+    assert (result["processed_chats"], result["imported_chats"]) == (30, 30)
+
+
+def test_import_counts_only_the_chats_it_created(server):
+    receive(server[0], "5511999990001", "oi", "2025-01-01T10:00:00+00:00")
+    rows = [("5511999990001", "Maria", None, None, 0), ("5511999990002", "João", None, None, 0),
+            ("5511999990002", "João", None, None, 1)]
+    with app.get_db().write() as conn:
+        # Chats of other instances and existing chats of this one are not counted
+        conn.execute("INSERT INTO chats (id, contact_phone, contact_name, instance_id) VALUES ('x', '5511999990002', 'J', 'inst9')")
+        assert app.import_chat_rows(conn, rows, "inst1", "2025-01-01T11:00:00+00:00") == (1, 1)
+
+
+def test_sent_message_becomes_the_chat_summary(server, monkeypatch):
+    port, path = server
+    monkeypatch.setattr(app, "baileys_send_message", lambda instance_id, data: True)
+    receive(port, "5511999990001", "qual o preço?", "2025-01-01T10:00:00+00:00")
+    status, _ = request(port, "POST", "/api/messages/send/inst1",
+                        {"to": "5511999990001@s.whatsapp.net", "message": "R$ 10"})
+    assert status == 200
+
+    status, chats = request(port, "GET", "/api/chats")
+    assert [(c["last_message"], c["unread_count"]) for c in chats] == [("R$ 10", 1)]
+    # The live summary matches what --rebuild-chats computes
+    conn = sqlite3.connect(path)
+    live = conn.execute("SELECT last_message, last_message_time, unread_count FROM chats").fetchall()
+    conn.close()
+    app.rebuild_chat_summaries()
+    conn = sqlite3.connect(path)
+    assert conn.execute("SELECT last_message, last_message_time, unread_count FROM chats").fetchall() == live
+    conn.close()
@@ -0,0 +1,100 @@
+import importlib.util
+import os
+import pathlib
+import sqlite3
+import tempfile
+import threading
+
+import pytest
+
+spec = importlib.util.spec_from_file_location(
+    "app", pathlib.Path(__file__).resolve().parents[1] / "whatsflow-real.py"
+)
+app = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(app)
+
+
+@pytest.fixture
+def temp_db():
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    app.DB_FILE = path
+    app.init_db()
+    try:
+        yield path
+    finally:
+        app.close_db()
+        os.remove(path)
+
+
+def test_pooled_connections_keep_pragmas(temp_db):
+    db = app.get_db()
+    with db.read() as conn:
+        assert conn.execute("PRAGMA temp_store").fetchone()[0] == 2
+        assert conn.execute("PRAGMA cache_size").fetchone()[0] == 1000
+        assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+        first = conn
+    with db.read() as conn:
+        assert conn is first
+    with db.write() as conn:
+        assert conn.execute("PRAGMA temp_store").fetchone()[0] == 2
+
+
+def test_reader_connection_is_read_only(temp_db):
+    with app.get_db().read() as conn:
+        with pytest.raises(sqlite3.OperationalError):
+            conn.execute("INSERT INTO instances (id, name) VALUES ('x', 'x')")
+
+
+def test_write_rolls_back_on_error(temp_db):
+    db = app.get_db()
+    with pytest.raises(RuntimeError):
+        with db.write() as conn:
+            conn.execute("INSERT INTO instances (id, name) VALUES ('a', 'A')")
+            raise RuntimeError("boom")
+    with db.write() as conn:
+        conn.execute("INSERT INTO instances (id, name) VALUES ('b', 'B')")
+    with db.read() as conn:
+        ids = [r[0] for r in conn.execute("SELECT id FROM instances")]
+    assert ids == ["b"]
+
+
+def test_readers_do_not_wait_for_open_write_transaction(temp_db):
+    db = app.get_db()
+    with db.write() as conn:
+        conn.execute("INSERT INTO instances (id, name) VALUES ('committed', 'C')")
+
+    in_tx = threading.Event()
+    release = threading.Event()
+
+    def writer():
+        with db.write() as conn:
+            conn.execute("INSERT INTO instances (id, name) VALUES ('pending', 'P')")
+            in_tx.set()
+            release.wait(5)
+
+    t = threading.Thread(target=writer)
+    t.start()
+    try:
+        assert in_tx.wait(5)
+        with db.read() as conn:
+            ids = [r[0] for r in conn.execute("SELECT id FROM instances")]
+        assert ids == ["committed"]
+    finally:
+        release.set()
+        t.join()
+
+
+def test_manager_follows_db_file(temp_db):
+    first = app.get_db()
+    fd, other = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        app.DB_FILE = other
+        app.init_db()
+        assert app.get_db() is not first
+        assert app.get_db().path == other
+    finally:
+        app.close_db()
+        app.DB_FILE = temp_db
+        os.remove(other)
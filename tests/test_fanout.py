@@ -0,0 +1,125 @@
+import importlib.util
+import os
+import pathlib
+import sqlite3
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+spec = importlib.util.spec_from_file_location(
+    "app", pathlib.Path(__file__).resolve().parents[1] / "whatsflow-real.py"
+)
+app = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(app)
+
+
+@pytest.fixture
+def temp_db():
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    app.DB_FILE = path
+    app.init_db()
+    try:
+        yield path
+    finally:
+        app.close_db()
+        os.remove(path)
+
+
+def test_fanout_respects_global_and_per_instance_caps():
+    fanout = app.FanOutExecutor(max_workers=4, per_instance=3)
+    lock = threading.Lock()
+    active = {"total": 0}
+    peaks = {"total": 0}
+
+    def send(instance_id, group_id):
+        with lock:
+            active["total"] += 1
+            active[instance_id] = active.get(instance_id, 0) + 1
+            peaks["total"] = max(peaks["total"], active["total"])
+            peaks[instance_id] = max(peaks.get(instance_id, 0), active[instance_id])
+        time.sleep(0.02)
+        with lock:
+            active["total"] -= 1
+            active[instance_id] -= 1
+        if group_id == "g7":
+            raise RuntimeError("grupo indisponível")
+        return True
+
+    targets = [("i1" if n % 2 else "i2", f"g{n}") for n in range(40)]
+    started = time.monotonic()
+    try:
+        outcomes = fanout.run(targets, send)
+    finally:
+        fanout.shutdown()
+    elapsed = time.monotonic() - started
+
+    assert [(o["instance_id"], o["group_id"]) for o in outcomes] == targets
+    failed = [o for o in outcomes if o["status"] == "failed"]
+    assert [o["group_id"] for o in failed] == ["g7"]
+    assert failed[0]["error"] == "grupo indisponível"
+    assert peaks["total"] <= 4
+    assert peaks["i1"] <= 3 and peaks["i2"] <= 3
+    # 40 sends of 20 ms each take 0.8 s one after another
+    assert elapsed < 0.6
+
+
+def test_scheduled_dispatch_records_deliveries(temp_db, monkeypatch):
+    def fake_send(group, content, mtype, mpath, instance_id="default", media=None):
+        return group != "g2"
+
+    monkeypatch.setattr(app, "send_scheduled_message", fake_send)
+    conn = sqlite3.connect(temp_db)
+    conn.execute("INSERT INTO campaigns (id, name, recurrence, send_time) VALUES ('1', 'C', 'once', '00:00')")
+    conn.executemany(
+        "INSERT INTO campaign_groups (campaign_id, instance_id, group_id) VALUES (?,?,?)",
+        [(1, "inst1", "g1"), (1, None, "g2")],
+    )
+    past = (datetime.now(timezone.utc) - timedelta(minutes=1)).isoformat()
+    conn.execute(
+        "INSERT INTO scheduled_messages (id, campaign_id, content, next_run, status) VALUES ('s1', 1, 'oi', ?, 'pending')",
+        (past,),
+    )
+    conn.commit()
+    conn.close()
+
+    app.process_scheduled_messages()
+
+    conn = sqlite3.connect(temp_db)
+    rows = conn.execute(
+        "SELECT source, source_id, campaign_id, instance_id, group_id, status FROM deliveries ORDER BY group_id"
+    ).fetchall()
+    conn.close()
+    assert rows == [
+        ("scheduled_message", "s1", "1", "inst1", "g1", "sent"),
+        ("scheduled_message", "s1", "1", "default", "g2", "retrying"),
+    ]
+
+
+def test_busy_instance_does_not_starve_others():
+    fanout = app.FanOutExecutor(max_workers=3, per_instance=1)
+    gate = threading.Event()
+
+    def send(instance_id, group_id):
+        if instance_id == "i1":
+            gate.wait(5)
+        return True
+
+    # Three concurrent campaigns on the same instance, each blocked in its send
+    runs = [threading.Thread(target=fanout.run, args=([("i1", f"g{n}")], send)) for n in range(3)]
+    try:
+        for run in runs:
+            run.start()
+        time.sleep(0.05)
+        started = time.monotonic()
+        outcomes = fanout.run([("i2", "g9")], send)
+        assert time.monotonic() - started < 1
+        assert outcomes[0]["status"] == "sent"
+    finally:
+        gate.set()
+        for run in runs:
+            run.join()
+        fanout.shutdown()
@@ -0,0 +1,117 @@
+import importlib.util
+import json
+import os
+import pathlib
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+spec = importlib.util.spec_from_file_location(
+    "app", pathlib.Path(__file__).resolve().parents[1] / "whatsflow-real.py"
+)
+app = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(app)
+
+NOW = datetime(2025, 1, 1, tzinfo=timezone.utc)
+
+
+@pytest.fixture
+def db(monkeypatch):
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    app.DB_FILE = path
+    app.init_db()
+    monkeypatch.setattr(app, "baileys_send_message", lambda instance_id, data: True)
+    nodes = [
+        {"id": "1", "type": "startNode", "data": {}},
+        {"id": "2", "type": "conditionNode", "data": {"condition": "cadastro"}},
+        {"id": "3", "type": "tagNode", "data": {"tag": "lead"}},
+        {"id": "4", "type": "messageNode", "data": {"message": "Qual é o seu nome?"}},
+        {"id": "5", "type": "conditionNode", "data": {"condition": "ana, bruno"}},
+        {"id": "6", "type": "messageNode", "data": {"message": "Obrigado! Podemos confirmar?"}},
+        {"id": "7", "type": "conditionNode", "data": {"condition": "sim"}},
+    ]
+    edges = [{"source": "1", "target": "2"}, {"source": "2", "target": "3", "sourceHandle": "yes"},
+             {"source": "3", "target": "4"}, {"source": "4", "target": "5"},
+             {"source": "5", "target": "6", "sourceHandle": "yes"}, {"source": "6", "target": "7"}]
+    with app.get_db().write() as conn:
+        conn.execute("INSERT INTO flows (id, name, nodes, edges, active) VALUES ('f1', 'Cadastro', ?, ?, 1)",
+                     (json.dumps(nodes), json.dumps(edges)))
+    try:
+        yield path
+    finally:
+        app.close_db()
+        os.remove(path)
+
+
+def engine(**store):
+    return app.FlowEngine(registry=app.FlowRegistry(), sessions=app.FlowSessionStore(**store))
+
+
+def test_sessions_are_written_through_and_loaded_lazily(db):
+    first = engine()
+    first.handle_message("inst1", "5511", "quero fazer cadastro", NOW)
+    session = first.sessions.get("inst1", "5511", NOW)
+    assert (session.flow_id, session.node_id, session.tags) == ("f1", "5", ("lead",))
+
+    first.handle_message("inst1", "5511", "Bruno", NOW)
+    # A new store (a restart) sees the same state from SQLite
+    reloaded = app.FlowSessionStore().get("inst1", "5511", NOW)
+    assert (reloaded.node_id, reloaded.variables, reloaded.tags) == ("7", {"5": "Bruno"}, ("lead",))
+
+    first.handle_message("inst1", "5511", "sim", NOW)
+    session = app.FlowSessionStore().get("inst1", "5511", NOW)
+    assert session.flow_id is None and session.tags == ("lead",)
+    with app.get_db().read() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM flow_sessions").fetchone()[0] == 0
+
+
+def test_cache_serves_repeat_messages_without_queries(db, monkeypatch):
+    flows = engine(capacity=2)
+    flows.handle_message("inst1", "5511", "bom dia", NOW)
+    loads = []
+    load = flows.sessions._load
+    monkeypatch.setattr(flows.sessions, "_load", lambda *a: loads.append(a) or load(*a))
+
+    flows.handle_message("inst1", "5511", "tudo bem?", NOW)
+    assert loads == []
+    flows.handle_message("inst1", "5522", "oi", NOW)
+    flows.handle_message("inst1", "5533", "oi", NOW)
+    assert len(flows.sessions) == 2
+    # The least recently used contact was evicted and is read again
+    flows.handle_message("inst1", "5511", "oi", NOW)
+    assert [phone for _, phone in loads] == ["5522", "5533", "5511"]
+    assert flows.sessions.stats()["hits"] >= 1
+
+
+def test_idle_sessions_expire(db):
+    flows = engine(ttl=60)
+    flows.handle_message("inst1", "5511", "cadastro", NOW)
+    flows.handle_message("inst1", "5522", "cadastro", NOW + timedelta(seconds=50))
+
+    # After the TTL the answer no longer continues the old question
+    later = NOW + timedelta(seconds=61)
+    assert flows.handle_message("inst1", "5511", "Ana", later) == []
+    assert flows.sessions.get("inst1", "5511", later).flow_id is None
+
+    assert flows.sessions.expire(NOW + timedelta(seconds=200)) == 1
+    with app.get_db().read() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM flow_sessions").fetchone()[0] == 0
+
+
+def test_cached_sessions_stay_compact():
+    store = app.FlowSessionStore(capacity=20_000)
+    now = time.time()
+    tracemalloc.start()
+    try:
+        before, _ = tracemalloc.get_traced_memory()
+        for i in range(20_000):
+            store.put(app.FlowSession("vendas", f"55119{i:08d}", "f1", "5", None, None, ("lead",), now))
+        after, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    # About 32 MB per 100k active sessions
+    assert (after - before) / 20_000 < 400
@@ -0,0 +1,130 @@
+import http.client
+import importlib.util
+import json
+import os
+import pathlib
+import tempfile
+import threading
+
+import pytest
+
+spec = importlib.util.spec_from_file_location(
+    "app", pathlib.Path(__file__).resolve().parents[1] / "whatsflow-real.py"
+)
+app = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(app)
+
+NODES = [
+    {"id": "inicio", "type": "startNode", "data": {}},
+    {"id": "menu", "type": "conditionNode", "data": {"condition": "pedido", "conditionType": "contains"}},
+    {"id": "pergunta", "type": "messageNode", "data": {"message": "Qual o número do pedido?"}},
+    {"id": "numero", "type": "conditionNode", "data": {"condition": "123, 456"}},
+    {"id": "espera", "type": "delayNode", "data": {"delay": "1", "delayUnit": "hours"}},
+    {"id": "status", "type": "messageNode", "data": {"message": "Seu pedido foi enviado"}},
+    {"id": "erro", "type": "messageNode", "data": {"message": "Pedido não encontrado"}},
+]
+EDGES = [
+    {"source": "inicio", "target": "menu"},
+    {"source": "menu", "target": "pergunta", "sourceHandle": "yes"},
+    {"source": "pergunta", "target": "numero"},
+    {"source": "numero", "target": "espera", "sourceHandle": "yes"},
+    {"source": "numero", "target": "erro", "sourceHandle": "no"},
+    {"source": "espera", "target": "status"},
+]
+
+
+@pytest.fixture
+def server(monkeypatch):
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    app.DB_FILE = path
+    app.init_db()
+
+    def no_sends(instance_id, data):
+        raise AssertionError("a simulação não deve enviar mensagens")
+
+    monkeypatch.setattr(app, "baileys_send_message", no_sends)
+    with app.get_db().write() as conn:
+        # Not active: flows are simulated before they are turned on
+        conn.execute("INSERT INTO flows (id, name, nodes, edges, active) VALUES ('pedidos', 'Pedidos', ?, ?, 0)",
+                     (json.dumps(NODES), json.dumps(EDGES)))
+        conn.execute("INSERT INTO flows (id, name, nodes, edges, active) VALUES ('quebrado', 'Quebrado', '[]', '[]', 0)")
+    srv = app.create_http_server(("127.0.0.1", 0), "threaded", 2)
+    thread = threading.Thread(target=srv.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield srv.server_address[1]
+    finally:
+        srv.shutdown()
+        srv.server_close()
+        thread.join()
+        app.close_db()
+        os.remove(path)
+
+
+def simulate(port, flow_id, body):
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+    conn.request("POST", f"/api/flows/{flow_id}/simulate", json.dumps(body), {"Content-Type": "application/json"})
+    resp = conn.getresponse()
+    data = json.loads(resp.read().decode())
+    conn.close()
+    return resp.status, data
+
+
+def test_simulation_returns_the_path_of_each_message(server):
+    status, report = simulate(server, "pedidos", {"messages": [
+        {"phone": "5511", "message": "quero ver meu pedido"},
+        {"phone": "5522", "message": "bom dia"},
+        {"phone": "5511", "message": "é o 123"},
+        "pedido",
+        {"message": "999"},
+    ]})
+    assert status == 200
+    first, other, answer, default, wrong = report["results"]
+    assert first["path"] == ["inicio", "menu", "pergunta", "numero"]
+    assert first["waiting_at"] == "numero"
+    assert [a["text"] for a in first["actions"]] == ["Qual o número do pedido?"]
+    assert other["triggered"] is False and other["path"] == ["inicio", "menu"]
+    # Delays are reported, not waited for
+    assert answer["path"] == ["numero", "espera", "status"]
+    assert answer["delays"] == [3600] and answer["waiting_at"] is None
+    assert default["phone"] == wrong["phone"] == "simulacao"
+    assert [a["text"] for a in wrong["actions"]] == ["Pedido não encontrado"]
+    assert report["count"] == 5 and report["triggered"] == 4
+    assert 0 < report["p50_us"] <= report["p99_us"]
+
+    with app.get_db().read() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM flow_sessions").fetchone()[0] == 0
+        assert conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0] == 0
+
+
+def test_recorded_messages_are_replayed_in_order(server):
+    app.receive_message_batch([
+        {"instanceId": "inst1", "from": "5511@s.whatsapp.net", "message": text, "messageId": text}
+        for text in ("tenho um pedido", "456")
+    ])
+    status, report = simulate(server, "pedidos", {"instance_id": "inst1"})
+    assert [r["message"] for r in report["results"]] == ["tenho um pedido", "456"]
+    assert report["results"][1]["actions"][0]["text"] == "Seu pedido foi enviado"
+
+    assert simulate(server, "quebrado", {})[0] == 400
+    assert simulate(server, "nao-existe", {})[0] == 404
+    assert simulate(server, "pedidos", {"messages": "oi"})[0] == 400
+
+
+def test_bench_flow_reports_latency_and_memory(server, capsys):
+    flow = app.load_flow("pedidos")
+    stats = app.benchmark_flow(flow, app.synthetic_messages(flow, 500), rounds=2)
+    assert stats["messages"] == 1000
+    assert 0 < stats["p50_us"] <= stats["p99_us"]
+    assert stats["peak_memory_kb"] > 0
+
+    with pytest.raises(SystemExit) as exit_info:
+        app.main(["--bench-flow", "pedidos", "--bench-messages", "200"])
+    assert exit_info.value.code == 0
+    output = capsys.readouterr().out
+    assert "p50" in output and "pico de memória" in output
+
+    with pytest.raises(SystemExit) as exit_info:
+        app.main(["--simulate-flow", "quebrado"])
+    assert exit_info.value.code == 1
@@ -0,0 +1,170 @@
+import importlib.util
+import json
+import os
+import pathlib
+import random
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+spec = importlib.util.spec_from_file_location(
+    "app", pathlib.Path(__file__).resolve().parents[1] / "whatsflow-real.py"
+)
+app = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(app)
+
+
+def delay_flow(delay, unit="seconds"):
+    nodes = [
+        {"id": "1", "type": "startNode", "data": {}},
+        {"id": "2", "type": "messageNode", "data": {"message": "Já volto"}},
+        {"id": "3", "type": "delayNode", "data": {"delay": delay, "delayUnit": unit}},
+        {"id": "4", "type": "messageNode", "data": {"message": "Voltei"}},
+    ]
+    edges = [{"source": "1", "target": "2"}, {"source": "2", "target": "3"}, {"source": "3", "target": "4"}]
+    return json.dumps(nodes), json.dumps(edges)
+
+
+@pytest.fixture
+def db():
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    app.DB_FILE = path
+    app.init_db()
+    try:
+        yield path
+    finally:
+        app.close_db()
+        os.remove(path)
+
+
+@pytest.fixture
+def sent(monkeypatch):
+    calls = []
+    monkeypatch.setattr(app, "baileys_send_message", lambda instance_id, data: calls.append(data["message"]) or True)
+    return calls
+
+
+def save_flow(delay, unit="seconds"):
+    with app.get_db().write() as conn:
+        conn.execute("INSERT INTO flows (id, name, nodes, edges, active) VALUES ('f1', 'Espera', ?, ?, 1)",
+                     delay_flow(delay, unit))
+
+
+def test_wheel_fires_every_entry_once_and_never_early():
+    rng = random.Random(7)
+    start = 1_700_000_000.0
+    wheel = app.TimingWheel(start, tick=0.05, slots=16, levels=4)
+    # Spread over all four levels, the last ones beyond the wheel's span
+    due = {i: start + rng.uniform(0, 4000) for i in range(20000)}
+    for item, at in due.items():
+        wheel.add(at, item)
+
+    fired = {}
+    now = start
+    while wheel.count:
+        now += rng.uniform(0.01, 3)
+        for item in wheel.advance(now):
+            assert item not in fired
+            fired[item] = now
+    assert fired.keys() == due.keys()
+    for item, at in fired.items():
+        assert due[item] <= at
+        assert at - due[item] < 3.1
+    assert wheel.advance(now + 10) == []
+
+
+def test_timers_survive_a_restart_without_firing_twice(db, sent):
+    save_flow("2", "hours")
+    now = datetime(2025, 1, 1, tzinfo=timezone.utc)
+    before = app.FlowEngine(registry=app.FlowRegistry())
+    before.handle_message("inst1", "5511", "oi", now)
+    before.handle_message("inst1", "5522", "oi", now)
+    assert before.flush(5)
+    assert before.resume_due(now + timedelta(minutes=1)) == 0
+    assert before.timers.pending() == 2
+
+    # A new process loads the timers from flow_timers
+    after = app.FlowEngine(registry=app.FlowRegistry())
+    assert after.resume_due(now + timedelta(hours=1)) == 0
+    assert after.timers.armed == 0
+    assert after.resume_due(now + timedelta(hours=2)) == 2
+    assert after.flush(5)
+    assert sent == ["Já volto", "Já volto", "Voltei", "Voltei"]
+    assert after.stats()["timers_pending"] == 0
+
+    # The first process still holds both timers in its wheel, but they were consumed
+    assert before.resume_due(now + timedelta(hours=3)) == 0
+    assert before.flush(5)
+    assert len(sent) == 4
+
+
+def test_new_message_replaces_a_cancelled_timer(db, sent):
+    save_flow("30")
+    now = datetime(2025, 1, 1, tzinfo=timezone.utc)
+    engine = app.FlowEngine(registry=app.FlowRegistry())
+    engine.resume_due(now)
+    engine.handle_message("inst1", "5511", "oi", now)
+    with app.get_db().write() as conn:
+        conn.execute("DELETE FROM flow_sessions")
+        engine.timers.cancel(conn, "inst1", "5511")
+    engine.sessions.discard("inst1", "5511")
+    # The contact starts over; only the new timer fires
+    engine.handle_message("inst1", "5511", "oi", now + timedelta(seconds=20))
+    assert engine.resume_due(now + timedelta(seconds=31)) == 0
+    assert engine.resume_due(now + timedelta(seconds=50)) == 1
+    assert engine.flush(5)
+    assert sent == ["Já volto", "Já volto", "Voltei"]
+
+
+def test_running_engine_fires_within_a_tick(db, monkeypatch):
+    save_flow("0.3")
+    fired = threading.Event()
+    sends = []
+    monkeypatch.setattr(app, "baileys_send_message",
+                        lambda instance_id, data: sends.append((data["message"], time.monotonic())) or
+                        (data["message"] == "Voltei" and fired.set()) or True)
+    engine = app.FlowEngine(registry=app.FlowRegistry())
+    engine.start()
+    try:
+        assert engine.submit({"instance_id": "inst1", "phone": "5511", "message": "oi"})
+        assert fired.wait(5)
+    finally:
+        engine.stop()
+    (_, first), (_, second) = sends
+    assert 0.3 <= second - first < 0.6
+
+
+def test_timer_fires_on_time_while_a_send_is_blocked(db, monkeypatch):
+    save_flow("0.3")
+    gate = threading.Event()
+    fired = threading.Event()
+    sends = []
+
+    def send(instance_id, data):
+        if instance_id == "lenta":
+            gate.wait(5)
+        sends.append((instance_id, data["message"], time.monotonic()))
+        if instance_id == "rapida" and data["message"] == "Voltei":
+            fired.set()
+        return True
+
+    monkeypatch.setattr(app, "baileys_send_message", send)
+    fanout = app.FanOutExecutor(max_workers=2, per_instance=1)
+    engine = app.FlowEngine(registry=app.FlowRegistry(), fanout=fanout)
+    engine.start()
+    try:
+        # The first contact's send stays blocked for the whole test
+        assert engine.submit({"instance_id": "lenta", "phone": "5511", "message": "oi"})
+        assert engine.submit({"instance_id": "rapida", "phone": "5522", "message": "oi"})
+        assert fired.wait(5)
+        assert not gate.is_set()
+        (_, _, first), (_, _, second) = [s for s in sends if s[0] == "rapida"]
+        assert 0.3 <= second - first < 0.6
+    finally:
+        gate.set()
+        engine.stop()
+        fanout.shutdown()
@@ -0,0 +1,307 @@
+import http.client
+import importlib.util
+import json
+import os
+import pathlib
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+spec = importlib.util.spec_from_file_location(
+    "app", pathlib.Path(__file__).resolve().parents[1] / "whatsflow-real.py"
+)
+app = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(app)
+
+
+def node(node_id, type_, **data):
+    return {"id": node_id, "type": type_, "position": {"x": 0, "y": 0}, "data": data}
+
+
+def edge(source, target, handle=None):
+    item = {"id": f"{source}-{target}", "source": source, "target": target}
+    if handle:
+        item["sourceHandle"] = handle
+    return item
+
+
+# start -> "Quer o catálogo?" -> waits; "sim" -> tag + catalogue after 2 min, otherwise goodbye
+NODES = [
+    node("1", "startNode"),
+    node("2", "messageNode", message="Olá! Quer o catálogo?"),
+    node("3", "conditionNode", condition="sim, quero", conditionType="contains"),
+    node("4", "tagNode", message="interessado"),
+    node("5", "delayNode", delay="2", delayUnit="minutes"),
+    node("6", "messageNode", message="Aqui está o catálogo", delay="5"),
+    node("7", "messageNode", message="Tudo bem, até logo"),
+]
+EDGES = [
+    edge("1", "2"), edge("2", "3"), edge("3", "4", "yes"), edge("3", "7", "no"),
+    edge("4", "5"), edge("5", "6"),
+]
+
+
+@pytest.fixture
+def db():
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    app.DB_FILE = path
+    app.init_db()
+    try:
+        yield path
+    finally:
+        app.close_db()
+        os.remove(path)
+
+
+@pytest.fixture
+def sent(monkeypatch):
+    calls = []
+    monkeypatch.setattr(app, "baileys_send_message", lambda instance_id, data: calls.append((instance_id, data)) or True)
+    return calls
+
+
+def save_flow(flow_id, nodes=NODES, edges=EDGES, instance_id=None):
+    with app.get_db().write() as conn:
+        conn.execute(
+            "INSERT INTO flows (id, name, nodes, edges, active, instance_id) VALUES (?, 'Catálogo', ?, ?, 1, ?)",
+            (flow_id, json.dumps(nodes), json.dumps(edges), instance_id),
+        )
+
+
+def test_compile_builds_an_immutable_index_linked_graph():
+    flow = app.compile_flow("f1", NODES, EDGES)
+    start = flow.nodes[flow.start]
+    assert start.kind == "start"
+    assert flow.nodes[start.next].params["text"] == "Olá! Quer o catálogo?"
+    condition = flow.nodes[flow.index["3"]]
+    assert condition.params["keywords"] == ("sim", "quero")
+    assert flow.nodes[condition.yes].kind == "tag"
+    assert flow.nodes[condition.no].id == "7"
+    # A message with its own delay is preceded by a delay step
+    assert flow.nodes[flow.index["6#delay"]].next == flow.index["6"]
+    assert flow.nodes[flow.index["5"]].params["seconds"] == 120
+
+    with pytest.raises(AttributeError):
+        condition.next = 0
+    with pytest.raises(TypeError):
+        condition.params["mode"] = "equals"
+
+    with pytest.raises(app.FlowCompileError):
+        app.compile_flow("f2", NODES[1:], [])
+    with pytest.raises(app.FlowCompileError):
+        app.compile_flow("f3", NODES, EDGES + [edge("2", "99")])
+    warned = app.compile_flow("f4", NODES, EDGES + [edge("2", "7")])
+    assert warned.warnings and warned.nodes[warned.index["2"]].next == warned.index["3"]
+
+
+def test_execute_flow_stops_at_conditions_and_delays():
+    flow = app.compile_flow("f1", NODES, EDGES)
+    actions, stop = app.execute_flow(flow, flow.start, "oi")
+    assert [params["text"] for _, params, _ in actions] == ["Olá! Quer o catálogo?"]
+    assert stop == ("input", flow.index["3"])
+
+    actions, stop = app.execute_flow(flow, stop[1], "SIM, por favor")
+    assert [(kind, params.get("tag")) for kind, params, _ in actions] == [("tag", "interessado")]
+    assert stop == ("delay", flow.index["6#delay"], 120)
+
+    actions, stop = app.execute_flow(flow, stop[1], None)
+    assert actions == [] and stop == ("delay", flow.index["6"], 5)
+    actions, stop = app.execute_flow(flow, stop[1], None)
+    assert [params["text"] for _, params, _ in actions] == ["Aqui está o catálogo"]
+    assert stop is None
+
+
+def test_engine_keeps_state_per_contact(db, sent):
+    save_flow("f1")
+    engine = app.FlowEngine(registry=app.FlowRegistry())
+    now = datetime(2025, 1, 1, tzinfo=timezone.utc)
+
+    engine.handle_message("inst1", "5511", "oi", now)
+    engine.handle_message("inst1", "5522", "oi", now)
+    assert engine.flush(5)
+    assert [data["message"] for _, data in sent] == ["Olá! Quer o catálogo?"] * 2
+
+    engine.handle_message("inst1", "5511", "sim", now)
+    engine.handle_message("inst1", "5522", "não", now)
+    assert engine.flush(5)
+    assert sent[-1] == ("inst1", {"to": "5522", "message": "Tudo bem, até logo"})
+    with app.get_db().read() as conn:
+        sessions = conn.execute("SELECT phone, node_id, resume_at FROM flow_sessions").fetchall()
+        tags = conn.execute("SELECT phone, tag FROM contact_tags").fetchall()
+        outgoing = conn.execute("SELECT COUNT(*) FROM messages WHERE direction = 'outgoing'").fetchone()[0]
+    assert [tuple(s) for s in sessions] == [("5511", "6#delay", (now + timedelta(minutes=2)).isoformat())]
+    assert [tuple(t) for t in tags] == [("5511", "interessado")]
+    assert outgoing == 3
+
+    # Messages during a delay do not move the flow; the timer does
+    engine.handle_message("inst1", "5511", "sim", now)
+    assert len(sent) == 3
+    assert engine.resume_due(now + timedelta(minutes=1)) == 0
+    assert engine.resume_due(now + timedelta(minutes=2)) == 1
+    assert engine.resume_due(now + timedelta(minutes=2, seconds=5)) == 1
+    assert engine.flush(5)
+    assert sent[-1][1]["message"] == "Aqui está o catálogo"
+    with app.get_db().read() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM flow_sessions").fetchone()[0] == 0
+
+
+def test_failed_sends_go_to_the_outbox(db, monkeypatch):
+    save_flow("f1")
+
+    def fail(instance_id, data):
+        raise app.BaileysError("Baileys fora do ar")
+
+    monkeypatch.setattr(app, "baileys_send_message", fail)
+    monkeypatch.setattr(app, "get_outbox_worker", lambda: type("W", (), {"wake": lambda self: None})())
+    engine = app.FlowEngine(registry=app.FlowRegistry())
+    engine.handle_message("inst1", "5511", "oi")
+    assert engine.flush(5)
+    with app.get_db().read() as conn:
+        row = conn.execute("SELECT recipient, content, last_error FROM outbox").fetchone()
+    assert tuple(row) == ("5511", "Olá! Quer o catálogo?", "Baileys fora do ar")
+
+
+def test_slow_send_does_not_hold_up_other_contacts(db, monkeypatch):
+    save_flow("f1")
+    gate = threading.Event()
+    sent = []
+
+    def send(instance_id, data):
+        if instance_id == "lenta":
+            gate.wait(5)
+        sent.append((instance_id, data["to"]))
+        return True
+
+    monkeypatch.setattr(app, "baileys_send_message", send)
+    fanout = app.FanOutExecutor(max_workers=2, per_instance=1)
+    engine = app.FlowEngine(registry=app.FlowRegistry(), fanout=fanout)
+    engine.start()
+    try:
+        engine.submit({"instance_id": "lenta", "phone": "5511", "message": "oi"})
+        engine.submit({"instance_id": "rapida", "phone": "5522", "message": "oi"})
+        deadline = time.monotonic() + 2
+        while not sent and time.monotonic() < deadline:
+            time.sleep(0.01)
+        # The second contact got its reply while the first send is still blocked
+        assert sent == [("rapida", "5522")]
+        assert engine.stats()["sends_pending"] == 0
+    finally:
+        gate.set()
+        engine.stop()
+        fanout.shutdown()
+    assert sorted(sent) == [("lenta", "5511"), ("rapida", "5522")]
+
+
+def test_flows_for_instance_come_before_global_ones(db, sent):
+    save_flow("global")
+    save_flow("vendas", [node("1", "startNode"), node("2", "messageNode", message="Bem-vindo às vendas")],
+              [edge("1", "2")], instance_id="vendas")
+    registry = app.FlowRegistry()
+    assert [f.id for f in registry.flows_for("vendas")] == ["vendas", "global"]
+    assert [f.id for f in registry.flows_for("suporte")] == ["global"]
+
+    engine = app.FlowEngine(registry=registry)
+    engine.handle_message("vendas", "5511", "oi")
+    assert engine.flush(5)
+    assert [data["message"] for _, data in sent] == ["Bem-vindo às vendas"]
+
+
+def test_saving_a_flow_recompiles_only_that_flow(db, monkeypatch):
+    registry = app.FlowRegistry()
+    monkeypatch.setattr(app, "get_flow_registry", lambda: registry)
+    srv = app.create_http_server(("127.0.0.1", 0), "threaded", 2)
+    thread = threading.Thread(target=srv.serve_forever, daemon=True)
+    thread.start()
+
+    def call(method, path, body):
+        conn = http.client.HTTPConnection("127.0.0.1", srv.server_address[1], timeout=10)
+        conn.request(method, path, json.dumps(body), {"Content-Type": "application/json"})
+        resp = conn.getresponse()
+        data = json.loads(resp.read().decode())
+        conn.close()
+        return resp.status, data
+
+    try:
+        status, created = call("POST", "/api/flows", {"name": "Catálogo", "nodes": NODES, "edges": EDGES, "active": True})
+        assert status == 200 and created["warnings"] == []
+        assert registry.get(created["flow_id"]).name == "Catálogo"
+        compiles = registry.compiles
+
+        status, updated = call("PUT", f"/api/flows/{created['flow_id']}", {"name": "Catálogo 2"})
+        assert status == 200
+        assert registry.get(created["flow_id"]).name == "Catálogo 2"
+        assert registry.compiles == compiles + 1
+
+        status, error = call("PUT", f"/api/flows/{created['flow_id']}", {"nodes": NODES[1:]})
+        assert status == 400 and error["error"].startswith("Fluxo inválido")
+        status, _ = call("POST", "/api/flows", {"name": "Rascunho", "nodes": [], "edges": []})
+        assert status == 200
+
+        status, _ = call("DELETE", f"/api/flows/{created['flow_id']}", {})
+        assert status == 200
+        assert registry.get(created["flow_id"]) is None
+    finally:
+        srv.shutdown()
+        srv.server_close()
+        thread.join()
+
+
+def keyword_nodes(flow_id, keywords, mode="contains"):
+    nodes = [node("1", "startNode"), node("2", "conditionNode", condition=keywords, conditionType=mode),
+             node("3", "messageNode", message=f"Resposta {flow_id}")]
+    return nodes, [edge("1", "2"), edge("2", "3", "yes")]
+
+
+def keyword_flow(flow_id, keywords, mode="contains"):
+    return app.compile_flow(flow_id, *keyword_nodes(flow_id, keywords, mode))
+
+
+def test_trigger_index_matches_folded_words_and_phrases():
+    index = app.TriggerIndex()
+    preco = keyword_flow("preco", "preço, quanto custa")
+    sim = keyword_flow("sim", "sim", mode="equals")
+    index.add(preco)
+    index.add(sim)
+    trigger = preco.trigger
+
+    assert index.match("Qual o PRECO?") == {("preco", trigger)}
+    assert index.match("quanto   custa isso") == {("preco", trigger)}
+    assert index.match("quanto mais custa") == set()
+    assert index.match("Sim!") == {("sim", sim.trigger)}
+    assert index.match("sim, quanto custa") == {("preco", trigger)}
+    assert index.match("assim") == set()
+    # The index and the condition node agree
+    for text in ("Qual o PRECO?", "quanto mais custa", "assim"):
+        assert app.condition_matches(preco.nodes[trigger], text) == bool(index.match(text))
+
+    index.add(keyword_flow("preco", "valor"))
+    assert index.match("preço") == set()
+    assert index.match("valor") == {("preco", trigger)}
+    index.remove("preco")
+    index.remove("sim")
+    assert index.match("valor sim") == set() and index.keywords == 0
+
+
+def test_only_matching_keyword_flows_are_tried(db, sent):
+    save_flow("boas-vindas", [node("1", "startNode"), node("2", "messageNode", message="Olá")], [edge("1", "2")])
+    save_flow("preco", *keyword_nodes("preco", "preço"))
+    save_flow("vendas", *keyword_nodes("vendas", "catálogo"), instance_id="vendas")
+    registry = app.FlowRegistry()
+
+    assert [f.id for f in registry.candidates("vendas", "Qual o preco do catalogo?")] == [
+        "vendas", "boas-vindas", "preco"]
+    assert [f.id for f in registry.candidates("suporte", "Qual o preco do catalogo?")] == ["boas-vindas", "preco"]
+    assert [f.id for f in registry.candidates("suporte", "bom dia")] == ["boas-vindas"]
+
+    with app.get_db().write() as conn:
+        conn.execute("UPDATE flows SET active = 0 WHERE id = 'boas-vindas'")
+    registry.invalidate("boas-vindas")
+    engine = app.FlowEngine(registry=registry)
+    engine.handle_message("suporte", "5511", "bom dia")
+    engine.handle_message("suporte", "5511", "e o preço?")
+    assert engine.flush(5)
+    assert [data["message"] for _, data in sent] == ["Resposta preco"]
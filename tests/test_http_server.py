@@ -0,0 +1,111 @@
+import http.client
+import importlib.util
+import json
+import os
+import pathlib
+import tempfile
+import threading
+import time
+
+import pytest
+
+spec = importlib.util.spec_from_file_location(
+    "app", pathlib.Path(__file__).resolve().parents[1] / "whatsflow-real.py"
+)
+app = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(app)
+
+
+@pytest.fixture
+def temp_db():
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    app.DB_FILE = path
+    app.init_db()
+    try:
+        yield path
+    finally:
+        os.remove(path)
+
+
+def _start(server):
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return thread
+
+
+def _get(port, path):
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+    conn.request("GET", path)
+    resp = conn.getresponse()
+    body = resp.read()
+    conn.close()
+    return resp.status, body
+
+
+def test_slow_request_does_not_block_others(temp_db, monkeypatch):
+    release = threading.Event()
+
+    def slow_groups(self, instance_id):
+        release.wait(5)
+        self.send_json_response({"success": True, "groups": []})
+
+    monkeypatch.setattr(app.WhatsFlowRealHandler, "handle_get_groups", slow_groups)
+    server = app.create_http_server(("127.0.0.1", 0), "threaded", 4)
+    port = server.server_address[1]
+    thread = _start(server)
+    try:
+        slow = threading.Thread(target=_get, args=(port, "/api/groups/default"))
+        slow.start()
+        time.sleep(0.1)
+
+        started = time.monotonic()
+        status, body = _get(port, "/api/stats")
+        assert status == 200
+        assert "messages_count" in json.loads(body)
+        assert time.monotonic() - started < 2
+        assert server.in_flight >= 1
+    finally:
+        release.set()
+        slow.join()
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+
+def test_server_close_drains_in_flight_requests(temp_db, monkeypatch):
+    entered = threading.Event()
+    results = []
+
+    def slow_stats(self):
+        entered.set()
+        time.sleep(0.3)
+        self.send_json_response({"ok": True})
+
+    monkeypatch.setattr(app.WhatsFlowRealHandler, "handle_get_stats", slow_stats)
+    server = app.create_http_server(("127.0.0.1", 0), "threaded", 2)
+    port = server.server_address[1]
+    thread = _start(server)
+
+    client = threading.Thread(target=lambda: results.append(_get(port, "/api/stats")))
+    client.start()
+    assert entered.wait(5)
+
+    server.shutdown()
+    server.server_close()
+    thread.join()
+    client.join()
+
+    assert results and results[0][0] == 200
+    assert server.in_flight == 0
+
+
+def test_single_mode_uses_plain_http_server():
+    server = app.create_http_server(("127.0.0.1", 0), "single")
+    try:
+        assert type(server) is app.HTTPServer
+    finally:
+        server.server_close()
+
+    with pytest.raises(ValueError):
+        app.create_http_server(("127.0.0.1", 0), "bogus")
@@ -0,0 +1,173 @@
+import http.client
+import importlib.util
+import json
+import os
+import pathlib
+import tempfile
+import threading
+import time
+
+import pytest
+
+spec = importlib.util.spec_from_file_location(
+    "app", pathlib.Path(__file__).resolve().parents[1] / "whatsflow-real.py"
+)
+app = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(app)
+
+
+@pytest.fixture
+def temp_db():
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    app.DB_FILE = path
+    app.init_db()
+    try:
+        yield path
+    finally:
+        app.close_db()
+        os.remove(path)
+
+
+def record(n, instance="inst1"):
+    return app.normalize_incoming_message({
+        "instanceId": instance,
+        "from": f"55119000{n:05d}@s.whatsapp.net",
+        "message": f"msg {n}",
+        "pushName": "Cliente",
+        "timestamp": f"2025-01-01T10:{n % 60:02d}:00+00:00",
+    })
+
+
+def test_burst_is_committed_in_few_batches(temp_db):
+    ingest = app.MessageIngestQueue(batch_size=50, flush_interval_ms=200, max_pending=1000)
+    try:
+        records = [record(n) for n in range(120)]
+        futures = [ingest.submit(r) for r in records]
+        statuses = [f.result(timeout=5) for f in futures]
+    finally:
+        ingest.stop()
+
+    stats = ingest.stats()
+    assert stats["messages"] == 120
+    assert stats["batches"] <= 4
+    assert stats["queue_depth"] == 0
+    with app.get_db().read() as conn:
+        stored = {r[0] for r in conn.execute("SELECT id FROM messages")}
+        chats = conn.execute("SELECT COUNT(*) FROM chats").fetchone()[0]
+    assert statuses == ["inserted"] * 120
+    assert stored == {r["id"] for r in records}
+    assert chats == 120
+
+
+def test_submit_raises_when_queue_is_full(temp_db):
+    ingest = app.MessageIngestQueue(batch_size=1, flush_interval_ms=10, max_pending=2)
+    blocked = threading.Event()
+    release = threading.Event()
+
+    def hold_writer():
+        with app.get_db().write():
+            blocked.set()
+            release.wait(5)
+
+    holder = threading.Thread(target=hold_writer)
+    holder.start()
+    try:
+        assert blocked.wait(5)
+        first = ingest.submit(record(1))
+        # Wait for the worker to pick up the first message and block on the writer
+        for _ in range(100):
+            if ingest.stats()["queue_depth"] == 0:
+                break
+            time.sleep(0.01)
+        ingest.submit(record(2))
+        ingest.submit(record(3))
+        with pytest.raises(app.IngestQueueFull):
+            ingest.submit(record(4))
+        assert ingest.stats()["rejected"] == 1
+    finally:
+        release.set()
+        holder.join()
+    assert first.result(timeout=5)
+    ingest.stop()
+    assert ingest.stats()["messages"] == 3
+
+
+def test_batch_endpoint_skips_duplicates(temp_db):
+    server = app.create_http_server(("127.0.0.1", 0), "threaded", 2)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    def post(messages):
+        conn = http.client.HTTPConnection("127.0.0.1", server.server_address[1], timeout=10)
+        conn.request("POST", "/api/messages/receive/batch", json.dumps({"messages": messages}),
+                     {"Content-Type": "application/json"})
+        resp = conn.getresponse()
+        body = json.loads(resp.read())
+        conn.close()
+        return resp.status, body
+
+    messages = [
+        {"instanceId": "inst1", "from": "5511999990001@s.whatsapp.net", "message": "oi",
+         "messageId": "WA1", "timestamp": "2025-01-01T10:00:00+00:00"},
+        {"instanceId": "inst1", "from": "5511999990001@s.whatsapp.net", "message": "tudo bem?",
+         "messageId": "WA2", "timestamp": "2025-01-01T10:01:00+00:00"},
+        {"instanceId": "inst1", "from": "5511999990001@s.whatsapp.net", "message": "oi",
+         "messageId": "WA1", "timestamp": "2025-01-01T10:00:00+00:00"},
+        {"instanceId": "inst1", "message": "sem remetente", "messageId": "WA3"},
+        # The same WhatsApp id on another instance is a different message
+        {"instanceId": "inst2", "from": "5511999990001@s.whatsapp.net", "message": "oi",
+         "messageId": "WA1", "timestamp": "2025-01-01T10:00:00+00:00"},
+    ]
+    try:
+        status, body = post(messages)
+        assert status == 200
+        assert [r["status"] for r in body["results"]] == [
+            "inserted", "inserted", "duplicate", "error", "inserted"]
+        assert (body["inserted"], body["duplicates"], body["errors"]) == (3, 1, 1)
+
+        # Replaying the batch after a reconnect stores nothing new
+        status, body = post(messages)
+        assert body["inserted"] == 0 and body["duplicates"] == 4
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+    with app.get_db().read() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0] == 3
+        unread = conn.execute(
+            "SELECT unread_count FROM chats WHERE instance_id = 'inst1'").fetchone()[0]
+    assert unread == 2
+
+
+def test_receive_returns_503_with_retry_after_when_full(temp_db, monkeypatch):
+    class FullQueue:
+        def submit(self, record):
+            raise app.IngestQueueFull("cheia")
+
+        def stats(self):
+            return {"queue_depth": 5}
+
+    monkeypatch.setattr(app, "get_ingest_queue", lambda: FullQueue())
+    server = app.create_http_server(("127.0.0.1", 0), "threaded", 2)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        conn = http.client.HTTPConnection("127.0.0.1", server.server_address[1], timeout=10)
+        conn.request("POST", "/api/messages/receive",
+                     json.dumps({"from": "5511999990001@s.whatsapp.net", "message": "oi"}),
+                     {"Content-Type": "application/json"})
+        resp = conn.getresponse()
+        resp.read()
+        assert resp.status == 503
+        assert resp.getheader("Retry-After") == "1"
+
+        conn.request("GET", "/api/metrics")
+        resp = conn.getresponse()
+        assert json.loads(resp.read())["ingest"] == {"queue_depth": 5}
+        conn.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
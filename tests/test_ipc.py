@@ -0,0 +1,188 @@
+import base64
+import importlib.util
+import json
+import os
+import pathlib
+import socket
+import tempfile
+import threading
+
+import pytest
+
+spec = importlib.util.spec_from_file_location(
+    "app", pathlib.Path(__file__).resolve().parents[1] / "whatsflow-real.py"
+)
+app = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(app)
+
+
+class FakeBaileysIPC:
+    """Stand-in for the Node side of the socket.
+
+    Requests are answered once ``hold`` of them have arrived, in reverse
+    order, to check that replies are matched by id and not by position.
+    """
+
+    def __init__(self, path, hold=1):
+        self.path = path
+        self.hold = hold
+        self.requests = []
+        self.responses = []
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(path)
+        self.server.listen(1)
+        self.conn = None
+        self.connected = threading.Event()
+        self.got_response = threading.Event()
+        self.thread = threading.Thread(target=self._serve, daemon=True)
+        self.thread.start()
+
+    def _serve(self):
+        self.conn, _ = self.server.accept()
+        self.connected.set()
+        stream = self.conn.makefile("rb")
+        held = []
+        while True:
+            try:
+                frame = app.read_frame(stream)
+            except OSError:
+                return
+            if frame is None:
+                return
+            header, body = frame
+            if header["type"] == "response":
+                self.responses.append(header)
+                self.got_response.set()
+                continue
+            self.requests.append((header, body))
+            held.append(header)
+            if len(held) >= self.hold:
+                for pending in reversed(held):
+                    app.write_frame(self.conn, {
+                        "id": pending["id"], "type": "response", "status": 200,
+                        "payload": {"success": True, "to": pending["payload"]["to"]},
+                    })
+                held = []
+
+    def push(self, header, body=b""):
+        assert self.connected.wait(5)
+        app.write_frame(self.conn, header, body)
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+        self.server.close()
+        self.thread.join(5)
+
+
+@pytest.fixture
+def sock_path():
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "baileys.sock")
+    try:
+        yield path
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+        os.rmdir(directory)
+
+
+def test_frames_round_trip():
+    left, right = socket.socketpair()
+    try:
+        app.write_frame(left, {"id": 1, "type": "request", "path": "/send/x"}, b"\x00\x01raw")
+        app.write_frame(left, {"id": 2, "type": "response", "status": 200})
+        stream = right.makefile("rb")
+        assert app.read_frame(stream) == ({"id": 1, "type": "request", "path": "/send/x"}, b"\x00\x01raw")
+        assert app.read_frame(stream) == ({"id": 2, "type": "response", "status": 200}, b"")
+        left.close()
+        assert app.read_frame(stream) is None
+    finally:
+        right.close()
+
+
+def test_send_carries_media_as_raw_body(sock_path):
+    fake = FakeBaileysIPC(sock_path)
+    client = app.BaileysIPCClient(sock_path, "http://127.0.0.1:1")
+    media = os.urandom(256 * 1024)
+    try:
+        result = client.send("inst1", {"to": "g1", "image": media})
+    finally:
+        client.close()
+        fake.close()
+
+    assert result == {"success": True, "to": "g1"}
+    header, body = fake.requests[0]
+    assert header["path"] == "/send/inst1"
+    assert header["bodyField"] == "image"
+    assert header["payload"] == {"to": "g1"}
+    assert body == media
+
+
+def test_concurrent_sends_share_one_connection(sock_path):
+    fake = FakeBaileysIPC(sock_path, hold=8)
+    client = app.BaileysIPCClient(sock_path, "http://127.0.0.1:1")
+    results = {}
+
+    def send(n):
+        results[n] = client.send("inst1", {"to": f"g{n}", "message": "oi"})["to"]
+
+    threads = [threading.Thread(target=send, args=(n,)) for n in range(8)]
+    try:
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(5)
+    finally:
+        client.close()
+        fake.close()
+
+    assert results == {n: f"g{n}" for n in range(8)}
+    assert len(fake.requests) == 8
+
+
+def test_incoming_batch_is_served_over_the_socket(sock_path):
+    fd, db_path = tempfile.mkstemp()
+    os.close(fd)
+    app.DB_FILE = db_path
+    app.init_db()
+    fake = FakeBaileysIPC(sock_path)
+    client = app.BaileysIPCClient(sock_path, "http://127.0.0.1:1")
+    try:
+        client.send("inst1", {"to": "g1", "message": "abre a conexão"})
+        message = {"instanceId": "inst1", "from": "5511999990001@s.whatsapp.net",
+                   "message": "oi", "messageId": "ABC"}
+        fake.push({"id": 1, "type": "request", "method": "POST",
+                   "path": "/api/messages/receive/batch", "payload": {"messages": [message, message]}})
+        assert fake.got_response.wait(5)
+    finally:
+        client.close()
+        fake.close()
+        app.close_db()
+        os.remove(db_path)
+
+    reply = fake.responses[0]
+    assert reply["id"] == 1 and reply["status"] == 200
+    assert (reply["payload"]["inserted"], reply["payload"]["duplicates"]) == (1, 1)
+
+
+def test_falls_back_to_http_without_socket(sock_path, monkeypatch):
+    calls = []
+
+    def fake_http(self, method, path, payload=None, timeout=None):
+        calls.append((method, path, payload))
+        return 200, {"success": True}
+
+    monkeypatch.setattr(app.BaileysClient, "request", fake_http)
+    client = app.BaileysIPCClient(sock_path, "http://127.0.0.1:1")
+    try:
+        assert client.send("inst1", {"to": "g1", "message": "oi"}) == {"success": True}
+        client.status("inst1")
+    finally:
+        client.close()
+    assert [c[1] for c in calls] == ["/send/inst1", "/status/inst1"]
+
+
+def test_http_transport_base64_encodes_raw_media():
+    body = json.dumps({"to": "g1", "image": b"\xff\x00"}, default=app._json_bytes)
+    assert json.loads(body)["image"] == base64.b64encode(b"\xff\x00").decode()
@@ -0,0 +1,213 @@
+import base64
+import http.client
+import importlib.util
+import json
+import os
+import pathlib
+import sqlite3
+import tempfile
+import threading
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+spec = importlib.util.spec_from_file_location(
+    "app", pathlib.Path(__file__).resolve().parents[1] / "whatsflow-real.py"
+)
+app = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(app)
+
+
+@pytest.fixture
+def server(monkeypatch):
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    media_dir = tempfile.mkdtemp()
+    monkeypatch.setattr(app, "MEDIA_DIR", media_dir)
+    app.DB_FILE = path
+    app.init_db()
+    srv = app.create_http_server(("127.0.0.1", 0), "threaded", 4)
+    thread = threading.Thread(target=srv.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield srv.server_address[1], path, media_dir
+    finally:
+        srv.shutdown()
+        srv.server_close()
+        thread.join()
+        app.close_db()
+        os.remove(path)
+        for root, dirs, files in os.walk(media_dir, topdown=False):
+            for name in files:
+                os.remove(os.path.join(root, name))
+            for name in dirs:
+                os.rmdir(os.path.join(root, name))
+        os.rmdir(media_dir)
+
+
+def request(port, method, path, body=None, headers=None):
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+    if isinstance(body, dict):
+        body = json.dumps(body)
+        headers = {"Content-Type": "application/json"}
+    conn.request(method, path, body, headers or {})
+    resp = conn.getresponse()
+    data = json.loads(resp.read().decode())
+    conn.close()
+    return resp.status, data
+
+
+def stored_files(media_dir):
+    return sorted(
+        name for root, _, files in os.walk(media_dir) for name in files
+        if os.path.basename(root) != "tmp"
+    )
+
+
+def test_identical_uploads_are_stored_once(server):
+    port, _, media_dir = server
+    jpeg = os.urandom(600 * 1024)
+    status, first = request(port, "POST", "/api/media", jpeg, {"Content-Type": "image/jpeg"})
+    assert status == 201
+    assert first["media_type"] == "image" and first["size"] == len(jpeg)
+    assert first["deduplicated"] is False
+
+    status, second = request(port, "POST", "/api/media?encoding=base64",
+                             base64.b64encode(jpeg), {"Content-Type": "image/jpeg"})
+    assert status == 201
+    assert second["media_id"] == first["media_id"]
+    assert second["deduplicated"] is True
+    assert stored_files(media_dir) == [first["media_id"]]
+
+    status, info = request(port, "GET", f"/api/media/{first['media_id']}")
+    assert (status, info["mimetype"], info["refcount"]) == (200, "image/jpeg", 0)
+
+
+def test_campaign_messages_count_references_and_gc_removes_orphans(server):
+    port, db_path, media_dir = server
+    conn = sqlite3.connect(db_path)
+    conn.execute("INSERT INTO campaigns (id, name) VALUES (1, 'C')")
+    conn.commit()
+    conn.close()
+
+    media = base64.b64encode(b"mesma imagem").decode()
+    for _ in range(2):
+        status, _ = request(port, "POST", "/api/campaigns/1/messages", {
+            "send_time": "10:00", "message": "oi", "media_type": "image",
+            "media_data": media, "mimetype": "image/png",
+        })
+        assert status == 200
+    status, orphan = request(port, "POST", "/api/media", b"sem uso", {"Content-Type": "video/mp4"})
+
+    store = app.get_media_store()
+    conn = sqlite3.connect(db_path)
+    paths = {row[0] for row in conn.execute("SELECT media_path FROM campaign_messages")}
+    conn.close()
+    assert len(paths) == 1
+    shared = store.info_for_path(paths.pop())
+    assert store.info(shared["media_id"])["refcount"] == 2
+
+    later = datetime.now(timezone.utc) + timedelta(hours=2)
+    assert store.gc(now=later) == {"removed": 1, "bytes": len(b"sem uso")}
+    assert stored_files(media_dir) == [shared["media_id"]]
+
+    status, _ = request(port, "DELETE", "/api/campaigns/1")
+    assert status == 200
+    assert store.info(shared["media_id"])["refcount"] == 0
+    assert store.gc(now=later)["removed"] == 1
+    assert stored_files(media_dir) == []
+
+
+def test_deleting_a_campaign_releases_its_scheduled_media(server):
+    port, db_path, media_dir = server
+    conn = sqlite3.connect(db_path)
+    conn.execute("INSERT INTO campaigns (id, name, recurrence, send_time) VALUES ('1', 'C', 'daily', '10:00')")
+    conn.commit()
+    conn.close()
+    status, media = request(port, "POST", "/api/media", b"panfleto", {"Content-Type": "image/png"})
+    assert status == 201
+
+    status, _ = request(port, "POST", "/api/campaigns/1/messages", {
+        "send_time": "10:00", "message": "oi", "media_type": "image", "media_id": media["media_id"],
+    })
+    assert status == 200
+    status, scheduled = request(port, "POST", "/api/messages/schedule", {
+        "campaign_id": "1", "content": "oi", "media_id": media["media_id"],
+    })
+    assert status == 200
+    store = app.get_media_store()
+    assert store.info(media["media_id"])["refcount"] == 2
+    assert scheduled["id"] in app.get_scheduled_queue()._due
+
+    status, _ = request(port, "DELETE", "/api/campaigns/1")
+    assert status == 200
+    assert store.info(media["media_id"])["refcount"] == 0
+    assert scheduled["id"] not in app.get_scheduled_queue()._due
+    assert store.gc(now=datetime.now(timezone.utc) + timedelta(hours=2))["removed"] == 1
+    assert stored_files(media_dir) == []
+
+
+def test_sent_one_off_message_releases_its_media(server, monkeypatch):
+    _, db_path, _ = server
+    monkeypatch.setattr(app, "send_scheduled_message", lambda *a, **k: True)
+    store = app.get_media_store()
+    stored = store.put_bytes(b"convite", "image/png")
+    past = (datetime.now(timezone.utc) - timedelta(minutes=1)).isoformat()
+    conn = sqlite3.connect(db_path)
+    conn.execute("INSERT INTO campaigns (id, name, recurrence, send_time) VALUES ('1', 'C', 'once', '00:00')")
+    conn.execute("INSERT INTO campaign_groups (campaign_id, group_id) VALUES (1, 'g1')")
+    conn.execute(
+        "INSERT INTO scheduled_messages (id, campaign_id, content, media_type, media_path, next_run, status) "
+        "VALUES ('s1', 1, 'oi', 'image', ?, ?, 'pending')",
+        (stored["path"], past),
+    )
+    conn.commit()
+    conn.close()
+    assert store.info(stored["media_id"])["refcount"] == 1
+
+    app.process_scheduled_messages()
+    assert store.info(stored["media_id"])["refcount"] == 0
+    assert store.gc(now=datetime.now(timezone.utc) + timedelta(hours=2))["removed"] == 1
+
+
+def test_gc_unlinks_before_releasing_the_writer(server, monkeypatch):
+    store = app.get_media_store()
+    stored = store.put_bytes(b"antigo", "image/png")
+    committed = []
+    remove = os.remove
+
+    def checked_remove(path):
+        # Another connection must still see the row while the file goes away
+        conn = sqlite3.connect(app.DB_FILE)
+        committed.append(conn.execute("SELECT COUNT(*) FROM media_blobs").fetchone()[0])
+        conn.close()
+        remove(path)
+
+    monkeypatch.setattr(app.os, "remove", checked_remove)
+    assert store.gc(now=datetime.now(timezone.utc) + timedelta(hours=2))["removed"] == 1
+    assert committed == [1]
+    assert store.info(stored["media_id"]) is None
+
+
+def test_gc_keeps_media_of_pending_outbox_rows(server):
+    _, _, media_dir = server
+    store = app.get_media_store()
+    stored = store.put_bytes(b"audio", "audio/ogg")
+    with app.get_db().write() as conn:
+        app.enqueue_outbox(conn, "inst1", "g1", None, "audio", stored["path"], delivery_id=None, error="offline")
+
+    assert store.gc(now=datetime.now(timezone.utc) + timedelta(hours=2))["removed"] == 0
+    assert stored_files(media_dir) == [stored["media_id"]]
+
+
+def test_send_payload_carries_cached_mimetype(server, monkeypatch):
+    store = app.get_media_store()
+    stored = store.put_bytes(b"%PDF-1.4", "application/pdf")
+    payload = app.build_send_payload("g1", None, "document", stored["path"])
+    assert payload["mimetype"] == "application/pdf"
+    assert payload["document"]["url"] == os.path.abspath(stored["path"])
+
+    monkeypatch.setattr(app, "MEDIA_TRANSFER", "inline")
+    inline = app.build_send_payload("g1", None, "document", stored["path"])
+    assert inline["mimetype"] == "application/pdf"
+    assert inline["document"].data == b"%PDF-1.4"
@@ -0,0 +1,122 @@
+import base64
+import importlib.util
+import json
+import os
+import pathlib
+import sqlite3
+import tempfile
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+spec = importlib.util.spec_from_file_location(
+    "app", pathlib.Path(__file__).resolve().parents[1] / "whatsflow-real.py"
+)
+app = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(app)
+
+
+@pytest.fixture
+def temp_db():
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    app.DB_FILE = path
+    app.init_db()
+    try:
+        yield path
+    finally:
+        app.close_db()
+        os.remove(path)
+
+
+@pytest.fixture(autouse=True)
+def no_rate_limit(monkeypatch):
+    monkeypatch.setattr(app, "get_rate_limiter", lambda: app.InstanceRateLimiter(1000, 1000))
+
+
+@pytest.fixture
+def media_dir(monkeypatch):
+    directory = tempfile.mkdtemp()
+    monkeypatch.setattr(app, "MEDIA_DIR", directory)
+    try:
+        yield directory
+    finally:
+        for name in os.listdir(directory):
+            os.remove(os.path.join(directory, name))
+        os.rmdir(directory)
+
+
+def seed_campaign(db_path, media_path, groups=50):
+    conn = sqlite3.connect(db_path)
+    conn.execute(
+        "INSERT INTO campaigns (id, name, recurrence, send_time, weekday) VALUES (?,?,?,?,?)",
+        ("c1", "C", "once", "00:00", None),
+    )
+    conn.executemany(
+        "INSERT INTO campaign_groups (campaign_id, group_id) VALUES (?,?)",
+        [("c1", f"g{n}") for n in range(groups)],
+    )
+    past = (datetime.now(timezone.utc) - timedelta(minutes=1)).isoformat()
+    conn.execute(
+        "INSERT INTO scheduled_messages (id, campaign_id, content, media_type, media_path, next_run, status) VALUES (?,?,?,?,?,?,?)",
+        ("s1", "c1", "legenda", "video", media_path, past, "pending"),
+    )
+    conn.commit()
+    conn.close()
+
+
+def test_inline_media_is_read_and_encoded_once_per_run(temp_db, monkeypatch):
+    fd, media_path = tempfile.mkstemp()
+    os.write(fd, os.urandom(64 * 1024))
+    os.close(fd)
+    seed_campaign(temp_db, media_path)
+
+    reads, encodes, bodies = [], [], []
+    from_file = app.MediaBlob.from_file.__func__
+    b64encode = base64.b64encode
+    monkeypatch.setattr(app.MediaBlob, "from_file",
+                        classmethod(lambda cls, path, mimetype=None: reads.append(path) or from_file(cls, path, mimetype)))
+    monkeypatch.setattr(app.base64, "b64encode", lambda data: encodes.append(len(data)) or b64encode(data))
+    monkeypatch.setattr(app, "baileys_post", lambda url, data: bodies.append(app._json_body(data)) or True)
+    try:
+        app.process_scheduled_messages(now=datetime.now(timezone.utc))
+    finally:
+        os.remove(media_path)
+
+    assert len(bodies) == 50
+    assert reads == [media_path]
+    assert encodes == [64 * 1024]
+    # Every request reuses the same encoded bytes instead of a fresh copy
+    assert len({id(parts[2]) for parts in bodies}) == 1
+
+
+def test_media_in_media_dir_is_sent_by_path(temp_db, media_dir, monkeypatch):
+    media_path = os.path.join(media_dir, "video.mp4")
+    with open(media_path, "wb") as f:
+        f.write(b"video")
+    seed_campaign(temp_db, media_path, groups=3)
+
+    payloads = []
+    monkeypatch.setattr(app, "baileys_post", lambda url, data: payloads.append(data) or True)
+    app.process_scheduled_messages(now=datetime.now(timezone.utc))
+
+    assert [p["video"] for p in payloads] == [{"url": os.path.abspath(media_path)}] * 3
+
+
+def test_inline_transfer_setting_forces_bytes(temp_db, media_dir, monkeypatch):
+    media_path = os.path.join(media_dir, "foto.jpg")
+    with open(media_path, "wb") as f:
+        f.write(b"jpg")
+    monkeypatch.setattr(app, "MEDIA_TRANSFER", "inline")
+    media = app.prepare_media("image", media_path)
+    assert isinstance(media, app.MediaBlob) and media.data == b"jpg"
+    assert app.prepare_media("text", media_path) is None
+
+
+def test_json_body_parts_match_plain_json():
+    blob = app.MediaBlob(b"\x00\x01binary")
+    for payload in ({"to": "g1", "image": blob}, {"image": blob}):
+        parts = app._json_body(payload)
+        decoded = json.loads(b"".join(parts))
+        assert decoded["image"] == base64.b64encode(b"\x00\x01binary").decode()
+        assert decoded.get("to") == payload.get("to")
@@ -0,0 +1,166 @@
+import http.client
+import importlib.util
+import json
+import os
+import pathlib
+import sqlite3
+import tempfile
+import threading
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+spec = importlib.util.spec_from_file_location(
+    "app", pathlib.Path(__file__).resolve().parents[1] / "whatsflow-real.py"
+)
+app = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(app)
+
+
+@pytest.fixture
+def temp_db():
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    app.DB_FILE = path
+    app.init_db()
+    try:
+        yield path
+    finally:
+        app.close_db()
+        os.remove(path)
+
+
+@pytest.fixture
+def baileys(monkeypatch):
+    """Fake Baileys that fails while ``state["down"]`` is set."""
+    state = {"down": True, "calls": []}
+
+    def fake_post(url, data):
+        state["calls"].append(data["to"])
+        if state["down"]:
+            raise app.BaileysError("Serviço Baileys indisponível")
+        return True
+
+    monkeypatch.setattr(app, "baileys_post", fake_post)
+    monkeypatch.setattr(app, "get_rate_limiter", lambda: app.InstanceRateLimiter(1000, 1000))
+    return state
+
+
+def later(seconds):
+    return datetime.now(timezone.utc) + timedelta(seconds=seconds)
+
+
+def outbox_row(path):
+    conn = sqlite3.connect(path)
+    row = conn.execute("SELECT status, attempts, next_attempt_at, last_error FROM outbox").fetchone()
+    conn.close()
+    return row
+
+
+def test_send_scheduled_message_reports_failure(temp_db, baileys):
+    assert app.send_scheduled_message("g1@g.us", "oi", "text", None) is False
+    baileys["down"] = False
+    assert app.send_scheduled_message("g1@g.us", "oi", "text", None) is True
+
+
+def test_backoff_grows_with_jitter_and_is_capped(monkeypatch):
+    monkeypatch.setattr(app, "OUTBOX_BASE_BACKOFF", 2)
+    monkeypatch.setattr(app, "OUTBOX_MAX_BACKOFF", 30)
+    for attempts, full in [(1, 2), (2, 4), (3, 8), (10, 30)]:
+        delays = [app.outbox_backoff(attempts) for _ in range(50)]
+        assert all(full / 2 <= d <= full for d in delays)
+        assert len(set(delays)) > 1
+
+
+def test_failed_send_is_retried_until_delivered(temp_db, baileys):
+    worker = app.OutboxWorker()
+    with app.get_db().write() as conn:
+        app.record_deliveries(
+            conn, "scheduled_message", "s1", "1",
+            [{"instance_id": "default", "group_id": "g1", "status": "failed", "error": "down", "duration_ms": 1}],
+            retry=("oi", "text", None),
+        )
+
+    # Not due yet
+    assert worker.drain() == 0
+    assert worker.drain(now=later(10)) == 1
+    status, attempts, next_attempt, error = outbox_row(temp_db)
+    assert (status, attempts) == ("pending", 2)
+    assert "indisponível" in error
+
+    baileys["down"] = False
+    assert worker.drain(now=later(3600)) == 1
+    assert outbox_row(temp_db)[:2] == ("sent", 3)
+    conn = sqlite3.connect(temp_db)
+    assert conn.execute("SELECT status FROM deliveries").fetchone()[0] == "sent"
+    conn.close()
+
+
+def test_worker_is_woken_after_the_retry_commits(temp_db, monkeypatch):
+    seen = []
+
+    class Worker:
+        def wake(self):
+            # A separate connection only sees committed rows
+            conn = sqlite3.connect(temp_db)
+            seen.append(conn.execute("SELECT COUNT(*) FROM outbox").fetchone()[0])
+            conn.close()
+
+    monkeypatch.setattr(app, "get_outbox_worker", Worker)
+    monkeypatch.setattr(app, "send_scheduled_message", lambda *a, **k: False)
+    conn = sqlite3.connect(temp_db)
+    conn.execute("INSERT INTO campaigns (id, name, recurrence, send_time) VALUES ('1', 'C', 'once', '00:00')")
+    conn.execute("INSERT INTO campaign_groups (campaign_id, group_id) VALUES (1, 'g1')")
+    conn.execute(
+        "INSERT INTO scheduled_messages (id, campaign_id, content, next_run, status) VALUES ('s1', 1, 'oi', ?, 'pending')",
+        (later(-60).isoformat(),),
+    )
+    conn.commit()
+    conn.close()
+
+    app.process_scheduled_messages()
+    assert seen == [1]
+
+
+def test_send_is_dead_after_max_attempts(temp_db, baileys, monkeypatch):
+    monkeypatch.setattr(app, "OUTBOX_MAX_ATTEMPTS", 3)
+    worker = app.OutboxWorker()
+    with app.get_db().write() as conn:
+        app.enqueue_outbox(conn, "default", "g1", "oi", "text", None)
+
+    worker.drain(now=later(3600))
+    worker.drain(now=later(7200))
+    assert outbox_row(temp_db)[:2] == ("dead", 3)
+    assert worker.drain(now=later(99999)) == 0
+    assert worker.stats()["dead"] == 1
+    assert baileys["calls"] == ["g1", "g1"]
+
+
+def test_dead_sends_can_be_listed_and_retried(temp_db):
+    with app.get_db().write() as conn:
+        outbox_id = app.enqueue_outbox(conn, "default", "g1", "oi", "text", None)
+        conn.execute("UPDATE outbox SET status = 'dead' WHERE id = ?", (outbox_id,))
+
+    server = app.create_http_server(("127.0.0.1", 0), "threaded", 2)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        conn = http.client.HTTPConnection("127.0.0.1", server.server_address[1], timeout=10)
+        conn.request("GET", "/api/outbox?status=dead")
+        dead = json.loads(conn.getresponse().read())
+        assert [row["id"] for row in dead] == [outbox_id]
+
+        conn.request("POST", f"/api/outbox/{outbox_id}/retry", b"", {"Content-Length": "0"})
+        resp = conn.getresponse()
+        resp.read()
+        assert resp.status == 200
+        conn.request("POST", f"/api/outbox/{outbox_id}/retry", b"", {"Content-Length": "0"})
+        resp = conn.getresponse()
+        resp.read()
+        assert resp.status == 404
+        conn.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+    assert outbox_row(temp_db)[:2] == ("pending", 0)
@@ -0,0 +1,141 @@
+import http.client
+import importlib.util
+import json
+import os
+import pathlib
+import sqlite3
+import tempfile
+import threading
+
+import pytest
+
+spec = importlib.util.spec_from_file_location(
+    "app", pathlib.Path(__file__).resolve().parents[1] / "whatsflow-real.py"
+)
+app = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(app)
+
+
+@pytest.fixture
+def server():
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    app.DB_FILE = path
+    app.init_db()
+    srv = app.create_http_server(("127.0.0.1", 0), "threaded", 2)
+    thread = threading.Thread(target=srv.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield srv.server_address[1], path
+    finally:
+        srv.shutdown()
+        srv.server_close()
+        thread.join()
+        app.close_db()
+        os.remove(path)
+
+
+def get(port, path):
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+    conn.request("GET", path)
+    resp = conn.getresponse()
+    data = json.loads(resp.read().decode())
+    conn.close()
+    return resp, data
+
+
+def walk(port, path):
+    """Follow the Link headers; returns the pages."""
+    pages = []
+    while path:
+        resp, data = get(port, path)
+        assert resp.status == 200
+        pages.append(data)
+        link = resp.getheader("Link")
+        path = link[1:link.index(">")] if link else None
+        if link:
+            assert resp.getheader("X-Next-Cursor") in path
+    return pages
+
+
+def insert_messages(db_path, rows):
+    conn = sqlite3.connect(db_path)
+    conn.executemany(
+        "INSERT INTO messages (id, contact_name, phone, message, direction, instance_id, created_at) "
+        "VALUES (?, 'Ana', ?, ?, 'incoming', 'inst1', ?)",
+        rows,
+    )
+    conn.commit()
+    conn.close()
+
+
+def test_conversation_pages_are_stable_with_equal_timestamps(server):
+    port, db_path = server
+    # Several messages share a timestamp; rowid breaks the tie
+    insert_messages(db_path, [(f"m{i}", "5511", f"msg {i}", f"2024-01-01T00:00:0{i // 3}") for i in range(10)])
+
+    pages = walk(port, "/api/messages?phone=5511&instance_id=inst1&limit=4")
+    assert [len(page) for page in pages] == [4, 4, 2]
+    assert [m["id"] for page in pages for m in page] == [f"m{i}" for i in range(10)]
+
+    pages = walk(port, "/api/messages?phone=5511&limit=4&order=desc")
+    assert [m["id"] for page in pages for m in page] == [f"m{i}" for i in reversed(range(10))]
+
+
+def test_new_rows_do_not_shift_later_pages(server):
+    port, _ = server
+    with app.get_db().write() as conn:
+        for i in range(5):
+            conn.execute("INSERT INTO contacts (id, name, phone, instance_id) VALUES (?, ?, ?, 'inst1')",
+                         (f"c{i}", f"Contato {i}", f"55{i}"))
+
+    resp, first = get(port, "/api/contacts?limit=2")
+    assert [c["id"] for c in first] == ["c4", "c3"]
+    with app.get_db().write() as conn:
+        conn.execute("INSERT INTO contacts (id, name, phone, instance_id) VALUES ('c5', 'Novo', '555', 'inst1')")
+    cursor = resp.getheader("X-Next-Cursor")
+    _, second = get(port, f"/api/contacts?limit=2&cursor={cursor}")
+    assert [c["id"] for c in second] == ["c2", "c1"]
+
+    _, everything = get(port, "/api/contacts?all=1")
+    assert len(everything) == 6
+
+
+def test_chats_flows_and_campaigns_are_paginated(server):
+    port, db_path = server
+    conn = sqlite3.connect(db_path)
+    conn.executemany(
+        "INSERT INTO chats (id, contact_phone, contact_name, instance_id, last_message, last_message_time) "
+        "VALUES (?, ?, 'Ana', 'inst1', 'oi', ?)",
+        [(f"chat{i}", f"55{i}", f"2024-01-0{i + 1}") for i in range(5)],
+    )
+    conn.executemany("INSERT INTO flows (id, name, nodes, edges) VALUES (?, ?, '[]', '[]')",
+                     [(f"f{i}", f"Fluxo {i}") for i in range(3)])
+    conn.executemany("INSERT INTO campaigns (id, name) VALUES (?, ?)", [(f"k{i}", f"C{i}") for i in range(3)])
+    conn.executemany("INSERT INTO campaign_groups (campaign_id, group_id, instance_id) VALUES (?, ?, 'inst1')",
+                     [("k0", "grupo-a"), ("k0", "grupo-b"), ("k2", "grupo-c")])
+    conn.commit()
+    conn.close()
+
+    chats = walk(port, "/api/chats?limit=2")
+    assert [c["contact_phone"] for page in chats for c in page] == ["554", "553", "552", "551", "550"]
+    flows = walk(port, "/api/flows?limit=2")
+    assert [f["id"] for page in flows for f in page] == ["f2", "f1", "f0"]
+    campaigns = [c for page in walk(port, "/api/campaigns?limit=1") for c in page]
+    assert [(c["id"], sorted(c["groups"])) for c in campaigns] == [
+        ("k2", ["grupo-c"]), ("k1", []), ("k0", ["grupo-a", "grupo-b"]),
+    ]
+
+
+def test_latest_messages_and_bad_cursors(server):
+    port, db_path = server
+    insert_messages(db_path, [(f"m{i}", f"55{i}", "oi", f"2024-01-01T00:00:{i:02d}") for i in range(60)])
+    resp, latest = get(port, "/api/messages")
+    assert len(latest) == 50 and latest[0]["id"] == "m59"
+    assert resp.getheader("X-Next-Cursor")
+
+    assert get(port, "/api/contacts?cursor=nao-e-um-cursor")[0].status == 400
+    assert get(port, "/api/contacts?limit=abc")[0].status == 400
+    for route in ("/api/chats", "/api/flows", "/api/campaigns", "/api/messages"):
+        assert get(port, f"{route}?cursor=nao-e-um-cursor")[0].status == 400, route
+    assert app.decode_cursor(app.encode_cursor(["2024-01-01", 7]), 2) == ["2024-01-01", 7]
@@ -0,0 +1,71 @@
+import importlib.util
+import pathlib
+import threading
+import time
+
+spec = importlib.util.spec_from_file_location(
+    "app", pathlib.Path(__file__).resolve().parents[1] / "whatsflow-real.py"
+)
+app = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(app)
+
+
+def test_bucket_allows_burst_then_paces():
+    bucket = app.TokenBucket(rate=20, burst=3)
+    waits = [bucket.reserve() for _ in range(5)]
+    assert waits[:3] == [0.0, 0.0, 0.0]
+    assert 0.04 <= waits[3] <= 0.06
+    assert 0.09 <= waits[4] <= 0.11
+
+
+def test_zero_rate_does_not_pace():
+    bucket = app.TokenBucket(rate=0, burst=1)
+    assert [bucket.reserve() for _ in range(5)] == [0.0] * 5
+    limiter = app.InstanceRateLimiter(default_rate=1, default_burst=1, rates=app._parse_send_rates("livre=0"))
+    assert [limiter.acquire("livre") for _ in range(3)] == [0.0] * 3
+    assert limiter.stats()["livre"]["rate_per_second"] == 0
+
+
+def test_limiter_is_per_instance_and_reports_wait_time():
+    limiter = app.InstanceRateLimiter(default_rate=10, default_burst=1, rates={"fast": (1000, 50)})
+    started = time.monotonic()
+    threads = [threading.Thread(target=limiter.acquire, args=("slow",)) for _ in range(4)]
+    threads += [threading.Thread(target=limiter.acquire, args=("fast",)) for _ in range(20)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.monotonic() - started
+
+    stats = limiter.stats()
+    assert stats["slow"]["sends"] == 4
+    assert stats["slow"]["burst"] == 1
+    # 1 token up front, then 3 more at 10/s
+    assert 0.28 <= elapsed < 1
+    assert 280 <= stats["slow"]["max_wait_ms"] <= 320
+    assert stats["fast"]["sends"] == 20
+    assert stats["fast"]["max_wait_ms"] == 0
+    assert stats["slow"]["waiting"] == 0
+
+
+def test_parse_send_rates():
+    assert app._parse_send_rates("vendas=2/10, suporte=0.5") == {
+        "vendas": (2.0, 10.0),
+        "suporte": (0.5, 0.5),
+    }
+
+
+def test_scheduled_sends_go_through_the_limiter(monkeypatch):
+    acquired = []
+    posted = []
+
+    class Limiter:
+        def acquire(self, instance_id):
+            acquired.append(instance_id)
+            return 0.0
+
+    monkeypatch.setattr(app, "get_rate_limiter", lambda: Limiter())
+    monkeypatch.setattr(app, "baileys_post", lambda url, data: posted.append(url) or True)
+    assert app.send_scheduled_message("g1@g.us", "oi", "text", None, instance_id="vendas")
+    assert acquired == ["vendas"]
+    assert posted == [f"{app.BAILEYS_URL}/send/vendas"]
@@ -0,0 +1,123 @@
+import http.client
+import importlib.util
+import json
+import os
+import pathlib
+import sqlite3
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+spec = importlib.util.spec_from_file_location(
+    "app", pathlib.Path(__file__).resolve().parents[1] / "whatsflow-real.py"
+)
+app = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(app)
+
+
+@pytest.fixture
+def temp_db():
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    app.DB_FILE = path
+    app.init_db()
+    try:
+        yield path
+    finally:
+        app.close_db()
+        os.remove(path)
+
+
+def at(seconds):
+    return datetime.now(timezone.utc) + timedelta(seconds=seconds)
+
+
+def test_pop_due_orders_by_next_run_and_skips_stale_entries():
+    q = app.ScheduledMessageQueue()
+    q.schedule("a", at(60))
+    q.schedule("b", at(-1))
+    q.schedule("c", at(-5))
+    q.schedule("a", at(-2))  # rescheduled earlier
+    q.discard("c")
+    q.schedule("bad", "not a date")
+
+    assert len(q) == 2
+    assert q.pop_due() == ["a", "b"]
+    assert q.pop_due() == []
+    assert q.next_due() is None
+
+
+def test_wait_due_wakes_at_next_run():
+    q = app.ScheduledMessageQueue()
+    q.schedule("later", at(30))
+    started = time.monotonic()
+    # Scheduling an earlier item must wake a waiter already sleeping
+    threading.Timer(0.1, q.schedule, args=("soon", at(0.3))).start()
+    assert q.wait_due() == ["soon"]
+    elapsed = time.monotonic() - started
+    assert 0.3 <= elapsed < 1.5
+
+
+def test_load_reads_pending_rows(temp_db):
+    conn = sqlite3.connect(temp_db)
+    conn.executemany(
+        "INSERT INTO scheduled_messages (id, campaign_id, content, next_run, status) VALUES (?,?,?,?,?)",
+        [("p1", "c1", "x", at(-10).isoformat(), "pending"),
+         ("p2", "c1", "x", at(100).isoformat(), "pending"),
+         ("s1", "c1", "x", at(-10).isoformat(), "sent")],
+    )
+    conn.commit()
+    conn.close()
+
+    q = app.ScheduledMessageQueue()
+    assert q.load() == 2
+    assert q.pop_due() == ["p1"]
+
+
+def test_dispatcher_sends_message_scheduled_through_api(temp_db, monkeypatch):
+    sent = []
+    monkeypatch.setattr(app, "_scheduled_queue", app.ScheduledMessageQueue())
+    monkeypatch.setattr(
+        app, "send_scheduled_message",
+        lambda group, content, mtype, mpath, instance_id="default", media=None: sent.append((group, time.monotonic())) or True,
+    )
+    conn = sqlite3.connect(temp_db)
+    conn.execute("INSERT INTO campaigns (id, name, recurrence, send_time) VALUES ('1', 'C', 'once', '00:00')")
+    conn.execute("INSERT INTO campaign_groups (campaign_id, group_id) VALUES (1, 'g1')")
+    conn.commit()
+    conn.close()
+
+    stop = threading.Event()
+    dispatcher = app.start_scheduled_dispatcher(stop)
+    server = app.create_http_server(("127.0.0.1", 0), "threaded", 2)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        http_conn = http.client.HTTPConnection("127.0.0.1", server.server_address[1], timeout=10)
+        http_conn.request("POST", "/api/campaigns/1/schedule",
+                          json.dumps({"message": "oi", "send_at": at(0.5).isoformat()}),
+                          {"Content-Type": "application/json"})
+        resp = http_conn.getresponse()
+        resp.read()
+        assert resp.status == 200
+        requested = time.monotonic()
+
+        deadline = time.monotonic() + 5
+        while not sent and time.monotonic() < deadline:
+            time.sleep(0.02)
+        assert [g for g, _ in sent] == ["g1"]
+        assert sent[0][1] - requested < 1.5
+    finally:
+        stop.set()
+        app.get_scheduled_queue().stop()
+        dispatcher.join(2)
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+    conn = sqlite3.connect(temp_db)
+    assert conn.execute("SELECT status FROM scheduled_messages").fetchone()[0] == "sent"
+    conn.close()
@@ -172,7 +172,7 @@ class TestDispatcherProcessing:
 
         calls = []
 
-        def fake_send(group, content, mtype, mpath, instance_id="default"):
+        def fake_send(group, content, mtype, mpath, instance_id="default", media=None):
             calls.append(group)
             return True
 
@@ -181,7 +181,7 @@ class TestDispatcherProcessing:
         app.process_scheduled_messages(now=now)
         app.send_scheduled_message = orig
 
-        assert calls == ["g1", "g2", "g3"]
+        assert sorted(calls) == ["g1", "g2", "g3"]
 
         conn = sqlite3.connect(self.db_path)
         cur = conn.cursor()
@@ -66,9 +66,9 @@ def test_scheduler_sends_media_to_multiple_groups(temp_db, fake_baileys, media_t
     os.remove(mpath)
 
     assert len(fake_baileys) == 2
-    groups = ["g1", "g2"]
-    for call, group in zip(fake_baileys, groups):
-        assert call["data"]["to"] == group
+    # Groups are sent to in parallel, so compare without relying on order
+    assert sorted(call["data"]["to"] for call in fake_baileys) == ["g1", "g2"]
+    for call in fake_baileys:
         assert media_type in call["data"]
 
     conn = sqlite3.connect(temp_db)
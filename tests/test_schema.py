@@ -0,0 +1,64 @@
+import importlib.util
+import os
+import pathlib
+import sqlite3
+import tempfile
+
+import pytest
+
+spec = importlib.util.spec_from_file_location(
+    "app", pathlib.Path(__file__).resolve().parents[1] / "whatsflow-real.py"
+)
+app = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(app)
+
+
+@pytest.fixture
+def temp_db():
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    app.DB_FILE = path
+    app.init_db()
+    try:
+        yield path
+    finally:
+        app.close_db()
+        os.remove(path)
+
+
+def test_migrations_set_user_version(temp_db):
+    conn = sqlite3.connect(temp_db)
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    conn.close()
+    assert version == app.SCHEMA_MIGRATIONS[-1][0]
+
+
+def test_init_db_is_idempotent(temp_db):
+    app.init_db()
+    conn = sqlite3.connect(temp_db)
+    assert app.apply_migrations(conn) == app.SCHEMA_MIGRATIONS[-1][0]
+    conn.close()
+
+
+def test_hot_queries_use_indexes(temp_db):
+    report = app.explain_hot_queries()
+    assert report
+    slow = [(name, plan) for name, plan, is_slow in report if is_slow]
+    assert not slow
+
+
+def test_whatsapp_id_migration_removes_duplicates(temp_db):
+    conn = sqlite3.connect(temp_db)
+    conn.execute("DROP INDEX idx_messages_instance_whatsapp")
+    conn.executemany(
+        "INSERT INTO messages (id, contact_name, phone, message, direction, instance_id, whatsapp_id) "
+        "VALUES (?, '', ?, ?, 'incoming', ?, ?)",
+        [("a", "1", "x", "i1", "WA1"), ("b", "1", "x", "i1", "WA1"),
+         ("c", "1", "y", "i2", "WA1"), ("d", "1", "z", "i1", None), ("e", "1", "z", "i1", None)],
+    )
+    conn.execute("PRAGMA user_version = 2")
+    conn.commit()
+    app.apply_migrations(conn)
+    ids = [r[0] for r in conn.execute("SELECT id FROM messages ORDER BY id")]
+    conn.close()
+    assert ids == ["a", "c", "d", "e"]
@@ -0,0 +1,135 @@
+import http.client
+import importlib.util
+import io
+import json
+import os
+import pathlib
+import socket
+import sqlite3
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import pytest
+
+spec = importlib.util.spec_from_file_location(
+    "app", pathlib.Path(__file__).resolve().parents[1] / "whatsflow-real.py"
+)
+app = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(app)
+
+CONTACTS = 20000
+
+
+@pytest.fixture(scope="module")
+def server():
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    app.DB_FILE = path
+    app.init_db()
+    conn = sqlite3.connect(path)
+    conn.executemany(
+        "INSERT INTO contacts (id, name, phone, instance_id, created_at) VALUES (?, ?, ?, 'inst1', '2024-01-01')",
+        ((f"c{i}", f"Contato número {i} " + "x" * 100, f"55119{i:08d}") for i in range(CONTACTS)),
+    )
+    conn.commit()
+    conn.close()
+    srv = app.create_http_server(("127.0.0.1", 0), "threaded", 2)
+    thread = threading.Thread(target=srv.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield srv.server_address[1]
+    finally:
+        srv.shutdown()
+        srv.server_close()
+        thread.join()
+        app.close_db()
+        os.remove(path)
+
+
+def test_full_dump_is_chunked_compact_json(server):
+    conn = http.client.HTTPConnection("127.0.0.1", server, timeout=30)
+    conn.request("GET", "/api/contacts?all=1")
+    resp = conn.getresponse()
+    assert resp.version == 11
+    assert resp.getheader("Transfer-Encoding") == "chunked"
+    assert resp.getheader("Connection") == "close"
+    body = resp.read()
+    conn.close()
+
+    contacts = json.loads(body)
+    assert len(contacts) == CONTACTS
+    assert contacts[0]["id"] == f"c{CONTACTS - 1}"
+    assert b"\n" not in body
+
+
+def test_ndjson_page_keeps_cursor_headers(server):
+    conn = http.client.HTTPConnection("127.0.0.1", server, timeout=30)
+    conn.request("GET", "/api/contacts?limit=3", headers={"Accept": "application/x-ndjson"})
+    resp = conn.getresponse()
+    lines = resp.read().decode().splitlines()
+    conn.close()
+    assert resp.getheader("Content-Type").startswith("application/x-ndjson")
+    assert [json.loads(line)["id"] for line in lines] == [f"c{i}" for i in range(CONTACTS - 1, CONTACTS - 4, -1)]
+    assert resp.getheader("X-Next-Cursor")
+
+
+def test_http10_clients_get_a_close_delimited_body(server):
+    sock = socket.create_connection(("127.0.0.1", server), timeout=30)
+    sock.sendall(b"GET /api/contacts?all=1&format=ndjson HTTP/1.0\r\nHost: localhost\r\n\r\n")
+    raw = b""
+    while chunk := sock.recv(65536):
+        raw += chunk
+    sock.close()
+    head, _, body = raw.partition(b"\r\n\r\n")
+    assert head.startswith(b"HTTP/1.0 200")
+    assert b"chunked" not in head.lower()
+    assert len(body.splitlines()) == CONTACTS
+
+
+def test_dump_runs_in_constant_memory(server):
+    conn = http.client.HTTPConnection("127.0.0.1", server, timeout=60)
+    tracemalloc.start()
+    try:
+        conn.request("GET", "/api/contacts?all=1&format=ndjson")
+        resp = conn.getresponse()
+        size = 0
+        while chunk := resp.read(64 * 1024):
+            size += len(chunk)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+        conn.close()
+    assert size > 3_000_000
+    assert peak < size / 4
+
+
+def test_stream_writer_frames_chunks():
+    out = io.BytesIO()
+    writer = app.StreamWriter(out, chunked=True, chunk_size=4)
+    writer.write(b"ab")
+    writer.write(b"cdef")
+    writer.write(b"g")
+    writer.close()
+    assert out.getvalue() == b"6\r\nabcdef\r\n1\r\ng\r\n0\r\n\r\n"
+
+
+def test_slow_dump_does_not_pin_a_read_snapshot(server):
+    # A client that stops reading keeps the handler blocked mid-stream
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    sock.settimeout(30)
+    sock.connect(("127.0.0.1", server))
+    sock.sendall(b"GET /api/contacts?all=1&format=ndjson HTTP/1.1\r\nHost: localhost\r\n\r\n")
+    assert sock.recv(4096)
+    time.sleep(0.5)
+    try:
+        conn = sqlite3.connect(app.DB_FILE, timeout=2)
+        conn.execute("UPDATE contacts SET name = name WHERE id = 'c0'")
+        conn.commit()
+        busy, _, _ = conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()
+        conn.close()
+        assert busy == 0
+    finally:
+        sock.close()
@@ -0,0 +1,173 @@
+import http.client
+import importlib.util
+import json
+import os
+import pathlib
+import tempfile
+import threading
+import time
+
+import pytest
+
+spec = importlib.util.spec_from_file_location(
+    "app", pathlib.Path(__file__).resolve().parents[1] / "whatsflow-real.py"
+)
+app = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(app)
+
+
+@pytest.fixture
+def server(monkeypatch):
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    app.DB_FILE = path
+    app.init_db()
+    feed = app.ChangeFeed(max_waiters=2)
+    monkeypatch.setattr(app, "get_change_feed", lambda: feed)
+    srv = app.create_http_server(("127.0.0.1", 0), "threaded", 4)
+    thread = threading.Thread(target=srv.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield srv.server_address[1], feed
+    finally:
+        feed.close()
+        srv.shutdown()
+        srv.server_close()
+        thread.join()
+        app.close_db()
+        os.remove(path)
+
+
+def get(port, path):
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+    conn.request("GET", path)
+    resp = conn.getresponse()
+    data = json.loads(resp.read().decode())
+    conn.close()
+    return resp.status, data
+
+
+def receive(*texts, phone="5511999990001", instance="inst1"):
+    items = [{"instanceId": instance, "from": f"{phone}@s.whatsapp.net", "message": text,
+              "messageId": f"{phone}-{text}"} for text in texts]
+    return app.receive_message_batch(items)
+
+
+def test_since_returns_only_later_changes(server):
+    port, _ = server
+    receive("oi", "tudo bem?")
+    status, first = get(port, "/api/sync/messages?since=0")
+    assert status == 200
+    assert [m["message"] for m in first["items"]] == ["oi", "tudo bem?"]
+    assert first["has_more"] is False
+
+    receive("novidade")
+    status, second = get(port, f"/api/sync/messages?since={first['cursor']}")
+    assert [m["message"] for m in second["items"]] == ["novidade"]
+    assert second["cursor"] > first["cursor"]
+
+    # The chat summary changed three times but is listed once, as it is now
+    status, chats = get(port, "/api/sync/chats?since=0")
+    assert len(chats["items"]) == 1
+    assert chats["items"][0]["last_message"] == "novidade"
+    status, idle = get(port, f"/api/sync/chats?since={chats['cursor']}")
+    assert (idle["items"], idle["cursor"]) == ([], chats["cursor"])
+
+
+def test_filters_pages_and_deletes(server):
+    port, _ = server
+    receive("a", "b", "c", phone="5511999990001")
+    receive("x", phone="5511999990002", instance="inst2")
+
+    status, page = get(port, "/api/sync/messages?since=0&limit=2&instance_id=inst1")
+    assert page["has_more"] is True and len(page["items"]) == 2
+    status, rest = get(port, f"/api/sync/messages?since={page['cursor']}&limit=2&instance_id=inst1")
+    assert [m["message"] for m in rest["items"]] == ["c"]
+    assert rest["has_more"] is False
+
+    status, contacts = get(port, "/api/sync/contacts?since=0")
+    with app.get_db().write() as conn:
+        conn.execute("DELETE FROM contacts WHERE phone = '5511999990002'")
+    status, deleted = get(port, f"/api/sync/contacts?since={contacts['cursor']}")
+    assert deleted["items"] == []
+    assert deleted["deleted"] == ["5511999990002_inst2"]
+
+    assert get(port, "/api/sync/groups?since=0")[0] == 404
+    assert get(port, "/api/sync/messages?since=abc")[0] == 400
+
+
+def test_long_poll_wakes_up_on_commit(server):
+    port, feed = server
+    status, start = get(port, "/api/sync/messages?since=0")
+    results = {}
+
+    def poll():
+        started = time.monotonic()
+        results["page"] = get(port, f"/api/sync/messages?since={start['cursor']}&wait=10")[1]
+        results["elapsed"] = time.monotonic() - started
+
+    thread = threading.Thread(target=poll)
+    thread.start()
+    deadline = time.monotonic() + 5
+    while feed.waiting == 0 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert feed.waiting == 1
+    receive("chegou")
+    thread.join(10)
+
+    assert [m["message"] for m in results["page"]["items"]] == ["chegou"]
+    assert results["elapsed"] < 5
+    assert feed.waiting == 0
+
+
+def test_long_poll_times_out_without_queries(server, monkeypatch):
+    port, feed = server
+    calls = []
+    fetch = feed.fetch
+    monkeypatch.setattr(feed, "fetch", lambda *a, **kw: calls.append(1) or fetch(*a, **kw))
+    started = time.monotonic()
+    status, page = get(port, "/api/sync/chats?since=0&wait=1.5")
+    assert time.monotonic() - started >= 1.4
+    assert page["items"] == []
+    assert len(calls) == 1
+
+
+def test_event_stream_pushes_changes(server):
+    port, _ = server
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+    conn.request("GET", "/api/sync/stream?entities=messages,chats")
+    resp = conn.getresponse()
+    assert resp.status == 200
+    assert resp.getheader("Content-Type").startswith("text/event-stream")
+    assert resp.fp.readline() == b"retry: 5000\n"
+    resp.fp.readline()
+
+    receive("ao vivo")
+    lines = [resp.fp.readline().decode().strip() for _ in range(3)]
+    conn.close()
+
+    assert lines[0].startswith("id: ") and lines[1] == "event: changes"
+    event = json.loads(lines[2][len("data: "):])
+    assert event["cursor"] == int(lines[0][4:])
+    assert {(c["entity"], c["op"]) for c in event["changes"]} == {("messages", "upsert"), ("chats", "upsert")}
+
+
+def test_existing_rows_are_backfilled(tmp_path):
+    path = str(tmp_path / "old.db")
+    app.DB_FILE = path
+    app.init_db()
+    with app.get_db().write() as conn:
+        conn.execute("DROP TABLE changes")
+        for trigger in [row[0] for row in conn.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'trigger' AND name LIKE '%_changes_%'")]:
+            conn.execute(f"DROP TRIGGER {trigger}")
+        conn.execute("PRAGMA user_version = 7")
+        conn.execute("""INSERT INTO contacts (id, name, phone, instance_id, created_at)
+                        VALUES ('c1', 'Ana', '5511999990001', 'inst1', '2024-01-01T00:00:00+00:00')""")
+    app.close_db()
+    app.init_db()
+    try:
+        page = app.ChangeFeed().fetch(["contacts"])
+    finally:
+        app.close_db()
+    assert [(c["id"], c["data"]["name"]) for c in page["changes"]] == [("c1", "Ana")]
@@ -0,0 +1,249 @@
+import asyncio
+import http.client
+import importlib.util
+import json
+import os
+import pathlib
+import tempfile
+import threading
+import time
+
+import pytest
+
+spec = importlib.util.spec_from_file_location(
+    "app", pathlib.Path(__file__).resolve().parents[1] / "whatsflow-real.py"
+)
+app = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(app)
+
+
+class FakeClient:
+    """Minimal stand-in for a websockets connection."""
+
+    def __init__(self, expected=0, stall=False):
+        self.received = []
+        self.expected = expected
+        self.stall = stall
+        self.done = threading.Event()
+        self.close_code = None
+        self._closed = None
+
+    async def send(self, message):
+        if self.stall:
+            await asyncio.sleep(3600)
+        self.received.append(json.loads(message))
+        if len(self.received) >= self.expected:
+            self.done.set()
+
+    async def close(self, code=1000, reason=""):
+        self.close_code = code
+        self._get_closed().set()
+
+    async def wait_closed(self):
+        await self._get_closed().wait()
+
+    def _get_closed(self):
+        if self._closed is None:
+            self._closed = asyncio.Event()
+        return self._closed
+
+
+async def cancel_tasks():
+    tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    try:
+        yield loop
+    finally:
+        asyncio.run_coroutine_threadsafe(cancel_tasks(), loop).result(5)
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join(5)
+        loop.close()
+
+
+def connect(hub, loop, client):
+    before = hub.stats()["clients"]
+    asyncio.run_coroutine_threadsafe(hub.serve(client), loop)
+    deadline = time.monotonic() + 5
+    while hub.stats()["clients"] == before and time.monotonic() < deadline:
+        time.sleep(0.005)
+
+
+def test_publish_without_loop_is_a_no_op():
+    assert app.WebSocketHub().publish({"type": "x"}) is False
+
+
+def test_events_from_many_threads_reach_every_client(loop):
+    hub = app.WebSocketHub()
+    hub.attach(loop)
+    clients = [FakeClient(expected=40) for _ in range(3)]
+    for client in clients:
+        connect(hub, loop, client)
+
+    def publisher(n):
+        for i in range(10):
+            assert hub.publish({"type": "tick", "n": n, "i": i})
+
+    threads = [threading.Thread(target=publisher, args=(n,)) for n in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    for client in clients:
+        assert client.done.wait(5)
+        assert sorted((e["n"], e["i"]) for e in client.received) == [(n, i) for n in range(4) for i in range(10)]
+    assert hub.stats()["published"] == 40
+
+
+def test_slow_consumer_is_dropped_without_stalling_others(loop):
+    hub = app.WebSocketHub(queue_max=4, send_timeout=60)
+    hub.attach(loop)
+    fast = FakeClient(expected=20)
+    slow = FakeClient(stall=True)
+    connect(hub, loop, fast)
+    connect(hub, loop, slow)
+
+    for i in range(20):
+        hub.publish({"type": "tick", "i": i})
+        # Keep pace with the fast client; only the stalled one falls behind
+        deadline = time.monotonic() + 5
+        while len(fast.received) <= i and time.monotonic() < deadline:
+            time.sleep(0.001)
+
+    assert fast.done.wait(5)
+    assert [e["i"] for e in fast.received] == list(range(20))
+    deadline = time.monotonic() + 5
+    while hub.stats()["clients"] != 1 and time.monotonic() < deadline:
+        time.sleep(0.005)
+    assert slow.close_code == 1013
+    assert hub.stats()["slow_disconnects"] == 1
+
+
+def test_stalled_send_times_out(loop):
+    hub = app.WebSocketHub(send_timeout=0.05)
+    hub.attach(loop)
+    stalled = FakeClient(stall=True)
+    connect(hub, loop, stalled)
+    hub.publish({"type": "tick"})
+
+    deadline = time.monotonic() + 5
+    while hub.stats()["clients"] and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert hub.stats()["clients"] == 0
+    assert stalled.close_code == 1013
+
+
+def test_received_message_is_published_from_handler_thread(loop, monkeypatch):
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    app.DB_FILE = path
+    app.init_db()
+    hub = app.WebSocketHub()
+    hub.attach(loop)
+    monkeypatch.setattr(app, "get_ws_hub", lambda: hub)
+    client = FakeClient(expected=1)
+    connect(hub, loop, client)
+    srv = app.create_http_server(("127.0.0.1", 0), "threaded", 2)
+    thread = threading.Thread(target=srv.serve_forever, daemon=True)
+    thread.start()
+    try:
+        conn = http.client.HTTPConnection("127.0.0.1", srv.server_address[1], timeout=10)
+        conn.request("POST", "/api/messages/receive", json.dumps({
+            "instanceId": "inst1", "from": "5511999990001@s.whatsapp.net", "message": "oi",
+        }), {"Content-Type": "application/json"})
+        assert conn.getresponse().status == 200
+        conn.close()
+        assert client.done.wait(5)
+    finally:
+        srv.shutdown()
+        srv.server_close()
+        thread.join()
+        app.close_db()
+        os.remove(path)
+
+    event = client.received[0]
+    assert event["type"] == "new_message"
+    assert (event["message"]["phone"], event["message"]["instance_id"]) == ("5511999990001", "inst1")
+
+
+class SubscribingClient(FakeClient):
+    """Client that also sends requests to the hub."""
+
+    def __init__(self, loop, expected=0):
+        super().__init__(expected)
+        self.loop = loop
+        self.inbox = asyncio.Queue()
+
+    def say(self, request):
+        self.loop.call_soon_threadsafe(self.inbox.put_nowait, json.dumps(request))
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self.inbox.get()
+
+
+def wait_for(predicate):
+    deadline = time.monotonic() + 5
+    while not predicate() and time.monotonic() < deadline:
+        time.sleep(0.005)
+    return predicate()
+
+
+def test_events_are_routed_by_topic_and_serialized_once(loop, monkeypatch):
+    hub = app.WebSocketHub()
+    hub.attach(loop)
+    agents = [FakeClient() for _ in range(5)]
+    for agent in agents:
+        asyncio.run_coroutine_threadsafe(hub.serve(agent, ["instance:vendas"]), loop)
+    other = FakeClient()
+    everything = FakeClient()
+    asyncio.run_coroutine_threadsafe(hub.serve(other, ["instance:suporte"]), loop)
+    connect(hub, loop, everything)
+    assert wait_for(lambda: hub.stats()["clients"] == 7)
+
+    dumps = []
+    real_dumps = json.dumps
+    monkeypatch.setattr(app.json, "dumps", lambda *a, **kw: dumps.append(1) or real_dumps(*a, **kw))
+    hub.publish({"type": "new_message", "n": 1}, ["instance:vendas", "chat:5511"])
+    hub.publish({"type": "new_message", "n": 2}, ["instance:suporte"])
+    assert len(dumps) == 2
+
+    assert wait_for(lambda: len(everything.received) == 2)
+    assert wait_for(lambda: all(len(a.received) == 1 for a in agents))
+    assert [e["n"] for e in agents[0].received] == [1]
+    assert agents[0].received[0]["topics"] == ["instance:vendas", "chat:5511"]
+    assert [e["n"] for e in other.received] == [2]
+
+
+def test_clients_subscribe_and_unsubscribe_with_messages(loop):
+    hub = app.WebSocketHub()
+    hub.attach(loop)
+    client = SubscribingClient(loop)
+    connect(hub, loop, client)
+
+    client.say({"action": "subscribe", "topics": ["campaign:1", "connection"]})
+    assert wait_for(lambda: client.received and client.received[-1]["type"] == "subscriptions")
+    assert client.received[-1]["topics"] == ["campaign:1", "connection"]
+
+    hub.publish({"type": "campaign_progress", "campaign_id": "2"}, ["campaign:2"])
+    hub.publish({"type": "campaign_progress", "campaign_id": "1"}, ["campaign:1"])
+    assert wait_for(lambda: client.received[-1]["type"] == "campaign_progress")
+    assert [e.get("campaign_id") for e in client.received[1:]] == ["1"]
+
+    client.say({"action": "unsubscribe", "topics": ["campaign:1"]})
+    assert wait_for(lambda: client.received[-1]["topics"] == ["connection"])
+    hub.publish({"type": "campaign_progress", "campaign_id": "1"}, ["campaign:1"])
+    hub.publish({"type": "connection_status", "instance_id": "inst1"}, ["connection"])
+    assert wait_for(lambda: client.received[-1]["type"] == "connection_status")
+    assert hub.stats()["topics"] == 1
@@ -18,13 +18,32 @@ import sys
 import threading
 import time
 import signal
+import socket
+import struct
+import argparse
+import queue
+import heapq
+import itertools
+import random
+import math
+import hashlib
+import tempfile
+import types
+import re
+import unicodedata
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeout
 from http.server import HTTPServer, BaseHTTPRequestHandler
+import http.client
 import urllib.parse
 import logging
 from typing import Set, Dict, Any
 from zoneinfo import ZoneInfo
 from pathlib import Path
 import mimetypes
+import weakref
+import tracemalloc
+from contextlib import contextmanager
 
 import base64
 
@@ -46,22 +65,653 @@ BAILEYS_PORT = 3002
 # Brazil timezone
 BR_TZ = ZoneInfo("America/Sao_Paulo")
 BAILEYS_URL = os.getenv("BAILEYS_URL", f"http://127.0.0.1:{BAILEYS_PORT}")
+BAILEYS_TIMEOUT = 5  # seconds for status/qr/groups/connect calls
+BAILEYS_SEND_TIMEOUT = 10  # seconds for message sends
+BAILEYS_POOL_SIZE = 16  # idle keep-alive connections kept open
+BAILEYS_KEEPALIVE_IDLE = 4  # seconds; Node closes idle sockets after 5
+# Optional Unix socket shared with the Baileys service (same variable on both
+# sides). When set, sends and incoming batches use framed IPC with raw media
+# bytes instead of loopback HTTP with base64.
+IPC_SOCKET = os.getenv("WHATSFLOW_IPC_SOCKET", "")
+IPC_MAX_FRAME = 64 * 1024 * 1024
+IPC_RECONNECT_DELAY = 2  # seconds before retrying a socket that refused us
 WEBSOCKET_PORT = 8890
+WS_CLIENT_QUEUE_MAX = 256  # events buffered per client before it counts as slow
+WS_SEND_TIMEOUT = 5  # seconds one frame may take before the client is dropped
+
+# HTTP server concurrency: "threaded" uses a bounded worker pool, "single"
+# keeps the historical one-request-at-a-time HTTPServer.
+SERVER_MODE = os.getenv("WHATSFLOW_SERVER_MODE", "threaded")
+HTTP_MAX_WORKERS = int(os.getenv("WHATSFLOW_HTTP_WORKERS", "16"))
+
+# Incoming message ingestion: messages are committed in batches of up to
+# INGEST_BATCH_SIZE, or whatever arrived within INGEST_FLUSH_INTERVAL_MS
+INGEST_BATCH_SIZE = int(os.getenv("WHATSFLOW_INGEST_BATCH_SIZE", "200"))
+INGEST_FLUSH_INTERVAL_MS = int(os.getenv("WHATSFLOW_INGEST_FLUSH_MS", "25"))
+INGEST_QUEUE_MAX = int(os.getenv("WHATSFLOW_INGEST_QUEUE_MAX", "5000"))
+INGEST_ACK_TIMEOUT = 10  # seconds a request waits for its batch to commit
+
+# Campaign fan-out: sends run in parallel, at most FANOUT_MAX_WORKERS in
+# total and FANOUT_PER_INSTANCE at a time on any one WhatsApp instance
+FANOUT_MAX_WORKERS = int(os.getenv("WHATSFLOW_FANOUT_WORKERS", "32"))
+FANOUT_PER_INSTANCE = int(os.getenv("WHATSFLOW_FANOUT_PER_INSTANCE", "4"))
+
+# Outbound pacing per WhatsApp instance: messages per second and burst size.
+# WHATSFLOW_SEND_RATES overrides single instances, e.g. "vendas=2/10,suporte=0.5/3";
+# a rate of 0 turns pacing off
+SEND_RATE_PER_SECOND = float(os.getenv("WHATSFLOW_SEND_RATE", "1"))
+SEND_BURST = float(os.getenv("WHATSFLOW_SEND_BURST", "10"))
+SEND_RATES = os.getenv("WHATSFLOW_SEND_RATES", "")
+
+# Outbox of failed sends: retried with jittered exponential backoff
+# (OUTBOX_BASE_BACKOFF * 2^attempt, capped at OUTBOX_MAX_BACKOFF seconds)
+# until OUTBOX_MAX_ATTEMPTS, after which the row is marked dead
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("WHATSFLOW_OUTBOX_MAX_ATTEMPTS", "8"))
+OUTBOX_BASE_BACKOFF = float(os.getenv("WHATSFLOW_OUTBOX_BASE_BACKOFF", "2"))
+OUTBOX_MAX_BACKOFF = float(os.getenv("WHATSFLOW_OUTBOX_MAX_BACKOFF", "300"))
+OUTBOX_BATCH_SIZE = 50
+OUTBOX_POLL_INTERVAL = 1  # seconds between checks when nothing is due
+
+# Longest the scheduled dispatcher sleeps without re-checking the clock
+SCHEDULER_MAX_SLEEP = 300
+# Delay before retrying a scheduled message whose dispatch raised
+SCHEDULER_RETRY_DELAY = 60
+
+# Campaign media: uploads live in WHATSFLOW_MEDIA_DIR. With the default
+# "path" transfer, files there are sent to Baileys as a path reference and
+# Baileys streams them from disk; "inline" sends the bytes (use it when
+# Baileys runs on another host).
+MEDIA_DIR = os.getenv("WHATSFLOW_MEDIA_DIR", "uploads")
+MEDIA_TRANSFER = os.getenv("WHATSFLOW_MEDIA_TRANSFER", "path")
+MEDIA_CHUNK_SIZE = 256 * 1024  # bytes read per step when storing uploads
+MEDIA_GC_INTERVAL = 3600  # seconds between sweeps of unreferenced media
+MEDIA_GC_GRACE = 3600  # unreferenced media younger than this is kept
+
+# Delta sync (/api/sync/*): changes returned per page, and how long a
+# long-poll or event stream may wait for new ones. Waiting requests hold an
+# HTTP worker, so at most SYNC_MAX_WAITERS of them wait at once.
+SYNC_PAGE_SIZE = 500
+SYNC_PAGE_MAX = 1000
+SYNC_MAX_WAIT = 30  # seconds
+SYNC_KEEPALIVE = 15  # seconds between comments on an idle event stream
+SYNC_MAX_WAITERS = int(os.getenv("WHATSFLOW_SYNC_MAX_WAITERS", str(max(1, HTTP_MAX_WORKERS // 2))))
+
+# List routes return pages of LIST_PAGE_SIZE rows by default (up to
+# LIST_PAGE_MAX with ?limit=); ?all=1 still returns the whole list
+LIST_PAGE_SIZE = 100
+LIST_PAGE_MAX = 1000
+# Streamed responses (?all=1 and NDJSON) go out in pieces of this size,
+# read STREAM_PAGE_ROWS rows per read transaction
+STREAM_CHUNK_SIZE = 64 * 1024
+STREAM_PAGE_ROWS = 200
+
+# Flow runtime: incoming messages waiting for the flow worker, how long the
+# idle worker sleeps, and the most steps a single message may run (guards
+# against cycles without a condition)
+FLOW_QUEUE_MAX = int(os.getenv("WHATSFLOW_FLOW_QUEUE_MAX", "10000"))
+FLOW_TIMER_INTERVAL = 1.0  # seconds
+FLOW_MAX_STEPS = 100
+# Delay timers live in flow_timers; the ones due within FLOW_TIMER_HORIZON
+# are also kept in an in-memory timing wheel that advances every tick
+FLOW_TIMER_TICK = 0.05  # seconds
+FLOW_TIMER_HORIZON = 300  # seconds
+# Contacts' flow state kept in memory (LRU), and how long a session waiting
+# for a reply lives without activity before it is dropped
+FLOW_SESSION_CACHE_SIZE = int(os.getenv("WHATSFLOW_FLOW_SESSION_CACHE", "100000"))
+FLOW_SESSION_TTL = float(os.getenv("WHATSFLOW_FLOW_SESSION_TTL", str(7 * 24 * 3600)))  # seconds
+FLOW_SESSION_SWEEP_INTERVAL = 60  # seconds
+# Most messages one /api/flows/{id}/simulate request replays
+FLOW_SIMULATE_MAX = 10000
+
+# /api/chats/import writes this many chats per transaction
+IMPORT_CHUNK_SIZE = int(os.getenv("WHATSFLOW_IMPORT_CHUNK_SIZE", "1000"))
 
 # Path to React build for serving the frontend
 FRONTEND_BUILD_DIR = Path(__file__).resolve().parent / "frontend" / "build"
 
 
-def baileys_post(url: str, data: dict):
+class BaileysError(Exception):
+    """Raised when Baileys answers a call with an error status."""
+
+    def __init__(self, message: str, status: int | None = None, data=None):
+        super().__init__(message)
+        self.status = status
+        self.data = data
+
+
+class BaileysUnavailable(BaileysError):
+    """Raised when the Baileys service cannot be reached."""
+
+
+class MediaBlob:
+    """Media bytes read once and shared by every send of a run.
+
+    The base64 form needed by the HTTP transport is computed on first use
+    and cached, so a campaign to many groups encodes the file only once.
+    """
+
+    __slots__ = ("data", "mimetype", "_b64", "_lock")
+
+    def __init__(self, data: bytes, mimetype: str | None = None):
+        self.data = data
+        self.mimetype = mimetype
+        self._b64: bytes | None = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_file(cls, path: str, mimetype: str | None = None) -> "MediaBlob":
+        with open(path, "rb") as f:
+            return cls(f.read(), mimetype)
+
+    @property
+    def b64(self) -> bytes:
+        with self._lock:
+            if self._b64 is None:
+                self._b64 = base64.b64encode(self.data)
+            return self._b64
+
+    def __len__(self):
+        return len(self.data)
+
+
+def _json_bytes(value):
+    """JSON fallback that base64-encodes raw media for the HTTP transport."""
+    if isinstance(value, MediaBlob):
+        return value.b64.decode("ascii")
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return base64.b64encode(value).decode("ascii")
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def _json_body(payload) -> list[bytes]:
+    """Serialize a request body as a list of byte parts.
+
+    Top-level ``MediaBlob`` values are appended as their cached base64 bytes
+    instead of being copied into one large JSON string per request.
+    """
+    blobs = {}
+    if isinstance(payload, dict):
+        blobs = {k: v for k, v in payload.items() if isinstance(v, MediaBlob)}
+    if not blobs:
+        return [json.dumps(payload, default=_json_bytes).encode("utf-8")]
+    rest = {k: v for k, v in payload.items() if k not in blobs}
+    parts = [json.dumps(rest, default=_json_bytes).encode("utf-8")[:-1]]
+    separator = b"," if rest else b""
+    for key, blob in blobs.items():
+        parts += [separator + json.dumps(key).encode("utf-8") + b':"', blob.b64, b'"']
+        separator = b","
+    parts.append(b"}")
+    return parts
+
+
+class BaileysClient:
+    """HTTP client for the Baileys service with a pool of keep-alive connections.
+
+    Connections are taken from an idle pool and returned after each
+    response is read, so sends reuse the TCP connection instead of opening a
+    new one per call. A reused connection that the server already closed is
+    retried once on a fresh one. Only the standard library is used.
+    """
+
+    def __init__(self, base_url: str = BAILEYS_URL, timeout: float = BAILEYS_TIMEOUT,
+                 pool_size: int = BAILEYS_POOL_SIZE):
+        parts = urllib.parse.urlsplit(base_url)
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self._https = parts.scheme == "https"
+        self._host = parts.hostname or "127.0.0.1"
+        self._port = parts.port or (443 if self._https else 80)
+        self._prefix = parts.path.rstrip("/")
+        self._idle: queue.LifoQueue = queue.LifoQueue(maxsize=pool_size)
+
+    def _new_connection(self) -> http.client.HTTPConnection:
+        cls = http.client.HTTPSConnection if self._https else http.client.HTTPConnection
+        return cls(self._host, self._port, timeout=self.timeout)
+
+    def _acquire(self):
+        while True:
+            try:
+                conn, last_used = self._idle.get_nowait()
+            except queue.Empty:
+                return self._new_connection(), False
+            if time.monotonic() - last_used < BAILEYS_KEEPALIVE_IDLE:
+                return conn, True
+            conn.close()
+
+    def _release(self, conn):
+        try:
+            self._idle.put_nowait((conn, time.monotonic()))
+        except queue.Full:
+            conn.close()
+
+    def request(self, method: str, path: str, payload=None, timeout: float | None = None):
+        """Send a request and return ``(status, decoded JSON body)``."""
+        if path.startswith(self.base_url):
+            path = path[len(self.base_url):]
+        body = None
+        headers = {"Connection": "keep-alive"}
+        if payload is not None or method == "POST":
+            parts = _json_body(payload if payload is not None else {})
+            body = parts[0] if len(parts) == 1 else parts
+            headers["Content-Type"] = "application/json"
+            headers["Content-Length"] = str(sum(len(part) for part in parts))
+
+        while True:
+            conn, reused = self._acquire()
+            try:
+                conn.timeout = timeout or self.timeout
+                if conn.sock is not None:
+                    conn.sock.settimeout(conn.timeout)
+                conn.request(method, self._prefix + path, body=body, headers=headers)
+                response = conn.getresponse()
+                raw = response.read()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError) as e:
+                conn.close()
+                if reused:
+                    continue  # keep-alive connection closed by the server meanwhile
+                raise BaileysUnavailable(f"Serviço Baileys indisponível em {self.base_url}: {e}") from e
+            except (OSError, http.client.HTTPException) as e:
+                conn.close()
+                raise BaileysUnavailable(f"Serviço Baileys indisponível em {self.base_url}: {e}") from e
+
+            if response.will_close:
+                conn.close()
+            else:
+                self._release(conn)
+            try:
+                data = json.loads(raw.decode("utf-8")) if raw else {}
+            except ValueError:
+                data = {"raw": raw.decode("utf-8", "replace")}
+            return response.status, data
+
+    def _call(self, method: str, path: str, payload=None, timeout: float | None = None):
+        status, data = self.request(method, path, payload, timeout)
+        if not 200 <= status < 300:
+            detail = data.get("error") if isinstance(data, dict) else None
+            raise BaileysError(f"Baileys respondeu HTTP {status}: {detail or data}", status, data)
+        return data
+
+    @staticmethod
+    def _instance_path(action: str, instance_id: str | None) -> str:
+        return f"/{action}/{instance_id}" if instance_id else f"/{action}"
+
+    def send(self, instance_id: str, payload: dict) -> dict:
+        return self._call("POST", f"/send/{instance_id}", payload, timeout=BAILEYS_SEND_TIMEOUT)
+
+    def status(self, instance_id: str | None = None) -> dict:
+        return self._call("GET", self._instance_path("status", instance_id))
+
+    def qr(self, instance_id: str | None = None) -> dict:
+        return self._call("GET", self._instance_path("qr", instance_id))
+
+    def groups(self, instance_id: str):
+        return self._call("GET", f"/groups/{instance_id}")
+
+    def connect(self, instance_id: str | None = None) -> dict:
+        return self._call("POST", self._instance_path("connect", instance_id))
+
+    def disconnect(self, instance_id: str) -> dict:
+        return self._call("POST", f"/disconnect/{instance_id}")
+
+    def close(self):
+        while True:
+            try:
+                conn, _ = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            conn.close()
+
+
+# IPC frames: uint32 header length + uint32 body length (big endian), a JSON
+# header ({id, type, method, path, payload, status, bodyField}) and the raw
+# body. The same layout is parsed by baileys_service/server.js.
+_FRAME_PREFIX = struct.Struct(">II")
+
+
+def write_frame(sock: socket.socket, header: dict, body: bytes = b""):
+    """Write one frame; callers serialize writes on a shared socket."""
+    head = json.dumps(header, separators=(",", ":")).encode("utf-8")
+    sock.sendall(_FRAME_PREFIX.pack(len(head), len(body)) + head)
+    if body:
+        sock.sendall(body)
+
+
+def read_frame(stream) -> tuple[dict, bytes] | None:
+    """Read one frame from a binary file object, or None at a clean EOF."""
+    prefix = stream.read(_FRAME_PREFIX.size)
+    if not prefix:
+        return None
+    if len(prefix) < _FRAME_PREFIX.size:
+        raise ConnectionError("Frame IPC truncado")
+    head_len, body_len = _FRAME_PREFIX.unpack(prefix)
+    if head_len + body_len > IPC_MAX_FRAME:
+        raise ConnectionError(f"Frame IPC grande demais: {head_len + body_len} bytes")
+    head = stream.read(head_len)
+    body = stream.read(body_len) if body_len else b""
+    if len(head) < head_len or len(body) < body_len:
+        raise ConnectionError("Frame IPC truncado")
+    return json.loads(head.decode("utf-8")), body
+
+
+def _split_binary(payload):
+    """Return ``(payload without media, media field, media bytes)``."""
+    if isinstance(payload, dict):
+        for key, value in payload.items():
+            if isinstance(value, MediaBlob):
+                value = value.data
+            if isinstance(value, (bytes, bytearray, memoryview)):
+                rest = {k: v for k, v in payload.items() if k != key}
+                return rest, key, value
+    return payload, None, b""
+
+
+def handle_ipc_request(method: str, path: str, payload, body: bytes = b""):
+    """Serve a request the Baileys service pushed over the IPC socket."""
+    if method == "POST" and path == "/api/messages/receive/batch":
+        items = payload.get("messages") if isinstance(payload, dict) else payload
+        if not isinstance(items, list):
+            return 400, {"error": "Envie uma lista de mensagens"}
+        return 200, receive_message_batch(items)
+    return 404, {"error": f"Rota IPC não encontrada: {method} {path}"}
+
+
+class BaileysIPCClient(BaileysClient):
+    """Baileys client that multiplexes sends over a local Unix socket.
+
+    Every frame carries an ``id`` and a ``type`` (request or response), so
+    many sends can be in flight on one connection while Node pushes incoming
+    message batches the other way. Media goes as the raw frame body. Only
+    ``/send`` uses the socket; control calls, and sends made while the
+    socket is unreachable, fall back to HTTP.
+    """
+
+    IPC_PATHS = ("/send/",)
+
+    def __init__(self, socket_path: str, base_url: str = BAILEYS_URL, timeout: float = BAILEYS_TIMEOUT,
+                 pool_size: int = BAILEYS_POOL_SIZE, handler=None):
+        super().__init__(base_url, timeout, pool_size)
+        self.socket_path = socket_path
+        self.handler = handler or handle_ipc_request
+        self._sock: socket.socket | None = None
+        self._lock = threading.Lock()  # connection state and pending map
+        self._write_lock = threading.Lock()
+        self._pending: dict[int, Future] = {}
+        self._ids = itertools.count(1)
+        self._retry_at = 0.0
+        self._executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="baileys-ipc")
+
+    @property
+    def connected(self) -> bool:
+        return self._sock is not None
+
+    def _connect(self) -> socket.socket | None:
+        """Open the socket if needed; caller holds ``self._lock``."""
+        if self._sock is not None:
+            return self._sock
+        if time.monotonic() < self._retry_at:
+            return None
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.socket_path)
+        except OSError:
+            sock.close()
+            self._retry_at = time.monotonic() + IPC_RECONNECT_DELAY
+            return None
+        self._sock = sock
+        threading.Thread(target=self._read_loop, args=(sock,), daemon=True, name="baileys-ipc-reader").start()
+        print(f"🔌 IPC com Baileys conectado em {self.socket_path}")
+        return sock
+
+    def _drop(self, sock: socket.socket, reason: str):
+        with self._lock:
+            if self._sock is not sock:
+                return
+            self._sock = None
+            pending, self._pending = self._pending, {}
+        try:
+            sock.shutdown(socket.SHUT_RDWR)  # also wakes the reader thread
+        except OSError:
+            pass
+        sock.close()
+        for future in pending.values():
+            future.set_exception(BaileysUnavailable(f"IPC com Baileys encerrado: {reason}"))
+
+    def _write(self, sock: socket.socket, header: dict, body: bytes = b""):
+        with self._write_lock:
+            write_frame(sock, header, body)
+
+    def _read_loop(self, sock: socket.socket):
+        reason = "conexão fechada"
+        stream = sock.makefile("rb")
+        try:
+            while True:
+                frame = read_frame(stream)
+                if frame is None:
+                    break
+                header, body = frame
+                if header.get("type") == "response":
+                    with self._lock:
+                        future = self._pending.pop(header.get("id"), None)
+                    if future is not None:
+                        future.set_result(header)
+                else:
+                    self._executor.submit(self._serve, sock, header, body)
+        except (OSError, ValueError) as e:
+            reason = str(e)
+        finally:
+            stream.close()
+            self._drop(sock, reason)
+
+    def _serve(self, sock: socket.socket, header: dict, body: bytes):
+        try:
+            status, payload = self.handler(header.get("method"), header.get("path"), header.get("payload"), body)
+        except Exception as e:
+            logger.error(f"IPC request failed: {e}")
+            status, payload = 500, {"error": str(e)}
+        try:
+            self._write(sock, {"id": header.get("id"), "type": "response", "status": status, "payload": payload})
+        except OSError as e:
+            self._drop(sock, str(e))
+
+    def request(self, method: str, path: str, payload=None, timeout: float | None = None):
+        if path.startswith(self.base_url):
+            path = path[len(self.base_url):]
+        if not path.startswith(self.IPC_PATHS):
+            return super().request(method, path, payload, timeout)
+        with self._lock:
+            sock = self._connect()
+            if sock is not None:
+                request_id = next(self._ids)
+                future = Future()
+                self._pending[request_id] = future
+        if sock is None:
+            return super().request(method, path, payload, timeout)
+
+        fields, body_field, body = _split_binary(payload)
+        header = {"id": request_id, "type": "request", "method": method, "path": path, "payload": fields}
+        if body_field:
+            header["bodyField"] = body_field
+        try:
+            self._write(sock, header, body)
+            reply = future.result(timeout or self.timeout)
+        except OSError as e:
+            self._drop(sock, str(e))
+            raise BaileysUnavailable(f"IPC com Baileys indisponível: {e}") from e
+        except FutureTimeout:
+            with self._lock:
+                self._pending.pop(request_id, None)
+            raise BaileysUnavailable(f"Baileys não respondeu via IPC em {timeout or self.timeout}s")
+        return reply.get("status", 200), reply.get("payload") or {}
+
+    def close(self):
+        with self._lock:
+            sock = self._sock
+        if sock is not None:
+            self._drop(sock, "cliente fechado")
+        self._executor.shutdown(wait=False)
+        super().close()
+
+
+_baileys_client: BaileysClient | None = None
+_baileys_client_lock = threading.Lock()
+
+
+def get_baileys_client() -> BaileysClient:
+    """Shared client for the current BAILEYS_URL (and IPC_SOCKET, if set)."""
+    global _baileys_client
+    with _baileys_client_lock:
+        current = _baileys_client
+        if (current is None or current.base_url != BAILEYS_URL.rstrip("/")
+                or getattr(current, "socket_path", "") != IPC_SOCKET):
+            if current is not None:
+                current.close()
+            if IPC_SOCKET:
+                _baileys_client = BaileysIPCClient(IPC_SOCKET, BAILEYS_URL)
+            else:
+                _baileys_client = BaileysClient(BAILEYS_URL)
+        return _baileys_client
+
+
+def baileys_post(url: str, data: dict) -> bool:
     """Wrapper to send data to Baileys service.
 
-    Separated for easier monkeypatching during tests.
+    Separated for easier monkeypatching during tests. Returns True when
+    Baileys answered with a 2xx status and raises BaileysError otherwise.
     """
-    try:
-        import requests
-        requests.post(url, json=data, timeout=10)
-    except Exception as e:
-        logger.error(f"Baileys POST failed: {e}")
+    get_baileys_client()._call("POST", url, data, timeout=BAILEYS_SEND_TIMEOUT)
+    return True
+
+
+def _parse_send_rates(spec: str) -> dict[str, tuple[float, float]]:
+    """Parse ``"inst1=2/10,inst2=0.5/3"`` into ``{instance: (rate, burst)}``."""
+    rates = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        instance_id, _, value = item.partition("=")
+        rate, _, burst = value.partition("/")
+        rates[instance_id.strip()] = (float(rate), float(burst or rate))
+    return rates
+
+
+class TokenBucket:
+    """Token bucket refilled at ``rate`` tokens per second, holding up to ``burst``.
+
+    ``acquire`` reserves a token even when the bucket is empty (the balance
+    goes negative) and sleeps until that token is due, so callers are served
+    in arrival order without holding the lock while they wait. A ``rate``
+    of 0 or less leaves the sends unpaced.
+    """
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = float(rate)
+        self.burst = max(1.0, float(burst))
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """Take a token and return how many seconds to wait before using it."""
+        if self.rate <= 0:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.rate
+
+    def acquire(self) -> float:
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+class InstanceRateLimiter:
+    """One token bucket per WhatsApp instance for every outbound send.
+
+    Instances without an entry in ``rates`` get ``default_rate`` messages per
+    second with bursts of ``default_burst``. ``stats()`` reports how long
+    sends waited for a token, to tune the rates.
+    """
+
+    def __init__(self, default_rate: float, default_burst: float, rates: dict[str, tuple[float, float]] | None = None):
+        self.default_rate = default_rate
+        self.default_burst = default_burst
+        self._rates = dict(rates or {})
+        self._buckets: dict[str, TokenBucket] = {}
+        self._stats: dict[str, dict] = {}
+        self._lock = threading.Lock()
+
+    def configure(self, instance_id: str, rate: float, burst: float):
+        with self._lock:
+            self._rates[instance_id] = (rate, burst)
+            self._buckets.pop(instance_id, None)
+
+    def _bucket(self, instance_id: str) -> TokenBucket:
+        with self._lock:
+            bucket = self._buckets.get(instance_id)
+            if bucket is None:
+                rate, burst = self._rates.get(instance_id, (self.default_rate, self.default_burst))
+                bucket = self._buckets[instance_id] = TokenBucket(rate, burst)
+                self._stats[instance_id] = {
+                    "sends": 0, "waiting": 0, "total_wait": 0.0, "max_wait": 0.0, "last_wait": 0.0,
+                }
+            return bucket
+
+    def acquire(self, instance_id: str) -> float:
+        """Block until *instance_id* may send; returns the seconds waited."""
+        bucket = self._bucket(instance_id)
+        wait = bucket.reserve()
+        stats = self._stats[instance_id]
+        if wait > 0:
+            with self._lock:
+                stats["waiting"] += 1
+            try:
+                time.sleep(wait)
+            finally:
+                with self._lock:
+                    stats["waiting"] -= 1
+        with self._lock:
+            stats["sends"] += 1
+            stats["total_wait"] += wait
+            stats["max_wait"] = max(stats["max_wait"], wait)
+            stats["last_wait"] = wait
+        return wait
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                instance_id: {
+                    "rate_per_second": self._buckets[instance_id].rate,
+                    "burst": self._buckets[instance_id].burst,
+                    "sends": st["sends"],
+                    "waiting": st["waiting"],
+                    "avg_wait_ms": round(st["total_wait"] * 1000 / st["sends"], 3) if st["sends"] else 0.0,
+                    "max_wait_ms": round(st["max_wait"] * 1000, 3),
+                    "last_wait_ms": round(st["last_wait"] * 1000, 3),
+                }
+                for instance_id, st in self._stats.items()
+            }
+
+
+_rate_limiter: InstanceRateLimiter | None = None
+_rate_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter() -> InstanceRateLimiter:
+    global _rate_limiter
+    with _rate_limiter_lock:
+        if _rate_limiter is None:
+            _rate_limiter = InstanceRateLimiter(SEND_RATE_PER_SECOND, SEND_BURST, _parse_send_rates(SEND_RATES))
+        return _rate_limiter
+
+
+def baileys_send_message(instance_id: str, data: dict) -> bool:
+    """Send a message through Baileys, paced by the instance's rate limit."""
+    get_rate_limiter().acquire(instance_id)
+    return baileys_post(f"{BAILEYS_URL}/send/{instance_id}", data)
 # codex/redesign-grupos-tab-with-campaign-button-1n5c7l
 def compute_next_run(schedule_type: str, weekday: int, time_str: str) -> datetime:
     """Compute next datetime for a campaign message based on schedule."""
@@ -105,10 +755,6 @@ def calculate_next_run(recurrence: str, send_time: str, weekday: int | None, tim
 
     return scheduled.astimezone(timezone.utc)
 
-# WebSocket clients management
-if WEBSOCKETS_AVAILABLE:
-    websocket_clients: Set[websockets.WebSocketServerProtocol] = set()
-
 # codex/redesign-grupos-tab-with-campaign-button-1n5c7l
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -116,6 +762,161 @@ logger = logging.getLogger(__name__)
 
 
 
+# Tuning applied to every pooled connection (journal_mode=WAL is persistent
+# and only needs to be set once, in init_db)
+DB_PRAGMAS = (
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA cache_size = 1000",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA mmap_size = 268435456",  # 256MB
+    "PRAGMA busy_timeout = 5000",
+)
+DB_STATEMENT_CACHE_SIZE = 256
+# The writer fsyncs every commit so an acknowledged write survives power
+# loss; ingestion batches messages to keep the number of commits low
+DB_WRITER_SYNCHRONOUS = "FULL"
+
+
+class DatabaseManager:
+    """Long-lived SQLite connections with the tuning PRAGMAs already applied.
+
+    Each thread gets its own read-only connection, so under WAL readers never
+    wait for the writer. All writes go through a single shared connection
+    guarded by a lock; ``write()`` wraps the block in ``BEGIN IMMEDIATE`` and
+    commits (or rolls back) on exit. Both paths keep a prepared-statement
+    cache of ``DB_STATEMENT_CACHE_SIZE`` entries.
+
+    Every commit bumps ``commit_count``, so readers can sleep in
+    ``wait_for_commit`` instead of polling the database.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        self._write_lock = threading.RLock()
+        self._writer = None
+        # (owner thread, connection) pairs, so readers of finished threads
+        # can be closed instead of leaking
+        self._connections: list[tuple[weakref.ref, sqlite3.Connection]] = []
+        self._connections_lock = threading.Lock()
+        self._commits = threading.Condition()
+        self.commit_count = 0
+
+    def _open(self, *, readonly: bool) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            self.path,
+            timeout=5,
+            isolation_level=None,
+            check_same_thread=False,
+            cached_statements=DB_STATEMENT_CACHE_SIZE,
+        )
+        conn.row_factory = sqlite3.Row
+        for pragma in DB_PRAGMAS:
+            conn.execute(pragma)
+        if readonly:
+            conn.execute("PRAGMA query_only = 1")
+        else:
+            conn.execute(f"PRAGMA synchronous = {DB_WRITER_SYNCHRONOUS}")
+        with self._connections_lock:
+            alive = []
+            for owner, other in self._connections:
+                thread = owner()
+                if thread is None or not thread.is_alive():
+                    other.close()
+                else:
+                    alive.append((owner, other))
+            alive.append((weakref.ref(threading.current_thread()), conn))
+            self._connections = alive
+        return conn
+
+    @contextmanager
+    def read(self):
+        """Yield this thread's read-only connection."""
+        conn = getattr(self._local, "reader", None)
+        if conn is None:
+            conn = self._local.reader = self._open(readonly=True)
+        yield conn
+
+    @contextmanager
+    def write(self):
+        """Yield the writer connection inside a transaction.
+
+        Nested ``write()`` blocks on the same thread join the outer
+        transaction.
+        """
+        with self._write_lock:
+            if self._writer is None:
+                self._writer = self._open(readonly=False)
+                # The writer outlives whichever thread happened to open it
+                with self._connections_lock:
+                    self._connections = [c for c in self._connections if c[1] is not self._writer]
+            conn = self._writer
+            if conn.in_transaction:
+                yield conn
+                return
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.rollback()
+                raise
+            else:
+                conn.commit()
+                with self._commits:
+                    self.commit_count += 1
+                    self._commits.notify_all()
+
+    def wait_for_commit(self, seen: int, timeout: float | None = None) -> int:
+        """Block until ``commit_count`` moves past *seen*, or *timeout*.
+
+        Returns the current count either way.
+        """
+        with self._commits:
+            self._commits.wait_for(lambda: self.commit_count != seen, timeout)
+            return self.commit_count
+
+    def close(self):
+        with self._write_lock, self._connections_lock:
+            connections = [conn for _, conn in self._connections]
+            if self._writer is not None:
+                connections.append(self._writer)
+            for conn in connections:
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+            self._connections = []
+            self._writer = None
+            self._local = threading.local()
+
+
+_db_manager: DatabaseManager | None = None
+_db_manager_lock = threading.Lock()
+
+
+def get_db() -> DatabaseManager:
+    """Return the connection manager for the current ``DB_FILE``."""
+    global _db_manager
+    manager = _db_manager
+    if manager is None or manager.path != DB_FILE:
+        with _db_manager_lock:
+            if _db_manager is None or _db_manager.path != DB_FILE:
+                if _db_manager is not None:
+                    _db_manager.close()
+                _db_manager = DatabaseManager(DB_FILE)
+            manager = _db_manager
+    return manager
+
+
+def close_db():
+    """Close every pooled connection (they are reopened on demand)."""
+    global _db_manager
+    with _db_manager_lock:
+        if _db_manager is not None:
+            _db_manager.close()
+            _db_manager = None
+
+
 # Database setup (same as before but with WebSocket integration)
 def init_db():
     """Initialize SQLite database with WAL mode for better concurrency"""
@@ -248,194 +1049,3283 @@ def init_db():
 
 
     conn.commit()
+    apply_migrations(conn)
     conn.close()
+    # Drop pooled connections that may point at a previous database file
+    close_db()
     print("✅ Banco de dados inicializado com suporte WebSocket")
 
 
-# Campaign scheduler
-def campaign_scheduler_loop():
-    while True:
-        try:
-            now = datetime.now(BR_TZ).isoformat()
-            conn = sqlite3.connect(DB_FILE)
-            cursor = conn.cursor()
-            cursor.execute(
-                "SELECT id, campaign_id, message, media_type, media_path, schedule_type, weekday, send_time FROM campaign_messages WHERE next_run <= ?",
-                (now,)
+def _media_ref_triggers(table: str) -> list[str]:
+    """Triggers keeping ``media_blobs.refcount`` in step with *table*."""
+    now = "strftime('%Y-%m-%dT%H:%M:%S+00:00', 'now')"
+    add = "UPDATE media_blobs SET refcount = refcount + 1, last_used_at = {now} WHERE path = NEW.media_path;"
+    drop = "UPDATE media_blobs SET refcount = refcount - 1, last_used_at = {now} WHERE path = OLD.media_path;"
+    add, drop = add.format(now=now), drop.format(now=now)
+    return [
+        f"""
+        CREATE TRIGGER IF NOT EXISTS trg_{table}_media_insert AFTER INSERT ON {table}
+        WHEN NEW.media_path IS NOT NULL BEGIN {add} END
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS trg_{table}_media_delete AFTER DELETE ON {table}
+        WHEN OLD.media_path IS NOT NULL BEGIN {drop} END
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS trg_{table}_media_update AFTER UPDATE OF media_path ON {table}
+        WHEN OLD.media_path IS NOT NEW.media_path BEGIN {drop} {add} END
+        """,
+    ]
+
+
+# Entities served by /api/sync: name -> (table, phone column)
+SYNC_ENTITIES = {
+    "chats": ("chats", "contact_phone"),
+    "messages": ("messages", "phone"),
+    "contacts": ("contacts", "phone"),
+}
+
+
+def _change_log_triggers(entity: str) -> list[str]:
+    """Triggers recording every write to *entity*'s table in ``changes``.
+
+    Each row keeps a single entry, the latest: the previous one is deleted
+    and a new one appended with a higher ``seq``, so the log grows with the
+    number of rows (plus deletions), not with the number of writes.
+    """
+    table, phone = SYNC_ENTITIES[entity]
+    now = "strftime('%Y-%m-%dT%H:%M:%S+00:00', 'now')"
+    steps = []
+    for event, row, op in (("INSERT", "NEW", "upsert"), ("UPDATE", "NEW", "upsert"), ("DELETE", "OLD", "delete")):
+        steps.append(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_{table}_changes_{event.lower()} AFTER {event} ON {table} BEGIN
+            DELETE FROM changes WHERE entity = '{entity}' AND entity_id = {row}.id;
+            INSERT INTO changes (entity, entity_id, instance_id, phone, op, changed_at)
+            VALUES ('{entity}', {row}.id, {row}.instance_id, {row}.{phone}, '{op}', {now});
+        END
+        """)
+    return steps
+
+
+def _add_flow_session_variables(conn: sqlite3.Connection):
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(flow_sessions)")]
+    if "variables" not in columns:
+        conn.execute("ALTER TABLE flow_sessions ADD COLUMN variables TEXT")
+
+
+def _backfill_change_log(conn: sqlite3.Connection):
+    """Log the rows that existed before ``changes``, oldest first."""
+    for entity, (table, phone) in SYNC_ENTITIES.items():
+        conn.execute(f"""
+            INSERT INTO changes (entity, entity_id, instance_id, phone, op, changed_at)
+            SELECT '{entity}', id, instance_id, {phone}, 'upsert', created_at
+            FROM {table} WHERE true ORDER BY created_at, rowid
+            ON CONFLICT(entity, entity_id) DO NOTHING
+        """)
+
+
+# Versioned schema changes applied by init_db on top of the base tables.
+# The current version is stored in PRAGMA user_version; each step is either
+# an SQL statement or a callable receiving the connection.
+SCHEMA_MIGRATIONS = [
+    (1, "índices das consultas de mensagens, contatos e agendamentos", [
+        "CREATE INDEX IF NOT EXISTS idx_messages_phone_instance_created ON messages (phone, instance_id, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_messages_phone_created ON messages (phone, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_messages_created ON messages (created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_contacts_phone_instance ON contacts (phone, instance_id, id)",
+        "CREATE INDEX IF NOT EXISTS idx_chats_phone_instance ON chats (contact_phone, instance_id, id)",
+        "CREATE INDEX IF NOT EXISTS idx_scheduled_messages_status_next_run ON scheduled_messages (status, next_run)",
+        "CREATE INDEX IF NOT EXISTS idx_campaign_messages_next_run ON campaign_messages (next_run)",
+        "CREATE INDEX IF NOT EXISTS idx_campaign_groups_campaign ON campaign_groups (campaign_id, instance_id, group_id)",
+    ]),
+    (2, "chats como resumo materializado (um por telefone e instância)", [
+        # Keep the most recent row of each conversation before enforcing uniqueness
+        """
+        DELETE FROM chats WHERE rowid NOT IN (
+            SELECT rowid FROM (
+                SELECT rowid, ROW_NUMBER() OVER (
+                    PARTITION BY contact_phone, instance_id
+                    ORDER BY last_message_time DESC, rowid DESC
+                ) AS rn FROM chats
+            ) WHERE rn = 1
+        )
+        """,
+        "DROP INDEX IF EXISTS idx_chats_phone_instance",
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_chats_contact_instance ON chats (contact_phone, instance_id)",
+        "CREATE INDEX IF NOT EXISTS idx_chats_last_message_time ON chats (last_message_time)",
+    ]),
+    (3, "mensagens únicas por instância e whatsapp_id", [
+        # Retries and reconnect replays stored the same WhatsApp message more than once
+        """
+        DELETE FROM messages WHERE whatsapp_id IS NOT NULL AND rowid NOT IN (
+            SELECT MIN(rowid) FROM messages
+            WHERE whatsapp_id IS NOT NULL
+            GROUP BY instance_id, whatsapp_id
+        )
+        """,
+        """
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_instance_whatsapp
+        ON messages (instance_id, whatsapp_id) WHERE whatsapp_id IS NOT NULL
+        """,
+    ]),
+    (4, "contatos únicos por telefone e instância", [
+        # Keep the most recently written row of each contact
+        """
+        DELETE FROM contacts WHERE rowid NOT IN (
+            SELECT MAX(rowid) FROM contacts GROUP BY phone, instance_id
+        )
+        """,
+        "DROP INDEX IF EXISTS idx_contacts_phone_instance",
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_contacts_phone_instance_unique ON contacts (phone, instance_id)",
+    ]),
+    (5, "resultado de envio por grupo (deliveries)", [
+        """
+        CREATE TABLE IF NOT EXISTS deliveries (
+            id TEXT PRIMARY KEY,
+            source TEXT NOT NULL,
+            source_id TEXT NOT NULL,
+            campaign_id TEXT,
+            instance_id TEXT,
+            group_id TEXT,
+            status TEXT NOT NULL,
+            error TEXT,
+            duration_ms REAL,
+            created_at TEXT
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_deliveries_campaign_created ON deliveries (campaign_id, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_deliveries_source ON deliveries (source, source_id)",
+    ]),
+    (6, "outbox de envios com nova tentativa", [
+        """
+        CREATE TABLE IF NOT EXISTS outbox (
+            id TEXT PRIMARY KEY,
+            delivery_id TEXT,
+            instance_id TEXT NOT NULL,
+            recipient TEXT NOT NULL,
+            content TEXT,
+            media_type TEXT,
+            media_path TEXT,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at TEXT NOT NULL,
+            last_error TEXT,
+            created_at TEXT,
+            updated_at TEXT
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_outbox_status_next_attempt ON outbox (status, next_attempt_at)",
+    ]),
+    (7, "armazenamento de mídia por conteúdo (media_blobs)", [
+        """
+        CREATE TABLE IF NOT EXISTS media_blobs (
+            sha256 TEXT PRIMARY KEY,
+            path TEXT NOT NULL UNIQUE,
+            size INTEGER NOT NULL,
+            mimetype TEXT,
+            media_type TEXT,
+            refcount INTEGER NOT NULL DEFAULT 0,
+            created_at TEXT,
+            last_used_at TEXT
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_media_blobs_refcount ON media_blobs (refcount, last_used_at)",
+        *_media_ref_triggers("campaign_messages"),
+        *_media_ref_triggers("scheduled_messages"),
+    ]),
+    (8, "registro de alterações para sincronização incremental (changes)", [
+        """
+        CREATE TABLE IF NOT EXISTS changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            entity TEXT NOT NULL,
+            entity_id TEXT NOT NULL,
+            instance_id TEXT,
+            phone TEXT,
+            op TEXT NOT NULL,
+            changed_at TEXT
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_changes_entity_seq ON changes (entity, seq)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_changes_entity_id ON changes (entity, entity_id)",
+        _backfill_change_log,
+        *(trigger for entity in SYNC_ENTITIES for trigger in _change_log_triggers(entity)),
+    ]),
+    (9, "estado dos fluxos por contato (flow_sessions) e etiquetas (contact_tags)", [
+        """
+        CREATE TABLE IF NOT EXISTS flow_sessions (
+            instance_id TEXT NOT NULL,
+            phone TEXT NOT NULL,
+            flow_id TEXT NOT NULL,
+            node_id TEXT NOT NULL,
+            resume_at TEXT,
+            started_at TEXT,
+            updated_at TEXT,
+            PRIMARY KEY (instance_id, phone)
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_flow_sessions_resume ON flow_sessions (resume_at) WHERE resume_at IS NOT NULL",
+        "CREATE INDEX IF NOT EXISTS idx_flow_sessions_flow ON flow_sessions (flow_id)",
+        """
+        CREATE TABLE IF NOT EXISTS contact_tags (
+            instance_id TEXT NOT NULL,
+            phone TEXT NOT NULL,
+            tag TEXT NOT NULL,
+            created_at TEXT,
+            PRIMARY KEY (instance_id, phone, tag)
+        )
+        """,
+    ]),
+    (10, "temporizadores persistentes dos atrasos de fluxo (flow_timers)", [
+        """
+        CREATE TABLE IF NOT EXISTS flow_timers (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            instance_id TEXT NOT NULL,
+            phone TEXT NOT NULL,
+            flow_id TEXT NOT NULL,
+            node_id TEXT NOT NULL,
+            fire_at TEXT NOT NULL,
+            created_at TEXT
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_flow_timers_fire_at ON flow_timers (fire_at)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_flow_timers_contact ON flow_timers (instance_id, phone)",
+        "CREATE INDEX IF NOT EXISTS idx_flow_timers_flow ON flow_timers (flow_id)",
+        # Sessions paused before this migration get their timer
+        """
+        INSERT INTO flow_timers (instance_id, phone, flow_id, node_id, fire_at, created_at)
+        SELECT instance_id, phone, flow_id, node_id, resume_at, updated_at FROM flow_sessions
+        WHERE resume_at IS NOT NULL
+        ON CONFLICT DO NOTHING
+        """,
+        "DROP INDEX IF EXISTS idx_flow_sessions_resume",
+    ]),
+    (11, "variáveis e expiração por inatividade das sessões de fluxo", [
+        _add_flow_session_variables,
+        "CREATE INDEX IF NOT EXISTS idx_flow_sessions_idle ON flow_sessions (updated_at) WHERE resume_at IS NULL",
+    ]),
+]
+
+
+def apply_migrations(conn: sqlite3.Connection) -> int:
+    """Bring the schema up to the latest SCHEMA_MIGRATIONS version."""
+    current = conn.execute("PRAGMA user_version").fetchone()[0]
+    for version, description, steps in SCHEMA_MIGRATIONS:
+        if version <= current:
+            continue
+        for step in steps:
+            if callable(step):
+                step(conn)
+            else:
+                conn.execute(step)
+        conn.execute(f"PRAGMA user_version = {version}")
+        conn.commit()
+        print(f"🗂️ Migração {version} aplicada: {description}")
+        current = version
+    return current
+
+
+# Queries on the request/scheduler hot paths, checked by --explain
+HOT_QUERIES = [
+    ("mensagens por conversa",
+     "SELECT * FROM messages WHERE phone = ? AND instance_id = ? ORDER BY created_at ASC",
+     ("5511999999999", "default")),
+    ("mensagens por telefone",
+     "SELECT * FROM messages WHERE phone = ? ORDER BY created_at ASC",
+     ("5511999999999",)),
+    ("últimas mensagens",
+     "SELECT * FROM messages ORDER BY created_at DESC LIMIT 50",
+     ()),
+    ("contato por telefone",
+     "SELECT id FROM contacts WHERE phone = ? AND instance_id = ?",
+     ("5511999999999", "default")),
+    ("chat por telefone",
+     "SELECT id FROM chats WHERE contact_phone = ? AND instance_id = ?",
+     ("5511999999999", "default")),
+    ("lista de chats",
+     "SELECT contact_phone, contact_name, instance_id, last_message, last_message_time, unread_count FROM chats WHERE last_message_time IS NOT NULL ORDER BY last_message_time DESC",
+     ()),
+    ("campanhas vencidas",
+     "SELECT id, campaign_id, message, media_type, media_path, schedule_type, weekday, send_time FROM campaign_messages WHERE next_run <= ?",
+     ("2025-01-01T00:00:00+00:00",)),
+    ("agendamentos pendentes",
+     "SELECT id, campaign_id, content, media_type, media_path, next_run, status FROM scheduled_messages WHERE status='pending'",
+     ()),
+    ("grupos da campanha",
+     "SELECT instance_id, group_id FROM campaign_groups WHERE campaign_id=?",
+     ("c1",)),
+    ("página de chats",
+     "SELECT contact_phone, last_message_time FROM chats WHERE last_message_time IS NOT NULL AND (last_message_time, rowid) < (?, ?) ORDER BY last_message_time DESC, rowid DESC LIMIT ?",
+     ("2025-01-01T00:00:00+00:00", 1000, 100)),
+    ("página de mensagens da conversa",
+     "SELECT * FROM messages WHERE phone = ? AND instance_id = ? AND (created_at, rowid) > (?, ?) ORDER BY created_at, rowid LIMIT ?",
+     ("5511999999999", "default", "2025-01-01T00:00:00+00:00", 1000, 100)),
+    ("alterações desde o cursor",
+     "SELECT seq, entity, entity_id, op FROM changes WHERE entity IN (?) AND seq > ? AND seq <= ? ORDER BY seq LIMIT ?",
+     ("messages", 0, 100, 500)),
+    ("sessões de fluxo inativas",
+     "SELECT instance_id, phone FROM flow_sessions WHERE resume_at IS NULL AND updated_at < ?",
+     ("2025-01-01T00:00:00+00:00",)),
+    ("temporizadores de fluxo no horizonte",
+     "SELECT id, fire_at FROM flow_timers WHERE fire_at > ? AND fire_at <= ? ORDER BY fire_at",
+     ("2025-01-01T00:00:00+00:00", "2025-01-01T00:05:00+00:00")),
+]
+
+
+def explain_hot_queries(conn: sqlite3.Connection | None = None) -> list[tuple[str, list[str], bool]]:
+    """Return ``(name, plan lines, slow)`` for every hot query.
+
+    A plan is flagged as slow when it scans a table without an index or
+    needs a temporary B-tree to sort.
+    """
+    own = conn is None
+    if own:
+        conn = sqlite3.connect(DB_FILE)
+    try:
+        report = []
+        for name, sql, params in HOT_QUERIES:
+            plan = [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params)]
+            slow = any(
+                (line.startswith("SCAN ") and " USING " not in line) or "TEMP B-TREE" in line
+                for line in plan
             )
-            rows = cursor.fetchall()
-            for row in rows:
-                msg_id, campaign_id, message, media_type, media_path, schedule_type, weekday, send_time = row
-                cursor.execute(
-                    "SELECT instance_id, group_id FROM campaign_groups WHERE campaign_id=?",
-                    (campaign_id,)
+            report.append((name, plan, slow))
+        return report
+    finally:
+        if own:
+            conn.close()
+
+
+def print_query_plans() -> bool:
+    """Print the query plan of each hot query; False if any plan is slow."""
+    ok = True
+    for name, plan, slow in explain_hot_queries():
+        ok = ok and not slow
+        print(f"{'⚠️' if slow else '✅'} {name}")
+        for line in plan:
+            print(f"    {line}")
+    return ok
+
+
+class CursorError(ValueError):
+    """Raised for a malformed page cursor or limit."""
+
+
+def encode_cursor(values) -> str:
+    """Opaque page token holding the sort key of the last row served."""
+    raw = json.dumps(list(values), separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(token: str, size: int) -> list:
+    try:
+        values = json.loads(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+    except ValueError:
+        raise CursorError("Cursor inválido") from None
+    if not isinstance(values, list) or len(values) != size:
+        raise CursorError("Cursor inválido")
+    return values
+
+
+def keyset_page(conn: sqlite3.Connection, table: str, columns: str, where: str, params, keys: tuple,
+                limit: int | None, after: str | None = None, descending: bool = False):
+    """Read *columns* of the *table* rows matching *where* one page at a time,
+    ordered by the columns in *keys*.
+
+    The last key must be unique (normally ``rowid``) so the order is total,
+    and an index should cover the rest. The next page starts after the row
+    in the *after* cursor, so pages stay stable while rows are inserted.
+    Returns ``(rows, next_cursor)``; ``next_cursor`` is None on the last
+    page. When *limit* is None, ``rows`` is an iterator over every row,
+    read from the cursor as it is consumed.
+    """
+    conditions = [where] if where else []
+    params = list(params)
+    if after is not None and limit is not None:
+        conditions.append(f"({', '.join(keys)}) {'<' if descending else '>'} ({', '.join('?' * len(keys))})")
+        params.extend(decode_cursor(after, len(keys)))
+    direction = "DESC" if descending else "ASC"
+    sort_key = ", ".join(f"{key} AS _key{i}" for i, key in enumerate(keys))
+    sql = f"SELECT {columns}, {sort_key} FROM {table}"
+    if conditions:
+        sql += " WHERE " + " AND ".join(conditions)
+    sql += " ORDER BY " + ", ".join(f"{key} {direction}" for key in keys)
+    if limit is not None:
+        sql += " LIMIT ?"
+        params.append(limit + 1)
+
+    cursor = conn.execute(sql, params)
+    if limit is None:
+        return ({k: row[k] for k in row.keys() if not k.startswith("_key")} for row in cursor), None
+    fetched = cursor.fetchall()
+    rows, last_key = [], None
+    for row in fetched[:limit]:
+        item = dict(row)
+        last_key = [item.pop(f"_key{i}") for i in range(len(keys))]
+        rows.append(item)
+    more = limit is not None and len(fetched) > limit
+    return rows, encode_cursor(last_key) if more else None
+
+
+def read_page(table: str, columns: str, where: str, params, keys: tuple, limit: int | None,
+              after: str | None = None, descending: bool = False):
+    """:func:`keyset_page` on a pooled read connection, released before the rows are sent.
+
+    With *limit* None every row is returned as an iterator that reads
+    STREAM_PAGE_ROWS rows per short read transaction. Streaming straight from
+    one cursor would keep a WAL snapshot open for as long as the slowest
+    client takes to download, blocking checkpoints while ingest writes.
+    Each page is its own snapshot, so a dump taken during writes is not one
+    consistent view; the keyset order still never repeats or skips a row
+    that existed when the dump started.
+    """
+    if limit is not None:
+        with get_db().read() as conn:
+            return keyset_page(conn, table, columns, where, params, keys, limit, after, descending)
+
+    def rows():
+        cursor = None
+        while True:
+            with get_db().read() as conn:
+                page, cursor = keyset_page(conn, table, columns, where, params, keys, STREAM_PAGE_ROWS,
+                                           cursor, descending)
+            yield from page
+            if cursor is None:
+                return
+
+    return rows(), None
+
+
+def upsert_chat_summary(conn: sqlite3.Connection, phone: str, instance_id: str, contact_name: str,
+                        message: str, timestamp: str, incoming: bool = True) -> None:
+    """Fold one new message into the ``chats`` summary row of its conversation.
+
+    Must run in the same transaction as the message insert so the summary
+    never disagrees with ``messages``. Incoming messages bump
+    ``unread_count``; messages older than the current summary only count.
+    """
+    conn.execute(
+        """
+        INSERT INTO chats (id, contact_phone, contact_name, instance_id, last_message, last_message_time, unread_count, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(contact_phone, instance_id) DO UPDATE SET
+            contact_name = CASE WHEN excluded.unread_count > 0 THEN excluded.contact_name ELSE chats.contact_name END,
+            last_message = CASE
+                WHEN chats.last_message_time IS NULL OR excluded.last_message_time >= chats.last_message_time
+                THEN excluded.last_message ELSE chats.last_message END,
+            last_message_time = CASE
+                WHEN chats.last_message_time IS NULL OR excluded.last_message_time >= chats.last_message_time
+                THEN excluded.last_message_time ELSE chats.last_message_time END,
+            unread_count = chats.unread_count + excluded.unread_count
+        """,
+        (
+            f"{phone}_{instance_id}",
+            phone,
+            contact_name,
+            instance_id,
+            message[:100],
+            timestamp,
+            1 if incoming else 0,
+            timestamp,
+        ),
+    )
+
+
+def rebuild_chat_summaries() -> int:
+    """Recompute every ``chats`` row from ``messages`` (one-shot backfill).
+
+    Chats created by the import that have no stored messages are kept as
+    they are. Returns the number of conversations rebuilt.
+    """
+    with get_db().write() as conn:
+        conn.execute(
+            """
+            INSERT INTO chats (id, contact_phone, contact_name, instance_id, last_message, last_message_time, unread_count, created_at)
+            SELECT
+                g.phone || '_' || g.instance_id,
+                g.phone,
+                COALESCE(
+                    (SELECT c.name FROM contacts c WHERE c.phone = g.phone AND c.instance_id = g.instance_id LIMIT 1),
+                    g.contact_name
+                ),
+                g.instance_id,
+                substr(g.message, 1, 100),
+                g.last_at,
+                g.incoming,
+                (SELECT MIN(m.created_at) FROM messages m WHERE m.phone = g.phone AND m.instance_id = g.instance_id)
+            FROM (
+                -- bare columns take their value from the row holding MAX(created_at)
+                SELECT phone, instance_id, contact_name, message,
+                       MAX(created_at) AS last_at,
+                       SUM(direction = 'incoming') AS incoming
+                FROM messages
+                GROUP BY phone, instance_id
+            ) AS g
+            WHERE true
+            ON CONFLICT(contact_phone, instance_id) DO UPDATE SET
+                contact_name = excluded.contact_name,
+                last_message = excluded.last_message,
+                last_message_time = excluded.last_message_time,
+                unread_count = excluded.unread_count
+            """
+        )
+        return conn.execute(
+            "SELECT COUNT(*) FROM (SELECT 1 FROM messages GROUP BY phone, instance_id)"
+        ).fetchone()[0]
+
+
+def format_phone_number(phone):
+    """Format phone number for Brazilian display"""
+    cleaned = phone.replace('+', '').replace('-', '').replace(' ', '')
+    
+    if len(cleaned) == 13 and cleaned.startswith('55'):
+        # Brazilian format: +55 (11) 99999-9999
+        return f"+55 ({cleaned[2:4]}) {cleaned[4:9]}-{cleaned[9:]}"
+    elif len(cleaned) == 11:
+        # Local format: (11) 99999-9999
+        return f"({cleaned[0:2]}) {cleaned[2:7]}-{cleaned[7:]}"
+    else:
+        # Return as is if format not recognized
+        return phone
+
+
+def normalize_incoming_message(data: dict) -> dict:
+    """Turn a Baileys ``messages/receive`` payload into a row for ingestion."""
+    instance_id = data.get('instanceId', 'default')
+    phone = data.get('from', '').replace('@s.whatsapp.net', '').replace('@c.us', '')
+    if not phone:
+        raise ValueError("Campo 'from' é obrigatório")
+    contact_name = data.get('pushName', data.get('contactName', ''))
+    # If no name provided, use formatted phone number
+    if not contact_name or contact_name == phone:
+        contact_name = format_phone_number(phone)
+    return {
+        'id': str(uuid.uuid4()),
+        'instance_id': instance_id,
+        'phone': phone,
+        'contact_name': contact_name,
+        'message': data.get('message', ''),
+        'message_type': data.get('messageType', 'text'),
+        'whatsapp_id': data.get('messageId', str(uuid.uuid4())),
+        'timestamp': data.get('timestamp', datetime.now(BR_TZ).astimezone(timezone.utc).isoformat()),
+    }
+
+
+def store_incoming_messages(conn: sqlite3.Connection, records: list[dict]) -> list[str]:
+    """Write contacts, messages and chat summaries for *records*.
+
+    Runs inside the caller's transaction. Returns one status per record:
+    ``"inserted"``, or ``"duplicate"`` when the instance already stored that
+    WhatsApp message id (contacts and chats are then left untouched).
+    """
+    statuses = []
+    for record in records:
+        cursor = conn.execute("""
+            INSERT INTO messages (id, contact_name, phone, message, direction, instance_id, message_type, whatsapp_id, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT DO NOTHING
+        """, (record['id'], record['contact_name'], record['phone'], record['message'], 'incoming',
+              record['instance_id'], record['message_type'], record['whatsapp_id'], record['timestamp']))
+        if cursor.rowcount == 0:
+            statuses.append("duplicate")
+            continue
+
+        # Create or update contact with real name
+        conn.execute("""
+            INSERT INTO contacts (id, name, phone, instance_id, created_at)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(phone, instance_id) DO UPDATE SET name = excluded.name
+        """, (f"{record['phone']}_{record['instance_id']}", record['contact_name'], record['phone'],
+              record['instance_id'], record['timestamp']))
+
+        upsert_chat_summary(conn, record['phone'], record['instance_id'], record['contact_name'],
+                            record['message'], record['timestamp'])
+        statuses.append("inserted")
+    return statuses
+
+
+def chat_import_rows(chats, instance_id: str, now: str):
+    """Yield ``(phone, contact_name, last_message, last_message_time, unread_count)``
+    for each individual chat in a Baileys ``getChats()`` list."""
+    for chat in chats:
+        if chat.get('id') and not chat['id'].endswith('@g.us'):  # Skip groups for now
+            phone = chat['id'].replace('@s.whatsapp.net', '').replace('@c.us', '')
+            contact_name = chat.get('name') or f"Contato {phone[-4:]}"
+            last_message = None
+            last_message_time = None
+
+            # Try to get last message from chat
+            if chat.get('messages') and len(chat['messages']) > 0:
+                last_msg = chat['messages'][-1]
+                if last_msg.get('message'):
+                    last_message = last_msg['message'].get('conversation') or 'Mídia'
+                    last_message_time = now
+
+            yield phone, contact_name, last_message, last_message_time, chat.get('unreadCount', 0)
+
+
+def import_chat_rows(conn: sqlite3.Connection, rows: list[tuple], instance_id: str,
+                     now: str) -> tuple[int, int]:
+    """Upsert contacts and chat summaries for *rows* from ``chat_import_rows``.
+
+    Existing contacts are kept as they are; existing chats get the new name
+    and unread count, and keep their last message unless the import has
+    one. Returns the number of contacts and of chats created.
+    """
+    # Chats of this chunk that already exist, looked up through the unique
+    # (contact_phone, instance_id) index in the same transaction as the upsert
+    phones = list(dict.fromkeys(phone for phone, *_ in rows))
+    existing_chats = conn.execute(
+        "SELECT COUNT(*) FROM chats WHERE instance_id = ? AND contact_phone IN (SELECT value FROM json_each(?))",
+        (instance_id, json.dumps(phones)),
+    ).fetchone()[0]
+
+    # rowcount, unlike total_changes, leaves out rows written by triggers
+    imported_contacts = conn.executemany("""
+        INSERT INTO contacts (id, name, phone, instance_id, created_at)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(phone, instance_id) DO NOTHING
+    """, [(str(uuid.uuid4()), name, phone, instance_id, now) for phone, name, *_ in rows]).rowcount
+
+    conn.executemany("""
+        INSERT INTO chats (id, contact_phone, contact_name, instance_id, last_message, last_message_time, unread_count, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(contact_phone, instance_id) DO UPDATE SET
+            contact_name = excluded.contact_name,
+            last_message = COALESCE(excluded.last_message, chats.last_message),
+            last_message_time = COALESCE(excluded.last_message_time, chats.last_message_time),
+            unread_count = excluded.unread_count
+    """, [(str(uuid.uuid4()), phone, name, instance_id, last_message, last_time, unread, now)
+          for phone, name, last_message, last_time, unread in rows])
+    return imported_contacts, len(phones) - existing_chats
+
+
+def receive_message_batch(items: list) -> dict:
+    """Store a batch of incoming messages in one transaction.
+
+    Shared by /api/messages/receive/batch and the IPC socket. Returns the
+    counts plus one result per item, in order.
+    """
+    results = [None] * len(items)
+    records = []
+    positions = []
+    for index, item in enumerate(items):
+        try:
+            if not isinstance(item, dict):
+                raise ValueError("Mensagem deve ser um objeto")
+            record = normalize_incoming_message(item)
+        except ValueError as e:
+            results[index] = {"index": index, "status": "error", "error": str(e)}
+            continue
+        records.append(record)
+        positions.append(index)
+
+    statuses = []
+    if records:
+        with get_db().write() as conn:
+            statuses = store_incoming_messages(conn, records)
+
+    for index, record, status in zip(positions, records, statuses):
+        results[index] = {
+            "index": index,
+            "status": status,
+            "messageId": record['whatsapp_id'],
+            "id": record['id'] if status == "inserted" else None,
+        }
+
+    hub = get_ws_hub()
+    flows = get_flow_engine()
+    for record, status in zip(records, statuses):
+        if status == "inserted":
+            hub.publish(message_event(record), message_topics(record))
+            flows.submit(record)
+
+    inserted = statuses.count("inserted")
+    duplicates = statuses.count("duplicate")
+    errors = len(items) - len(records)
+    print(f"📦 Lote recebido: {inserted} novas, {duplicates} duplicadas, {errors} com erro")
+    return {
+        "success": True,
+        "inserted": inserted,
+        "duplicates": duplicates,
+        "errors": errors,
+        "results": results,
+    }
+
+
+class IngestQueueFull(Exception):
+    """Raised when the ingest queue cannot take more messages."""
+
+
+class MessageIngestQueue:
+    """Write-behind queue that commits incoming messages in batches.
+
+    ``submit`` returns a Future that resolves to the storage status
+    (``"inserted"`` or ``"duplicate"``) once the batch holding it has been
+    committed, so callers can acknowledge
+    only durable messages. A single worker thread groups whatever arrives
+    within ``flush_interval_ms`` (up to ``batch_size`` messages) into one
+    transaction. When ``max_pending`` messages are waiting, ``submit``
+    raises IngestQueueFull so the sender backs off.
+    """
+
+    def __init__(self, batch_size: int = INGEST_BATCH_SIZE,
+                 flush_interval_ms: int = INGEST_FLUSH_INTERVAL_MS,
+                 max_pending: int = INGEST_QUEUE_MAX):
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval_ms / 1000
+        self.max_pending = max_pending
+        self._queue: queue.Queue = queue.Queue(maxsize=max_pending)
+        self._thread: threading.Thread | None = None
+        self._start_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._batches = 0
+        self._messages = 0
+        self._rejected = 0
+        self._failed = 0
+        self._last_batch_size = 0
+        self._last_flush_ms = 0.0
+        self._max_flush_ms = 0.0
+        self._total_flush_ms = 0.0
+
+    def start(self):
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name="whatsflow-ingest", daemon=True
                 )
-                targets = cursor.fetchall()
-                for instance_id, group_id in targets:
-                    data = {"to": group_id, "message": message, "type": media_type or "text"}
-                    try:
-                        import requests
-                        requests.post(
-                            f"http://127.0.0.1:{BAILEYS_PORT}/send/{instance_id}",
-                            json=data,
-                            timeout=10,
-                        )
-                    except Exception:
-                        pass
+                self._thread.start()
+        return self._thread
+
+    def submit(self, record: dict, timeout: float = 0) -> Future:
+        future: Future = Future()
+        try:
+            if timeout:
+                self._queue.put((record, future), timeout=timeout)
+            else:
+                self._queue.put_nowait((record, future))
+        except queue.Full:
+            with self._stats_lock:
+                self._rejected += 1
+            raise IngestQueueFull(f"{self.max_pending} mensagens aguardando gravação")
+        self.start()
+        return future
+
+    def stop(self, timeout: float | None = 10):
+        """Flush everything already queued and stop the worker."""
+        thread = self._thread
+        if thread is None:
+            return
+        self._queue.put(None)
+        thread.join(timeout)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            stopping = False
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._flush(batch)
+            if stopping:
+                return
+
+    def _flush(self, batch):
+        started = time.monotonic()
+        try:
+            with get_db().write() as conn:
+                statuses = store_incoming_messages(conn, [record for record, _ in batch])
+        except Exception as e:
+            logger.error(f"Falha ao gravar lote de {len(batch)} mensagens: {e}")
+            with self._stats_lock:
+                self._failed += len(batch)
+            for _, future in batch:
+                future.set_exception(e)
+            return
+
+        elapsed_ms = (time.monotonic() - started) * 1000
+        with self._stats_lock:
+            self._batches += 1
+            self._messages += len(batch)
+            self._last_batch_size = len(batch)
+            self._last_flush_ms = elapsed_ms
+            self._max_flush_ms = max(self._max_flush_ms, elapsed_ms)
+            self._total_flush_ms += elapsed_ms
+        for (_, future), status in zip(batch, statuses):
+            future.set_result(status)
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            return {
+                "queue_depth": self._queue.qsize(),
+                "queue_capacity": self.max_pending,
+                "batches": self._batches,
+                "messages": self._messages,
+                "rejected": self._rejected,
+                "failed": self._failed,
+                "last_batch_size": self._last_batch_size,
+                "last_flush_ms": round(self._last_flush_ms, 3),
+                "avg_flush_ms": round(self._total_flush_ms / self._batches, 3) if self._batches else 0.0,
+                "max_flush_ms": round(self._max_flush_ms, 3),
+            }
+
+
+_ingest_queue: MessageIngestQueue | None = None
+_ingest_queue_lock = threading.Lock()
+
+
+def get_ingest_queue() -> MessageIngestQueue:
+    global _ingest_queue
+    with _ingest_queue_lock:
+        if _ingest_queue is None:
+            _ingest_queue = MessageIngestQueue()
+        return _ingest_queue
+
+
+class FanOutExecutor:
+    """Send one message to many (instance_id, group_id) targets in parallel.
+
+    A shared thread pool bounds the total number of sends in flight. Each
+    instance has one queue of pending sends, shared by every campaign being
+    dispatched at that moment, and at most ``per_instance`` lanes draining
+    it. A lane is only handed to the pool while its instance has a free
+    slot, so a busy instance never parks pool threads that sends to other
+    instances need. ``run`` waits for a batch of targets; ``submit`` queues
+    one job and returns at once.
+    """
+
+    def __init__(self, max_workers: int = FANOUT_MAX_WORKERS, per_instance: int = FANOUT_PER_INSTANCE):
+        self.max_workers = max(1, max_workers)
+        self.per_instance = max(1, per_instance)
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="whatsflow-fanout")
+        self._queues: dict[str, deque] = {}
+        self._lanes: dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def _lane(self, instance_id: str) -> None:
+        """Run one queued job for ``instance_id``, then yield the pool thread.
+
+        The lane resubmits itself after each job, which puts it behind
+        lanes of other instances already waiting for a thread, and retires
+        once it finds its instance's queue empty.
+        """
+        while True:
+            with self._lock:
+                pending = self._queues[instance_id]
+                if not pending:
+                    self._lanes[instance_id] -= 1
+                    return
+                job = pending.popleft()
+            try:
+                job()
+            except Exception as e:
+                logger.error(f"Erro em envio da instância {instance_id}: {e}")
+            try:
+                self._executor.submit(self._lane, instance_id)
+                return
+            except RuntimeError:
+                # The pool is shutting down; drain the queue on this thread
+                continue
+
+    def _enqueue(self, instance_id: str, jobs) -> None:
+        """Append *jobs* to the instance queue and start lanes for its free slots."""
+        with self._lock:
+            pending = self._queues.setdefault(instance_id, deque())
+            pending.extend(jobs)
+            # Lanes already running for this instance pick up the new jobs too
+            lanes = self._lanes.get(instance_id, 0)
+            start = min(self.per_instance - lanes, len(pending))
+            for _ in range(start):
+                self._executor.submit(self._lane, instance_id)
+            self._lanes[instance_id] = lanes + start
+
+    def submit(self, instance_id: str, job) -> None:
+        """Queue ``job()`` behind the other sends of *instance_id* without waiting for it."""
+        self._enqueue(instance_id, (job,))
+
+    def run(self, targets, send) -> list[dict]:
+        """Call ``send(instance_id, group_id)`` for every target.
+
+        Returns one outcome per target, in the order given, with
+        ``status`` ``"sent"`` or ``"failed"``. A send that returns a falsy
+        value or raises counts as failed.
+        """
+        targets = list(targets)
+        outcomes: list[dict | None] = [None] * len(targets)
+        if not targets:
+            return outcomes
+        remaining = [len(targets)]
+        done = threading.Event()
+
+        def target_job(index, instance_id, group_id):
+            def job():
+                started = time.monotonic()
+                error = None
+                try:
+                    ok = bool(send(instance_id, group_id))
+                except Exception as e:
+                    ok = False
+                    error = str(e)
+                outcomes[index] = {
+                    "instance_id": instance_id,
+                    "group_id": group_id,
+                    "status": "sent" if ok else "failed",
+                    "error": error,
+                    "duration_ms": round((time.monotonic() - started) * 1000, 3),
+                }
+                with self._lock:
+                    remaining[0] -= 1
+                    if remaining[0] == 0:
+                        done.set()
+            return job
+
+        jobs: dict[str, list] = {}
+        for index, (instance_id, group_id) in enumerate(targets):
+            jobs.setdefault(instance_id, []).append(target_job(index, instance_id, group_id))
+        for instance_id, instance_jobs in jobs.items():
+            self._enqueue(instance_id, instance_jobs)
+        done.wait()
+        return outcomes
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+
+
+_fanout: FanOutExecutor | None = None
+_fanout_lock = threading.Lock()
+
+
+def get_fanout() -> FanOutExecutor:
+    global _fanout
+    with _fanout_lock:
+        if _fanout is None:
+            _fanout = FanOutExecutor()
+        return _fanout
+
+
+def record_deliveries(conn: sqlite3.Connection, source: str, source_id: str, campaign_id, outcomes: list[dict],
+                      retry: tuple | None = None) -> int:
+    """Store the per-group outcomes of one dispatch in ``deliveries``.
+
+    With ``retry=(content, media_type, media_path)`` failed targets are put
+    in the outbox and their delivery is recorded as ``retrying``. Returns
+    how many sends were queued, so the caller knows to wake the outbox
+    worker once the transaction commits.
+    """
+    now = datetime.now(timezone.utc).isoformat()
+    rows = []
+    queued = 0
+    for o in outcomes:
+        delivery_id = str(uuid.uuid4())
+        status = o["status"]
+        if status == "failed" and retry is not None:
+            status = "retrying"
+            enqueue_outbox(conn, o["instance_id"], o["group_id"], *retry,
+                           delivery_id=delivery_id, error=o["error"])
+            queued += 1
+        rows.append((delivery_id, source, source_id, None if campaign_id is None else str(campaign_id),
+                     o["instance_id"], o["group_id"], status, o["error"], o["duration_ms"], now))
+    conn.executemany("""
+        INSERT INTO deliveries (id, source, source_id, campaign_id, instance_id, group_id, status, error, duration_ms, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, rows)
+    return queued
+
+
+def publish_campaign_progress(source: str, source_id: str, campaign_id, outcomes: list[dict]):
+    """Tell ``campaign:<id>`` subscribers how a dispatch went."""
+    if campaign_id is None:
+        return
+    sent = sum(1 for o in outcomes if o["status"] == "sent")
+    get_ws_hub().publish({
+        'type': 'campaign_progress',
+        'campaign_id': str(campaign_id),
+        'source': source,
+        'source_id': source_id,
+        'sent': sent,
+        'failed': len(outcomes) - sent,
+        'total': len(outcomes),
+    }, [f"campaign:{campaign_id}"])
+
+
+def outbox_backoff(attempts: int) -> float:
+    """Seconds to wait before attempt number ``attempts + 1`` (jittered)."""
+    delay = min(OUTBOX_MAX_BACKOFF, OUTBOX_BASE_BACKOFF * (2 ** max(0, attempts - 1)))
+    return delay * random.uniform(0.5, 1.0)
+
+
+def enqueue_outbox(conn: sqlite3.Connection, instance_id: str, recipient: str, content: str | None,
+                   media_type: str | None, media_path: str | None, *, delivery_id: str | None = None,
+                   error: str | None = None, attempts: int = 1) -> str:
+    """Queue a send that failed ``attempts`` times for a later retry.
+
+    The row only becomes visible when ``conn`` commits; call
+    ``get_outbox_worker().wake()`` after the ``write()`` block exits.
+    """
+    outbox_id = str(uuid.uuid4())
+    now = datetime.now(timezone.utc)
+    next_attempt = now + timedelta(seconds=outbox_backoff(attempts))
+    conn.execute("""
+        INSERT INTO outbox (id, delivery_id, instance_id, recipient, content, media_type, media_path,
+                            status, attempts, next_attempt_at, last_error, created_at, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, 'pending', ?, ?, ?, ?, ?)
+    """, (outbox_id, delivery_id, instance_id, recipient, content, media_type, media_path,
+          attempts, next_attempt.isoformat(), error, now.isoformat(), now.isoformat()))
+    return outbox_id
+
+
+class OutboxWorker:
+    """Background thread that retries queued sends from the ``outbox`` table.
+
+    Due rows are sent one at a time, in ``next_attempt_at`` order, through
+    ``baileys_send_message``, and so through the instance rate limiter. A
+    failed row is rescheduled with ``outbox_backoff``. After
+    OUTBOX_MAX_ATTEMPTS failures it is marked ``dead`` and left for
+    inspection.
+    """
+
+    def __init__(self, batch_size: int = OUTBOX_BATCH_SIZE, poll_interval: float = OUTBOX_POLL_INTERVAL):
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="whatsflow-outbox", daemon=True)
+            self._thread.start()
+        return self._thread
+
+    def wake(self):
+        self._wake.set()
+
+    def stop(self, timeout: float | None = 10):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                processed = self.drain()
+            except Exception as e:
+                logger.error(f"Erro no processamento do outbox: {e}")
+                processed = 0
+            if not processed:
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
+
+    def drain(self, now: datetime | None = None) -> int:
+        """Retry the sends due at *now*; returns how many were attempted."""
+        now = now or datetime.now(timezone.utc)
+        db = get_db()
+        with db.read() as conn:
+            rows = conn.execute("""
+                SELECT id, delivery_id, instance_id, recipient, content, media_type, media_path, attempts
+                FROM outbox WHERE status = 'pending' AND next_attempt_at <= ?
+                ORDER BY next_attempt_at LIMIT ?
+            """, (now.isoformat(), self.batch_size)).fetchall()
+
+        for outbox_id, delivery_id, instance_id, recipient, content, media_type, media_path, attempts in rows:
+            if self._stop.is_set():
+                break
+            try:
+                baileys_send_message(instance_id, build_send_payload(recipient, content, media_type, media_path))
+                ok, error = True, None
+            except Exception as e:
+                ok, error = False, str(e)
+            attempts += 1
+            updated_at = datetime.now(timezone.utc)
+            with db.write() as conn:
+                if ok:
+                    status = "sent"
+                    conn.execute(
+                        "UPDATE outbox SET status = 'sent', attempts = ?, last_error = NULL, updated_at = ? WHERE id = ?",
+                        (attempts, updated_at.isoformat(), outbox_id),
+                    )
+                elif attempts >= OUTBOX_MAX_ATTEMPTS:
+                    status = "dead"
+                    conn.execute(
+                        "UPDATE outbox SET status = 'dead', attempts = ?, last_error = ?, updated_at = ? WHERE id = ?",
+                        (attempts, error, updated_at.isoformat(), outbox_id),
+                    )
+                    logger.error(f"Envio para {recipient} ({instance_id}) desistido após {attempts} tentativas: {error}")
+                else:
+                    status = "retrying"
+                    next_attempt = updated_at + timedelta(seconds=outbox_backoff(attempts))
+                    conn.execute(
+                        "UPDATE outbox SET attempts = ?, next_attempt_at = ?, last_error = ?, updated_at = ? WHERE id = ?",
+                        (attempts, next_attempt.isoformat(), error, updated_at.isoformat(), outbox_id),
+                    )
+                if delivery_id:
+                    conn.execute(
+                        "UPDATE deliveries SET status = ?, error = ? WHERE id = ?",
+                        (status, error, delivery_id),
+                    )
+        return len(rows)
+
+    def stats(self) -> dict:
+        with get_db().read() as conn:
+            counts = dict(conn.execute("SELECT status, COUNT(*) FROM outbox GROUP BY status").fetchall())
+            oldest = conn.execute(
+                "SELECT MIN(next_attempt_at) FROM outbox WHERE status = 'pending'"
+            ).fetchone()[0]
+        return {
+            "pending": counts.get("pending", 0),
+            "sent": counts.get("sent", 0),
+            "dead": counts.get("dead", 0),
+            "next_attempt_at": oldest,
+        }
+
+
+_outbox_worker: OutboxWorker | None = None
+_outbox_worker_lock = threading.Lock()
+
+
+def get_outbox_worker() -> OutboxWorker:
+    global _outbox_worker
+    with _outbox_worker_lock:
+        if _outbox_worker is None:
+            _outbox_worker = OutboxWorker()
+        return _outbox_worker
+
+
+# Campaign scheduler
+def campaign_scheduler_loop():
+    while True:
+        try:
+            now = datetime.now(BR_TZ).isoformat()
+            db = get_db()
+            with db.read() as conn:
+                rows = conn.execute(
+                    "SELECT id, campaign_id, message, media_type, media_path, schedule_type, weekday, send_time FROM campaign_messages WHERE next_run <= ?",
+                    (now,)
+                ).fetchall()
+            for row in rows:
+                msg_id, campaign_id, message, media_type, media_path, schedule_type, weekday, send_time = row
+                with db.read() as conn:
+                    targets = [
+                        (instance_id or "default", group_id)
+                        for instance_id, group_id in conn.execute(
+                            "SELECT instance_id, group_id FROM campaign_groups WHERE campaign_id=?",
+                            (campaign_id,)
+                        ).fetchall()
+                    ]
+                media = _prepare_run_media(media_type, media_path)
+                outcomes = get_fanout().run(
+                    targets,
+                    lambda instance_id, group_id: send_scheduled_message(
+                        group_id, message, media_type, media_path, instance_id=instance_id, media=media
+                    ),
+                )
+
+                # compute next run
+                next_dt = compute_next_run(schedule_type, weekday or 0, send_time)
+                with db.write() as conn:
+                    queued = record_deliveries(conn, "campaign_message", msg_id, campaign_id, outcomes,
+                                               retry=(message, media_type, media_path))
+                    conn.execute(
+                        "UPDATE campaign_messages SET next_run=? WHERE id=?",
+                        (next_dt.isoformat(), msg_id),
+                    )
+                if queued:
+                    get_outbox_worker().wake()
+                publish_campaign_progress("campaign_message", msg_id, campaign_id, outcomes)
+        except Exception as e:
+            logger.error(f"Erro no agendador de campanhas: {e}")
+
+        time.sleep(60)
+
+
+def start_campaign_scheduler():
+    thread = threading.Thread(target=campaign_scheduler_loop, daemon=True)
+    thread.start()
+    return thread
+
+
+def _media_type_for(mimetype: str | None) -> str:
+    major = (mimetype or "").split("/")[0]
+    return major if major in ("image", "video", "audio") else "document"
+
+
+def iter_base64_chunks(pieces):
+    """Decode base64 arriving in pieces (str or bytes), one piece at a time."""
+    pending = b""
+    for piece in pieces:
+        if isinstance(piece, str):
+            piece = piece.encode("ascii")
+        pending += piece.translate(None, b" \t\r\n")
+        cut = len(pending) - len(pending) % 4
+        if cut:
+            yield base64.b64decode(pending[:cut])
+            pending = pending[cut:]
+    if pending:
+        yield base64.b64decode(pending)
+
+
+class MediaStore:
+    """Content-addressed store for campaign media, keyed by SHA-256.
+
+    Files live at ``<root>/<sha[:2]>/<sha>`` and are registered in the
+    ``media_blobs`` table. Triggers on ``campaign_messages`` and
+    ``scheduled_messages`` keep ``refcount`` up to date, so the same content
+    uploaded to several campaigns is stored once and :meth:`gc` can remove
+    files nothing points at. Metadata Baileys needs (mimetype, size) is
+    cached by path.
+    """
+
+    def __init__(self, root: str = MEDIA_DIR, cache_size: int = 1024):
+        self.root = root
+        self.cache_size = cache_size
+        self._cache: OrderedDict[str, dict] = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def path_for(self, sha256: str) -> str:
+        return os.path.join(self.root, sha256[:2], sha256)
+
+    def put_stream(self, chunks, mimetype: str | None = None, media_type: str | None = None) -> dict:
+        """Store the bytes of an iterable of chunks and return their metadata.
+
+        Chunks are hashed and written to a temporary file as they arrive, so
+        the whole blob is never held in memory.
+        """
+        tmp_dir = os.path.join(self.root, "tmp")
+        os.makedirs(tmp_dir, exist_ok=True)
+        digest = hashlib.sha256()
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(dir=tmp_dir)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for chunk in chunks:
+                    digest.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+            return self._register(digest.hexdigest(), tmp_path, size, mimetype,
+                                  media_type or _media_type_for(mimetype))
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def put_bytes(self, data: bytes, mimetype: str | None = None, media_type: str | None = None) -> dict:
+        return self.put_stream([data], mimetype, media_type)
+
+    def _register(self, sha256: str, tmp_path: str, size: int, mimetype: str | None, media_type: str) -> dict:
+        now = datetime.now(timezone.utc).isoformat()
+        with get_db().write() as conn:
+            row = conn.execute(
+                "SELECT path, size, mimetype, media_type FROM media_blobs WHERE sha256 = ?", (sha256,)
+            ).fetchone()
+            if row and os.path.exists(row[0]):
+                conn.execute("UPDATE media_blobs SET last_used_at = ? WHERE sha256 = ?", (now, sha256))
+                return dict(self._remember(sha256, *row), deduplicated=True)
+            path = self.path_for(sha256)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp_path, path)
+            conn.execute("""
+                INSERT INTO media_blobs (sha256, path, size, mimetype, media_type, refcount, created_at, last_used_at)
+                VALUES (?, ?, ?, ?, ?, 0, ?, ?)
+                ON CONFLICT(sha256) DO UPDATE SET path = excluded.path, size = excluded.size,
+                    last_used_at = excluded.last_used_at
+            """, (sha256, path, size, mimetype, media_type, now, now))
+        return dict(self._remember(sha256, path, size, mimetype, media_type), deduplicated=False)
+
+    def _remember(self, sha256, path, size, mimetype, media_type) -> dict:
+        info = {"media_id": sha256, "path": path, "size": size, "mimetype": mimetype, "media_type": media_type}
+        with self._cache_lock:
+            self._cache[path] = info
+            self._cache.move_to_end(path)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return info
+
+    def info(self, sha256: str) -> dict | None:
+        """Metadata for a stored blob, or None if unknown."""
+        with get_db().read() as conn:
+            row = conn.execute(
+                "SELECT path, size, mimetype, media_type, refcount FROM media_blobs WHERE sha256 = ?", (sha256,)
+            ).fetchone()
+        if row is None:
+            return None
+        return dict(self._remember(sha256, *row[:4]), refcount=row[4])
+
+    def info_for_path(self, path: str) -> dict | None:
+        """Cached metadata for a stored file path, or None if not in the store."""
+        with self._cache_lock:
+            info = self._cache.get(path)
+            if info is not None:
+                self._cache.move_to_end(path)
+                return info
+        with get_db().read() as conn:
+            row = conn.execute(
+                "SELECT sha256, path, size, mimetype, media_type FROM media_blobs WHERE path = ?", (path,)
+            ).fetchone()
+        return self._remember(*row) if row else None
+
+    def gc(self, now: datetime | None = None, grace: float = MEDIA_GC_GRACE) -> dict:
+        """Delete blobs unreferenced for *grace* seconds; returns counts."""
+        now = now or datetime.now(timezone.utc)
+        cutoff = (now - timedelta(seconds=grace)).isoformat()
+        with get_db().write() as conn:
+            rows = conn.execute("""
+                SELECT sha256, path, size FROM media_blobs b
+                WHERE refcount <= 0 AND last_used_at < ?
+                  AND NOT EXISTS (SELECT 1 FROM outbox o WHERE o.status = 'pending' AND o.media_path = b.path)
+            """, (cutoff,)).fetchall()
+            conn.executemany("DELETE FROM media_blobs WHERE sha256 = ?", [(row[0],) for row in rows])
+            # Unlink while the writer is held: an upload of the same content
+            # registers under the writer too, so it cannot recreate the file
+            # between the unlink and the commit and then lose it
+            for _, path, _ in rows:
+                with self._cache_lock:
+                    self._cache.pop(path, None)
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+        # Leftovers of uploads interrupted mid-stream
+        tmp_dir = os.path.join(self.root, "tmp")
+        if os.path.isdir(tmp_dir):
+            for name in os.listdir(tmp_dir):
+                tmp_path = os.path.join(tmp_dir, name)
+                if os.path.getmtime(tmp_path) < now.timestamp() - grace:
+                    os.remove(tmp_path)
+        return {"removed": len(rows), "bytes": sum(row[2] for row in rows)}
+
+    def start(self, interval: float = MEDIA_GC_INTERVAL):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, args=(interval,), name="whatsflow-media-gc", daemon=True)
+            self._thread.start()
+        return self._thread
+
+    def stop(self, timeout: float | None = 10):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self, interval: float):
+        while not self._stop.wait(interval):
+            try:
+                result = self.gc()
+                if result["removed"]:
+                    print(f"🧹 Mídia sem uso removida: {result['removed']} arquivos, {result['bytes']} bytes")
+            except Exception as e:
+                logger.error(f"Erro na limpeza de mídia: {e}")
+
+
+_media_store: MediaStore | None = None
+_media_store_lock = threading.Lock()
+
+
+def get_media_store() -> MediaStore:
+    """Shared store for the current MEDIA_DIR."""
+    global _media_store
+    with _media_store_lock:
+        if _media_store is None or _media_store.root != MEDIA_DIR:
+            _media_store = MediaStore(MEDIA_DIR)
+        return _media_store
+
+
+def prepare_media(media_type: str | None, media_path: str | None):
+    """Return the ``/send`` media value for a stored file, or None for text.
+
+    Files under MEDIA_DIR become a ``{"url": path}`` reference that Baileys
+    reads from disk itself; anything else (or ``MEDIA_TRANSFER=inline``) is
+    read once into a shared :class:`MediaBlob`. Raises OSError if the file is
+    missing.
+    """
+    if not media_type or media_type == "text" or not media_path:
+        return None
+    path = os.path.abspath(media_path)
+    media_dir = os.path.join(os.path.abspath(MEDIA_DIR), "")
+    stored = get_media_store().info_for_path(media_path) if path.startswith(media_dir) else None
+    mimetype = stored["mimetype"] if stored else None
+    if MEDIA_TRANSFER == "path" and path.startswith(media_dir):
+        if not os.path.isfile(path):
+            raise FileNotFoundError(f"Arquivo de mídia não encontrado: {media_path}")
+        return {"url": path, "mimetype": mimetype} if mimetype else {"url": path}
+    return MediaBlob.from_file(path, mimetype)
+
+
+def build_send_payload(group_id: str, content: str | None, media_type: str | None, media_path: str | None,
+                       media=None) -> dict:
+    """Build the Baileys ``/send`` body for a text or media message.
+
+    Pass ``media`` from :func:`prepare_media` to reuse it across targets.
+    """
+    data = {"to": group_id}
+    if media is None:
+        media = prepare_media(media_type, media_path)
+    if media is not None:
+        data[media_type] = media
+        mimetype = media.get("mimetype") if isinstance(media, dict) else media.mimetype
+        if mimetype:
+            data["mimetype"] = mimetype
+    else:
+        data["message"] = content
+    return data
+
+
+def _prepare_run_media(media_type: str | None, media_path: str | None):
+    """Prepare media once for a fan-out; on error each send reports it."""
+    try:
+        return prepare_media(media_type, media_path)
+    except OSError as e:
+        logger.error(f"Failed to read media file: {e}")
+        return None
+
+
+def send_scheduled_message(group_id: str, content: str, media_type: str | None, media_path: str | None,
+                           instance_id: str = "default", media=None) -> bool:
+    """Send a scheduled message through the Baileys service."""
+    try:
+        data = build_send_payload(group_id, content, media_type, media_path, media)
+    except Exception as e:
+        logger.error(f"Failed to read media file: {e}")
+        return False
+
+    try:
+        baileys_send_message(instance_id, data)
+        return True
+    except Exception as e:
+        logger.error(f"Scheduled message send failed: {e}")
+        return False
+
+
+def _parse_next_run(value) -> float | None:
+    """Return the UTC timestamp of a stored ``next_run``, or None if invalid."""
+    if isinstance(value, datetime):
+        dt = value
+    else:
+        try:
+            dt = datetime.fromisoformat(value)
+        except Exception:
+            return None
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.timestamp()
+
+
+class ScheduledMessageQueue:
+    """In-memory due-queue of pending ``scheduled_messages`` ordered by next_run.
+
+    The heap holds ``(due, seq, schedule_id)`` entries. Rescheduling or
+    removing an id only updates ``_due``; outdated heap entries are skipped
+    when they reach the top, so every change costs O(log n).
+    """
+
+    def __init__(self):
+        self._heap: list[tuple[float, int, str]] = []
+        self._due: dict[str, float] = {}
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+
+    def __len__(self):
+        with self._cond:
+            return len(self._due)
+
+    def load(self):
+        """Replace the queue contents with every pending row in the database."""
+        with get_db().read() as conn:
+            rows = conn.execute(
+                "SELECT id, next_run FROM scheduled_messages WHERE status='pending'"
+            ).fetchall()
+        with self._cond:
+            self._due = {}
+            for sched_id, next_run in rows:
+                due = _parse_next_run(next_run)
+                if due is not None:
+                    self._due[sched_id] = due
+            self._heap = [(due, next(self._seq), sched_id) for sched_id, due in self._due.items()]
+            heapq.heapify(self._heap)
+            self._cond.notify_all()
+        return len(self._due)
+
+    def schedule(self, sched_id: str, next_run):
+        due = _parse_next_run(next_run)
+        if due is None:
+            self.discard(sched_id)
+            return
+        with self._cond:
+            self._due[sched_id] = due
+            heapq.heappush(self._heap, (due, next(self._seq), sched_id))
+            self._cond.notify_all()
+
+    def discard(self, sched_id: str):
+        with self._cond:
+            self._due.pop(sched_id, None)
+
+    def reload_campaign(self, campaign_id: str):
+        """Re-read the scheduled messages of a campaign after it changed."""
+        with get_db().read() as conn:
+            rows = conn.execute(
+                "SELECT id, next_run, status FROM scheduled_messages WHERE campaign_id=?",
+                (campaign_id,),
+            ).fetchall()
+        for sched_id, next_run, status in rows:
+            if status == 'pending':
+                self.schedule(sched_id, next_run)
+            else:
+                self.discard(sched_id)
+
+    def _drop_stale(self):
+        while self._heap:
+            due, _, sched_id = self._heap[0]
+            if self._due.get(sched_id) == due:
+                return
+            heapq.heappop(self._heap)
+
+    def next_due(self) -> float | None:
+        with self._cond:
+            self._drop_stale()
+            return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now: float | None = None) -> list[str]:
+        """Remove and return the ids due at or before *now* (a UTC timestamp)."""
+        now = time.time() if now is None else now
+        due_ids = []
+        with self._cond:
+            while True:
+                self._drop_stale()
+                if not self._heap or self._heap[0][0] > now:
+                    break
+                _, _, sched_id = heapq.heappop(self._heap)
+                del self._due[sched_id]
+                due_ids.append(sched_id)
+        return due_ids
+
+    def wait_due(self, stop_event: threading.Event | None = None) -> list[str]:
+        """Block until at least one message is due and return the due ids."""
+        with self._cond:
+            while not (stop_event and stop_event.is_set()):
+                self._drop_stale()
+                if self._heap:
+                    delay = self._heap[0][0] - time.time()
+                    if delay <= 0:
+                        break
+                    self._cond.wait(min(delay, SCHEDULER_MAX_SLEEP))
+                else:
+                    self._cond.wait(SCHEDULER_MAX_SLEEP)
+            else:
+                return []
+        return self.pop_due()
+
+    def stop(self):
+        with self._cond:
+            self._cond.notify_all()
+
+
+_scheduled_queue: ScheduledMessageQueue | None = None
+_scheduled_queue_lock = threading.Lock()
+
+
+def get_scheduled_queue() -> ScheduledMessageQueue:
+    global _scheduled_queue
+    with _scheduled_queue_lock:
+        if _scheduled_queue is None:
+            _scheduled_queue = ScheduledMessageQueue()
+        return _scheduled_queue
+
+
+def process_scheduled_messages(now: datetime | None = None, ids: list[str] | None = None):
+    """Dispatch scheduled messages due at or before *now*.
+
+    Args:
+        now: Optional datetime to use for comparisons. If omitted, current
+             UTC time is used.
+        ids: Scheduled message ids taken from the due-queue. If omitted,
+             every pending row is checked.
+    """
+    now = now or datetime.now(timezone.utc)
+    if now.tzinfo is None:
+        now_cmp = now.replace(tzinfo=timezone.utc)
+    else:
+        now_cmp = now.astimezone(timezone.utc)
+
+    db = get_db()
+    with db.read() as conn:
+        if ids is None:
+            rows = conn.execute(
+                "SELECT id, campaign_id, content, media_type, media_path, next_run, status FROM scheduled_messages WHERE status='pending'"
+            ).fetchall()
+        elif ids:
+            placeholders = ",".join("?" * len(ids))
+            rows = conn.execute(
+                f"SELECT id, campaign_id, content, media_type, media_path, next_run, status FROM scheduled_messages WHERE status='pending' AND id IN ({placeholders})",
+                list(ids),
+            ).fetchall()
+        else:
+            rows = []
+
+    scheduled_queue = get_scheduled_queue()
+    for sched_id, campaign_id, content, media_type, media_path, next_run_str, status in rows:
+        due = _parse_next_run(next_run_str)
+        if due is None:
+            continue
+
+        if due <= now_cmp.timestamp():
+            with db.read() as conn:
+                targets = [
+                    (instance_id or "default", group_id)
+                    for instance_id, group_id in conn.execute(
+                        "SELECT instance_id, group_id FROM campaign_groups WHERE campaign_id=?", (campaign_id,)
+                    ).fetchall()
+                ]
+                row = conn.execute(
+                    "SELECT recurrence, send_time, weekday, timezone FROM campaigns WHERE id=?",
+                    (campaign_id,),
+                ).fetchone()
+            media = _prepare_run_media(media_type, media_path)
+            outcomes = get_fanout().run(
+                targets,
+                lambda instance_id, group_id: send_scheduled_message(
+                    group_id, content, media_type, media_path, instance_id=instance_id, media=media
+                ),
+            )
+
+            next_dt = None
+            with db.write() as conn:
+                queued = record_deliveries(conn, "scheduled_message", sched_id, campaign_id, outcomes,
+                                           retry=(content, media_type, media_path))
+                if row and row[0] in ("daily", "weekly"):
+                    recurrence, send_time, weekday, tz = row
+                    next_dt = calculate_next_run(recurrence, send_time, weekday, tz, now=now_cmp)
+                    conn.execute(
+                        "UPDATE scheduled_messages SET next_run=?, status='pending' WHERE id=?",
+                        (next_dt.isoformat(), sched_id),
+                    )
+                else:
+                    conn.execute(
+                        # A sent one-off no longer needs its media; the trigger drops the reference
+                        "UPDATE scheduled_messages SET status='sent', media_path=NULL WHERE id=?",
+                        (sched_id,),
+                    )
+            if queued:
+                get_outbox_worker().wake()
+            publish_campaign_progress("scheduled_message", sched_id, campaign_id, outcomes)
+            if next_dt is not None:
+                scheduled_queue.schedule(sched_id, next_dt)
+            else:
+                scheduled_queue.discard(sched_id)
+        elif ids is not None:
+            # Picked up early (e.g. next_run changed): put it back
+            scheduled_queue.schedule(sched_id, next_run_str)
+
+
+def _scheduled_loop(stop_event: threading.Event | None = None):
+    scheduled_queue = get_scheduled_queue()
+    scheduled_queue.load()
+    while not (stop_event and stop_event.is_set()):
+        ids = scheduled_queue.wait_due(stop_event)
+        if not ids:
+            continue
+        try:
+            process_scheduled_messages(ids=ids)
+        except Exception as e:
+            logger.error(f"Scheduler loop error: {e}")
+            retry_at = datetime.now(timezone.utc) + timedelta(seconds=SCHEDULER_RETRY_DELAY)
+            for sched_id in ids:
+                scheduled_queue.schedule(sched_id, retry_at)
+
+
+def start_scheduled_dispatcher(stop_event: threading.Event | None = None):
+    thread = threading.Thread(target=_scheduled_loop, args=(stop_event,), daemon=True)
+    thread.start()
+    return thread
+
+
+class FlowCompileError(ValueError):
+    """Raised when a stored flow cannot be turned into a runnable graph."""
+
+
+# React Flow node types from FlowEditor.js -> runtime step kinds
+FLOW_NODE_KINDS = {
+    "startNode": "start",
+    "messageNode": "message",
+    "conditionNode": "condition",
+    "tagNode": "tag",
+    "mediaNode": "media",
+    "delayNode": "delay",
+}
+FLOW_DELAY_UNITS = {"seconds": 1, "minutes": 60, "hours": 3600}
+
+
+_WORD_RE = re.compile(r"\w+")
+
+
+def fold_text(text: str | None) -> str:
+    """Normalize text for keyword matching.
+
+    Case and accents are dropped and punctuation splits words, so
+    ``"Não, OBRIGADO!"`` becomes ``"nao obrigado"``.
+    """
+    text = unicodedata.normalize("NFKD", (text or "").casefold())
+    text = "".join(ch for ch in text if not unicodedata.combining(ch))
+    return " ".join(_WORD_RE.findall(text))
+
+
+class FlowNode:
+    """One step of a compiled flow.
+
+    ``next``, ``yes`` and ``no`` are indexes into ``CompiledFlow.nodes``
+    (-1 ends the flow), so running a flow never looks anything up by id.
+    """
+
+    __slots__ = ("id", "kind", "params", "next", "yes", "no")
+
+    def __init__(self, node_id: str, kind: str, params: dict, next: int = -1, yes: int = -1, no: int = -1):
+        for name, value in (("id", node_id), ("kind", kind), ("params", types.MappingProxyType(params)),
+                            ("next", next), ("yes", yes), ("no", no)):
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("FlowNode é imutável")
+
+    def __repr__(self):
+        return f"FlowNode({self.id!r}, {self.kind!r}, next={self.next}, yes={self.yes}, no={self.no})"
+
+
+class CompiledFlow:
+    """Immutable, index-linked graph of one stored flow."""
+
+    __slots__ = ("id", "name", "instance_id", "order", "nodes", "index", "start", "trigger", "warnings")
+
+    def __init__(self, flow_id: str, name: str, instance_id: str | None, order: int,
+                 nodes: tuple, index: dict, start: int, warnings: tuple = ()):
+        for attr, value in (("id", flow_id), ("name", name), ("instance_id", instance_id or None),
+                            ("order", order), ("nodes", nodes), ("index", types.MappingProxyType(index)),
+                            ("start", start), ("trigger", _flow_trigger(nodes, start)), ("warnings", warnings)):
+            object.__setattr__(self, attr, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("CompiledFlow é imutável")
+
+
+def _flow_trigger(nodes: tuple, start: int) -> int | None:
+    """Index of the condition that gates a flow's start, or None.
+
+    A flow whose start leads straight to a condition without a ``no`` branch
+    only starts for messages matching that condition; any other flow reacts
+    to every message.
+    """
+    index = nodes[start].next
+    while index >= 0 and nodes[index].kind == "delay" and not nodes[index].params["seconds"]:
+        index = nodes[index].next
+    if index >= 0 and nodes[index].kind == "condition" and nodes[index].no < 0:
+        return index
+    return None
+
+
+def _flow_delay(value, unit: str | None = None) -> float:
+    try:
+        amount = float(value or 0)
+    except (TypeError, ValueError):
+        raise FlowCompileError(f"Atraso inválido: {value!r}") from None
+    return max(amount, 0.0) * FLOW_DELAY_UNITS.get(unit or "seconds", 1)
+
+
+def _flow_node_params(kind: str, data: dict) -> dict:
+    """Settings of one editor node, normalized once at compile time."""
+    if kind == "message":
+        return {"text": (data.get("message") or "").strip()}
+    if kind == "condition":
+        # The editor stores the typed text under "message" for every node type
+        text = data.get("condition") or data.get("message") or ""
+        return {
+            "mode": "equals" if data.get("conditionType") == "equals" else "contains",
+            "keywords": tuple(k for k in (fold_text(part) for part in text.split(",")) if k),
+        }
+    if kind == "tag":
+        return {
+            "tag": (data.get("tag") or data.get("message") or "").strip(),
+            "action": "remove" if data.get("action") == "remove" else "add",
+        }
+    if kind == "media":
+        return {
+            "media_type": data.get("mediaType") or "audio",
+            "media_path": data.get("mediaPath") or data.get("media_path"),
+            "media_id": data.get("mediaId") or data.get("media_id"),
+        }
+    if kind == "delay":
+        return {"seconds": _flow_delay(data.get("delay"), data.get("delayUnit"))}
+    return {}
+
+
+def compile_flow(flow_id: str, nodes, edges, name: str = "", instance_id: str | None = None,
+                 order: int = 0) -> CompiledFlow:
+    """Turn React Flow ``nodes``/``edges`` into a :class:`CompiledFlow`.
+
+    Message and media nodes with their own delay become a delay step
+    followed by the send. A node follows its first outgoing edge (a
+    condition, the first of each of its ``yes``/``no`` handles); extra edges
+    are reported in ``warnings``.
+    """
+    if isinstance(nodes, str):
+        nodes = json.loads(nodes or "[]")
+    if isinstance(edges, str):
+        edges = json.loads(edges or "[]")
+    if not isinstance(nodes, list) or not isinstance(edges, list):
+        raise FlowCompileError("nodes e edges devem ser listas")
+
+    steps = []  # [node_id, kind, params, editor id that edges point at]
+    entry = {}  # editor node id -> index an incoming edge jumps to
+    kinds = {}
+    for node in nodes:
+        node_id = str(node.get("id", ""))
+        kind = FLOW_NODE_KINDS.get(node.get("type"))
+        if kind is None:
+            raise FlowCompileError(f"Tipo de nó desconhecido: {node.get('type')!r}")
+        if not node_id or node_id in kinds:
+            raise FlowCompileError(f"Id de nó ausente ou repetido: {node_id!r}")
+        data = node.get("data") or {}
+        kinds[node_id] = kind
+        entry[node_id] = len(steps)
+        if kind in ("message", "media") and _flow_delay(data.get("delay")) > 0:
+            steps.append([f"{node_id}#delay", "delay", {"seconds": _flow_delay(data.get("delay"))}, None])
+        steps.append([node_id, kind, _flow_node_params(kind, data), node_id])
+
+    starts = [node_id for node_id, kind in kinds.items() if kind == "start"]
+    if len(starts) != 1:
+        raise FlowCompileError("O fluxo precisa de exatamente um nó de início")
+
+    links = {}  # (source id, handle) -> target index
+    warnings = []
+    for edge in edges:
+        source, target = str(edge.get("source", "")), str(edge.get("target", ""))
+        if source not in kinds or target not in kinds:
+            raise FlowCompileError(f"Conexão com nó inexistente: {source!r} -> {target!r}")
+        handle = edge.get("sourceHandle") if kinds[source] == "condition" else None
+        if kinds[source] == "condition" and handle not in ("yes", "no"):
+            handle = "yes"
+        if (source, handle) in links:
+            warnings.append(f"Conexão extra ignorada: {source} -> {target}")
+            continue
+        links[source, handle] = entry[target]
+
+    compiled = []
+    for index, (node_id, kind, params, editor_id) in enumerate(steps):
+        if editor_id is None:
+            # Synthetic delay: continues with the send right after it
+            compiled.append(FlowNode(node_id, kind, params, next=index + 1))
+        elif kind == "condition":
+            compiled.append(FlowNode(node_id, kind, params,
+                                     yes=links.get((editor_id, "yes"), -1), no=links.get((editor_id, "no"), -1)))
+        else:
+            compiled.append(FlowNode(node_id, kind, params, next=links.get((editor_id, None), -1)))
+    index = {node.id: i for i, node in enumerate(compiled)}
+    return CompiledFlow(flow_id, name, instance_id, order, tuple(compiled), index,
+                        entry[starts[0]], tuple(warnings))
+
+
+def check_flow(flow_id: str, nodes, edges, active) -> list[str]:
+    """Validate a flow about to be saved; returns its compile warnings.
+
+    Only active flows must compile, so drafts can be saved half-built.
+    Raises :class:`FlowCompileError` for an active flow that cannot run.
+    """
+    if not active:
+        return []
+    return list(compile_flow(flow_id, nodes, edges).warnings)
+
+
+def condition_matches(node: FlowNode, text: str | None) -> bool:
+    """Whether *text* satisfies a condition node.
+
+    ``equals`` needs the whole message to be one of the keywords; ``contains``
+    needs a keyword to appear as whole words. Both ignore case and accents.
+    """
+    folded = fold_text(text)
+    if node.params["mode"] == "equals":
+        return folded in node.params["keywords"]
+    padded = f" {folded} "
+    return any(f" {keyword} " in padded for keyword in node.params["keywords"])
+
+
+def execute_flow(flow: CompiledFlow, index: int, text: str | None, max_steps: int = FLOW_MAX_STEPS,
+                 path: list | None = None):
+    """Run *flow* from node *index* with the incoming *text*.
+
+    Pure: returns ``(actions, stop)`` and leaves sending and storage to the
+    caller. ``actions`` lists ``(kind, params, node_id)`` for each message,
+    media or tag step reached. ``stop`` is None when the flow ended,
+    ``("input", index)`` when a condition waits for the contact's next
+    message, or ``("delay", index, seconds)`` to continue at *index* later.
+    A condition is answered by *text* until a step has acted on it; after
+    that it waits for a new message. *text* is None when a delay resumes.
+    Pass a list as *path* to collect the ids of the nodes visited.
+    """
+    actions = []
+    answered = text is None
+    for _ in range(max_steps):
+        if index < 0:
+            return actions, None
+        node = flow.nodes[index]
+        if path is not None:
+            path.append(node.id)
+        if node.kind == "condition":
+            if answered:
+                return actions, ("input", index)
+            index = node.yes if condition_matches(node, text) else node.no
+            continue
+        if node.kind == "delay" and node.params["seconds"] > 0:
+            return actions, ("delay", node.next, node.params["seconds"])
+        if node.kind in ("message", "media", "tag"):
+            actions.append((node.kind, node.params, node.id))
+            answered = True
+        index = node.next
+    logger.warning(f"Fluxo {flow.id} interrompido após {max_steps} passos (ciclo sem condição?)")
+    return actions, None
+
+
+class TriggerIndex:
+    """Inverted index from condition keywords to the nodes that use them.
+
+    ``match`` tokenizes a message once and looks each word up, so its cost
+    depends on the message and the keywords it hits, not on how many flows
+    or keywords exist. ``equals`` keywords are looked up by the whole
+    folded message. Entries are added and removed one flow at a time;
+    values are replaced, never mutated, so readers need no lock.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._phrases: dict[str, tuple] = {}  # first word -> ((words, flow_id, node index), ...)
+        self._exact: dict[str, tuple] = {}  # folded message -> ((flow_id, node index), ...)
+        self._by_flow: dict[str, list] = {}  # flow_id -> [(exact, key)] to remove it again
+        self.keywords = 0
+
+    def add(self, flow: CompiledFlow):
+        with self._lock:
+            self._remove(flow.id)
+            keys = []
+            for index, node in enumerate(flow.nodes):
+                if node.kind != "condition":
+                    continue
+                for keyword in node.params["keywords"]:
+                    exact = node.params["mode"] == "equals"
+                    if exact:
+                        key, entry = keyword, (flow.id, index)
+                    else:
+                        words = tuple(keyword.split(" "))
+                        key, entry = words[0], (words, flow.id, index)
+                    table = self._exact if exact else self._phrases
+                    table[key] = table.get(key, ()) + (entry,)
+                    keys.append((exact, key))
+            self._by_flow[flow.id] = keys
+            self.keywords += len(keys)
+
+    def remove(self, flow_id: str):
+        with self._lock:
+            self._remove(flow_id)
+
+    def _remove(self, flow_id: str):
+        keys = self._by_flow.pop(flow_id, ())
+        for exact, key in set(keys):
+            table = self._exact if exact else self._phrases
+            kept = tuple(entry for entry in table.get(key, ()) if entry[-2] != flow_id)
+            if kept:
+                table[key] = kept
+            else:
+                table.pop(key, None)
+        self.keywords -= len(keys)
+
+    def match(self, text: str | None) -> set:
+        """``(flow_id, node index)`` of every condition node *text* satisfies."""
+        folded = fold_text(text)
+        hits = set(self._exact.get(folded, ()))
+        words = folded.split(" ")
+        phrases = self._phrases
+        for position, word in enumerate(words):
+            for keyword, flow_id, index in phrases.get(word, ()):
+                if len(keyword) == 1 or tuple(words[position:position + len(keyword)]) == keyword:
+                    hits.add((flow_id, index))
+        return hits
+
+
+class FlowRegistry:
+    """Compiled graphs of the active flows, cached in memory.
+
+    The whole set is compiled on first use; after that only the flow being
+    saved or deleted is recompiled, through :meth:`invalidate`. Readers get
+    immutable snapshots and never take the lock.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flows: dict[str, CompiledFlow] | None = None
+        self._by_instance: dict[str | None, tuple] = {}
+        self._open_by_instance: dict[str | None, tuple] = {}
+        self.triggers = TriggerIndex()
+        self.compiles = 0
+
+    def _compile_row(self, row) -> CompiledFlow | None:
+        try:
+            flow = compile_flow(row["id"], row["nodes"], row["edges"], row["name"], row["instance_id"], row["rowid"])
+        except ValueError as e:
+            logger.warning(f"Fluxo {row['id']} ignorado: {e}")
+            return None
+        self.compiles += 1
+        return flow
+
+    def _publish(self, flows: dict):
+        by_instance = {}
+        for flow in sorted(flows.values(), key=lambda f: f.order):
+            by_instance.setdefault(flow.instance_id, []).append(flow)
+        self._by_instance = {key: tuple(value) for key, value in by_instance.items()}
+        self._open_by_instance = {
+            key: tuple(flow for flow in value if flow.trigger is None) for key, value in by_instance.items()
+        }
+        self._flows = flows
+
+    def _ensure_loaded(self):
+        if self._flows is not None:
+            return
+        with self._lock:
+            if self._flows is None:
+                with get_db().read() as conn:
+                    rows = conn.execute(
+                        "SELECT rowid, id, name, nodes, edges, instance_id FROM flows WHERE active = 1"
+                    ).fetchall()
+                flows = {}
+                for row in rows:
+                    flow = self._compile_row(row)
+                    if flow is not None:
+                        flows[flow.id] = flow
+                        self.triggers.add(flow)
+                self._publish(flows)
+
+    def get(self, flow_id: str) -> CompiledFlow | None:
+        self._ensure_loaded()
+        return self._flows.get(flow_id)
+
+    def flows_for(self, instance_id: str) -> tuple:
+        """Active flows for *instance_id*: its own first, then those for every instance."""
+        self._ensure_loaded()
+        by_instance = self._by_instance
+        return by_instance.get(instance_id, ()) + by_instance.get(None, ())
+
+    def candidates(self, instance_id: str, text: str | None) -> list:
+        """Flows that may start for *text*, in the order :meth:`flows_for` uses.
+
+        Flows gated by a keyword condition are only included when the
+        trigger index matches their entry condition.
+        """
+        self._ensure_loaded()
+        flows = self._flows
+        candidates = list(self._open_by_instance.get(instance_id, ()) + self._open_by_instance.get(None, ()))
+        for flow_id, index in self.triggers.match(text):
+            flow = flows.get(flow_id)
+            if flow is not None and flow.trigger == index and flow.instance_id in (instance_id, None):
+                candidates.append(flow)
+        candidates.sort(key=lambda flow: (flow.instance_id is None, flow.order))
+        return candidates
+
+    def invalidate(self, flow_id: str):
+        """Recompile *flow_id* from the database, or drop it if gone or inactive."""
+        with self._lock:
+            if self._flows is None:
+                return
+            with get_db().read() as conn:
+                row = conn.execute(
+                    "SELECT rowid, id, name, nodes, edges, instance_id, active FROM flows WHERE id = ?", (flow_id,)
+                ).fetchone()
+            flows = dict(self._flows)
+            flows.pop(flow_id, None)
+            self.triggers.remove(flow_id)
+            if row is not None and row["active"]:
+                flow = self._compile_row(row)
+                if flow is not None:
+                    flows[flow_id] = flow
+                    self.triggers.add(flow)
+            self._publish(flows)
+
+    def clear(self):
+        with self._lock:
+            self._flows = None
+            self._by_instance = {}
+            self._open_by_instance = {}
+            self.triggers = TriggerIndex()
+
+
+_flow_registry: FlowRegistry | None = None
+_flow_registry_lock = threading.Lock()
+
+
+def get_flow_registry() -> FlowRegistry:
+    global _flow_registry
+    with _flow_registry_lock:
+        if _flow_registry is None:
+            _flow_registry = FlowRegistry()
+        return _flow_registry
+
+
+class TimingWheel:
+    """Hierarchical timing wheel of ``(due time, item)`` entries.
+
+    Level 0 has one slot per ``tick``; each slot of level ``n`` covers a
+    full turn of level ``n - 1``. Adding is O(1), and an entry moves down
+    one level each time its slot comes up, so advancing costs O(ticks
+    elapsed + entries due) however many entries wait further out. Entries
+    never fire early and at most one tick late.
+    """
+
+    def __init__(self, start: float, tick: float = FLOW_TIMER_TICK, slots: int = 256, levels: int = 4):
+        self.tick = tick
+        self.slots = slots
+        self.current = math.floor(start / tick)  # last tick processed
+        self.levels = [[[] for _ in range(slots)] for _ in range(levels)]
+        self.overdue = []
+        self.count = 0
+
+    def add(self, due: float, item):
+        self._place(math.ceil(due / self.tick), item)
+        self.count += 1
+
+    def _place(self, expires: int, item):
+        delta = expires - self.current
+        if delta <= 0:
+            self.overdue.append(item)
+            return
+        span = 1
+        for level, wheel in enumerate(self.levels):
+            if delta < span * self.slots or level == len(self.levels) - 1:
+                wheel[(expires // span) % self.slots].append((expires, item))
+                return
+            span *= self.slots
+
+    def advance(self, now: float) -> list:
+        """Move the wheel to *now*; returns the items that came due, in order."""
+        target = math.floor(now / self.tick)
+        due, self.overdue = self.overdue, []
+        if self.count == len(due):
+            # Nothing else waiting: skip the idle ticks
+            self.current = max(self.current, target)
+        while self.current < target:
+            self.current += 1
+            tick = self.current
+            for level in range(len(self.levels) - 1, 0, -1):
+                span = self.slots ** level
+                if tick % span == 0:
+                    slot = self.levels[level][(tick // span) % self.slots]
+                    self.levels[level][(tick // span) % self.slots] = []
+                    for expires, item in slot:
+                        self._place(expires, item)
+            slot = tick % self.slots
+            due.extend(self.overdue)
+            self.overdue = []
+            due.extend(item for _, item in self.levels[0][slot])
+            self.levels[0][slot] = []
+        self.count -= len(due)
+        return due
+
+
+class FlowTimers:
+    """Durable delay timers for paused flows.
+
+    Every timer is a row of ``flow_timers``, so none is lost on restart.
+    The ones due within ``horizon`` seconds are also loaded into a
+    :class:`TimingWheel`, which tells the flow worker when to fire them;
+    rows further out are loaded as the horizon moves forward. Firing only
+    touches SQLite and queues the sends, so a timer is not held up by a
+    send blocked on Baileys or the rate limiter. A timer
+    fires by deleting its row in the same transaction that moves the
+    contact on, so it fires once even if several processes or restarts
+    see it. Rescheduling always creates a new row id, which makes the
+    stale wheel entries of cancelled timers harmless.
+    """
+
+    def __init__(self, horizon: float = FLOW_TIMER_HORIZON, tick: float = FLOW_TIMER_TICK):
+        self.horizon = horizon
+        self.tick = tick
+        self._lock = threading.Lock()
+        self._wheel: TimingWheel | None = None
+        self._loaded_until: float | None = None
+        self.fired = 0
+
+    def schedule(self, conn: sqlite3.Connection, instance_id: str, phone: str, flow_id: str, node_id: str,
+                 fire_at: datetime) -> int:
+        """Replace the contact's timer inside the caller's transaction; returns its id."""
+        self.cancel(conn, instance_id, phone)
+        timer_id = conn.execute("""
+            INSERT INTO flow_timers (instance_id, phone, flow_id, node_id, fire_at, created_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, (instance_id, phone, flow_id, node_id, fire_at.isoformat(),
+              datetime.now(timezone.utc).isoformat())).lastrowid
+        with self._lock:
+            # Later timers are picked up by the loader when the horizon reaches them
+            if self._loaded_until is not None and fire_at.timestamp() <= self._loaded_until:
+                self._wheel.add(fire_at.timestamp(), timer_id)
+        return timer_id
+
+    def cancel(self, conn: sqlite3.Connection, instance_id: str, phone: str):
+        conn.execute("DELETE FROM flow_timers WHERE instance_id = ? AND phone = ?", (instance_id, phone))
+
+    def due(self, now: datetime) -> list:
+        """Ids of the timers due by *now*, oldest first."""
+        with self._lock:
+            stamp = now.timestamp()
+            if self._loaded_until is None or stamp + self.horizon / 2 > self._loaded_until:
+                self._load(stamp)
+            return self._wheel.advance(stamp)
+
+    def _load(self, stamp: float):
+        until = stamp + self.horizon
+        with get_db().read() as conn:
+            if self._loaded_until is None:
+                # First load after start: includes every timer that fell due while stopped
+                self._wheel = TimingWheel(stamp, self.tick)
+                rows = conn.execute(
+                    "SELECT id, fire_at FROM flow_timers WHERE fire_at <= ? ORDER BY fire_at",
+                    (datetime.fromtimestamp(until, timezone.utc).isoformat(),),
+                ).fetchall()
+            else:
+                rows = conn.execute(
+                    "SELECT id, fire_at FROM flow_timers WHERE fire_at > ? AND fire_at <= ? ORDER BY fire_at",
+                    (datetime.fromtimestamp(self._loaded_until, timezone.utc).isoformat(),
+                     datetime.fromtimestamp(until, timezone.utc).isoformat()),
+                ).fetchall()
+        for timer_id, fire_at in rows:
+            self._wheel.add(datetime.fromisoformat(fire_at).timestamp(), timer_id)
+        self._loaded_until = until
+
+    @property
+    def armed(self) -> int:
+        """Timers currently held by the wheel."""
+        return self._wheel.count if self._wheel is not None else 0
+
+    def pending(self) -> int:
+        """Timers waiting in ``flow_timers``."""
+        with get_db().read() as conn:
+            return conn.execute("SELECT COUNT(*) FROM flow_timers").fetchone()[0]
+
+
+class FlowSession:
+    """One contact's place in the flows, as kept in memory.
+
+    ``flow_id`` is None for a contact outside any flow; those are cached
+    too, so most incoming messages need no query. Timestamps are epoch
+    floats, ``variables`` is None until something is stored and ids are
+    interned, which keeps an entry to a few hundred bytes.
+    """
+
+    __slots__ = ("instance_id", "phone", "flow_id", "node_id", "resume_at", "variables", "tags", "touched")
+
+    def __init__(self, instance_id: str, phone: str, flow_id: str | None = None, node_id: str | None = None,
+                 resume_at: float | None = None, variables: dict | None = None, tags: tuple = (),
+                 touched: float = 0.0):
+        self.instance_id = sys.intern(instance_id)
+        self.phone = phone
+        self.flow_id = sys.intern(flow_id) if flow_id else None
+        self.node_id = sys.intern(node_id) if node_id else None
+        self.resume_at = resume_at
+        self.variables = variables or None
+        self.tags = tags
+        self.touched = touched
+
+    def expired(self, now: float, ttl: float) -> bool:
+        """Waiting for a reply for longer than *ttl*; paused sessions wait for their timer."""
+        return self.flow_id is not None and self.resume_at is None and now - self.touched > ttl
+
+    def __repr__(self):
+        return f"FlowSession({self.instance_id!r}, {self.phone!r}, {self.flow_id!r}, {self.node_id!r})"
+
+
+def _epoch(value: str | None) -> float | None:
+    return datetime.fromisoformat(value).timestamp() if value else None
+
+
+class FlowSessionStore:
+    """Per-contact flow state, cached in a bounded LRU over ``flow_sessions``.
+
+    A contact's session is loaded on first use, with its tags from
+    ``contact_tags``, and kept until it is the least recently used of
+    ``capacity`` entries. Changes are written to SQLite by :meth:`write`
+    inside the caller's transaction, and put in the cache by :meth:`put`
+    once that transaction committed. Sessions waiting for a reply for
+    longer than ``ttl`` seconds are treated as ended and removed by
+    :meth:`expire`.
+    """
+
+    def __init__(self, capacity: int = FLOW_SESSION_CACHE_SIZE, ttl: float = FLOW_SESSION_TTL):
+        self.capacity = capacity
+        self.ttl = ttl
+        self._cache: OrderedDict[tuple, FlowSession] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+
+    def get(self, instance_id: str, phone: str, now: datetime | None = None) -> FlowSession:
+        key = (instance_id, phone)
+        with self._lock:
+            session = self._cache.get(key)
+            if session is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+        if session is None:
+            self.misses += 1
+            session = self._load(instance_id, phone)
+            self.put(session)
+        stamp = (now or datetime.now(timezone.utc)).timestamp()
+        if session.expired(stamp, self.ttl):
+            self.expired += 1
+            return FlowSession(instance_id, phone, tags=session.tags, touched=stamp)
+        return session
+
+    def _load(self, instance_id: str, phone: str) -> FlowSession:
+        with get_db().read() as conn:
+            row = conn.execute("""
+                SELECT flow_id, node_id, resume_at, variables, updated_at FROM flow_sessions
+                WHERE instance_id = ? AND phone = ?
+            """, (instance_id, phone)).fetchone()
+            tags = tuple(sys.intern(tag) for (tag,) in conn.execute(
+                "SELECT tag FROM contact_tags WHERE instance_id = ? AND phone = ? ORDER BY tag", (instance_id, phone)
+            ))
+        if row is None:
+            return FlowSession(instance_id, phone, tags=tags)
+        return FlowSession(instance_id, phone, row["flow_id"], row["node_id"], _epoch(row["resume_at"]),
+                           json.loads(row["variables"]) if row["variables"] else None, tags,
+                           _epoch(row["updated_at"]) or 0.0)
+
+    def put(self, session: FlowSession):
+        key = (session.instance_id, session.phone)
+        with self._lock:
+            self._cache[key] = session
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.capacity:
+                self._cache.popitem(last=False)
+
+    def write(self, conn: sqlite3.Connection, session: FlowSession):
+        """Store *session* in ``flow_sessions`` inside the caller's transaction."""
+        if session.flow_id is None:
+            conn.execute("DELETE FROM flow_sessions WHERE instance_id = ? AND phone = ?",
+                         (session.instance_id, session.phone))
+            return
+        touched = datetime.fromtimestamp(session.touched, timezone.utc).isoformat()
+        resume_at = (datetime.fromtimestamp(session.resume_at, timezone.utc).isoformat()
+                     if session.resume_at is not None else None)
+        conn.execute("""
+            INSERT INTO flow_sessions (instance_id, phone, flow_id, node_id, resume_at, variables, started_at, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(instance_id, phone) DO UPDATE SET
+                flow_id = excluded.flow_id,
+                node_id = excluded.node_id,
+                resume_at = excluded.resume_at,
+                variables = excluded.variables,
+                started_at = CASE WHEN flow_sessions.flow_id = excluded.flow_id
+                                  THEN flow_sessions.started_at ELSE excluded.started_at END,
+                updated_at = excluded.updated_at
+        """, (session.instance_id, session.phone, session.flow_id, session.node_id, resume_at,
+              json.dumps(session.variables, ensure_ascii=False) if session.variables else None, touched, touched))
+
+    def discard(self, instance_id: str, phone: str):
+        with self._lock:
+            self._cache.pop((instance_id, phone), None)
+
+    def drop_flow(self, flow_id: str):
+        """Forget cached sessions of a deleted flow (their rows are deleted by the caller)."""
+        with self._lock:
+            for key in [key for key, session in self._cache.items() if session.flow_id == flow_id]:
+                del self._cache[key]
+
+    def expire(self, now: datetime | None = None) -> int:
+        """Delete sessions idle for longer than ``ttl``; returns how many."""
+        cutoff = ((now or datetime.now(timezone.utc)) - timedelta(seconds=self.ttl)).isoformat()
+        with get_db().write() as conn:
+            stale = conn.execute(
+                "SELECT instance_id, phone FROM flow_sessions WHERE resume_at IS NULL AND updated_at < ?", (cutoff,)
+            ).fetchall()
+            conn.execute("DELETE FROM flow_sessions WHERE resume_at IS NULL AND updated_at < ?", (cutoff,))
+        for instance_id, phone in stale:
+            self.discard(instance_id, phone)
+        return len(stale)
+
+    def __len__(self):
+        return len(self._cache)
+
+    def stats(self) -> dict:
+        return {"cached": len(self._cache), "capacity": self.capacity, "hits": self.hits,
+                "misses": self.misses, "expired": self.expired}
+
+
+class FlowEngine:
+    """Advances each contact through the active flows.
+
+    Incoming messages are queued by the receive routes and handled in order
+    by one worker thread, which also fires the :class:`FlowTimers` of
+    flows whose delay has passed. A contact has at most one running flow
+    per instance, stored in ``flow_sessions``; without one, the message is
+    offered to the instance's flows in order and the first that reacts
+    starts.
+
+    The worker never talks to Baileys: once a step is committed, its sends
+    are handed to the :class:`FanOutExecutor` queue of the instance, in
+    order per contact, so a rate-limited or slow instance does not hold
+    up other contacts or the timers.
+    """
+
+    def __init__(self, registry: FlowRegistry | None = None, queue_max: int = FLOW_QUEUE_MAX,
+                 timer_interval: float = FLOW_TIMER_INTERVAL, timers: FlowTimers | None = None,
+                 sessions: FlowSessionStore | None = None, fanout: FanOutExecutor | None = None):
+        self.registry = registry
+        self.fanout = fanout
+        self.timer_interval = timer_interval
+        self.timers = timers if timers is not None else FlowTimers()
+        self.sessions = sessions if sessions is not None else FlowSessionStore()
+        self._queue: queue.Queue = queue.Queue(maxsize=queue_max)
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+        # (instance_id, phone) -> sends not yet made, drained by one job at a time
+        self._outgoing: dict[tuple[str, str], deque] = {}
+        self._outgoing_done = threading.Condition()
+        self.processed = 0
+        self.dropped = 0
+
+    def _registry(self) -> FlowRegistry:
+        return self.registry or get_flow_registry()
+
+    def _fanout(self) -> FanOutExecutor:
+        return self.fanout or get_fanout()
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="whatsflow-flows", daemon=True)
+            self._thread.start()
+        return self._thread
+
+    def stop(self, timeout: float | None = 10):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self.flush(timeout)
+
+    def flush(self, timeout: float | None = None) -> bool:
+        """Wait until every queued flow send was made; False on timeout."""
+        with self._outgoing_done:
+            return self._outgoing_done.wait_for(lambda: not self._outgoing, timeout)
+
+    def submit(self, record: dict) -> bool:
+        """Queue a stored incoming message; False when the engine is not running or full."""
+        if self._thread is None or not self._thread.is_alive():
+            return False
+        try:
+            self._queue.put_nowait(record)
+            return True
+        except queue.Full:
+            self.dropped += 1
+            logger.warning(f"Fila de fluxos cheia: mensagem de {record['phone']} não processada")
+            return False
+
+    def _run(self):
+        next_expiry = time.monotonic() + FLOW_SESSION_SWEEP_INTERVAL
+        while not self._stop.is_set():
+            # Wake up every tick while timers are armed, so they fire on time
+            timeout = self.timers.tick if self.timers.armed else self.timer_interval
+            try:
+                record = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                record = None
+            if record is not None:
+                try:
+                    self.handle_message(record['instance_id'], record['phone'], record['message'])
+                except Exception as e:
+                    logger.error(f"Erro ao executar fluxo para {record['phone']}: {e}")
+            try:
+                self.resume_due()
+            except Exception as e:
+                logger.error(f"Erro ao retomar fluxos: {e}")
+            if time.monotonic() >= next_expiry:
+                next_expiry = time.monotonic() + FLOW_SESSION_SWEEP_INTERVAL
+                try:
+                    self.sessions.expire()
+                except Exception as e:
+                    logger.error(f"Erro ao expirar sessões de fluxo: {e}")
+
+    def handle_message(self, instance_id: str, phone: str, text: str, now: datetime | None = None) -> list:
+        """Advance *phone*'s flow with one incoming message; returns the actions run."""
+        now = now or datetime.now(timezone.utc)
+        registry = self._registry()
+        session = self.sessions.get(instance_id, phone, now)
+
+        flow, actions, stop, variables = None, [], None, session.variables
+        if session.flow_id is not None:
+            flow = registry.get(session.flow_id)
+            index = flow.index.get(session.node_id) if flow is not None else None
+            if index is not None and session.resume_at is not None:
+                # Waiting out a delay: the message does not move the flow
+                return []
+            if index is not None:
+                if flow.nodes[index].kind == "condition":
+                    # Keep the contact's answer to each question
+                    variables = {**(variables or {}), session.node_id: text}
+                actions, stop = execute_flow(flow, index, text)
+            if index is None or (not actions and stop is None):
+                # Stale session, or the answer led nowhere: offer the message to every flow
+                flow, variables = None, None
+        if flow is None:
+            for candidate in registry.candidates(instance_id, text):
+                actions, stop = execute_flow(candidate, candidate.start, text)
+                if actions or stop is not None:
+                    flow = candidate
+                    break
+
+        self._advance(session, flow, actions, stop, now, variables=variables)
+        self.processed += 1
+        return actions
+
+    def resume_due(self, now: datetime | None = None) -> int:
+        """Fire the timers due by *now*; returns how many flows continued."""
+        now = now or datetime.now(timezone.utc)
+        return sum(self.fire(timer_id, now) for timer_id in self.timers.due(now))
+
+    def fire(self, timer_id: int, now: datetime) -> bool:
+        """Continue the flow paused by *timer_id*; False if it already fired or was cancelled."""
+        with get_db().read() as conn:
+            timer = conn.execute(
+                "SELECT instance_id, phone, flow_id, node_id FROM flow_timers WHERE id = ?", (timer_id,)
+            ).fetchone()
+        if timer is None:
+            return False
+        instance_id, phone, flow_id, node_id = timer
+        session = self.sessions.get(instance_id, phone, now)
+        flow = self._registry().get(flow_id)
+        index = flow.index.get(node_id) if flow is not None else None
+        if index is None:
+            return self._advance(session, None, [], None, now, timer_id)
+        actions, stop = execute_flow(flow, index, None)
+        return self._advance(session, flow, actions, stop, now, timer_id, session.variables)
+
+    def _advance(self, session: FlowSession, flow: CompiledFlow | None, actions: list, stop, now: datetime,
+                 timer_id: int | None = None, variables: dict | None = None) -> bool:
+        """Store where the contact stopped and its tag changes, then send.
+
+        With *timer_id*, the timer is consumed in the same transaction and
+        nothing happens when another run already consumed it.
+        """
+        instance_id, phone = session.instance_id, session.phone
+        stamp = now.isoformat()
+        tags = set(session.tags)
+        if flow is None or stop is None or stop[1] < 0:
+            updated = FlowSession(instance_id, phone, touched=now.timestamp())
+        else:
+            delay = stop[2] if stop[0] == "delay" else None
+            updated = FlowSession(instance_id, phone, flow.id, flow.nodes[stop[1]].id,
+                                  now.timestamp() + delay if delay is not None else None, variables,
+                                  touched=now.timestamp())
+        with get_db().write() as conn:
+            if timer_id is not None:
+                if conn.execute("DELETE FROM flow_timers WHERE id = ?", (timer_id,)).rowcount == 0:
+                    return False
+                self.timers.fired += 1
+            self.sessions.write(conn, updated)
+            if updated.resume_at is not None:
+                self.timers.schedule(conn, instance_id, phone, updated.flow_id, updated.node_id,
+                                     now + timedelta(seconds=stop[2]))
+            else:
+                self.timers.cancel(conn, instance_id, phone)
+            for kind, params, _ in actions:
+                if kind == "tag" and params["tag"]:
+                    if params["action"] == "remove":
+                        tags.discard(params["tag"])
+                        conn.execute("DELETE FROM contact_tags WHERE instance_id = ? AND phone = ? AND tag = ?",
+                                     (instance_id, phone, params["tag"]))
+                    else:
+                        tags.add(sys.intern(params["tag"]))
+                        conn.execute("""
+                            INSERT INTO contact_tags (instance_id, phone, tag, created_at) VALUES (?, ?, ?, ?)
+                            ON CONFLICT DO NOTHING
+                        """, (instance_id, phone, params["tag"], stamp))
+        updated.tags = tuple(sorted(tags)) if tags else ()
+        self.sessions.put(updated)
+
+        sends = [(kind, params, node_id) for kind, params, node_id in actions
+                 if (kind == "message" and params["text"]) or kind == "media"]
+        if sends:
+            self._post(instance_id, phone, sends)
+        return True
+
+    def _post(self, instance_id: str, phone: str, sends: list):
+        """Hand *sends* to the instance's send queue, after any still pending for *phone*."""
+        key = (instance_id, phone)
+        with self._outgoing_done:
+            pending = self._outgoing.get(key)
+            if pending is not None:
+                # A job for this contact is queued or running and will make these too
+                pending.extend(sends)
+                return
+            self._outgoing[key] = deque(sends)
+        self._fanout().submit(instance_id, lambda: self._deliver(key))
+
+    def _deliver(self, key: tuple[str, str]):
+        instance_id, phone = key
+        while True:
+            with self._outgoing_done:
+                pending = self._outgoing[key]
+                if not pending:
+                    del self._outgoing[key]
+                    self._outgoing_done.notify_all()
+                    return
+                kind, params, node_id = pending.popleft()
+            try:
+                if kind == "message":
+                    self._send(instance_id, phone, params["text"], None, None)
+                    continue
+                media_path = params["media_path"]
+                if params["media_id"]:
+                    stored = get_media_store().info(params["media_id"])
+                    media_path = stored["path"] if stored else None
+                if media_path:
+                    self._send(instance_id, phone, None, params["media_type"], media_path)
+                else:
+                    logger.warning(f"Nó de mídia {node_id} sem arquivo: envio ignorado")
+            except Exception as e:
+                logger.error(f"Erro ao enviar mensagem do fluxo para {phone}: {e}")
+
+    def _send(self, instance_id: str, phone: str, content: str | None, media_type: str | None, media_path: str | None):
+        try:
+            baileys_send_message(instance_id, build_send_payload(phone, content, media_type, media_path))
+        except (BaileysError, OSError) as e:
+            logger.error(f"Envio do fluxo para {phone} falhou: {e}")
+            with get_db().write() as conn:
+                enqueue_outbox(conn, instance_id, phone, content, media_type, media_path, error=str(e))
+            get_outbox_worker().wake()
+            return
+        now = datetime.now(timezone.utc).isoformat()
+        with get_db().write() as conn:
+            conn.execute("""
+                INSERT INTO messages (id, contact_name, phone, message, direction, instance_id, message_type, created_at)
+                VALUES (?, ?, ?, ?, 'outgoing', ?, ?, ?)
+            """, (str(uuid.uuid4()), f"Para {phone[-4:]}", phone, content or "", instance_id, media_type or "text", now))
+            upsert_chat_summary(conn, phone, instance_id, f"Para {phone[-4:]}", content or f"[{media_type}]", now,
+                                incoming=False)
+
+    def stats(self) -> dict:
+        with get_db().read() as conn:
+            waiting = conn.execute("SELECT COUNT(*) FROM flow_sessions").fetchone()[0]
+        registry = self._registry()
+        registry._ensure_loaded()
+        return {
+            "active_flows": len(registry._flows),
+            "compiles": registry.compiles,
+            "trigger_keywords": registry.triggers.keywords,
+            "sessions": waiting,
+            "timers_pending": self.timers.pending(),
+            "timers_armed": self.timers.armed,
+            "timers_fired": self.timers.fired,
+            "session_cache": self.sessions.stats(),
+            "queued": self._queue.qsize(),
+            "sends_pending": sum(len(pending) for pending in list(self._outgoing.values())),
+            "processed": self.processed,
+            "dropped": self.dropped,
+        }
+
+
+_flow_engine: FlowEngine | None = None
+_flow_engine_lock = threading.Lock()
+
+
+def get_flow_engine() -> FlowEngine:
+    global _flow_engine
+    with _flow_engine_lock:
+        if _flow_engine is None:
+            _flow_engine = FlowEngine()
+        return _flow_engine
+
+
+def load_flow(flow_id: str) -> CompiledFlow | None:
+    """Compile a stored flow whether or not it is active; None if it does not exist.
+
+    Raises :class:`FlowCompileError` when the flow cannot run.
+    """
+    with get_db().read() as conn:
+        row = conn.execute(
+            "SELECT rowid, id, name, nodes, edges, instance_id FROM flows WHERE id = ?", (flow_id,)
+        ).fetchone()
+    if row is None:
+        return None
+    try:
+        return compile_flow(row["id"], row["nodes"], row["edges"], row["name"], row["instance_id"], row["rowid"])
+    except json.JSONDecodeError as e:
+        raise FlowCompileError(f"JSON inválido: {e}") from None
+
+
+class FlowSimulator:
+    """Dry run of one compiled flow: no sends, no database, no timers.
+
+    Follows the engine's rules for each contact, with the state held in a
+    dict. Delays are not waited for: the flow continues at once and the
+    skipped seconds are reported.
+    """
 
-                # compute next run
-                next_dt = compute_next_run(schedule_type, weekday or 0, send_time)
-                cursor.execute(
-                    "UPDATE campaign_messages SET next_run=? WHERE id=?",
-                    (next_dt.isoformat(), msg_id),
-                )
-            conn.commit()
-            conn.close()
-        except Exception:
-            pass
+    def __init__(self, flow: CompiledFlow, default_phone: str = "simulacao"):
+        self.flow = flow
+        self.default_phone = default_phone
+        self._waiting: dict[str, int] = {}  # phone -> condition waiting for its reply
+
+    def feed(self, phone: str | None, text: str | None) -> dict:
+        """Run one message from *phone*; returns the path taken and what it did."""
+        flow = self.flow
+        phone = phone or self.default_phone
+        path, delays = [], []
+        index = self._waiting.pop(phone, None)
+        actions, stop = [], None
+        if index is not None:
+            actions, stop = execute_flow(flow, index, text, path=path)
+        if index is None or (not actions and stop is None):
+            actions, stop = execute_flow(flow, flow.start, text, path=path)
+        triggered = bool(actions) or stop is not None
+        while stop is not None and stop[0] == "delay":
+            delays.append(stop[2])
+            more, stop = execute_flow(flow, stop[1], None, path=path)
+            actions.extend(more)
+        if stop is not None and stop[1] >= 0:
+            self._waiting[phone] = stop[1]
+        return {
+            "phone": phone,
+            "message": text,
+            "triggered": triggered,
+            "path": path,
+            "actions": [{"type": kind, "node_id": node_id, **params} for kind, params, node_id in actions],
+            "delays": delays,
+            "waiting_at": flow.nodes[stop[1]].id if stop is not None and stop[1] >= 0 else None,
+        }
 
-        time.sleep(60)
 
+def _message_fields(item) -> tuple:
+    if isinstance(item, str):
+        return None, item
+    return (str(item["phone"]) if item.get("phone") else None), str(item.get("message") or "")
+
+
+def recorded_messages(instance_id: str | None = None, phone: str | None = None, limit: int = 1000) -> list[dict]:
+    """The latest *limit* incoming messages, oldest first, to replay through a flow."""
+    where, params = ["direction = 'incoming'"], []
+    if instance_id:
+        where.append("instance_id = ?")
+        params.append(instance_id)
+    if phone:
+        where.append("phone = ?")
+        params.append(phone)
+    with get_db().read() as conn:
+        rows = conn.execute(f"""
+            SELECT phone, message FROM messages WHERE {' AND '.join(where)}
+            ORDER BY created_at DESC, rowid DESC LIMIT ?
+        """, (*params, limit)).fetchall()
+    return [{"phone": row["phone"], "message": row["message"]} for row in reversed(rows)]
+
+
+def synthetic_messages(flow: CompiledFlow, count: int, contacts: int = 100, seed: int = 0) -> list[dict]:
+    """Messages mixing the flow's keywords with other words, spread over *contacts*."""
+    rng = random.Random(seed)
+    keywords = [keyword for node in flow.nodes if node.kind == "condition" for keyword in node.params["keywords"]]
+    filler = "oi bom dia obrigado quero saber mais informações ok talvez depois".split()
+    messages = []
+    for i in range(count):
+        words = rng.choices(filler, k=rng.randint(1, 6))
+        if keywords and rng.random() < 0.5:
+            words.insert(rng.randrange(len(words) + 1), rng.choice(keywords))
+        messages.append({"phone": f"5500000{i % contacts:05d}", "message": " ".join(words)})
+    return messages
+
+
+def _percentile(sorted_values: list, fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def simulate_flow(flow: CompiledFlow, messages) -> dict:
+    """Replay *messages* through *flow*; returns each message's result and the latency."""
+    simulator = FlowSimulator(flow)
+    results, timings = [], []
+    for item in messages:
+        phone, text = _message_fields(item)
+        started = time.perf_counter()
+        results.append(simulator.feed(phone, text))
+        timings.append(time.perf_counter() - started)
+    timings.sort()
+    return {
+        "flow_id": flow.id,
+        "name": flow.name,
+        "warnings": list(flow.warnings),
+        "count": len(results),
+        "triggered": sum(result["triggered"] for result in results),
+        "p50_us": round(_percentile(timings, 0.50) * 1e6, 2),
+        "p99_us": round(_percentile(timings, 0.99) * 1e6, 2),
+        "results": results,
+    }
 
-def start_campaign_scheduler():
-    thread = threading.Thread(target=campaign_scheduler_loop, daemon=True)
-    thread.start()
-    return thread
 
+def benchmark_flow(flow: CompiledFlow, messages: list, rounds: int = 3) -> dict:
+    """Per-message evaluation latency and peak memory of *flow* over *messages*.
 
-def send_scheduled_message(group_id: str, content: str, media_type: str | None, media_path: str | None, instance_id: str = "default") -> bool:
-    """Send a scheduled message through the Baileys service."""
-    url = f"{BAILEYS_URL}/send/{instance_id}"
-    data = {"to": group_id}
-    if media_type and media_type != "text" and media_path:
-        try:
-            with open(media_path, "rb") as f:
-                encoded = base64.b64encode(f.read()).decode()
-            data[media_type] = encoded
-        except Exception as e:
-            logger.error(f"Failed to read media file: {e}")
-            return False
-    else:
-        data["message"] = content
+    Latency comes from *rounds* untraced passes; peak memory from one more
+    pass under tracemalloc, which would otherwise slow the timings.
+    """
+    fields = [_message_fields(item) for item in messages]
+    timings = []
+    for _ in range(rounds):
+        simulator = FlowSimulator(flow)
+        for phone, text in fields:
+            started = time.perf_counter_ns()
+            simulator.feed(phone, text)
+            timings.append(time.perf_counter_ns() - started)
+    timings.sort()
+    tracemalloc.start()
+    try:
+        simulator = FlowSimulator(flow)
+        for phone, text in fields:
+            simulator.feed(phone, text)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    total = sum(timings) / 1e9
+    return {
+        "flow_id": flow.id,
+        "nodes": len(flow.nodes),
+        "messages": len(timings),
+        "p50_us": round(_percentile(timings, 0.50) / 1000, 2),
+        "p99_us": round(_percentile(timings, 0.99) / 1000, 2),
+        "messages_per_second": round(len(timings) / total) if total else 0,
+        "peak_memory_kb": round(peak / 1024, 1),
+    }
 
+
+def read_message_file(path: str) -> list:
+    """Messages from a JSON array or an NDJSON file ('-' reads stdin)."""
+    f = sys.stdin if path == "-" else open(path, encoding="utf-8")
+    try:
+        text = f.read()
+    finally:
+        if f is not sys.stdin:
+            f.close()
+    if text.lstrip().startswith("["):
+        return json.loads(text)
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+
+def run_flow_cli(flow_id: str, messages_path: str | None, bench: bool, count: int) -> int:
+    """``--simulate-flow`` / ``--bench-flow``; returns the exit status."""
+    init_db()
     try:
-        baileys_post(url, data)
+        flow = load_flow(flow_id)
+    except FlowCompileError as e:
+        print(f"❌ Fluxo inválido: {e}")
+        return 1
+    if flow is None:
+        print(f"❌ Fluxo {flow_id} não encontrado")
+        return 1
+    for warning in flow.warnings:
+        print(f"⚠️ {warning}")
+    messages = read_message_file(messages_path) if messages_path else recorded_messages(limit=count)
+    if bench:
+        if not messages:
+            messages = synthetic_messages(flow, count)
+            print(f"🧪 Sem mensagens gravadas: usando {len(messages)} mensagens sintéticas")
+        stats = benchmark_flow(flow, messages)
+        print(f"⏱️ Fluxo '{flow.name}' ({stats['nodes']} nós), {stats['messages']} mensagens avaliadas")
+        print(f"   p50: {stats['p50_us']} µs  p99: {stats['p99_us']} µs  ({stats['messages_per_second']} msg/s)")
+        print(f"   pico de memória: {stats['peak_memory_kb']} KB")
+        return 0
+    report = simulate_flow(flow, messages)
+    for result in report["results"]:
+        path = " → ".join(result["path"]) or "(não acionado)"
+        print(f"📨 {result['phone']}: {result['message']!r}")
+        print(f"   {path}")
+        for action in result["actions"]:
+            print(f"   ↳ {action['type']}: {action.get('text') or action.get('tag') or action.get('media_path') or ''}")
+    print(f"✅ {report['count']} mensagens, {report['triggered']} acionaram o fluxo "
+          f"(p50 {report['p50_us']} µs, p99 {report['p99_us']} µs)")
+    return 0
+
+
+class ChangeFeed:
+    """Reads the ``changes`` log for /api/sync and lets clients wait on it.
+
+    Each change is ``{"seq", "entity", "op", "id", "data"}``, where ``data``
+    is the row as it is now (``None`` once deleted). ``seq`` only grows, so a
+    client keeps the cursor of its last page and asks for what came after
+    it. Long-polls and event streams sleep on the database's commit
+    notifier and only query again after a commit, so an idle client costs
+    no queries. At most ``max_waiters`` requests wait at a time, since each
+    one holds an HTTP worker.
+    """
+
+    def __init__(self, max_waiters: int = SYNC_MAX_WAITERS):
+        self.max_waiters = max(0, max_waiters)
+        self._slots = threading.BoundedSemaphore(self.max_waiters) if self.max_waiters else None
+        self._closed = threading.Event()
+        self._lock = threading.Lock()
+        self.waiting = 0
+
+    def fetch(self, entities, since: int = 0, limit: int = SYNC_PAGE_SIZE,
+              instance_id: str | None = None, phone: str | None = None) -> dict:
+        """Changes to *entities* after *since*, oldest first, at most *limit*.
+
+        ``cursor`` is the *since* of the next call. When ``has_more`` is
+        false the caller is up to date as of this read, even if no change
+        matched its filters.
+        """
+        where = [f"entity IN ({', '.join('?' * len(entities))})", "seq > ?", "seq <= ?"]
+        with get_db().read() as conn:
+            head = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM changes").fetchone()[0]
+            params = [*entities, since, head]
+            if instance_id:
+                where.append("instance_id = ?")
+                params.append(instance_id)
+            if phone:
+                where.append("phone = ?")
+                params.append(phone)
+            rows = conn.execute(
+                f"SELECT seq, entity, entity_id, op FROM changes WHERE {' AND '.join(where)} ORDER BY seq LIMIT ?",
+                (*params, limit),
+            ).fetchall()
+
+            current = {}
+            for entity in {row[1] for row in rows if row[3] == "upsert"}:
+                ids = [row[2] for row in rows if row[1] == entity and row[3] == "upsert"]
+                table = SYNC_ENTITIES[entity][0]
+                current[entity] = {
+                    row["id"]: dict(row)
+                    for row in conn.execute(
+                        f"SELECT * FROM {table} WHERE id IN ({', '.join('?' * len(ids))})", ids
+                    )
+                }
+
+        changes = []
+        for seq, entity, entity_id, op in rows:
+            # A row deleted since the log was read counts as deleted already
+            data = current.get(entity, {}).get(entity_id)
+            changes.append({
+                "seq": seq,
+                "entity": entity,
+                "op": "upsert" if data is not None else "delete",
+                "id": entity_id,
+                "data": data,
+            })
+        has_more = len(rows) == limit
+        return {
+            "changes": changes,
+            "cursor": rows[-1][0] if has_more else head,
+            "has_more": has_more,
+        }
+
+    def acquire(self) -> bool:
+        """Take a waiter slot; False when all of them are in use."""
+        if self._slots is None or not self._slots.acquire(blocking=False):
+            return False
+        with self._lock:
+            self.waiting += 1
         return True
-    except Exception as e:
-        logger.error(f"Scheduled message send failed: {e}")
-        return False
 
+    def release(self):
+        with self._lock:
+            self.waiting -= 1
+        self._slots.release()
+
+    def wait(self, entities, since: int, timeout: float, **filters) -> dict:
+        """Like :meth:`fetch`, but hold on up to *timeout* seconds for a change.
+
+        Answers right away when every waiter slot is taken.
+        """
+        db = get_db()
+        seen = db.commit_count
+        page = self.fetch(entities, since, **filters)
+        if page["changes"] or timeout <= 0 or not self.acquire():
+            return page
+        try:
+            deadline = time.monotonic() + timeout
+            while not page["changes"] and not self._closed.is_set():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                # Wake up every second to notice close()
+                count = db.wait_for_commit(seen, min(remaining, 1.0))
+                if count != seen:
+                    seen = count
+                    page = self.fetch(entities, page["cursor"], **filters)
+        finally:
+            self.release()
+        return page
+
+    def stream(self, entities, since: int, keepalive: float = SYNC_KEEPALIVE, **filters):
+        """Yield each page of changes after *since* as it is committed.
+
+        Yields ``None`` after *keepalive* seconds without changes, so the
+        caller can ping the client. The caller holds a slot from
+        :meth:`acquire`; the generator ends on :meth:`close`.
+        """
+        db = get_db()
+        seen = None
+        idle = 0.0
+        while not self._closed.is_set():
+            count = db.commit_count
+            if count != seen:
+                seen = count
+                page = self.fetch(entities, since, **filters)
+                since = page["cursor"]
+                if page["changes"]:
+                    idle = 0.0
+                    yield page
+                    if page["has_more"]:
+                        seen = None
+                    continue
+            if idle >= keepalive:
+                idle = 0.0
+                yield None
+            started = time.monotonic()
+            db.wait_for_commit(seen, 1.0)
+            idle += time.monotonic() - started
+
+    def close(self):
+        """Release waiting requests so the HTTP server can shut down."""
+        self._closed.set()
+
+    def stats(self) -> dict:
+        with get_db().read() as conn:
+            head = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM changes").fetchone()[0]
+        return {"cursor": head, "waiting": self.waiting, "max_waiters": self.max_waiters}
+
+
+_change_feed: ChangeFeed | None = None
+_change_feed_lock = threading.Lock()
+
+
+def get_change_feed() -> ChangeFeed:
+    global _change_feed
+    with _change_feed_lock:
+        if _change_feed is None:
+            _change_feed = ChangeFeed()
+        return _change_feed
 
-def process_scheduled_messages(now: datetime | None = None):
-    """Dispatch scheduled messages due at or before *now*.
 
-    Args:
-        now: Optional datetime to use for comparisons. If omitted, current
-             UTC time is used.
+# WebSocket Server Functions
+class WebSocketHub:
+    """Thread-safe bridge from any thread to the WebSocket event loop.
+
+    :meth:`publish` can be called from HTTP handlers, the ingest queue or the
+    scheduler. It serializes the event once and hands it to the loop with
+    ``call_soon_threadsafe``, so it never blocks the caller. On the loop each
+    client gets a bounded queue and its own writer, so a slow browser only
+    delays itself. A client whose queue fills up, or whose send takes longer
+    than WS_SEND_TIMEOUT, is disconnected.
+
+    Events carry topics such as ``instance:<id>``, ``chat:<phone>``,
+    ``campaign:<id>`` and ``connection``. A client that sends
+    ``{"action": "subscribe", "topics": [...]}`` (or connects with
+    ``?topics=a,b``) only receives events for those topics; clients that
+    never subscribe receive everything. Routing uses a topic index, so the
+    cost of an event depends on its subscribers, not on all clients.
     """
-    now = now or datetime.now(timezone.utc)
-    if now.tzinfo is None:
-        now_cmp = now.replace(tzinfo=timezone.utc)
-    else:
-        now_cmp = now.astimezone(timezone.utc)
-
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute(
-        "SELECT id, campaign_id, content, media_type, media_path, next_run, status FROM scheduled_messages WHERE status='pending'"
-    )
-    rows = cursor.fetchall()
 
-    for sched_id, campaign_id, content, media_type, media_path, next_run_str, status in rows:
+    def __init__(self, queue_max: int = WS_CLIENT_QUEUE_MAX, send_timeout: float = WS_SEND_TIMEOUT):
+        self.queue_max = queue_max
+        self.send_timeout = send_timeout
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._clients: dict[Any, asyncio.Queue] = {}
+        # Loop-thread only: topic -> clients, client -> topics, and clients
+        # without subscriptions
+        self._subscribers: dict[str, set] = {}
+        self._topics: dict[Any, set[str]] = {}
+        self._firehose: set = set()
+        self._published = 0
+        self._delivered = 0
+        self._slow_disconnects = 0
+
+    def attach(self, loop: asyncio.AbstractEventLoop):
+        """Bind the hub to the loop that runs the WebSocket server."""
+        self._loop = loop
+
+    def publish(self, event: Dict[str, Any], topics=()) -> bool:
+        """Queue *event* for subscribers of *topics*; False when no loop runs."""
+        loop = self._loop
+        if loop is None or loop.is_closed():
+            return False
+        topics = tuple(topics)
+        message = json.dumps(dict(event, topics=list(topics)), default=str)
         try:
-            next_run_dt = datetime.fromisoformat(next_run_str)
-        except Exception:
-            continue
-        if next_run_dt.tzinfo is None:
-            next_run_dt = next_run_dt.replace(tzinfo=timezone.utc)
+            loop.call_soon_threadsafe(self._dispatch, message, topics)
+        except RuntimeError:  # loop closed meanwhile
+            return False
+        self._published += 1
+        return True
+
+    def _dispatch(self, message: str, topics: tuple = ()):
+        recipients = set(self._firehose)
+        for topic in topics:
+            recipients.update(self._subscribers.get(topic, ()))
+        for client in recipients:
+            pending = self._clients.get(client)
+            if pending is None:
+                continue
+            try:
+                pending.put_nowait(message)
+            except asyncio.QueueFull:
+                self._drop(client, "cliente lento")
+
+    def subscribe(self, client, topics):
+        """Route only events of *topics* (plus earlier subscriptions) to *client*."""
+        subscribed = self._topics.setdefault(client, set())
+        self._firehose.discard(client)
+        for topic in topics:
+            subscribed.add(topic)
+            self._subscribers.setdefault(topic, set()).add(client)
+
+    def unsubscribe(self, client, topics):
+        subscribed = self._topics.get(client, set())
+        for topic in topics:
+            subscribed.discard(topic)
+            clients = self._subscribers.get(topic)
+            if clients is not None:
+                clients.discard(client)
+                if not clients:
+                    del self._subscribers[topic]
+
+    def _forget(self, client):
+        self._clients.pop(client, None)
+        self._firehose.discard(client)
+        self.unsubscribe(client, list(self._topics.pop(client, ())))
+
+    async def _read(self, client):
+        """Apply subscribe/unsubscribe requests until the client goes away."""
+        if not hasattr(client, "__aiter__"):
+            await client.wait_closed()
+            return
+        async for raw in client:
+            try:
+                request = json.loads(raw)
+                action = request.get("action")
+                topics = [str(t) for t in request.get("topics", [])]
+            except (ValueError, AttributeError, TypeError):
+                continue
+            if action == "subscribe":
+                self.subscribe(client, topics)
+            elif action == "unsubscribe":
+                self.unsubscribe(client, topics)
+            else:
+                continue
+            reply = {"type": "subscriptions", "topics": sorted(self._topics.get(client, ()))}
+            try:
+                self._clients[client].put_nowait(json.dumps(reply))
+            except (KeyError, asyncio.QueueFull):
+                pass
+
+    def _drop(self, client, reason: str):
+        if client not in self._clients:
+            return
+        self._forget(client)
+        self._slow_disconnects += 1
+        logger.warning(f"⚠️ Cliente WebSocket desconectado: {reason}")
+        close = getattr(client, "close", None)
+        if close is not None:
+            asyncio.ensure_future(close(code=1013, reason=reason))
+
+    async def _write(self, client, pending: asyncio.Queue):
+        while True:
+            message = await pending.get()
+            try:
+                await asyncio.wait_for(client.send(message), self.send_timeout)
+            except asyncio.TimeoutError:
+                self._drop(client, "envio lento")
+                return
+            self._delivered += 1
+
+    async def serve(self, client, topics=()):
+        """Register *client* and feed it events until it disconnects."""
+        pending: asyncio.Queue = asyncio.Queue(maxsize=self.queue_max)
+        self._clients[client] = pending
+        if topics:
+            self.subscribe(client, topics)
         else:
-            next_run_dt = next_run_dt.astimezone(timezone.utc)
+            self._firehose.add(client)
+        logger.info(f"📱 Cliente WebSocket conectado. Total: {len(self._clients)}")
+        tasks = {asyncio.ensure_future(self._write(client, pending))}
+        if hasattr(client, "__aiter__") or hasattr(client, "wait_closed"):
+            tasks.add(asyncio.ensure_future(self._read(client)))
+        try:
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if not task.cancelled() and task.exception() is not None:
+                    logger.info(f"📱 Cliente WebSocket encerrado: {task.exception()}")
+        finally:
+            for task in tasks:
+                task.cancel()
+            self._forget(client)
+            logger.info(f"📱 Cliente WebSocket desconectado. Total: {len(self._clients)}")
+
+    def stats(self) -> dict:
+        return {
+            "clients": len(self._clients),
+            "published": self._published,
+            "delivered": self._delivered,
+            "slow_disconnects": self._slow_disconnects,
+            "queued": sum(q.qsize() for q in list(self._clients.values())),
+            "topics": len(self._subscribers),
+        }
 
-        if next_run_dt <= now_cmp:
-            cursor.execute("SELECT group_id FROM campaign_groups WHERE campaign_id=?", (campaign_id,))
-            groups = [g[0] for g in cursor.fetchall()]
-            for group in groups:
-                send_scheduled_message(group, content, media_type, media_path)
 
-            cursor.execute(
-                "SELECT recurrence, send_time, weekday, timezone FROM campaigns WHERE id=?",
-                (campaign_id,),
-            )
-            row = cursor.fetchone()
-            if row and row[0] in ("daily", "weekly"):
-                recurrence, send_time, weekday, tz = row
-                next_dt = calculate_next_run(recurrence, send_time, weekday, tz, now=now_cmp)
-                cursor.execute(
-                    "UPDATE scheduled_messages SET next_run=?, status='pending' WHERE id=?",
-                    (next_dt.isoformat(), sched_id),
-                )
-            else:
-                cursor.execute(
-                    "UPDATE scheduled_messages SET status='sent' WHERE id=?",
-                    (sched_id,),
-                )
+_ws_hub: WebSocketHub | None = None
+_ws_hub_lock = threading.Lock()
 
-    conn.commit()
-    conn.close()
 
+def get_ws_hub() -> WebSocketHub:
+    global _ws_hub
+    with _ws_hub_lock:
+        if _ws_hub is None:
+            _ws_hub = WebSocketHub()
+        return _ws_hub
 
-def _scheduled_loop():
-    while True:
-        try:
-            process_scheduled_messages()
-        except Exception as e:
-            logger.error(f"Scheduler loop error: {e}")
-        time.sleep(60)
 
+def message_topics(record: dict) -> tuple[str, ...]:
+    return (f"instance:{record['instance_id']}", f"chat:{record['phone']}")
 
-def start_scheduled_dispatcher():
-    thread = threading.Thread(target=_scheduled_loop, daemon=True)
-    thread.start()
-    return thread
 
+def message_event(record: dict) -> dict:
+    """WebSocket event for a stored incoming message."""
+    return {
+        'type': 'new_message',
+        'message': {
+            'id': record['id'],
+            'contact_name': record['contact_name'],
+            'phone': record['phone'],
+            'message': record['message'],
+            'direction': 'incoming',
+            'instance_id': record['instance_id'],
+            'created_at': record['timestamp'],
+        },
+    }
 
-# WebSocket Server Functions
-if WEBSOCKETS_AVAILABLE:
-    async def websocket_handler(websocket, path):
-        """Handle WebSocket connections"""
-        websocket_clients.add(websocket)
-        logger.info(f"📱 Cliente WebSocket conectado. Total: {len(websocket_clients)}")
-        
-        try:
-            await websocket.wait_closed()
-        except websockets.exceptions.ConnectionClosed:
-            pass
-        finally:
-            websocket_clients.discard(websocket)
-            logger.info(f"📱 Cliente WebSocket desconectado. Total: {len(websocket_clients)}")
 
-    async def broadcast_message(message_data: Dict[str, Any]):
-        """Broadcast message to all connected WebSocket clients"""
-        if not websocket_clients:
-            return
-        
-        message = json.dumps(message_data)
-        disconnected_clients = set()
-        
-        for client in websocket_clients:
-            try:
-                await client.send(message)
-            except websockets.exceptions.ConnectionClosed:
-                disconnected_clients.add(client)
-            except Exception as e:
-                logger.error(f"❌ Erro ao enviar mensagem WebSocket: {e}")
-                disconnected_clients.add(client)
-        
-        # Remove disconnected clients
-        for client in disconnected_clients:
-            websocket_clients.discard(client)
+if WEBSOCKETS_AVAILABLE:
+    async def websocket_handler(websocket, path=None):
+        """Handle WebSocket connections; ``?topics=a,b`` subscribes on connect"""
+        if path is None:
+            request = getattr(websocket, "request", None)
+            path = getattr(request, "path", None) or getattr(websocket, "path", "")
+        query = urllib.parse.parse_qs(urllib.parse.urlparse(path or "").query)
+        topics = [t for value in query.get("topics", []) for t in value.split(",") if t]
+        await get_ws_hub().serve(websocket, topics)
 
     async def _websocket_server():
+        get_ws_hub().attach(asyncio.get_running_loop())
         async with websockets.serve(
             websocket_handler,
             "0.0.0.0",
@@ -465,23 +4355,19 @@ else:
 
 
 def add_sample_data():
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    
-    cursor.execute("SELECT COUNT(*) FROM instances")
-    if cursor.fetchone()[0] > 0:
-        conn.close()
-        return
-    
-    current_time = datetime.now(BR_TZ).astimezone(timezone.utc).isoformat()
-    
-    # Sample instance
-    instance_id = str(uuid.uuid4())
-    cursor.execute("INSERT INTO instances (id, name, contacts_count, messages_today, created_at) VALUES (?, ?, ?, ?, ?)",
-                  (instance_id, "WhatsApp Principal", 0, 0, current_time))
-    
-    conn.commit()
-    conn.close()
+    with get_db().write() as conn:
+        cursor = conn.cursor()
+
+        cursor.execute("SELECT COUNT(*) FROM instances")
+        if cursor.fetchone()[0] > 0:
+            return
+
+        current_time = datetime.now(BR_TZ).astimezone(timezone.utc).isoformat()
+
+        # Sample instance
+        instance_id = str(uuid.uuid4())
+        cursor.execute("INSERT INTO instances (id, name, contacts_count, messages_today, created_at) VALUES (?, ?, ?, ?, ?)",
+                      (instance_id, "WhatsApp Principal", 0, 0, current_time))
 
 # Baileys Service Manager
 class BaileysManager:
@@ -533,6 +4419,7 @@ const makeWASocket = require('@whiskeysockets/baileys').default;
 const qrTerminal = require('qrcode-terminal');
 const fs = require('fs');
 const path = require('path');
+const net = require('net');
 
 const app = express();
 app.use(cors({
@@ -541,7 +4428,7 @@ app.use(cors({
     methods: ['GET', 'POST', 'PUT', 'DELETE', 'PATCH', 'OPTIONS'],
     allowedHeaders: ['Content-Type', 'Authorization', 'Accept']
 }));
-app.use(express.json());
+app.use(express.json({ limit: '25mb' }));
 
 // Global state management
 let instances = new Map(); // instanceId -> { sock, qr, connected, connecting, user }
@@ -717,10 +4604,19 @@ async function connectInstance(instanceId) {
                         const chats = await sock.getChats();
                         console.log(`📊 ${chats.length} conversas encontradas`);
                         
-                        // Process chats in batches to avoid overwhelming the system
-                        const batchSize = 20;
+                        // Process chats in batches; the backend writes each batch
+                        // with set-based upserts, so batches can be large
+                        const batchSize = 500;
                         for (let i = 0; i < chats.length; i += batchSize) {
-                            const batch = chats.slice(i, i + batchSize);
+                            // Only send the fields the import uses
+                            const batch = chats.slice(i, i + batchSize).map(chat => ({
+                                id: chat.id,
+                                name: chat.name,
+                                unreadCount: chat.unreadCount,
+                                messages: chat.messages && chat.messages.length > 0
+                                    ? [chat.messages[chat.messages.length - 1]]
+                                    : []
+                            }));
                             
                             // Send batch to Python backend
                             const fetch = (await import('node-fetch')).default;
@@ -739,7 +4635,7 @@ async function connectInstance(instanceId) {
                             console.log(`📦 Lote ${Math.floor(i / batchSize) + 1}/${Math.ceil(chats.length / batchSize)} enviado`);
                             
                             // Small delay between batches
-                            await new Promise(resolve => setTimeout(resolve, 1000));
+                            await new Promise(resolve => setTimeout(resolve, 100));
                         }
                         
                         console.log('✅ Importação de conversas concluída');
@@ -779,9 +4675,9 @@ async function connectInstance(instanceId) {
         
         // Handle incoming messages with better error handling
         sock.ev.on('messages.upsert', async (m) => {
-            const messages = m.messages;
+            const batch = [];
             
-            for (const message of messages) {
+            for (const message of m.messages) {
                 if (!message.key.fromMe && message.message) {
                     const from = message.key.remoteJid;
                     const messageText = message.message.conversation || 
@@ -797,38 +4693,59 @@ async function connectInstance(instanceId) {
                     console.log(`👤 Contato: ${contactName || from.split('@')[0]} (${from.split('@')[0]})`);
                     console.log(`💬 Mensagem: ${messageText.substring(0, 50)}...`);
                     
-                    // Send to Python backend with retry logic
-                    let retries = 3;
-                    while (retries > 0) {
-                        try {
-                            const fetch = (await import('node-fetch')).default;
-                            const response = await fetch('http://localhost:8889/api/messages/receive', {
-                                method: 'POST',
-                                headers: { 'Content-Type': 'application/json' },
-                                body: JSON.stringify({
-                                    instanceId: instanceId,
-                                    from: from,
-                                    message: messageText,
-                                    pushName: pushName,
-                                    contactName: contactName,
-                                    timestamp: new Date().toISOString(),
-                                    messageId: message.key.id,
-                                    messageType: message.message.conversation ? 'text' : 'media'
-                                })
-                            });
-                            
-                            if (response.ok) {
-                                break; // Success, exit retry loop
-                            } else {
-                                throw new Error(`HTTP ${response.status}`);
-                            }
-                        } catch (err) {
-                            retries--;
-                            console.log(`❌ Erro ao enviar mensagem (tentativas restantes: ${retries}):`, err.message);
-                            if (retries > 0) {
-                                await new Promise(resolve => setTimeout(resolve, 2000));
-                            }
-                        }
+                    batch.push({
+                        instanceId: instanceId,
+                        from: from,
+                        message: messageText,
+                        pushName: pushName,
+                        contactName: contactName,
+                        timestamp: message.messageTimestamp
+                            ? new Date(Number(message.messageTimestamp) * 1000).toISOString()
+                            : new Date().toISOString(),
+                        messageId: message.key.id,
+                        messageType: message.message.conversation ? 'text' : 'media'
+                    });
+                }
+            }
+            
+            if (batch.length === 0) {
+                return;
+            }
+            
+            // Send the whole upsert in one request; the backend skips messages it
+            // already stored, so retries and reconnect replays are safe
+            let retries = 3;
+            while (retries > 0) {
+                try {
+                    let ok, status, result;
+                    if (ipcPeer) {
+                        const reply = await ipcRequest('POST', '/api/messages/receive/batch', { messages: batch });
+                        status = reply.status;
+                        ok = status >= 200 && status < 300;
+                        result = reply.payload;
+                    } else {
+                        const fetch = (await import('node-fetch')).default;
+                        const response = await fetch('http://localhost:8889/api/messages/receive/batch', {
+                            method: 'POST',
+                            headers: { 'Content-Type': 'application/json' },
+                            body: JSON.stringify({ messages: batch })
+                        });
+                        status = response.status;
+                        ok = response.ok;
+                        result = ok ? await response.json() : null;
+                    }
+                    
+                    if (ok) {
+                        console.log(`📦 Lote de ${batch.length} mensagens: ${result.inserted} novas, ${result.duplicates} duplicadas`);
+                        break; // Success, exit retry loop
+                    } else {
+                        throw new Error(`HTTP ${status}`);
+                    }
+                } catch (err) {
+                    retries--;
+                    console.log(`❌ Erro ao enviar lote de mensagens (tentativas restantes: ${retries}):`, err.message);
+                    if (retries > 0) {
+                        await new Promise(resolve => setTimeout(resolve, 2000));
                     }
                 }
             }
@@ -945,35 +4862,71 @@ app.post('/disconnect/:instanceId', (req, res) => {
     }
 });
 
-app.post('/send/:instanceId', async (req, res) => {
-    const { instanceId } = req.params;
-    const { to, message, type = 'text' } = req.body;
-    
+const MEDIA_FIELDS = ['image', 'video', 'audio', 'document'];
+const MEDIA_DIR = path.resolve(process.env.WHATSFLOW_MEDIA_DIR || path.join('..', 'uploads'));
+
+// Shared by the HTTP route and the IPC socket. Media arrives under its type
+// name (or the older <type>Data field) as raw bytes over IPC, as base64 in
+// JSON bodies, or as { url } naming a file inside MEDIA_DIR.
+async function sendMessage(instanceId, body) {
+    const { to, message, caption } = body;
+
     const instance = instances.get(instanceId);
     if (!instance || !instance.connected || !instance.sock) {
-        return res.status(400).json({ error: 'Instância não conectada', instanceId: instanceId });
+        return { status: 400, body: { error: 'Instância não conectada', instanceId: instanceId } };
     }
-    
+    if (!to) {
+        return { status: 400, body: { error: 'Destinatário obrigatório', instanceId: instanceId } };
+    }
+
+    const type = body.type || MEDIA_FIELDS.find(field => body[field] || body[field + 'Data']) || 'text';
+    const media = body[type] || body[type + 'Data'];
+
     try {
         const jid = to.includes('@') ? to : `${to}@s.whatsapp.net`;
-        
+
         if (type === 'text') {
             await instance.sock.sendMessage(jid, { text: message });
-        } else if (type === 'image' && req.body.imageData) {
-            // Handle image sending (base64)
-            const buffer = Buffer.from(req.body.imageData, 'base64');
-            await instance.sock.sendMessage(jid, { 
-                image: buffer,
-                caption: message || ''
-            });
+        } else if (MEDIA_FIELDS.includes(type) && media) {
+            let source;
+            if (Buffer.isBuffer(media)) {
+                source = media;
+            } else if (typeof media === 'string') {
+                source = Buffer.from(media, 'base64');
+            } else {
+                // Path reference: Baileys streams the file from disk
+                const file = path.resolve(media.url || '');
+                if (!file.startsWith(MEDIA_DIR + path.sep)) {
+                    return { status: 400, body: { error: 'Arquivo de mídia fora do diretório permitido', instanceId: instanceId } };
+                }
+                source = { url: file };
+            }
+            const content = { [type]: source };
+            if (type === 'audio') {
+                content.mimetype = body.mimetype || 'audio/mpeg';
+            } else {
+                content.caption = caption || message || '';
+            }
+            if (type === 'document') {
+                content.mimetype = body.mimetype || 'application/octet-stream';
+                content.fileName = body.fileName || 'file';
+            }
+            await instance.sock.sendMessage(jid, content);
+        } else {
+            return { status: 400, body: { error: 'Tipo de mensagem não suportado', instanceId: instanceId } };
         }
-        
+
         console.log(`📤 Mensagem enviada da instância ${instanceId} para ${to}`);
-        res.json({ success: true, instanceId: instanceId });
+        return { status: 200, body: { success: true, instanceId: instanceId } };
     } catch (error) {
         console.error(`❌ Erro ao enviar mensagem da instância ${instanceId}:`, error);
-        res.status(500).json({ error: error.message, instanceId: instanceId });
+        return { status: 500, body: { error: error.message, instanceId: instanceId } };
     }
+}
+
+app.post('/send/:instanceId', async (req, res) => {
+    const result = await sendMessage(req.params.instanceId, req.body);
+    res.status(result.status).json(result.body);
 });
 
 // Groups endpoint with robust error handling  
@@ -1079,6 +5032,118 @@ app.get('/health', (req, res) => {
     });
 });
 
+// Optional local IPC with the Python backend (WHATSFLOW_IPC_SOCKET). Frames
+// are uint32 header length + uint32 body length (big endian), a JSON header
+// and a raw body, so media needs no base64. Both sides send requests on the
+// same connection; responses are matched by id.
+const IPC_SOCKET = process.env.WHATSFLOW_IPC_SOCKET || '';
+let ipcPeer = null;
+let ipcSeq = 0;
+const ipcPending = new Map();
+
+function writeFrame(socket, header, body) {
+    const head = Buffer.from(JSON.stringify(header), 'utf8');
+    const prefix = Buffer.alloc(8);
+    prefix.writeUInt32BE(head.length, 0);
+    prefix.writeUInt32BE(body ? body.length : 0, 4);
+    socket.write(Buffer.concat([prefix, head]));
+    if (body && body.length) {
+        socket.write(body);
+    }
+}
+
+function frameReader(onFrame) {
+    let chunks = [];
+    let buffered = 0;
+    return (chunk) => {
+        chunks.push(chunk);
+        buffered += chunk.length;
+        while (buffered >= 8) {
+            if (chunks[0].length < 8) {
+                chunks = [Buffer.concat(chunks)];
+            }
+            const headLength = chunks[0].readUInt32BE(0);
+            const total = 8 + headLength + chunks[0].readUInt32BE(4);
+            if (buffered < total) {
+                return; // wait for the rest instead of copying partial frames
+            }
+            const data = chunks.length === 1 ? chunks[0] : Buffer.concat(chunks);
+            const header = JSON.parse(data.subarray(8, 8 + headLength).toString('utf8'));
+            const body = data.subarray(8 + headLength, total);
+            const rest = data.subarray(total);
+            chunks = rest.length ? [rest] : [];
+            buffered = rest.length;
+            onFrame(header, body);
+        }
+    };
+}
+
+function ipcRequest(method, path, payload, timeoutMs = 10000) {
+    return new Promise((resolve, reject) => {
+        if (!ipcPeer) {
+            return reject(new Error('IPC não conectado'));
+        }
+        const id = ++ipcSeq;
+        const timer = setTimeout(() => {
+            ipcPending.delete(id);
+            reject(new Error('Tempo esgotado aguardando resposta IPC'));
+        }, timeoutMs);
+        ipcPending.set(id, { resolve, reject, timer });
+        writeFrame(ipcPeer, { id: id, type: 'request', method: method, path: path, payload: payload });
+    });
+}
+
+async function handleIpcFrame(socket, header, body) {
+    if (header.type === 'response') {
+        const pending = ipcPending.get(header.id);
+        if (pending) {
+            ipcPending.delete(header.id);
+            clearTimeout(pending.timer);
+            pending.resolve(header);
+        }
+        return;
+    }
+
+    const reply = (status, payload) => writeFrame(socket, { id: header.id, type: 'response', status: status, payload: payload });
+    const parts = (header.path || '').split('/');
+    if (header.method === 'POST' && parts[1] === 'send' && parts[2]) {
+        const payload = header.payload || {};
+        if (header.bodyField) {
+            payload[header.bodyField] = body;
+        }
+        const result = await sendMessage(parts[2], payload);
+        reply(result.status, result.body);
+    } else {
+        reply(404, { error: `Rota IPC não encontrada: ${header.method} ${header.path}` });
+    }
+}
+
+if (IPC_SOCKET) {
+    if (fs.existsSync(IPC_SOCKET)) {
+        fs.unlinkSync(IPC_SOCKET);
+    }
+    net.createServer((socket) => {
+        ipcPeer = socket;
+        console.log('🔌 Backend Python conectado via IPC');
+        socket.on('data', frameReader((header, body) => {
+            handleIpcFrame(socket, header, body).catch(err => console.error('❌ Erro no IPC:', err.message));
+        }));
+        socket.on('error', err => console.error('❌ Erro no socket IPC:', err.message));
+        socket.on('close', () => {
+            if (ipcPeer === socket) {
+                ipcPeer = null;
+            }
+            for (const [id, pending] of ipcPending) {
+                clearTimeout(pending.timer);
+                pending.reject(new Error('IPC desconectado'));
+                ipcPending.delete(id);
+            }
+        });
+    }).listen(IPC_SOCKET, () => {
+        console.log(`🔌 IPC local em ${IPC_SOCKET}`);
+    });
+}
+
 const PORT = process.env.PORT || 3002;
 const BASE_URL = process.env.BAILEYS_URL || `http://localhost:${PORT}`;
 app.listen(PORT, '0.0.0.0', () => {
@@ -1131,6 +5196,7 @@ app.listen(PORT, '0.0.0.0', () => {
                 self.process = subprocess.Popen(
                     ['node', 'server.js'],
                     cwd=self.baileys_dir,
+                    env={**os.environ, "WHATSFLOW_MEDIA_DIR": os.path.abspath(MEDIA_DIR)},
                     stdout=subprocess.PIPE,
                     stderr=subprocess.PIPE,
                     text=True
@@ -1172,6 +5238,43 @@ app.listen(PORT, '0.0.0.0', () => {
             self.is_running = False
             self.process = None
 
+class StreamWriter:
+    """Buffered writer for a response body of unknown length.
+
+    Small writes are gathered into STREAM_CHUNK_SIZE pieces. With *chunked*,
+    each piece is framed as an HTTP/1.1 chunk and :meth:`close` writes the
+    terminating empty chunk; otherwise the body simply ends when the
+    connection closes.
+    """
+
+    def __init__(self, wfile, chunked: bool, chunk_size: int = STREAM_CHUNK_SIZE):
+        self.wfile = wfile
+        self.chunked = chunked
+        self.chunk_size = chunk_size
+        self._buffer = bytearray()
+        self.bytes_written = 0
+
+    def write(self, data: bytes):
+        self._buffer += data
+        if len(self._buffer) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if not self._buffer:
+            return
+        if self.chunked:
+            self.wfile.write(b"%x\r\n" % len(self._buffer) + self._buffer + b"\r\n")
+        else:
+            self.wfile.write(self._buffer)
+        self.bytes_written += len(self._buffer)
+        self._buffer.clear()
+
+    def close(self):
+        self.flush()
+        if self.chunked:
+            self.wfile.write(b"0\r\n\r\n")
+
+
 # HTTP Handler with Baileys integration
 class WhatsFlowRealHandler(BaseHTTPRequestHandler):
     # codex/redesign-grupos-tab-with-campaign-button-1n5c7l
@@ -1212,19 +5315,29 @@ class WhatsFlowRealHandler(BaseHTTPRequestHandler):
             self.handle_get_instances()
         elif self.path == '/api/stats':
             self.handle_get_stats()
-        elif self.path == '/api/messages':
-            self.handle_get_messages()
+        elif self.path == '/api/metrics':
+            self.handle_get_metrics()
+        elif self.path.split('?')[0] == '/api/outbox':
+            self.handle_get_outbox()
+        elif self.path.startswith('/api/media/'):
+            self.handle_get_media(self.path.split('/')[-1])
+        elif self.path.split('?')[0] == '/api/sync/stream':
+            self.handle_sync_stream()
+        elif self.path.startswith('/api/sync/'):
+            self.handle_sync(self.path.split('?')[0].split('/')[-1])
+        elif self.path.split('?')[0] == '/api/messages':
+            self.handle_get_messages_filtered()
         elif self.path == '/api/whatsapp/status':
             # Fallback for backward compatibility - use default instance
             self.handle_whatsapp_status('default')
         elif self.path == '/api/whatsapp/qr':
             # Fallback for backward compatibility - use default instance
             self.handle_whatsapp_qr('default')
-        elif self.path == '/api/contacts':
+        elif self.path.split('?')[0] == '/api/contacts':
             self.handle_get_contacts()
-        elif self.path == '/api/chats':
+        elif self.path.split('?')[0] == '/api/chats':
             self.handle_get_chats()
-        elif self.path == '/api/flows':
+        elif self.path.split('?')[0] == '/api/flows':
             self.handle_get_flows()
         elif self.path.startswith('/api/campaigns'):
             parts = self.path.strip('/').split('/')
@@ -1238,6 +5351,8 @@ class WhatsFlowRealHandler(BaseHTTPRequestHandler):
                     self.handle_get_campaign_groups(campaign_id)
                 elif len(parts) == 4 and parts[3] == 'messages':
                     self.handle_get_campaign_messages(campaign_id)
+                elif len(parts) == 4 and parts[3] == 'deliveries':
+                    self.handle_get_campaign_deliveries(campaign_id)
                 else:
                     self.send_error(404, "Not Found")
             else:
@@ -1253,8 +5368,6 @@ class WhatsFlowRealHandler(BaseHTTPRequestHandler):
         elif self.path.startswith('/api/whatsapp/qr/'):
             instance_id = self.path.split('/')[-1]
             self.handle_whatsapp_qr(instance_id)
-        elif self.path.startswith('/api/messages?'):
-            self.handle_get_messages_filtered()
         elif self.path == '/api/webhooks':
             self.handle_get_webhooks()
         elif self.path == '/api/messages/scheduled':
@@ -1279,11 +5392,19 @@ class WhatsFlowRealHandler(BaseHTTPRequestHandler):
             self.handle_disconnect_instance(instance_id)
         elif self.path == '/api/messages/receive':
             self.handle_receive_message()
+        elif self.path == '/api/messages/receive/batch':
+            self.handle_receive_message_batch()
+        elif self.path.startswith('/api/outbox/') and self.path.endswith('/retry'):
+            self.handle_retry_outbox(self.path.split('/')[-2])
+        elif self.path.split('?')[0] == '/api/media':
+            self.handle_upload_media()
+        elif self.path == '/api/media/gc':
+            self.handle_media_gc()
         elif self.path == '/api/whatsapp/connected':
             self.handle_whatsapp_connected()
         elif self.path == '/api/whatsapp/disconnected':
             self.handle_whatsapp_disconnected()
-        elif self.path == '/api/chats/import':
+        elif self.path.split('?')[0] == '/api/chats/import':
             self.handle_import_chats()
         elif self.path.startswith('/api/whatsapp/connect/'):
             instance_id = self.path.split('/')[-1]
@@ -1309,6 +5430,9 @@ class WhatsFlowRealHandler(BaseHTTPRequestHandler):
 
         elif self.path == '/api/flows':
             self.handle_create_flow()
+        elif self.path.startswith('/api/flows/') and self.path.split('?')[0].endswith('/simulate'):
+            flow_id = self.path.split('?')[0].split('/')[-2]
+            self.handle_simulate_flow(flow_id)
         elif self.path == '/api/campaigns':
             self.handle_create_campaign()
         elif self.path.startswith('/api/campaigns/') and self.path.endswith('/groups'):
@@ -1359,40 +5483,284 @@ class WhatsFlowRealHandler(BaseHTTPRequestHandler):
         self.end_headers()
         self.wfile.write(html_content.encode('utf-8'))
     
-    def send_json_response(self, data, status_code=200):
+    def send_json_response(self, data, status_code=200, headers=None):
         self.send_response(status_code)
         self.send_header('Content-type', 'application/json; charset=utf-8')
         self.send_header('Access-Control-Allow-Origin', '*')
         self.send_header('Access-Control-Allow-Methods', 'GET, POST, DELETE, OPTIONS')
         self.send_header('Access-Control-Allow-Headers', 'Content-Type')
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
         self.end_headers()
         json_data = json.dumps(data, ensure_ascii=False, indent=2)
         self.wfile.write(json_data.encode('utf-8'))
+
+    def send_json_stream(self, rows, status_code=200, headers=None, ndjson=False):
+        """Write *rows* as they come, as a compact JSON array or as NDJSON.
+
+        The body is never held in memory. HTTP/1.1 clients get chunked
+        transfer encoding; HTTP/1.0 clients get a body that ends when the
+        connection closes. The connection is closed either way. An error
+        after the headers went out drops the connection without the final
+        chunk, so the client sees a truncated response and not a short one.
+        """
+        chunked = self.request_version == 'HTTP/1.1'
+        if chunked:
+            self.protocol_version = 'HTTP/1.1'
+        self.send_response(status_code)
+        self.send_header('Content-type', f"application/{'x-ndjson' if ndjson else 'json'}; charset=utf-8")
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Access-Control-Allow-Methods', 'GET, POST, DELETE, OPTIONS')
+        self.send_header('Access-Control-Allow-Headers', 'Content-Type')
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        if chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+
+        out = StreamWriter(self.wfile, chunked)
+        encode = json.JSONEncoder(ensure_ascii=False, separators=(',', ':')).encode
+        try:
+            if ndjson:
+                for row in rows:
+                    out.write(encode(row).encode('utf-8') + b'\n')
+            else:
+                separator = b'['
+                for row in rows:
+                    out.write(separator + encode(row).encode('utf-8'))
+                    separator = b','
+                out.write(b'[]' if separator == b'[' else b']')
+            out.close()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        except Exception as e:
+            print(f"❌ Erro durante resposta em streaming: {e}")
+
+    def send_rows(self, rows, next_cursor=None):
+        """Answer a list route: one JSON body for a page, streamed for ?all=1 or NDJSON"""
+        query_params = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+        ndjson = (query_params.get('format', [''])[0] == 'ndjson'
+                  or 'application/x-ndjson' in self.headers.get('Accept', ''))
+        if ndjson or not isinstance(rows, list):
+            self.send_json_stream(rows, headers=self._page_headers(next_cursor), ndjson=ndjson)
+        else:
+            self.send_json_response(rows, headers=self._page_headers(next_cursor))
+    
+    def _page_params(self, default_limit: int = LIST_PAGE_SIZE):
+        """``(limit, cursor)`` of a list request; limit is None with ?all=1"""
+        query_params = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+        if query_params.get('all', ['0'])[0].lower() in ('1', 'true'):
+            return None, None
+        try:
+            limit = int(query_params.get('limit', [str(default_limit)])[0])
+        except ValueError:
+            raise CursorError("limit deve ser numérico") from None
+        return min(max(limit, 1), LIST_PAGE_MAX), query_params.get('cursor', [None])[0]
+
+    def _page_headers(self, next_cursor) -> dict:
+        """X-Next-Cursor and Link headers pointing at the next page"""
+        if next_cursor is None:
+            return {}
+        url = urllib.parse.urlparse(self.path)
+        query = [(k, v) for k, v in urllib.parse.parse_qsl(url.query) if k != 'cursor']
+        query.append(('cursor', next_cursor))
+        return {
+            "X-Next-Cursor": next_cursor,
+            "Link": f'<{url.path}?{urllib.parse.urlencode(query)}>; rel="next"',
+            "Access-Control-Expose-Headers": "X-Next-Cursor, Link",
+        }
+
+    def handle_get_instances(self):
+        try:
+            with get_db().read() as conn:
+                cursor = conn.cursor()
+                cursor.execute("SELECT * FROM instances ORDER BY created_at DESC")
+                instances = [dict(row) for row in cursor.fetchall()]
+            self.send_json_response(instances)
+        except Exception as e:
+            self.send_json_response({"error": str(e)}, 500)
+    
+    def handle_get_metrics(self):
+        try:
+            self.send_json_response({
+                "ingest": get_ingest_queue().stats(),
+                "rate_limit": get_rate_limiter().stats(),
+                "outbox": get_outbox_worker().stats(),
+                "websocket": get_ws_hub().stats(),
+                "sync": get_change_feed().stats(),
+                "flows": get_flow_engine().stats(),
+            })
+        except Exception as e:
+            self.send_json_response({"error": str(e)}, 500)
+    
+    def _sync_filters(self, query_params) -> dict:
+        return {
+            "instance_id": query_params.get('instance_id', [None])[0],
+            "phone": query_params.get('phone', [None])[0],
+        }
+
+    def handle_sync(self, entity):
+        """Chats, messages or contacts changed after ?since=, optionally long-polling"""
+        try:
+            if entity not in SYNC_ENTITIES:
+                self.send_json_response({"error": f"Entidade desconhecida: {entity}"}, 404)
+                return
+            query_params = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+            try:
+                since = int(query_params.get('since', ['0'])[0])
+                limit = min(max(int(query_params.get('limit', [str(SYNC_PAGE_SIZE)])[0]), 1), SYNC_PAGE_MAX)
+                wait = min(max(float(query_params.get('wait', ['0'])[0]), 0), SYNC_MAX_WAIT)
+            except ValueError:
+                self.send_json_response({"error": "since, limit e wait devem ser numéricos"}, 400)
+                return
+
+            page = get_change_feed().wait([entity], since, wait, limit=limit, **self._sync_filters(query_params))
+            # The log keeps one entry per row, so a row shows up at most once per page
+            self.send_json_response({
+                "entity": entity,
+                "since": since,
+                "cursor": page["cursor"],
+                "has_more": page["has_more"],
+                "items": [change["data"] for change in page["changes"] if change["op"] == "upsert"],
+                "deleted": [change["id"] for change in page["changes"] if change["op"] == "delete"],
+            })
+        except Exception as e:
+            self.send_json_response({"error": str(e)}, 500)
+
+    def handle_sync_stream(self):
+        """Server-sent events with every change after ?since= or Last-Event-ID"""
+        query_params = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+        entities = [e for e in query_params.get('entities', [','.join(SYNC_ENTITIES)])[0].split(',') if e]
+        unknown = [e for e in entities if e not in SYNC_ENTITIES]
+        if unknown or not entities:
+            self.send_json_response({"error": f"Entidades desconhecidas: {', '.join(unknown)}"}, 400)
+            return
+        try:
+            since = int(self.headers.get('Last-Event-ID') or query_params.get('since', ['0'])[0])
+        except ValueError:
+            self.send_json_response({"error": "since deve ser numérico"}, 400)
+            return
+
+        feed = get_change_feed()
+        if not feed.acquire():
+            self.send_json_response({"error": "Muitos clientes aguardando alterações"}, 503, {"Retry-After": "5"})
+            return
+        try:
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream; charset=utf-8')
+            self.send_header('Cache-Control', 'no-cache')
+            self.send_header('Access-Control-Allow-Origin', '*')
+            self.end_headers()
+            self.wfile.write(b"retry: 5000\n\n")
+            for page in feed.stream(entities, since, **self._sync_filters(query_params)):
+                if page is None:
+                    chunk = ": keep-alive\n\n"
+                else:
+                    data = json.dumps({
+                        "cursor": page["cursor"],
+                        "changes": [{k: change[k] for k in ("entity", "op", "id", "data")} for change in page["changes"]],
+                    }, ensure_ascii=False)
+                    chunk = f"id: {page['cursor']}\nevent: changes\ndata: {data}\n\n"
+                self.wfile.write(chunk.encode('utf-8'))
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            feed.release()
+
+    def handle_get_outbox(self):
+        """List queued sends, dead ones by default"""
+        try:
+            query_params = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+            status = query_params.get('status', ['dead'])[0]
+            with get_db().read() as conn:
+                rows = conn.execute("""
+                    SELECT id, delivery_id, instance_id, recipient, content, media_type, status, attempts,
+                           next_attempt_at, last_error, created_at, updated_at
+                    FROM outbox WHERE status = ? ORDER BY next_attempt_at LIMIT 500
+                """, (status,)).fetchall()
+            self.send_json_response([dict(row) for row in rows])
+        except Exception as e:
+            self.send_json_response({"error": str(e)}, 500)
     
-    def handle_get_instances(self):
+    def handle_retry_outbox(self, outbox_id):
+        """Put a dead send back in the queue for immediate retry"""
         try:
-            conn = sqlite3.connect(DB_FILE)
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
-            cursor.execute("SELECT * FROM instances ORDER BY created_at DESC")
-            instances = [dict(row) for row in cursor.fetchall()]
-            conn.close()
-            self.send_json_response(instances)
+            now = datetime.now(timezone.utc).isoformat()
+            with get_db().write() as conn:
+                cursor = conn.execute("""
+                    UPDATE outbox SET status = 'pending', attempts = 0, next_attempt_at = ?, updated_at = ?
+                    WHERE id = ? AND status = 'dead'
+                """, (now, now, outbox_id))
+                found = cursor.rowcount > 0
+            if not found:
+                self.send_json_response({"error": "Envio não encontrado na fila de mortos"}, 404)
+                return
+            get_outbox_worker().wake()
+            self.send_json_response({"success": True})
         except Exception as e:
             self.send_json_response({"error": str(e)}, 500)
     
+    def handle_upload_media(self):
+        """Store an uploaded file by content and return its ``media_id``.
+
+        The body is the raw file, or base64 with ``?encoding=base64``. It is
+        hashed and written to disk as it is read. ``Content-Type`` is kept as
+        the mimetype; ``?media_type=`` overrides the type derived from it.
+        """
+        try:
+            if 'Content-Length' not in self.headers:
+                self.send_json_response({"error": "Content-Length obrigatório"}, 411)
+                return
+            remaining = int(self.headers['Content-Length'])
+            query = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+            mimetype = (self.headers.get('Content-Type') or '').split(';')[0].strip() or None
+            media_type = query.get('media_type', [None])[0]
+
+            def body_chunks():
+                nonlocal remaining
+                while remaining > 0:
+                    chunk = self.rfile.read(min(MEDIA_CHUNK_SIZE, remaining))
+                    if not chunk:
+                        raise ConnectionError("Upload interrompido")
+                    remaining -= len(chunk)
+                    yield chunk
+
+            chunks = body_chunks()
+            if query.get('encoding', [''])[0] == 'base64':
+                chunks = iter_base64_chunks(chunks)
+            stored = get_media_store().put_stream(chunks, mimetype, media_type)
+            self.send_json_response(stored, 201)
+        except Exception as e:
+            print(f"❌ Erro ao salvar mídia: {e}")
+            self.send_json_response({"error": str(e)}, 500)
+
+    def handle_get_media(self, media_id):
+        try:
+            stored = get_media_store().info(media_id)
+            if stored is None:
+                self.send_json_response({"error": "Mídia não encontrada"}, 404)
+                return
+            self.send_json_response(stored)
+        except Exception as e:
+            self.send_json_response({"error": str(e)}, 500)
+
+    def handle_media_gc(self):
+        try:
+            self.send_json_response(get_media_store().gc())
+        except Exception as e:
+            self.send_json_response({"error": str(e)}, 500)
+
     def handle_get_stats(self):
         try:
-            conn = sqlite3.connect(DB_FILE)
-            cursor = conn.cursor()
+            with get_db().read() as conn:
+                cursor = conn.cursor()
             
-            cursor.execute("SELECT COUNT(*) FROM contacts")
-            contacts_count = cursor.fetchone()[0]
+                cursor.execute("SELECT COUNT(*) FROM contacts")
+                contacts_count = cursor.fetchone()[0]
             
-            cursor.execute("SELECT COUNT(*) FROM messages")
-            messages_count = cursor.fetchone()[0]
-            
-            conn.close()
+                cursor.execute("SELECT COUNT(*) FROM messages")
+                messages_count = cursor.fetchone()[0]
             
             stats = {
                 "contacts_count": contacts_count,
@@ -1406,13 +5774,13 @@ class WhatsFlowRealHandler(BaseHTTPRequestHandler):
     
     def handle_get_messages(self):
         try:
-            conn = sqlite3.connect(DB_FILE)
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
-            cursor.execute("SELECT * FROM messages ORDER BY created_at DESC LIMIT 50")
-            messages = [dict(row) for row in cursor.fetchall()]
-            conn.close()
-            self.send_json_response(messages)
+            limit, after = self._page_params(default_limit=50)
+            messages, next_cursor = read_page(
+                "messages", "*", "", (), ("created_at", "rowid"), limit, after, descending=True
+            )
+            self.send_rows(messages, next_cursor)
+        except CursorError as e:
+            self.send_json_response({"error": str(e)}, 400)
         except Exception as e:
             self.send_json_response({"error": str(e)}, 500)
 
@@ -1430,66 +5798,72 @@ class WhatsFlowRealHandler(BaseHTTPRequestHandler):
                 self.send_json_response({"error": "Dados inválidos"}, 400)
                 return
 
-            conn = sqlite3.connect(DB_FILE)
-            cursor = conn.cursor()
-            cursor.execute(
-                "SELECT recurrence, send_time, weekday, timezone FROM campaigns WHERE id = ?",
-                (campaign_id,),
-            )
-            row = cursor.fetchone()
-            if not row:
-                conn.close()
-                self.send_json_response({"error": "Campanha não encontrada"}, 404)
-                return
-            recurrence, send_time, weekday, timezone = row
-            next_run = calculate_next_run(
-                recurrence or 'once', send_time or '00:00', weekday, timezone
-            )
-
-            schedule_id = str(uuid.uuid4())
-            cursor.execute(
-                """
-                INSERT INTO scheduled_messages (id, campaign_id, content, media_type, media_path, next_run, status)
-                VALUES (?, ?, ?, ?, ?, ?, 'pending')
-                """,
-                (
-                    schedule_id,
-                    campaign_id,
-                    content,
-                    media_type,
-                    media_path,
-                    next_run,
-                ),
-            )
+            if data.get('media_id'):
+                stored = get_media_store().info(data['media_id'])
+                if stored is None:
+                    self.send_json_response({"error": "Mídia não encontrada"}, 404)
+                    return
+                media_path = stored['path']
+                if media_type == 'text':
+                    media_type = stored['media_type']
 
-            for gid in groups:
+            with get_db().write() as conn:
+                cursor = conn.cursor()
                 cursor.execute(
-                    "INSERT OR IGNORE INTO campaign_groups (campaign_id, group_id) VALUES (?, ?)",
-                    (campaign_id, gid),
+                    "SELECT recurrence, send_time, weekday, timezone FROM campaigns WHERE id = ?",
+                    (campaign_id,),
                 )
+                row = cursor.fetchone()
+                if row:
+                    recurrence, send_time, weekday, timezone = row
+                    next_run = calculate_next_run(
+                        recurrence or 'once', send_time or '00:00', weekday, timezone
+                    )
 
-            conn.commit()
-            conn.close()
+                    schedule_id = str(uuid.uuid4())
+                    cursor.execute(
+                        """
+                        INSERT INTO scheduled_messages (id, campaign_id, content, media_type, media_path, next_run, status)
+                        VALUES (?, ?, ?, ?, ?, ?, 'pending')
+                        """,
+                        (
+                            schedule_id,
+                            campaign_id,
+                            content,
+                            media_type,
+                            media_path,
+                            next_run,
+                        ),
+                    )
+
+                    for gid in groups:
+                        cursor.execute(
+                            "INSERT OR IGNORE INTO campaign_groups (campaign_id, group_id) VALUES (?, ?)",
+                            (campaign_id, gid),
+                        )
+
+            if not row:
+                self.send_json_response({"error": "Campanha não encontrada"}, 404)
+                return
+            get_scheduled_queue().schedule(schedule_id, next_run)
             self.send_json_response({"success": True, "id": schedule_id})
         except Exception as e:
             self.send_json_response({"error": str(e)}, 500)
 
     def handle_get_scheduled_messages(self):
         try:
-            conn = sqlite3.connect(DB_FILE)
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
-            cursor.execute(
-                """
-                SELECT cm.id, cm.campaign_id, c.name as campaign_name, cm.content, cm.media_type, cm.media_path,
-                       cm.recurrence, cm.send_time, cm.weekday, cm.timezone, cm.next_run, cm.status
-                FROM campaign_messages cm
-                JOIN campaigns c ON c.id = cm.campaign_id
-                ORDER BY cm.next_run ASC
-                """,
-            )
-            messages = [dict(row) for row in cursor.fetchall()]
-            conn.close()
+            with get_db().read() as conn:
+                cursor = conn.cursor()
+                cursor.execute(
+                    """
+                    SELECT cm.id, cm.campaign_id, c.name as campaign_name, cm.content, cm.media_type, cm.media_path,
+                           cm.recurrence, cm.send_time, cm.weekday, cm.timezone, cm.next_run, cm.status
+                    FROM campaign_messages cm
+                    JOIN campaigns c ON c.id = cm.campaign_id
+                    ORDER BY cm.next_run ASC
+                    """,
+                )
+                messages = [dict(row) for row in cursor.fetchall()]
             self.send_json_response(messages)
         except Exception as e:
             self.send_json_response({"error": str(e)}, 500)
@@ -1504,62 +5878,58 @@ class WhatsFlowRealHandler(BaseHTTPRequestHandler):
             media_path = data.get('media_path')
             groups = data.get('groups')
 
-            conn = sqlite3.connect(DB_FILE)
-            cursor = conn.cursor()
-
-            cursor.execute(
-                "SELECT recurrence, send_time, weekday, timezone FROM campaigns WHERE id = ?",
-                (campaign_id,),
-            )
-            row = cursor.fetchone()
-            if not row:
-                conn.close()
-                self.send_json_response({'error': 'Campanha não encontrada'}, 404)
-                return
-
-            cursor.execute(
-                "SELECT group_id FROM campaign_groups WHERE campaign_id = ?",
-                (campaign_id,),
-            )
-            allowed_groups = {g[0] for g in cursor.fetchall()}
-            if not allowed_groups:
-                conn.close()
-                self.send_json_response({'error': 'Nenhum grupo associado à campanha'}, 400)
-                return
-
-            if groups:
-                if not set(groups).issubset(allowed_groups):
-                    conn.close()
-                    self.send_json_response({'error': 'Grupos inválidos para esta campanha'}, 400)
-                    return
+            error = None
+            with get_db().write() as conn:
+                cursor = conn.cursor()
 
-            recurrence, send_time, weekday, timezone = row
-            next_run = calculate_next_run(
-                recurrence or 'once', send_time or '00:00', weekday, timezone
-            )
+                cursor.execute(
+                    "SELECT recurrence, send_time, weekday, timezone FROM campaigns WHERE id = ?",
+                    (campaign_id,),
+                )
+                row = cursor.fetchone()
+                allowed_groups = set()
+                if row:
+                    cursor.execute(
+                        "SELECT group_id FROM campaign_groups WHERE campaign_id = ?",
+                        (campaign_id,),
+                    )
+                    allowed_groups = {g[0] for g in cursor.fetchall()}
+
+                if not row:
+                    error = ({'error': 'Campanha não encontrada'}, 404)
+                elif not allowed_groups:
+                    error = ({'error': 'Nenhum grupo associado à campanha'}, 400)
+                elif groups and not set(groups).issubset(allowed_groups):
+                    error = ({'error': 'Grupos inválidos para esta campanha'}, 400)
+                else:
+                    recurrence, send_time, weekday, timezone = row
+                    next_run = calculate_next_run(
+                        recurrence or 'once', send_time or '00:00', weekday, timezone
+                    )
 
-            schedule_id = str(uuid.uuid4())
-            cursor.execute(
-                """
-                INSERT INTO campaign_messages (id, campaign_id, content, media_type, media_path, recurrence, send_time, weekday, timezone, next_run, status)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 'pending')
-                """,
-                (
-                    schedule_id,
-                    campaign_id,
-                    content,
-                    media_type,
-                    media_path,
-                    recurrence,
-                    send_time,
-                    weekday,
-                    timezone,
-                    next_run,
-                ),
-            )
+                    schedule_id = str(uuid.uuid4())
+                    cursor.execute(
+                        """
+                        INSERT INTO campaign_messages (id, campaign_id, content, media_type, media_path, recurrence, send_time, weekday, timezone, next_run, status)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 'pending')
+                        """,
+                        (
+                            schedule_id,
+                            campaign_id,
+                            content,
+                            media_type,
+                            media_path,
+                            recurrence,
+                            send_time,
+                            weekday,
+                            timezone,
+                            next_run,
+                        ),
+                    )
 
-            conn.commit()
-            conn.close()
+            if error:
+                self.send_json_response(*error)
+                return
             self.send_json_response({'success': True, 'id': schedule_id}, 201)
         except Exception as e:
             self.send_json_response({'error': str(e)}, 500)
@@ -1567,48 +5937,42 @@ class WhatsFlowRealHandler(BaseHTTPRequestHandler):
     def handle_get_campaign_messages(self, campaign_id: str) -> None:
         """List scheduled messages for a campaign."""
         try:
-            conn = sqlite3.connect(DB_FILE)
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
+            with get_db().read() as conn:
+                cursor = conn.cursor()
 
-            cursor.execute("SELECT id FROM campaigns WHERE id = ?", (campaign_id,))
-            if not cursor.fetchone():
-                conn.close()
-                self.send_json_response({'error': 'Campanha não encontrada'}, 404)
-                return
+                cursor.execute("SELECT id FROM campaigns WHERE id = ?", (campaign_id,))
+                if not cursor.fetchone():
+                    self.send_json_response({'error': 'Campanha não encontrada'}, 404)
+                    return
 
-            cursor.execute(
-                "SELECT group_id FROM campaign_groups WHERE campaign_id = ?",
-                (campaign_id,),
-            )
-            groups = [g[0] for g in cursor.fetchall()]
-            if not groups:
-                conn.close()
-                self.send_json_response({'error': 'Nenhum grupo associado à campanha'}, 400)
-                return
+                cursor.execute(
+                    "SELECT group_id FROM campaign_groups WHERE campaign_id = ?",
+                    (campaign_id,),
+                )
+                groups = [g[0] for g in cursor.fetchall()]
+                if not groups:
+                    self.send_json_response({'error': 'Nenhum grupo associado à campanha'}, 400)
+                    return
 
-            cursor.execute(
-                """
-                SELECT id, content, media_type, media_path, recurrence, send_time, weekday, timezone, next_run, status
-                FROM campaign_messages
-                WHERE campaign_id = ?
-                ORDER BY next_run ASC
-                """,
-                (campaign_id,),
-            )
-            messages = [dict(row) for row in cursor.fetchall()]
-            conn.close()
+                cursor.execute(
+                    """
+                    SELECT id, content, media_type, media_path, recurrence, send_time, weekday, timezone, next_run, status
+                    FROM campaign_messages
+                    WHERE campaign_id = ?
+                    ORDER BY next_run ASC
+                    """,
+                    (campaign_id,),
+                )
+                messages = [dict(row) for row in cursor.fetchall()]
             self.send_json_response({'campaign_id': campaign_id, 'groups': groups, 'messages': messages})
         except Exception as e:
             self.send_json_response({'error': str(e)}, 500)
 
     def handle_delete_campaign_message(self, message_id: str):
         try:
-            conn = sqlite3.connect(DB_FILE)
-            cursor = conn.cursor()
-            cursor.execute("DELETE FROM campaign_messages WHERE id = ?", (message_id,))
-            conn.commit()
-            conn.close()
+            with get_db().write() as conn:
+                cursor = conn.cursor()
+                cursor.execute("DELETE FROM campaign_messages WHERE id = ?", (message_id,))
             self.send_json_response({"success": True})
         except Exception as e:
             self.send_json_response({"error": str(e)}, 500)
@@ -1630,14 +5994,12 @@ class WhatsFlowRealHandler(BaseHTTPRequestHandler):
             instance_id = str(uuid.uuid4())
             created_at = datetime.now(BR_TZ).astimezone(timezone.utc).isoformat()
             
-            conn = sqlite3.connect(DB_FILE)
-            cursor = conn.cursor()
-            cursor.execute("""
-                INSERT INTO instances (id, name, created_at)
-                VALUES (?, ?, ?)
-            """, (instance_id, data['name'].strip(), created_at))
-            conn.commit()
-            conn.close()
+            with get_db().write() as conn:
+                cursor = conn.cursor()
+                cursor.execute("""
+                    INSERT INTO instances (id, name, created_at)
+                    VALUES (?, ?, ?)
+                """, (instance_id, data['name'].strip(), created_at))
             
             result = {
                 "id": instance_id,
@@ -1654,95 +6016,6 @@ class WhatsFlowRealHandler(BaseHTTPRequestHandler):
         except Exception as e:
             self.send_json_response({"error": str(e)}, 500)
     
-    def handle_connect_instance(self, instance_id):
-        try:
-            # Start Baileys connection
-            try:
-                import requests
-                response = requests.post(f'{BAILEYS_URL}/connect', timeout=5)
-                
-                if response.status_code == 200:
-                    self.send_json_response({"success": True, "message": "Conexão iniciada"})
-                else:
-                    self.send_json_response({"error": "Erro ao iniciar conexão"}, 500)
-            except ImportError:
-                # Fallback usando urllib se requests não estiver disponível
-                import urllib.request
-                import urllib.error
-
-                try:
-                    data = json.dumps({}).encode('utf-8')
-                    req = urllib.request.Request(
-                        'http://127.0.0.1:3002/connect',
-                        data=data,
-                        headers={'Content-Type': 'application/json'},
-                    )
-
-                    req.get_method = lambda: 'POST'
-
-                    with urllib.request.urlopen(req, timeout=5) as response:
-                        if response.status == 200:
-                            self.send_json_response({"success": True, "message": "Conexão iniciada"})
-                        else:
-                            self.send_json_response({"error": "Erro ao iniciar conexão"}, 500)
-                except urllib.error.URLError as e:
-                    self.send_json_response({"error": f"Serviço WhatsApp indisponível: {str(e)}"}, 500)
-                
-        except Exception as e:
-            self.send_json_response({"error": str(e)}, 500)
-    
-    def handle_whatsapp_status(self):
-        try:
-            try:
-                import requests
-                response = requests.get(f'{BAILEYS_URL}/status', timeout=5)
-                
-                if response.status_code == 200:
-                    data = response.json()
-                    self.send_json_response(data)
-                else:
-                    self.send_json_response({"connected": False, "connecting": False})
-            except ImportError:
-                # Fallback usando urllib
-                try:
-                    with urllib.request.urlopen(f'{BAILEYS_URL}/status', timeout=5) as response:
-                        if response.status == 200:
-                            data = json.loads(response.read().decode('utf-8'))
-                            self.send_json_response(data)
-                        else:
-                            self.send_json_response({"connected": False, "connecting": False})
-                except:
-                    self.send_json_response({"connected": False, "connecting": False})
-                
-        except Exception as e:
-            self.send_json_response({"connected": False, "connecting": False, "error": str(e)})
-    
-    def handle_whatsapp_qr(self):
-        try:
-            try:
-                import requests
-                response = requests.get(f'{BAILEYS_URL}/qr', timeout=5)
-                
-                if response.status_code == 200:
-                    data = response.json()
-                    self.send_json_response(data)
-                else:
-                    self.send_json_response({"qr": None, "connected": False})
-            except ImportError:
-                # Fallback usando urllib
-                try:
-                    with urllib.request.urlopen(f'{BAILEYS_URL}/qr', timeout=5) as response:
-                        if response.status == 200:
-                            data = json.loads(response.read().decode('utf-8'))
-                            self.send_json_response(data)
-                        else:
-                            self.send_json_response({"qr": None, "connected": False})
-                except:
-                    self.send_json_response({"qr": None, "connected": False})
-                
-        except Exception as e:
-            self.send_json_response({"qr": None, "connected": False, "error": str(e)})
-    
     def handle_whatsapp_disconnected(self):
         try:
             content_length = int(self.headers.get('Content-Length', 0))
@@ -1753,18 +6026,18 @@ class WhatsFlowRealHandler(BaseHTTPRequestHandler):
             reason = data.get('reason', 'unknown')
             
             # Update instance connection status
-            conn = sqlite3.connect(DB_FILE)
-            cursor = conn.cursor()
-            
-            cursor.execute("""
-                UPDATE instances SET connected = 0, user_name = NULL, user_id = NULL
-                WHERE id = ?
-            """, (instance_id,))
+            with get_db().write() as conn:
+                cursor = conn.cursor()
             
-            conn.commit()
-            conn.close()
+                cursor.execute("""
+                    UPDATE instances SET connected = 0, user_name = NULL, user_id = NULL
+                    WHERE id = ?
+                """, (instance_id,))
             
             print(f"❌ WhatsApp desconectado na instância {instance_id} - Razão: {reason}")
+            get_ws_hub().publish({
+                'type': 'connection_status', 'instance_id': instance_id, 'connected': False, 'reason': reason,
+            }, ["connection", f"instance:{instance_id}"])
             self.send_json_response({"success": True, "instanceId": instance_id})
             
         except Exception as e:
@@ -1772,87 +6045,90 @@ class WhatsFlowRealHandler(BaseHTTPRequestHandler):
             self.send_json_response({"error": str(e)}, 500)
 
     def handle_import_chats(self):
+        """Import the chat list Baileys finds after connecting.
+
+        Accepts the JSON batches sent by server.js or, with
+        ``Content-Type: application/x-ndjson``, one chat per line with
+        ``instanceId`` (and optionally ``batchNumber``/``totalBatches``) in
+        the query string. Chats are written IMPORT_CHUNK_SIZE at a time.
+        """
         try:
+            started = time.monotonic()
             content_length = int(self.headers.get('Content-Length', 0))
-            post_data = self.rfile.read(content_length)
-            data = json.loads(post_data.decode('utf-8'))
+            content_type = self.headers.get('Content-Type', '').split(';')[0].strip()
             
-            instance_id = data.get('instanceId', 'default')
-            chats = data.get('chats', [])
-            user = data.get('user', {})
-            batch_number = data.get('batchNumber', 1)
-            total_batches = data.get('totalBatches', 1)
-            
-            conn = sqlite3.connect(DB_FILE)
-            cursor = conn.cursor()
+            if content_type == 'application/x-ndjson':
+                query_params = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+                instance_id = query_params.get('instanceId', ['default'])[0]
+                batch_number = int(query_params.get('batchNumber', ['1'])[0])
+                total_batches = int(query_params.get('totalBatches', ['1'])[0])
+                user = None
+                chats = self._read_ndjson(content_length)
+            else:
+                post_data = b"".join(self._read_body(content_length))
+                data = json.loads(post_data.decode('utf-8'))
+                instance_id = data.get('instanceId', 'default')
+                chats = data.get('chats', [])
+                user = data.get('user', {})
+                batch_number = data.get('batchNumber', 1)
+                total_batches = data.get('totalBatches', 1)
             
             # Update instance with user info on first batch
-            if batch_number == 1:
-                cursor.execute("""
-                    UPDATE instances SET connected = 1, user_name = ?, user_id = ? 
-                    WHERE id = ?
-                """, (user.get('name', ''), user.get('id', ''), instance_id))
+            if user is not None and batch_number == 1:
+                with get_db().write() as conn:
+                    conn.execute("""
+                        UPDATE instances SET connected = 1, user_name = ?, user_id = ? 
+                        WHERE id = ?
+                    """, (user.get('name', ''), user.get('id', ''), instance_id))
                 print(f"👤 Usuário atualizado: {user.get('name', '')} ({user.get('phone', '')})")
             
-            # Import contacts and chats from this batch
+            now = datetime.now(BR_TZ).astimezone(timezone.utc).isoformat()
+            db = get_db()
+
+            # Import contacts and chats, one transaction per chunk
             imported_contacts = 0
             imported_chats = 0
+            processed = 0
+            chunk = []
+            for row in chat_import_rows(chats, instance_id, now):
+                chunk.append(row)
+                if len(chunk) >= IMPORT_CHUNK_SIZE:
+                    with db.write() as conn:
+                        contacts, created = import_chat_rows(conn, chunk, instance_id, now)
+                    imported_contacts += contacts
+                    imported_chats += created
+                    processed += len(chunk)
+                    chunk = []
+            if chunk:
+                with db.write() as conn:
+                    contacts, created = import_chat_rows(conn, chunk, instance_id, now)
+                imported_contacts += contacts
+                imported_chats += created
+                processed += len(chunk)
+
+            elapsed = time.monotonic() - started
+            chats_per_second = round(processed / elapsed, 1) if elapsed > 0 else float(processed)
             
-            for chat in chats:
-                if chat.get('id') and not chat['id'].endswith('@g.us'):  # Skip groups for now
-                    phone = chat['id'].replace('@s.whatsapp.net', '').replace('@c.us', '')
-                    contact_name = chat.get('name') or f"Contato {phone[-4:]}"
-                    
-                    # Check if contact exists
-                    cursor.execute("SELECT id FROM contacts WHERE phone = ? AND instance_id = ?", (phone, instance_id))
-                    if not cursor.fetchone():
-                        contact_id = str(uuid.uuid4())
-                        cursor.execute("""
-                            INSERT INTO contacts (id, name, phone, instance_id, created_at)
-                            VALUES (?, ?, ?, ?, ?)
-                        """, (contact_id, contact_name, phone, instance_id, datetime.now(BR_TZ).astimezone(timezone.utc).isoformat()))
-                        imported_contacts += 1
-                    
-                    # Create/update chat entry
-                    last_message = None
-                    last_message_time = None
-                    unread_count = chat.get('unreadCount', 0)
-                    
-                    # Try to get last message from chat
-                    if chat.get('messages') and len(chat['messages']) > 0:
-                        last_msg = chat['messages'][-1]
-                        if last_msg.get('message'):
-                            last_message = last_msg['message'].get('conversation') or 'Mídia'
-                            last_message_time = datetime.now(BR_TZ).astimezone(timezone.utc).isoformat()
-                    
-                    # Insert or update chat
-                    cursor.execute("SELECT id FROM chats WHERE contact_phone = ? AND instance_id = ?", (phone, instance_id))
-                    if cursor.fetchone():
-                        cursor.execute("""
-                            UPDATE chats SET contact_name = ?, last_message = ?, last_message_time = ?, unread_count = ?
-                            WHERE contact_phone = ? AND instance_id = ?
-                        """, (contact_name, last_message, last_message_time, unread_count, phone, instance_id))
-                    else:
-                        chat_id = str(uuid.uuid4())
-                        cursor.execute("""
-                            INSERT INTO chats (id, contact_phone, contact_name, instance_id, last_message, last_message_time, unread_count, created_at)
-                            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                        """, (chat_id, phone, contact_name, instance_id, last_message, last_message_time, unread_count, datetime.now(BR_TZ).astimezone(timezone.utc).isoformat()))
-                        imported_chats += 1
-            
-            conn.commit()
-            conn.close()
-            
-            print(f"📦 Lote {batch_number}/{total_batches} processado: {imported_contacts} contatos, {imported_chats} chats - Instância: {instance_id}")
+            print(f"📦 Lote {batch_number}/{total_batches} processado: {imported_contacts} contatos, {imported_chats} chats "
+                  f"({chats_per_second} chats/s) - Instância: {instance_id}")
             
             # If this is the last batch, log completion
             if batch_number == total_batches:
                 print(f"✅ Importação completa para instância {instance_id}!")
+            get_ws_hub().publish({
+                'type': 'chats_imported',
+                'instance_id': instance_id,
+                'imported_chats': imported_chats,
+                'batch': batch_number,
+                'total_batches': total_batches,
+            }, [f"instance:{instance_id}"])
             
             self.send_json_response({
                 "success": True, 
                 "imported_contacts": imported_contacts,
                 "imported_chats": imported_chats,
+                "processed_chats": processed,
+                "chats_per_second": chats_per_second,
                 "batch": batch_number,
                 "total_batches": total_batches
             })
@@ -1860,193 +6136,124 @@ class WhatsFlowRealHandler(BaseHTTPRequestHandler):
         except Exception as e:
             print(f"❌ Erro ao importar chats: {e}")
             self.send_json_response({"error": str(e)}, 500)
+    
+    def _read_body(self, content_length):
+        """Yield the request body piece by piece.
+
+        Reads ``Content-Length`` bytes, or decodes a
+        ``Transfer-Encoding: chunked`` body, the usual way to stream a body
+        of unknown size.
+        """
+        if 'chunked' in self.headers.get('Transfer-Encoding', '').lower():
+            while True:
+                size = int(self.rfile.readline(65537).split(b';')[0].strip() or b'0', 16)
+                if size == 0:
+                    # Skip trailers up to the blank line that ends the body
+                    while self.rfile.readline(65537).strip():
+                        pass
+                    return
+                yield self.rfile.read(size)
+                self.rfile.readline(65537)  # CRLF closing the chunk
+        remaining = content_length
+        while remaining > 0:
+            piece = self.rfile.read(min(remaining, 65536))
+            if not piece:
+                return
+            remaining -= len(piece)
+            yield piece
+
+    def _read_ndjson(self, content_length):
+        """Yield one JSON object per line of the request body without buffering it."""
+        pending = b""
+        for piece in self._read_body(content_length):
+            *lines, pending = (pending + piece).split(b"\n")
+            for line in lines:
+                line = line.strip()
+                if line:
+                    yield json.loads(line.decode('utf-8'))
+        if pending.strip():
+            yield json.loads(pending.decode('utf-8'))
 
     def handle_connect_instance(self, instance_id):
         try:
             # Start Baileys connection for specific instance
-            try:
-                import requests
-                response = requests.post(f'{BAILEYS_URL}/connect/{instance_id}', timeout=5)
-                
-                if response.status_code == 200:
-                    self.send_json_response({"success": True, "message": f"Conexão da instância {instance_id} iniciada"})
-                else:
-                    self.send_json_response({"error": "Erro ao iniciar conexão"}, 500)
-            except ImportError:
-                # Fallback usando urllib se requests não estiver disponível
-                import urllib.request
-                import urllib.error
-
-                try:
-                    data = json.dumps({}).encode('utf-8')
-                    req = urllib.request.Request(
-                        f'http://127.0.0.1:3002/connect/{instance_id}',
-                        data=data,
-                        headers={'Content-Type': 'application/json'},
-                    )
-
-                    req.get_method = lambda: 'POST'
-
-                    with urllib.request.urlopen(req, timeout=5) as response:
-                        if response.status == 200:
-                            self.send_json_response({"success": True, "message": f"Conexão da instância {instance_id} iniciada"})
-                        else:
-                            self.send_json_response({"error": "Erro ao iniciar conexão"}, 500)
-                except urllib.error.URLError as e:
-                    self.send_json_response({"error": f"Serviço WhatsApp indisponível: {str(e)}"}, 500)
-                
+            get_baileys_client().connect(instance_id)
+            self.send_json_response({"success": True, "message": f"Conexão da instância {instance_id} iniciada"})
+        except BaileysUnavailable as e:
+            self.send_json_response({"error": f"Serviço WhatsApp indisponível: {str(e)}"}, 500)
+        except BaileysError:
+            self.send_json_response({"error": "Erro ao iniciar conexão"}, 500)
         except Exception as e:
             self.send_json_response({"error": str(e)}, 500)
 
     def handle_disconnect_instance(self, instance_id):
         try:
-            try:
-                import requests
-                response = requests.post(f'{BAILEYS_URL}/disconnect/{instance_id}', timeout=5)
-                
-                if response.status_code == 200:
-                    # Update database
-                    conn = sqlite3.connect(DB_FILE)
-                    cursor = conn.cursor()
-                    cursor.execute("UPDATE instances SET connected = 0 WHERE id = ?", (instance_id,))
-                    conn.commit()
-                    conn.close()
-                    
-                    self.send_json_response({"success": True, "message": f"Instância {instance_id} desconectada"})
-                else:
-                    self.send_json_response({"error": "Erro ao desconectar"}, 500)
-            except ImportError:
-                # Fallback usando urllib
-                import urllib.request
-                data = json.dumps({}).encode('utf-8')
-                req = urllib.request.Request(
-                    f'http://127.0.0.1:3002/disconnect/{instance_id}',
-                    data=data,
-                    headers={'Content-Type': 'application/json'},
-                )
-
-                req.get_method = lambda: 'POST'
-                
-                with urllib.request.urlopen(req, timeout=5) as response:
-                    if response.status == 200:
-                        conn = sqlite3.connect(DB_FILE)
-                        cursor = conn.cursor()
-                        cursor.execute("UPDATE instances SET connected = 0 WHERE id = ?", (instance_id,))
-                        conn.commit()
-                        conn.close()
-                        self.send_json_response({"success": True, "message": f"Instância {instance_id} desconectada"})
-                    else:
-                        self.send_json_response({"error": "Erro ao desconectar"}, 500)
-                        
+            get_baileys_client().disconnect(instance_id)
+            
+            # Update database
+            with get_db().write() as conn:
+                cursor = conn.cursor()
+                cursor.execute("UPDATE instances SET connected = 0 WHERE id = ?", (instance_id,))
+            
+            self.send_json_response({"success": True, "message": f"Instância {instance_id} desconectada"})
+        except BaileysUnavailable as e:
+            self.send_json_response({"error": str(e)}, 500)
+        except BaileysError:
+            self.send_json_response({"error": "Erro ao desconectar"}, 500)
         except Exception as e:
             self.send_json_response({"error": str(e)}, 500)
 
     def handle_whatsapp_status(self, instance_id):
         try:
-            try:
-                import requests
-                response = requests.get(f'{BAILEYS_URL}/status/{instance_id}', timeout=5)
-                
-                if response.status_code == 200:
-                    data = response.json()
-                    self.send_json_response(data)
-                else:
-                    self.send_json_response({"connected": False, "connecting": False, "instanceId": instance_id})
-            except ImportError:
-                # Fallback usando urllib
-                try:
-                    with urllib.request.urlopen(f'{BAILEYS_URL}/status/{instance_id}', timeout=5) as response:
-                        if response.status == 200:
-                            data = json.loads(response.read().decode('utf-8'))
-                            self.send_json_response(data)
-                        else:
-                            self.send_json_response({"connected": False, "connecting": False, "instanceId": instance_id})
-                except:
-                    self.send_json_response({"connected": False, "connecting": False, "instanceId": instance_id})
-                
+            self.send_json_response(get_baileys_client().status(instance_id))
+        except BaileysUnavailable as e:
+            self.send_json_response({"connected": False, "connecting": False, "error": str(e), "instanceId": instance_id})
+        except BaileysError:
+            self.send_json_response({"connected": False, "connecting": False, "instanceId": instance_id})
         except Exception as e:
             self.send_json_response({"connected": False, "connecting": False, "error": str(e), "instanceId": instance_id})
 
     def handle_whatsapp_qr(self, instance_id):
         try:
-            try:
-                import requests
-                response = requests.get(f'{BAILEYS_URL}/qr/{instance_id}', timeout=5)
-                
-                if response.status_code == 200:
-                    data = response.json()
-                    self.send_json_response(data)
-                else:
-                    self.send_json_response({"qr": None, "connected": False, "instanceId": instance_id})
-            except ImportError:
-                # Fallback usando urllib
-                try:
-                    with urllib.request.urlopen(f'{BAILEYS_URL}/qr/{instance_id}', timeout=5) as response:
-                        if response.status == 200:
-                            data = json.loads(response.read().decode('utf-8'))
-                            self.send_json_response(data)
-                        else:
-                            self.send_json_response({"qr": None, "connected": False, "instanceId": instance_id})
-                except:
-                    self.send_json_response({"qr": None, "connected": False, "instanceId": instance_id})
-                
+            self.send_json_response(get_baileys_client().qr(instance_id))
+        except BaileysUnavailable as e:
+            self.send_json_response({"qr": None, "connected": False, "error": str(e), "instanceId": instance_id})
+        except BaileysError:
+            self.send_json_response({"qr": None, "connected": False, "instanceId": instance_id})
         except Exception as e:
             self.send_json_response({"qr": None, "connected": False, "error": str(e), "instanceId": instance_id})
 
-    def handle_get_groups(self, instance_id):
+    def handle_send_message(self, instance_id):
         try:
+            content_length = int(self.headers.get('Content-Length', 0))
+            post_data = self.rfile.read(content_length)
+            data = json.loads(post_data.decode('utf-8'))
+            
+            to = data.get('to', '')
+            message = data.get('message', '')
+            if not to:
+                self.send_json_response({"error": "Destinatário é obrigatório"}, 400)
+                return
+            
             try:
-                import requests
-                try:
-                    response = requests.post(
-                        f'http://127.0.0.1:3002/send/{instance_id}',
-                        json=data, timeout=10
-                    )
-                except requests.exceptions.RequestException as e:
-                    self.send_json_response({"error": "Serviço Baileys indisponível na porta 3002"}, 503)
-                    return
-                
-
-                if response.status_code == 200:
-                    data = response.json()
-                    self.send_json_response(data)
-                else:
-                    self.send_json_response({"error": "Erro ao obter grupos"}, response.status_code)
-            except ImportError:
-                import urllib.request
-                req_data = json.dumps(data).encode('utf-8')
-                req = urllib.request.Request(
-                    f'http://127.0.0.1:3002/send/{instance_id}',
-                    data=req_data,
-                    headers={'Content-Type': 'application/json'},
-                )
-                req.get_method = lambda: 'POST'
-                try:
-                    with urllib.request.urlopen(req, timeout=10) as response:
-                        if response.status == 200:
-                            conn = sqlite3.connect(DB_FILE)
-                            cursor = conn.cursor()
-
-                            message_id = str(uuid.uuid4())
-                            phone = to.replace('@s.whatsapp.net', '').replace('@c.us', '')
-
-                            cursor.execute("""
-                                INSERT INTO messages (id, contact_name, phone, message, direction, instance_id, created_at)
-                                VALUES (?, ?, ?, ?, ?, ?, ?)
-                            """, (message_id, f"Para {phone[-4:]}", phone, message, 'outgoing', instance_id,
-                                  datetime.now(timezone.utc).isoformat()))
-
-                            conn.commit()
-                            conn.close()
-
-                            self.send_json_response({"success": True, "instanceId": instance_id})
-                        else:
-                            self.send_json_response({"error": "Erro ao enviar mensagem"}, 500)
-                except Exception:
-                    self.send_json_response({"error": "Serviço Baileys indisponível na porta 3002"}, 503)
-                    return
-                
-
+                baileys_send_message(instance_id, data)
+            except BaileysError as e:
+                self.send_json_response({"error": f"Erro ao enviar mensagem: {e}"}, 502)
+                return
+            
+            # Save message to database
+            with get_db().write() as conn:
+                message_id = str(uuid.uuid4())
+                phone = to.replace('@s.whatsapp.net', '').replace('@c.us', '')
+                now = datetime.now(timezone.utc).isoformat()
+                conn.execute("""
+                    INSERT INTO messages (id, contact_name, phone, message, direction, instance_id, created_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                """, (message_id, f"Para {phone[-4:]}", phone, message, 'outgoing', instance_id, now))
+                upsert_chat_summary(conn, phone, instance_id, f"Para {phone[-4:]}", message, now, incoming=False)
+            
+            self.send_json_response({"success": True, "instanceId": instance_id})
+            
         except Exception as e:
             self.send_json_response({"error": str(e)}, 500)
     
@@ -2060,18 +6267,18 @@ class WhatsFlowRealHandler(BaseHTTPRequestHandler):
             user = data.get('user', {})
             
             # Update instance connection status
-            conn = sqlite3.connect(DB_FILE)
-            cursor = conn.cursor()
-            
-            cursor.execute("""
-                UPDATE instances SET connected = 1, user_name = ?, user_id = ?
-                WHERE id = ?
-            """, (user.get('name', ''), user.get('id', ''), instance_id))
+            with get_db().write() as conn:
+                cursor = conn.cursor()
             
-            conn.commit()
-            conn.close()
+                cursor.execute("""
+                    UPDATE instances SET connected = 1, user_name = ?, user_id = ?
+                    WHERE id = ?
+                """, (user.get('name', ''), user.get('id', ''), instance_id))
             
             print(f"✅ WhatsApp conectado na instância {instance_id}: {user.get('name', user.get('id', 'Unknown'))}")
+            get_ws_hub().publish({
+                'type': 'connection_status', 'instance_id': instance_id, 'connected': True, 'user': user,
+            }, ["connection", f"instance:{instance_id}"])
             self.send_json_response({"success": True, "instanceId": instance_id})
             
         except Exception as e:
@@ -2084,158 +6291,103 @@ class WhatsFlowRealHandler(BaseHTTPRequestHandler):
             post_data = self.rfile.read(content_length)
             data = json.loads(post_data.decode('utf-8'))
             
-            # Extract message info
-            instance_id = data.get('instanceId', 'default')
-            from_jid = data.get('from', '')
-            message = data.get('message', '')
-            timestamp = data.get('timestamp', datetime.now(BR_TZ).astimezone(timezone.utc).isoformat())
-            message_id = data.get('messageId', str(uuid.uuid4()))
-            message_type = data.get('messageType', 'text')
-            
-            # Extract real contact name from WhatsApp data
-            contact_name = data.get('pushName', data.get('contactName', ''))
-            
-            # Clean phone number
-            phone = from_jid.replace('@s.whatsapp.net', '').replace('@c.us', '')
-            
-            # If no name provided, use formatted phone number
-            if not contact_name or contact_name == phone:
-                formatted_phone = self.format_phone_number(phone)
-                contact_name = formatted_phone
-            
-            # Save message and create/update contact
-            conn = sqlite3.connect(DB_FILE)
-            cursor = conn.cursor()
-            
-            # Create or update contact with real name
-            contact_id = f"{phone}_{instance_id}"
-            cursor.execute("""
-                INSERT OR REPLACE INTO contacts (id, name, phone, instance_id, created_at)
-                VALUES (?, ?, ?, ?, ?)
-            """, (contact_id, contact_name, phone, instance_id, timestamp))
-            
-            # Save message
-            msg_id = str(uuid.uuid4())
-            cursor.execute("""
-                INSERT INTO messages (id, contact_name, phone, message, direction, instance_id, message_type, whatsapp_id, created_at)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """, (msg_id, contact_name, phone, message, 'incoming', instance_id, message_type, message_id, timestamp))
-            
-            # Create or update chat conversation
-            chat_id = f"{phone}_{instance_id}"
-            cursor.execute("""
-                INSERT OR REPLACE INTO chats (id, contact_phone, contact_name, instance_id, last_message, last_message_time, unread_count, created_at)
-                VALUES (?, ?, ?, ?, ?, ?, COALESCE((SELECT unread_count FROM chats WHERE id = ?), 0) + 1, ?)
-            """, (chat_id, phone, contact_name, instance_id, message[:100], timestamp, chat_id, timestamp))
-            
-            conn.commit()
-            conn.close()
+            try:
+                record = normalize_incoming_message(data)
+            except ValueError as e:
+                self.send_json_response({"error": str(e)}, 400)
+                return
+            instance_id = record['instance_id']
+            
+            # Queue for the next batch commit and only acknowledge once it is durable
+            try:
+                future = get_ingest_queue().submit(record)
+            except IngestQueueFull as e:
+                self.send_json_response({"error": f"Fila de ingestão cheia: {e}"}, 503, headers={"Retry-After": "1"})
+                return
+            status = future.result(timeout=INGEST_ACK_TIMEOUT)
+            if status == "duplicate":
+                print(f"♻️ Mensagem {record['whatsapp_id']} já registrada na instância {instance_id}")
+                self.send_json_response({"success": True, "instanceId": instance_id, "duplicate": True})
+                return
             
             print(f"📥 Mensagem recebida na instância {instance_id}")
-            print(f"👤 Contato: {contact_name} ({phone})")
-            print(f"💬 Mensagem: {message[:50]}...")
-            
-            # Broadcast via WebSocket if available
-            if WEBSOCKETS_AVAILABLE and websocket_clients:
-                asyncio.create_task(broadcast_message({
-                    'type': 'new_message',
-                    'message': {
-                        'id': msg_id,
-                        'contact_name': contact_name,
-                        'phone': phone,
-                        'message': message,
-                        'direction': 'incoming',
-                        'instance_id': instance_id,
-                        'created_at': timestamp
-                    }
-                }))
+            print(f"👤 Contato: {record['contact_name']} ({record['phone']})")
+            print(f"💬 Mensagem: {record['message'][:50]}...")
+            
+            get_ws_hub().publish(message_event(record), message_topics(record))
+            get_flow_engine().submit(record)
+            
+            self.send_json_response({"success": True, "instanceId": instance_id})
+            
+        except Exception as e:
+            print(f"❌ Erro ao processar mensagem: {e}")
+            self.send_json_response({"error": str(e)}, 500)
+    
+    def handle_receive_message_batch(self):
+        """Store a list of incoming messages in a single transaction.
+
+        Accepts either a JSON array or ``{"messages": [...]}`` with the same
+        items as /api/messages/receive. Messages already stored for the
+        instance (same ``messageId``) are skipped, so the sender can retry
+        the whole batch safely.
+        """
+        try:
+            content_length = int(self.headers.get('Content-Length', 0))
+            post_data = self.rfile.read(content_length)
+            data = json.loads(post_data.decode('utf-8'))
+            items = data.get('messages') if isinstance(data, dict) else data
+            if not isinstance(items, list):
+                self.send_json_response({"error": "Envie uma lista de mensagens"}, 400)
+                return
             
-            self.send_json_response({"success": True, "instanceId": instance_id})
+            self.send_json_response(receive_message_batch(items))
             
         except Exception as e:
-            print(f"❌ Erro ao processar mensagem: {e}")
+            print(f"❌ Erro ao processar lote de mensagens: {e}")
             self.send_json_response({"error": str(e)}, 500)
     
     def format_phone_number(self, phone):
         """Format phone number for Brazilian display"""
-        cleaned = phone.replace('+', '').replace('-', '').replace(' ', '')
-        
-        if len(cleaned) == 13 and cleaned.startswith('55'):
-            # Brazilian format: +55 (11) 99999-9999
-            return f"+55 ({cleaned[2:4]}) {cleaned[4:9]}-{cleaned[9:]}"
-        elif len(cleaned) == 11:
-            # Local format: (11) 99999-9999
-            return f"({cleaned[0:2]}) {cleaned[2:7]}-{cleaned[7:]}"
-        else:
-            # Return as is if format not recognized
-            return phone
+        return format_phone_number(phone)
     
     def handle_get_contacts(self):
         try:
-            conn = sqlite3.connect(DB_FILE)
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
-            cursor.execute("SELECT * FROM contacts ORDER BY created_at DESC")
-            contacts = [dict(row) for row in cursor.fetchall()]
-            conn.close()
-            self.send_json_response(contacts)
+            limit, after = self._page_params()
+            # Newest first: rowid follows insertion order and is never NULL
+            contacts, next_cursor = read_page(
+                "contacts", "*", "", (), ("rowid",), limit, after, descending=True
+            )
+            self.send_rows(contacts, next_cursor)
+        except CursorError as e:
+            self.send_json_response({"error": str(e)}, 400)
         except Exception as e:
             self.send_json_response({"error": str(e)}, 500)
 
     def handle_get_groups(self, instance_id):
         try:
-            import requests
-            try:
-                response = requests.get(
-                    f"http://127.0.0.1:{BAILEYS_PORT}/groups/{instance_id}", timeout=5
-                )
-            except requests.exceptions.RequestException:
-                self.send_json_response({"error": "Serviço Baileys indisponível na porta 3002"}, 503)
-                return
-
-            if response.status_code == 200:
-                self.send_json_response({"success": True, "groups": response.json()})
-            else:
-                self.send_json_response({"success": False, "groups": []})
-        except ImportError:
-            # Fallback to urllib
-            import urllib.request
-            try:
-                with urllib.request.urlopen(
-                    f"http://127.0.0.1:{BAILEYS_PORT}/groups/{instance_id}", timeout=5
-                ) as resp:
-                    if resp.status == 200:
-                        groups = json.loads(resp.read().decode("utf-8"))
-                        self.send_json_response({"success": True, "groups": groups})
-                    else:
-                        self.send_json_response({"success": False, "groups": []})
-            except Exception:
-                self.send_json_response({"error": "Serviço Baileys indisponível na porta 3002"}, 503)
+            groups = get_baileys_client().groups(instance_id)
+            self.send_json_response({"success": True, "groups": groups})
+        except BaileysUnavailable:
+            self.send_json_response({"error": f"Serviço Baileys indisponível em {BAILEYS_URL}"}, 503)
+        except BaileysError:
+            self.send_json_response({"success": False, "groups": []})
+        except Exception as e:
+            self.send_json_response({"error": str(e)}, 500)
     
     def handle_get_chats(self):
         try:
-            conn = sqlite3.connect(DB_FILE)
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
-            
-            # Get chats with latest message info
-            cursor.execute("""
-                SELECT DISTINCT
-                    c.phone as contact_phone,
-                    c.name as contact_name, 
-                    c.instance_id,
-                    (SELECT message FROM messages m WHERE m.phone = c.phone ORDER BY m.created_at DESC LIMIT 1) as last_message,
-                    (SELECT created_at FROM messages m WHERE m.phone = c.phone ORDER BY m.created_at DESC LIMIT 1) as last_message_time,
-                    (SELECT COUNT(*) FROM messages m WHERE m.phone = c.phone AND m.direction = 'incoming') as unread_count
-                FROM contacts c
-                WHERE EXISTS (SELECT 1 FROM messages m WHERE m.phone = c.phone)
-                ORDER BY last_message_time DESC
-            """)
-            
-            chats = [dict(row) for row in cursor.fetchall()]
-            conn.close()
-            self.send_json_response(chats)
-            
+            limit, after = self._page_params()
+            # Chats summary is kept up to date by every message insert
+            chats, next_cursor = read_page(
+                "chats",
+                "contact_phone, contact_name, instance_id, last_message, last_message_time, unread_count",
+                "last_message_time IS NOT NULL", (),
+                ("last_message_time", "rowid"), limit, after, descending=True,
+            )
+            self.send_rows(chats, next_cursor)
+
+        except CursorError as e:
+            self.send_json_response({"error": str(e)}, 400)
         except Exception as e:
             print(f"❌ Erro ao buscar chats: {e}")
             self.send_json_response({"error": str(e)}, 500)
@@ -2243,12 +6395,10 @@ class WhatsFlowRealHandler(BaseHTTPRequestHandler):
     # Campaign handlers
     def handle_get_campaigns(self):
         try:
-            conn = sqlite3.connect(DB_FILE)
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
-            cursor.execute("SELECT * FROM campaigns ORDER BY id DESC")
-            campaigns = [dict(row) for row in cursor.fetchall()]
-            conn.close()
+            with get_db().read() as conn:
+                cursor = conn.cursor()
+                cursor.execute("SELECT * FROM campaigns ORDER BY id DESC")
+                campaigns = [dict(row) for row in cursor.fetchall()]
             self.send_json_response({"campaigns": campaigns})
         except Exception as e:
             self.send_json_response({"error": str(e)}, 500)
@@ -2258,15 +6408,13 @@ class WhatsFlowRealHandler(BaseHTTPRequestHandler):
             content_length = int(self.headers.get('Content-Length', 0))
             data = json.loads(self.rfile.read(content_length))
             name = data.get('name', 'Campanha')
-            conn = sqlite3.connect(DB_FILE)
-            cursor = conn.cursor()
-            cursor.execute(
-                "INSERT INTO campaigns (name, created_at) VALUES (?, ?)",
-                (name, datetime.now(BR_TZ).isoformat()),
-            )
-            campaign_id = cursor.lastrowid
-            conn.commit()
-            conn.close()
+            with get_db().write() as conn:
+                cursor = conn.cursor()
+                cursor.execute(
+                    "INSERT INTO campaigns (name, created_at) VALUES (?, ?)",
+                    (name, datetime.now(BR_TZ).isoformat()),
+                )
+                campaign_id = cursor.lastrowid
             self.send_json_response({"id": campaign_id, "name": name})
         except Exception as e:
             self.send_json_response({"error": str(e)}, 500)
@@ -2277,30 +6425,27 @@ class WhatsFlowRealHandler(BaseHTTPRequestHandler):
             data = json.loads(self.rfile.read(content_length))
             groups = data.get('groups', [])
 
-            conn = sqlite3.connect(DB_FILE)
-            cursor = conn.cursor()
-            cursor.execute("DELETE FROM campaign_groups WHERE campaign_id=?", (campaign_id,))
-            for item in groups:
-                cursor.execute(
-                    "INSERT INTO campaign_groups (campaign_id, instance_id, group_id) VALUES (?, ?, ?)",
-                    (campaign_id, item.get('instance_id'), item.get('group_id')),
-                )
-            conn.commit()
-            conn.close()
+            with get_db().write() as conn:
+                cursor = conn.cursor()
+                cursor.execute("DELETE FROM campaign_groups WHERE campaign_id=?", (campaign_id,))
+                for item in groups:
+                    cursor.execute(
+                        "INSERT INTO campaign_groups (campaign_id, instance_id, group_id) VALUES (?, ?, ?)",
+                        (campaign_id, item.get('instance_id'), item.get('group_id')),
+                    )
             self.send_json_response({"success": True})
         except Exception as e:
             self.send_json_response({"error": str(e)}, 500)
 
     def handle_get_campaign_groups(self, campaign_id):
         try:
-            conn = sqlite3.connect(DB_FILE)
-            cursor = conn.cursor()
-            cursor.execute(
-                "SELECT instance_id, group_id FROM campaign_groups WHERE campaign_id=?",
-                (campaign_id,),
-            )
-            groups = [dict(instance_id=row[0], group_id=row[1]) for row in cursor.fetchall()]
-            conn.close()
+            with get_db().read() as conn:
+                cursor = conn.cursor()
+                cursor.execute(
+                    "SELECT instance_id, group_id FROM campaign_groups WHERE campaign_id=?",
+                    (campaign_id,),
+                )
+                groups = [dict(instance_id=row[0], group_id=row[1]) for row in cursor.fetchall()]
             self.send_json_response({"groups": groups})
         except Exception as e:
             self.send_json_response({"error": str(e)}, 500)
@@ -2316,26 +6461,32 @@ class WhatsFlowRealHandler(BaseHTTPRequestHandler):
             media_type = data.get('media_type')
             media_data = data.get('media_data')
             media_path = None
-            if media_type and media_data:
-                os.makedirs('uploads', exist_ok=True)
-                file_name = f"uploads/{uuid.uuid4().hex}"
-                with open(file_name, 'wb') as f:
-                    f.write(base64.b64decode(media_data))
-                media_path = file_name
+            if data.get('media_id'):
+                stored = get_media_store().info(data['media_id'])
+                if stored is None:
+                    self.send_json_response({"error": "Mídia não encontrada"}, 404)
+                    return
+                media_path = stored['path']
+                media_type = media_type or stored['media_type']
+            elif media_type and media_data:
+                # Decoded piece by piece straight into the content-addressed store
+                pieces = (media_data[i:i + MEDIA_CHUNK_SIZE] for i in range(0, len(media_data), MEDIA_CHUNK_SIZE))
+                stored = get_media_store().put_stream(
+                    iter_base64_chunks(pieces), data.get('mimetype'), media_type
+                )
+                media_path = stored['path']
 
             next_run = compute_next_run(schedule_type, weekday or 0, send_time)
 
-            conn = sqlite3.connect(DB_FILE)
-            cursor = conn.cursor()
-            cursor.execute(
-                """
-                INSERT INTO campaign_messages (campaign_id, schedule_type, weekday, send_time, message, media_type, media_path, next_run)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                """,
-                (campaign_id, schedule_type, weekday, send_time, message, media_type, media_path, next_run.isoformat()),
-            )
-            conn.commit()
-            conn.close()
+            with get_db().write() as conn:
+                cursor = conn.cursor()
+                cursor.execute(
+                    """
+                    INSERT INTO campaign_messages (campaign_id, schedule_type, weekday, send_time, message, media_type, media_path, next_run)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                    """,
+                    (campaign_id, schedule_type, weekday, send_time, message, media_type, media_path, next_run.isoformat()),
+                )
             self.send_json_response({"success": True})
         except Exception as e:
             self.send_json_response({"error": str(e)}, 500)
@@ -2359,32 +6510,29 @@ class WhatsFlowRealHandler(BaseHTTPRequestHandler):
                 next_run = send_at
 
             schedule_id = str(uuid.uuid4())
-            conn = sqlite3.connect(DB_FILE)
-            cursor = conn.cursor()
-            cursor.execute(
-                """
-                INSERT INTO scheduled_messages (id, campaign_id, content, media_type, media_path, next_run, status)
-                VALUES (?, ?, ?, ?, ?, ?, 'pending')
-                """,
-                (schedule_id, campaign_id, message, None, None, next_run),
-            )
-            conn.commit()
-            conn.close()
+            with get_db().write() as conn:
+                cursor = conn.cursor()
+                cursor.execute(
+                    """
+                    INSERT INTO scheduled_messages (id, campaign_id, content, media_type, media_path, next_run, status)
+                    VALUES (?, ?, ?, ?, ?, ?, 'pending')
+                    """,
+                    (schedule_id, campaign_id, message, None, None, next_run),
+                )
+            get_scheduled_queue().schedule(schedule_id, next_run)
             self.send_json_response({'success': True, 'id': schedule_id})
         except Exception as e:
             self.send_json_response({'error': str(e)}, 500)
 
     def handle_get_campaign_messages(self, campaign_id):
         try:
-            conn = sqlite3.connect(DB_FILE)
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
-            cursor.execute(
-                "SELECT * FROM campaign_messages WHERE campaign_id=? ORDER BY id DESC",
-                (campaign_id,),
-            )
-            messages = [dict(row) for row in cursor.fetchall()]
-            conn.close()
+            with get_db().read() as conn:
+                cursor = conn.cursor()
+                cursor.execute(
+                    "SELECT * FROM campaign_messages WHERE campaign_id=? ORDER BY id DESC",
+                    (campaign_id,),
+                )
+                messages = [dict(row) for row in cursor.fetchall()]
             self.send_json_response({"messages": messages})
         except Exception as e:
             self.send_json_response({"error": str(e)}, 500)
@@ -2397,33 +6545,29 @@ class WhatsFlowRealHandler(BaseHTTPRequestHandler):
             
             phone = query_params.get('phone', [None])[0]
             instance_id = query_params.get('instance_id', [None])[0]
-            
+            order = query_params.get('order', ['asc'])[0].lower()
+
             if not phone:
-                self.send_json_response({"error": "Phone parameter required"}, 400)
+                # No conversation selected: the latest messages overall
+                self.handle_get_messages()
                 return
-            
-            conn = sqlite3.connect(DB_FILE)
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
-            
+            if order not in ('asc', 'desc'):
+                self.send_json_response({"error": "order deve ser asc ou desc"}, 400)
+                return
+
+            limit, after = self._page_params()
+            where, params = "phone = ?", [phone]
             if instance_id:
-                cursor.execute("""
-                    SELECT * FROM messages 
-                    WHERE phone = ? AND instance_id = ? 
-                    ORDER BY created_at ASC
-                """, (phone, instance_id))
-            else:
-                cursor.execute("""
-                    SELECT * FROM messages 
-                    WHERE phone = ? 
-                    ORDER BY created_at ASC
-                """, (phone,))
-            
-            messages = [dict(row) for row in cursor.fetchall()]
-            conn.close()
-            
-            self.send_json_response(messages)
-            
+                where += " AND instance_id = ?"
+                params.append(instance_id)
+            messages, next_cursor = read_page(
+                "messages", "*", where, params, ("created_at", "rowid"),
+                limit, after, descending=order == 'desc',
+            )
+            self.send_rows(messages, next_cursor)
+
+        except CursorError as e:
+            self.send_json_response({"error": str(e)}, 400)
         except Exception as e:
             print(f"❌ Erro ao buscar mensagens filtradas: {e}")
             self.send_json_response({"error": str(e)}, 500)
@@ -2483,18 +6627,15 @@ class WhatsFlowRealHandler(BaseHTTPRequestHandler):
     
     def handle_delete_instance(self, instance_id):
         try:
-            conn = sqlite3.connect(DB_FILE)
-            cursor = conn.cursor()
-            cursor.execute("DELETE FROM instances WHERE id = ?", (instance_id,))
-            
-            if cursor.rowcount == 0:
-                conn.close()
+            with get_db().write() as conn:
+                cursor = conn.cursor()
+                cursor.execute("DELETE FROM instances WHERE id = ?", (instance_id,))
+                deleted = cursor.rowcount > 0
+
+            if not deleted:
                 self.send_json_response({"error": "Instance not found"}, 404)
                 return
-            
-            conn.commit()
-            conn.close()
-            
+
             self.send_json_response({"message": "Instance deleted successfully"})
         except Exception as e:
             self.send_json_response({"error": str(e)}, 500)
@@ -2503,31 +6644,27 @@ class WhatsFlowRealHandler(BaseHTTPRequestHandler):
     def handle_get_flows(self):
         """Get all flows"""
         try:
-            conn = sqlite3.connect(DB_FILE)
-            cursor = conn.cursor()
-            
-            cursor.execute("""
-                SELECT * FROM flows 
-                ORDER BY created_at DESC
-            """)
-            
-            flows = []
-            for row in cursor.fetchall():
-                flows.append({
-                    'id': row[0],
-                    'name': row[1],
-                    'description': row[2],
-                    'nodes': json.loads(row[3]) if row[3] else [],
-                    'edges': json.loads(row[4]) if row[4] else [],
-                    'active': bool(row[5]),
-                    'instance_id': row[6],
-                    'created_at': row[7],
-                    'updated_at': row[8]
-                })
-            
-            conn.close()
-            self.send_json_response(flows)
-            
+            limit, after = self._page_params()
+            rows, next_cursor = read_page("flows", "*", "", (), ("rowid",), limit, after, descending=True)
+
+            def to_flow(row):
+                return {
+                    'id': row['id'],
+                    'name': row['name'],
+                    'description': row['description'],
+                    'nodes': json.loads(row['nodes']) if row['nodes'] else [],
+                    'edges': json.loads(row['edges']) if row['edges'] else [],
+                    'active': bool(row['active']),
+                    'instance_id': row['instance_id'],
+                    'created_at': row['created_at'],
+                    'updated_at': row['updated_at']
+                }
+
+            flows = [to_flow(row) for row in rows] if limit is not None else map(to_flow, rows)
+            self.send_rows(flows, next_cursor)
+
+        except CursorError as e:
+            self.send_json_response({"error": str(e)}, 400)
         except Exception as e:
             print(f"❌ Erro ao obter fluxos: {e}")
             self.send_json_response({"error": str(e)}, 500)
@@ -2540,26 +6677,30 @@ class WhatsFlowRealHandler(BaseHTTPRequestHandler):
             data = json.loads(post_data.decode('utf-8'))
             
             flow_id = str(uuid.uuid4())
+            try:
+                warnings = check_flow(flow_id, data.get('nodes', []), data.get('edges', []), data.get('active', False))
+            except FlowCompileError as e:
+                self.send_json_response({"error": f"Fluxo inválido: {e}"}, 400)
+                return
             
-            conn = sqlite3.connect(DB_FILE)
-            cursor = conn.cursor()
-            
-            cursor.execute("""
-                INSERT INTO flows (id, name, description, nodes, edges, active, instance_id, created_at, updated_at)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """, (flow_id, data['name'], data.get('description', ''), 
-                  json.dumps(data.get('nodes', [])), json.dumps(data.get('edges', [])),
-                  data.get('active', False), data.get('instance_id'),
-                  datetime.now(BR_TZ).astimezone(timezone.utc).isoformat(), datetime.now(BR_TZ).astimezone(timezone.utc).isoformat()))
+            with get_db().write() as conn:
+                cursor = conn.cursor()
             
-            conn.commit()
-            conn.close()
+                cursor.execute("""
+                    INSERT INTO flows (id, name, description, nodes, edges, active, instance_id, created_at, updated_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """, (flow_id, data['name'], data.get('description', ''), 
+                      json.dumps(data.get('nodes', [])), json.dumps(data.get('edges', [])),
+                      data.get('active', False), data.get('instance_id'),
+                      datetime.now(BR_TZ).astimezone(timezone.utc).isoformat(), datetime.now(BR_TZ).astimezone(timezone.utc).isoformat()))
+            get_flow_registry().invalidate(flow_id)
             
             print(f"✅ Fluxo '{data['name']}' criado com ID: {flow_id}")
             self.send_json_response({
                 'success': True,
                 'flow_id': flow_id,
-                'message': f'Fluxo "{data["name"]}" criado com sucesso'
+                'message': f'Fluxo "{data["name"]}" criado com sucesso',
+                'warnings': warnings,
             })
             
         except Exception as e:
@@ -2573,8 +6714,18 @@ class WhatsFlowRealHandler(BaseHTTPRequestHandler):
             post_data = self.rfile.read(content_length)
             data = json.loads(post_data.decode('utf-8'))
             
-            conn = sqlite3.connect(DB_FILE)
-            cursor = conn.cursor()
+            with get_db().read() as conn:
+                stored = conn.execute("SELECT nodes, edges, active FROM flows WHERE id = ?", (flow_id,)).fetchone()
+            if stored is None:
+                self.send_json_response({'error': 'Fluxo não encontrado'}, 404)
+                return
+            try:
+                warnings = check_flow(flow_id, data['nodes'] if 'nodes' in data else stored['nodes'],
+                                      data['edges'] if 'edges' in data else stored['edges'],
+                                      data['active'] if 'active' in data else stored['active'])
+            except FlowCompileError as e:
+                self.send_json_response({"error": f"Fluxo inválido: {e}"}, 400)
+                return
             
             # Update only the provided fields
             update_fields = []
@@ -2609,19 +6760,19 @@ class WhatsFlowRealHandler(BaseHTTPRequestHandler):
             
             values.append(flow_id)
             
-            cursor.execute(f"""
-                UPDATE flows 
-                SET {', '.join(update_fields)}
-                WHERE id = ?
-            """, values)
+            with get_db().write() as conn:
+                cursor = conn.execute(f"""
+                    UPDATE flows 
+                    SET {', '.join(update_fields)}
+                    WHERE id = ?
+                """, values)
+                updated = cursor.rowcount > 0
+            get_flow_registry().invalidate(flow_id)
             
-            if cursor.rowcount > 0:
-                conn.commit()
-                conn.close()
+            if updated:
                 print(f"✅ Fluxo {flow_id} atualizado")
-                self.send_json_response({'success': True, 'message': 'Fluxo atualizado com sucesso'})
+                self.send_json_response({'success': True, 'message': 'Fluxo atualizado com sucesso', 'warnings': warnings})
             else:
-                conn.close()
                 self.send_json_response({'error': 'Fluxo não encontrado'}, 404)
             
         except Exception as e:
@@ -2631,43 +6782,107 @@ class WhatsFlowRealHandler(BaseHTTPRequestHandler):
     def handle_delete_flow(self, flow_id):
         """Delete flow"""
         try:
-            conn = sqlite3.connect(DB_FILE)
-            cursor = conn.cursor()
+            with get_db().write() as conn:
+                cursor = conn.execute("DELETE FROM flows WHERE id = ?", (flow_id,))
+                deleted = cursor.rowcount > 0
+                # Contacts still inside the flow are released
+                conn.execute("DELETE FROM flow_sessions WHERE flow_id = ?", (flow_id,))
+                conn.execute("DELETE FROM flow_timers WHERE flow_id = ?", (flow_id,))
+            get_flow_registry().invalidate(flow_id)
+            get_flow_engine().sessions.drop_flow(flow_id)
             
-            cursor.execute("DELETE FROM flows WHERE id = ?", (flow_id,))
-            
-            if cursor.rowcount > 0:
-                conn.commit()
-                conn.close()
+            if deleted:
                 print(f"✅ Fluxo {flow_id} excluído")
                 self.send_json_response({'success': True, 'message': 'Fluxo excluído com sucesso'})
             else:
-                conn.close()
                 self.send_json_response({'error': 'Fluxo não encontrado'}, 404)
             
         except Exception as e:
             print(f"❌ Erro ao excluir fluxo: {e}")
             self.send_json_response({"error": str(e)}, 500)
 
+    def handle_simulate_flow(self, flow_id):
+        """Dry-run a stored flow against given or recorded messages"""
+        try:
+            content_length = int(self.headers.get('Content-Length', 0))
+            data = json.loads(self.rfile.read(content_length).decode('utf-8') or '{}') if content_length else {}
+            try:
+                flow = load_flow(flow_id)
+            except FlowCompileError as e:
+                self.send_json_response({"error": f"Fluxo inválido: {e}"}, 400)
+                return
+            if flow is None:
+                self.send_json_response({'error': 'Fluxo não encontrado'}, 404)
+                return
+
+            messages = data.get('messages')
+            if messages is None:
+                limit = min(int(data.get('limit', 1000)), FLOW_SIMULATE_MAX)
+                messages = recorded_messages(data.get('instance_id'), data.get('phone'), limit)
+            elif not isinstance(messages, list) or len(messages) > FLOW_SIMULATE_MAX:
+                self.send_json_response({"error": f"messages deve ser uma lista de até {FLOW_SIMULATE_MAX} itens"}, 400)
+                return
+            self.send_json_response(simulate_flow(flow, messages))
+        except (AttributeError, TypeError, ValueError) as e:
+            self.send_json_response({"error": f"Mensagens inválidas: {e}"}, 400)
+        except Exception as e:
+            print(f"❌ Erro ao simular fluxo: {e}")
+            self.send_json_response({"error": str(e)}, 500)
+
     # Campaign Management Functions
     def handle_get_campaigns(self):
         """Get all campaigns"""
         try:
-            conn = sqlite3.connect(DB_FILE)
-            cursor = conn.cursor()
-            cursor.execute(
-                "SELECT id, name, description, recurrence, send_time, weekday, timezone FROM campaigns"
-            )
-            campaigns = []
-            for row in cursor.fetchall():
-                campaign_id = row[0]
+            limit, after = self._page_params()
+            with get_db().read() as conn:
+                campaigns, next_cursor = keyset_page(
+                    conn, "campaigns", "id, name, description, recurrence, send_time, weekday, timezone",
+                    "", (), ("rowid",), limit, after, descending=True,
+                )
+                campaigns = list(campaigns)
+                # One query for the groups of the whole page
+                groups = {campaign['id']: [] for campaign in campaigns}
+                ids = list(groups)
+                for start in range(0, len(ids), 500):
+                    chunk = ids[start:start + 500]
+                    for campaign_id, group_id in conn.execute(
+                        f"SELECT campaign_id, group_id FROM campaign_groups WHERE campaign_id IN ({', '.join('?' * len(chunk))})",
+                        chunk,
+                    ):
+                        groups[campaign_id].append(group_id)
+            for campaign in campaigns:
+                campaign['groups'] = groups[campaign['id']]
+            self.send_rows(campaigns, next_cursor)
+
+        except CursorError as e:
+            self.send_json_response({"error": str(e)}, 400)
+        except Exception as e:
+            print(f"❌ Erro ao obter campanhas: {e}")
+            self.send_json_response({'error': str(e)}, 500)
+
+    def handle_get_campaign(self, campaign_id):
+        """Get a single campaign"""
+        try:
+            with get_db().read() as conn:
+                cursor = conn.cursor()
+
+                cursor.execute(
+                    "SELECT id, name, description, recurrence, send_time, weekday, timezone FROM campaigns WHERE id = ?",
+                    (campaign_id,),
+                )
+                row = cursor.fetchone()
+                if not row:
+                    self.send_json_response({'error': 'Campanha não encontrada'}, 404)
+                    return
+
                 cursor.execute(
                     "SELECT group_id FROM campaign_groups WHERE campaign_id = ?",
                     (campaign_id,),
                 )
                 groups = [g[0] for g in cursor.fetchall()]
-                campaigns.append({
-                    'id': campaign_id,
+
+                campaign = {
+                    'id': row[0],
                     'name': row[1],
                     'description': row[2],
                     'recurrence': row[3],
@@ -2675,48 +6890,8 @@ class WhatsFlowRealHandler(BaseHTTPRequestHandler):
                     'weekday': row[5],
                     'timezone': row[6],
                     'groups': groups,
-                })
-            conn.close()
-            self.send_json_response(campaigns)
-
-        except Exception as e:
-            print(f"❌ Erro ao obter campanhas: {e}")
-            self.send_json_response({'error': str(e)}, 500)
-
-    def handle_get_campaign(self, campaign_id):
-        """Get a single campaign"""
-        try:
-            conn = sqlite3.connect(DB_FILE)
-            cursor = conn.cursor()
-
-            cursor.execute(
-                "SELECT id, name, description, recurrence, send_time, weekday, timezone FROM campaigns WHERE id = ?",
-                (campaign_id,),
-            )
-            row = cursor.fetchone()
-            if not row:
-                conn.close()
-                self.send_json_response({'error': 'Campanha não encontrada'}, 404)
-                return
-
-            cursor.execute(
-                "SELECT group_id FROM campaign_groups WHERE campaign_id = ?",
-                (campaign_id,),
-            )
-            groups = [g[0] for g in cursor.fetchall()]
-
-            campaign = {
-                'id': row[0],
-                'name': row[1],
-                'description': row[2],
-                'recurrence': row[3],
-                'send_time': row[4],
-                'weekday': row[5],
-                'timezone': row[6],
-                'groups': groups,
-            }
+                }
 
-            conn.close()
             self.send_json_response(campaign)
 
         except Exception as e:
@@ -2732,49 +6907,46 @@ class WhatsFlowRealHandler(BaseHTTPRequestHandler):
 
             campaign_id = str(uuid.uuid4())
 
-            conn = sqlite3.connect(DB_FILE)
-            cursor = conn.cursor()
-
             groups = data.get('groups', [])
             if not isinstance(groups, list):
-                conn.close()
                 self.send_json_response({'error': 'Grupos inválidos'}, 400)
                 return
 
-            send_time = data.get('send_time')
-            if send_time:
-                try:
-                    dt = datetime.fromisoformat(send_time)
-                    if dt.tzinfo is None:
-                        dt = dt.replace(tzinfo=BR_TZ)
-                    send_time = dt.astimezone(timezone.utc).isoformat()
-                except ValueError:
-                    pass
-            cursor.execute(
-                """
-                INSERT INTO campaigns (id, name, description, recurrence, send_time, weekday, timezone)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-                """,
-                (
-                    campaign_id,
-                    data['name'],
-                    data.get('description'),
-                    data.get('recurrence'),
-                    data.get('send_time'),
-                    data.get('weekday'),
-                    data.get('timezone', 'America/Sao_Paulo'),
-
-                ),
-            )
+            with get_db().write() as conn:
+                cursor = conn.cursor()
 
-            for group_id in groups:
+                send_time = data.get('send_time')
+                if send_time:
+                    try:
+                        dt = datetime.fromisoformat(send_time)
+                        if dt.tzinfo is None:
+                            dt = dt.replace(tzinfo=BR_TZ)
+                        send_time = dt.astimezone(timezone.utc).isoformat()
+                    except ValueError:
+                        pass
                 cursor.execute(
-                    "INSERT OR IGNORE INTO campaign_groups (campaign_id, group_id) VALUES (?, ?)",
-                    (campaign_id, group_id),
+                    """
+                    INSERT INTO campaigns (id, name, description, recurrence, send_time, weekday, timezone)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                    """,
+                    (
+                        campaign_id,
+                        data['name'],
+                        data.get('description'),
+                        data.get('recurrence'),
+                        data.get('send_time'),
+                        data.get('weekday'),
+                        data.get('timezone', 'America/Sao_Paulo'),
+
+                    ),
                 )
 
-            conn.commit()
-            conn.close()
+                for group_id in groups:
+                    cursor.execute(
+                        "INSERT OR IGNORE INTO campaign_groups (campaign_id, group_id) VALUES (?, ?)",
+                        (campaign_id, group_id),
+                    )
+
 
             self.send_json_response({'success': True, 'campaign_id': campaign_id})
 
@@ -2789,71 +6961,68 @@ class WhatsFlowRealHandler(BaseHTTPRequestHandler):
             post_data = self.rfile.read(content_length)
             data = json.loads(post_data.decode('utf-8'))
 
-            conn = sqlite3.connect(DB_FILE)
-            cursor = conn.cursor()
+            if 'groups' in data and not isinstance(data['groups'], list):
+                self.send_json_response({'error': 'Grupos inválidos'}, 400)
+                return
 
-            update_fields = []
-            values = []
+            with get_db().write() as conn:
+                cursor = conn.cursor()
 
-            if 'name' in data:
-                update_fields.append('name = ?')
-                values.append(data['name'])
+                update_fields = []
+                values = []
 
-            if 'description' in data:
-                update_fields.append('description = ?')
-                values.append(data['description'])
+                if 'name' in data:
+                    update_fields.append('name = ?')
+                    values.append(data['name'])
 
-            if 'recurrence' in data:
-                update_fields.append('recurrence = ?')
-                values.append(data['recurrence'])
+                if 'description' in data:
+                    update_fields.append('description = ?')
+                    values.append(data['description'])
 
-            if 'send_time' in data:
-                st = data['send_time']
-                try:
-                    dt = datetime.fromisoformat(st)
-                    if dt.tzinfo is None:
-                        dt = dt.replace(tzinfo=BR_TZ)
-                    st = dt.astimezone(timezone.utc).isoformat()
-                except ValueError:
-                    pass
-                update_fields.append('send_time = ?')
-                values.append(st)
+                if 'recurrence' in data:
+                    update_fields.append('recurrence = ?')
+                    values.append(data['recurrence'])
 
-            if 'weekday' in data:
-                update_fields.append('weekday = ?')
-                values.append(data['weekday'])
+                if 'send_time' in data:
+                    st = data['send_time']
+                    try:
+                        dt = datetime.fromisoformat(st)
+                        if dt.tzinfo is None:
+                            dt = dt.replace(tzinfo=BR_TZ)
+                        st = dt.astimezone(timezone.utc).isoformat()
+                    except ValueError:
+                        pass
+                    update_fields.append('send_time = ?')
+                    values.append(st)
 
-            if 'timezone' in data:
-                update_fields.append('timezone = ?')
-                values.append(data['timezone'])
+                if 'weekday' in data:
+                    update_fields.append('weekday = ?')
+                    values.append(data['weekday'])
 
-            values.append(campaign_id)
-            cursor.execute(
-                f"UPDATE campaigns SET {', '.join(update_fields)} WHERE id = ?",
-                values,
-            )
+                if 'timezone' in data:
+                    update_fields.append('timezone = ?')
+                    values.append(data['timezone'])
 
-            if cursor.rowcount == 0:
-                conn.close()
+                values.append(campaign_id)
+                cursor.execute(
+                    f"UPDATE campaigns SET {', '.join(update_fields)} WHERE id = ?",
+                    values,
+                )
+                found = cursor.rowcount > 0
+
+                if found and 'groups' in data:
+                    groups = data['groups']
+                    cursor.execute("DELETE FROM campaign_groups WHERE campaign_id = ?", (campaign_id,))
+                    for group_id in groups:
+                        cursor.execute(
+                            "INSERT OR IGNORE INTO campaign_groups (campaign_id, group_id) VALUES (?, ?)",
+                            (campaign_id, group_id),
+                        )
+
+            if not found:
                 self.send_json_response({'error': 'Campanha não encontrada'}, 404)
                 return
-
-            if 'groups' in data:
-                groups = data['groups']
-                if not isinstance(groups, list):
-                    conn.close()
-                    self.send_json_response({'error': 'Grupos inválidos'}, 400)
-                    return
-                cursor.execute("DELETE FROM campaign_groups WHERE campaign_id = ?", (campaign_id,))
-                for group_id in groups:
-                    cursor.execute(
-                        "INSERT OR IGNORE INTO campaign_groups (campaign_id, group_id) VALUES (?, ?)",
-                        (campaign_id, group_id),
-                    )
-
-            conn.commit()
-            conn.close()
-
+            get_scheduled_queue().reload_campaign(campaign_id)
             self.send_json_response({'success': True})
 
         except Exception as e:
@@ -2863,35 +7032,63 @@ class WhatsFlowRealHandler(BaseHTTPRequestHandler):
     def handle_delete_campaign(self, campaign_id):
         """Delete campaign"""
         try:
-            conn = sqlite3.connect(DB_FILE)
-            cursor = conn.cursor()
-
-            cursor.execute("DELETE FROM campaign_groups WHERE campaign_id = ?", (campaign_id,))
-            cursor.execute("DELETE FROM campaign_messages WHERE campaign_id = ?", (campaign_id,))
-            cursor.execute("DELETE FROM campaigns WHERE id = ?", (campaign_id,))
-
-            if cursor.rowcount > 0:
-                conn.commit()
-                conn.close()
+            with get_db().write() as conn:
+                cursor = conn.cursor()
+                cursor.execute("SELECT 1 FROM campaigns WHERE id = ?", (campaign_id,))
+                found = cursor.fetchone() is not None
+                scheduled = []
+                if found:
+                    scheduled = [row[0] for row in cursor.execute(
+                        "SELECT id FROM scheduled_messages WHERE campaign_id = ?", (campaign_id,)
+                    ).fetchall()]
+                    # Deleting the rows releases their media through the refcount triggers
+                    cursor.execute("DELETE FROM scheduled_messages WHERE campaign_id = ?", (campaign_id,))
+                    cursor.execute("DELETE FROM campaign_groups WHERE campaign_id = ?", (campaign_id,))
+                    cursor.execute("DELETE FROM campaign_messages WHERE campaign_id = ?", (campaign_id,))
+                    cursor.execute("DELETE FROM campaigns WHERE id = ?", (campaign_id,))
+
+            if found:
+                scheduled_queue = get_scheduled_queue()
+                for sched_id in scheduled:
+                    scheduled_queue.discard(sched_id)
                 self.send_json_response({'success': True})
             else:
-                conn.close()
                 self.send_json_response({'error': 'Campanha não encontrada'}, 404)
 
         except Exception as e:
             print(f"❌ Erro ao excluir campanha: {e}")
             self.send_json_response({'error': str(e)}, 500)
 
+    def handle_get_campaign_deliveries(self, campaign_id):
+        """Per-group send results of a campaign, newest first"""
+        try:
+            with get_db().read() as conn:
+                rows = conn.execute(
+                    """
+                    SELECT source, source_id, instance_id, group_id, status, error, duration_ms, created_at
+                    FROM deliveries WHERE campaign_id = ?
+                    ORDER BY created_at DESC LIMIT 1000
+                    """,
+                    (campaign_id,),
+                ).fetchall()
+            deliveries = [dict(row) for row in rows]
+            summary = {
+                "sent": sum(1 for d in deliveries if d["status"] == "sent"),
+                "failed": sum(1 for d in deliveries if d["status"] == "failed"),
+            }
+            self.send_json_response({"deliveries": deliveries, "summary": summary})
+        except Exception as e:
+            self.send_json_response({"error": str(e)}, 500)
+
     def handle_get_campaign_groups(self, campaign_id: str) -> None:
         try:
-            conn = sqlite3.connect(DB_FILE)
-            cursor = conn.cursor()
-            cursor.execute(
-                "SELECT group_id FROM campaign_groups WHERE campaign_id = ?",
-                (campaign_id,),
-            )
-            groups = [row[0] for row in cursor.fetchall()]
-            conn.close()
+            with get_db().read() as conn:
+                cursor = conn.cursor()
+                cursor.execute(
+                    "SELECT group_id FROM campaign_groups WHERE campaign_id = ?",
+                    (campaign_id,),
+                )
+                groups = [row[0] for row in cursor.fetchall()]
             self.send_json_response({'campaign_id': campaign_id, 'groups': groups})
         except Exception as e:
             self.send_json_response({'error': str(e)}, 500)
@@ -2904,20 +7101,19 @@ class WhatsFlowRealHandler(BaseHTTPRequestHandler):
             if not isinstance(groups, list) or not groups:
                 self.send_json_response({'error': 'Grupos inválidos'}, 400)
                 return
-            conn = sqlite3.connect(DB_FILE)
-            cursor = conn.cursor()
-            cursor.execute("SELECT id FROM campaigns WHERE id = ?", (campaign_id,))
-            if not cursor.fetchone():
-                conn.close()
+            with get_db().write() as conn:
+                cursor = conn.cursor()
+                cursor.execute("SELECT id FROM campaigns WHERE id = ?", (campaign_id,))
+                found = cursor.fetchone() is not None
+                if found:
+                    for gid in groups:
+                        cursor.execute(
+                            "INSERT OR IGNORE INTO campaign_groups (campaign_id, group_id) VALUES (?, ?)",
+                            (campaign_id, gid),
+                        )
+            if not found:
                 self.send_json_response({'error': 'Campanha não encontrada'}, 404)
                 return
-            for gid in groups:
-                cursor.execute(
-                    "INSERT OR IGNORE INTO campaign_groups (campaign_id, group_id) VALUES (?, ?)",
-                    (campaign_id, gid),
-                )
-            conn.commit()
-            conn.close()
             self.send_json_response({'success': True})
         except Exception as e:
             self.send_json_response({'error': str(e)}, 500)
@@ -2950,6 +7146,121 @@ class WhatsFlowRealHandler(BaseHTTPRequestHandler):
         # Suppress default logging
         pass
 
+class PooledHTTPServer(HTTPServer):
+    """HTTPServer that dispatches each connection to a bounded worker pool.
+
+    At most ``max_workers`` requests run at the same time; further
+    connections wait in the accept loop (and then in the kernel backlog)
+    until a worker is free. ``server_close`` waits for in-flight requests to
+    finish before returning.
+    """
+
+    allow_reuse_address = True
+
+    def __init__(self, server_address, handler_class, max_workers: int = HTTP_MAX_WORKERS):
+        self.max_workers = max(1, int(max_workers))
+        self._slots = threading.BoundedSemaphore(self.max_workers)
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.max_workers, thread_name_prefix="whatsflow-http"
+        )
+        self._in_flight = 0
+        self._in_flight_lock = threading.Lock()
+        super().__init__(server_address, handler_class)
+
+    @property
+    def in_flight(self) -> int:
+        with self._in_flight_lock:
+            return self._in_flight
+
+    def process_request(self, request, client_address):
+        self._slots.acquire()
+        with self._in_flight_lock:
+            self._in_flight += 1
+        try:
+            self._executor.submit(self._process_request_worker, request, client_address)
+        except RuntimeError:
+            # Executor already shut down: refuse the connection
+            self._release_slot()
+            self.shutdown_request(request)
+
+    def _process_request_worker(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self._release_slot()
+
+    def _release_slot(self):
+        with self._in_flight_lock:
+            self._in_flight -= 1
+        self._slots.release()
+
+    def server_close(self):
+        super().server_close()
+        self._executor.shutdown(wait=True)
+
+
+def create_http_server(address=("0.0.0.0", PORT), mode: str | None = None, max_workers: int | None = None):
+    """Build the API server for the selected concurrency *mode*."""
+    mode = mode or SERVER_MODE
+    if mode == "single":
+        return HTTPServer(address, WhatsFlowRealHandler)
+    if mode == "threaded":
+        return PooledHTTPServer(address, WhatsFlowRealHandler, max_workers or HTTP_MAX_WORKERS)
+    raise ValueError(f"Modo de servidor desconhecido: {mode}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="WhatsFlow Real")
+    parser.add_argument(
+        "--server-mode",
+        choices=["threaded", "single"],
+        default=SERVER_MODE,
+        help="threaded: pool de workers limitado; single: uma requisição por vez",
+    )
+    parser.add_argument(
+        "--max-workers",
+        type=int,
+        default=HTTP_MAX_WORKERS,
+        help="Número máximo de requisições HTTP simultâneas (modo threaded)",
+    )
+    parser.add_argument(
+        "--explain",
+        action="store_true",
+        help="Mostra o plano de execução das consultas críticas e sai",
+    )
+    parser.add_argument(
+        "--rebuild-chats",
+        action="store_true",
+        help="Recalcula a tabela de chats a partir do histórico de mensagens e sai",
+    )
+    parser.add_argument(
+        "--simulate-flow",
+        metavar="FLOW_ID",
+        help="Reproduz mensagens no fluxo sem enviar nada, mostra o caminho de cada uma e sai",
+    )
+    parser.add_argument(
+        "--bench-flow",
+        metavar="FLOW_ID",
+        help="Mede a latência p50/p99 por mensagem e o pico de memória do fluxo e sai",
+    )
+    parser.add_argument(
+        "--messages",
+        metavar="ARQUIVO",
+        help="Mensagens para --simulate-flow/--bench-flow (JSON ou NDJSON; '-' para stdin). "
+             "Padrão: as últimas mensagens recebidas",
+    )
+    parser.add_argument(
+        "--bench-messages",
+        type=int,
+        default=10000,
+        help="Quantas mensagens usar sem --messages (padrão: 10000)",
+    )
+    return parser.parse_args(argv)
+
+
 def check_node_installed():
     """Check if Node.js is installed"""
     try:
@@ -2958,7 +7269,24 @@ def check_node_installed():
     except FileNotFoundError:
         return False
 
-def main():
+def main(argv=None):
+    args = parse_args(argv)
+
+    if args.explain:
+        init_db()
+        sys.exit(0 if print_query_plans() else 1)
+
+    if args.simulate_flow or args.bench_flow:
+        sys.exit(run_flow_cli(args.simulate_flow or args.bench_flow, args.messages, bool(args.bench_flow),
+                              args.bench_messages))
+
+    if args.rebuild_chats:
+        init_db()
+        started = time.monotonic()
+        rebuilt = rebuild_chat_summaries()
+        print(f"✅ {rebuilt} conversas recalculadas em {time.monotonic() - started:.1f}s")
+        return
+
     print("🚀 WhatsFlow Professional - Sistema Avançado")
     print("=" * 50)
     print("✅ Python backend com WebSocket")
@@ -2993,12 +7321,14 @@ def main():
     print("📱 Iniciando serviço WhatsApp (Baileys)...")
     baileys_manager = BaileysManager()
     
+    stop_event = threading.Event()
+
     def signal_handler(sig, frame):
         print("\n🛑 Parando serviços...")
-        baileys_manager.stop_baileys()
-        sys.exit(0)
+        stop_event.set()
     
     signal.signal(signal.SIGINT, signal_handler)
+    signal.signal(signal.SIGTERM, signal_handler)
     
     # Start Baileys in background
     baileys_thread = threading.Thread(target=baileys_manager.start_baileys)
@@ -3007,11 +7337,17 @@ def main():
 
     # Start campaign scheduler
     start_campaign_scheduler()
-    start_scheduled_dispatcher()
+    start_scheduled_dispatcher(stop_event)
+    get_outbox_worker().start()
+    get_ingest_queue().start()
+    get_media_store().start()
+    get_flow_engine().start()
     
     # Start HTTP server in background thread
-    server = HTTPServer(('0.0.0.0', PORT), WhatsFlowRealHandler)
+    server = create_http_server(('0.0.0.0', PORT), args.server_mode, args.max_workers)
     print(f"✅ Servidor rodando na porta {PORT}")
+    if args.server_mode == "threaded":
+        print(f"⚙️ Modo threaded: até {args.max_workers} requisições simultâneas")
     print("🔗 Pronto para conectar WhatsApp REAL!")
     print(f"🌐 Acesse: http://localhost:{PORT}")
     print("🎉 Sistema profissional pronto para uso!")
@@ -3027,12 +7363,24 @@ def main():
     print("   Para parar: Ctrl+C")
     print()
 
-    try:
-        server_thread.join()
-    except KeyboardInterrupt:
-        print("\n👋 WhatsFlow Professional finalizado!")
-        baileys_manager.stop_baileys()
-        server.shutdown()
+    # Wake up periodically so the signal handler gets a chance to run
+    while not stop_event.wait(1):
+        pass
+
+    # Stop accepting new connections, then wait for in-flight requests
+    get_change_feed().close()
+    server.shutdown()
+    server.server_close()
+    server_thread.join()
+    # Commit messages still waiting in the ingest queue
+    get_ingest_queue().stop()
+    get_scheduled_queue().stop()
+    get_flow_engine().stop()
+    get_fanout().shutdown()
+    get_outbox_worker().stop()
+    get_media_store().stop()
+    baileys_manager.stop_baileys()
+    print("👋 WhatsFlow Professional finalizado!")
 
 if __name__ == "__main__":
     main()